@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+层级判断规则快速通道基准测试
+按已标注的层级分析日志（level_analysis_logs 下的 .jsonl，或数组格式的 .json）依次回放：
+每一条先用规则判断，再按日志中的层级更新层级路径栈（与 LevelAnalysisService.update_level_path_stack 一致），
+统计规则能直接判断（省掉一次vLLM调用）的比例，以及规则结果与日志层级的一致率。
+
+用法：
+    python benchmark_level_rules.py
+    python benchmark_level_rules.py level_analysis_logs/level_analysis_log_20250627_014848.jsonl
+"""
+
+import sys
+import time
+from synapse_flow.web.services.level_rule_classifier import LevelRuleClassifier, parse_numbering
+from synapse_flow.web.utils.jsonl_log_writer import load_log_entries
+
+DEFAULT_LOG_FILE = "synapse_flow/例子/level_analysis_log_20250627_014848.json"
+
+
+def main():
+    log_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_LOG_FILE
+    log_entries = load_log_entries(log_file)
+    print(f"加载标注日志: {log_file}，共 {len(log_entries)} 条")
+
+    classifier = LevelRuleClassifier()
+    level_path_stack = []
+    llm_calls = 0        # 原流程需要调用AI的条数（第一条自动为层级1）
+    rule_hits = 0
+    agreed = 0
+    style_stats = {}     # 编号样式 -> [命中数, 一致数]
+    disagreements = []
+    elapsed = 0.0
+
+    for i, entry in enumerate(log_entries):
+        item = entry["original_data"]
+        parsed = entry["parsed_result"]
+        expected_level = parsed["level"]
+
+        if i > 0:
+            llm_calls += 1
+            started_at = time.perf_counter()
+            result = classifier.classify(item, level_path_stack)
+            elapsed += time.perf_counter() - started_at
+
+            if result is not None:
+                rule_hits += 1
+                style = parse_numbering(item["text"])["style"]
+                stats = style_stats.setdefault(style, [0, 0])
+                stats[0] += 1
+                if result["level"] == expected_level:
+                    agreed += 1
+                    stats[1] += 1
+                else:
+                    disagreements.append((i, item["text"][:40], result["level"], expected_level))
+
+        if expected_level is None:
+            continue
+        # 与 update_level_path_stack 相同：移除所有大于等于新层级的节点后入栈
+        level_path_stack = [node for node in level_path_stack if node["level"] < expected_level]
+        level_path_stack.append({
+            "text": item["text"],
+            "isTitleMarked": item["isTitleMarked"],
+            "level": expected_level,
+            "special_type": parsed.get("special_type")
+        })
+
+    print("\n=== 结果 ===")
+    print(f"原流程AI调用次数: {llm_calls}")
+    print(f"规则直接判断: {rule_hits} ({rule_hits / llm_calls:.1%} 的AI调用被省掉)" if llm_calls else "没有需要AI判断的条目")
+    if rule_hits:
+        print(f"与日志层级一致: {agreed}/{rule_hits} ({agreed / rule_hits:.1%})")
+        print(f"规则判断平均耗时: {elapsed / llm_calls * 1e6:.1f}µs/条")
+        print("\n按编号样式:")
+        for style, (hits, ok) in sorted(style_stats.items(), key=lambda x: -x[1][0]):
+            print(f"  {style}: 命中 {hits}，一致 {ok}")
+    if disagreements:
+        print("\n不一致的条目（索引, 文本, 规则层级, 日志层级）:")
+        for row in disagreements:
+            print(f"  {row}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+层级分析状态基准测试（5万条标题）
+1. 状态本身：逐条追加确认结果并取上文路径（构建prompt需要的部分），按四分位统计每条耗时，
+   后段与前段基本持平说明每条开销与已处理条数无关；用 tracemalloc 统计每条占用的内存
+2. 完整流程：LevelAnalysisService 逐条处理（模拟模型立即返回），统计每条耗时
+
+用法：
+    python benchmark_level_state.py
+    python benchmark_level_state.py --count 50000 --service-count 5000
+"""
+
+import io
+import time
+import random
+import argparse
+import tracemalloc
+from contextlib import redirect_stdout
+from synapse_flow.web.services.level_hierarchy_state import LevelHierarchyState
+from synapse_flow.web.services.level_analysis_service import LevelAnalysisService
+
+SPECIAL_TYPES = [None] * 18 + ["同属以往层级", "层级顺序混乱"]
+
+
+def make_headings(count, seed=0):
+    """生成层级在1~6之间随机游走的标题序列"""
+    rnd = random.Random(seed)
+    headings = []
+    level = 1
+    for i in range(count):
+        level = max(1, min(6, level + rnd.choice([-2, -1, 0, 0, 1, 1])))
+        headings.append({
+            "id": i + 1,
+            "text": f"标题{i}，正文内容",
+            "isTitleMarked": "section level" if level <= 3 else "context level",
+            "level": level,
+            "special_type": rnd.choice(SPECIAL_TYPES)
+        })
+    return headings
+
+
+def bench_state(headings):
+    tracemalloc.start()
+    state = LevelHierarchyState()
+    quarter = max(1, len(headings) // 4)
+    quarter_times = []
+    started_at = time.perf_counter()
+    for i, heading in enumerate(headings):
+        state.context_path_nodes()
+        state.push(heading["text"], heading["isTitleMarked"], heading["level"], heading["special_type"])
+        if (i + 1) % quarter == 0:
+            now = time.perf_counter()
+            quarter_times.append((now - started_at) / quarter)
+            started_at = now
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"\n=== 状态（{len(headings)} 条）===")
+    for i, per_item in enumerate(quarter_times):
+        print(f"  第{i + 1}个四分位: {per_item * 1e6:.2f}µs/条")
+    print(f"  内存: {current / len(headings):.1f} 字节/条（不含文本本身），峰值 {peak / 1024 / 1024:.1f}MB")
+    print(f"  最大路径深度: {max(len(state.path_stack(i)) for i in range(0, len(headings), 97))}")
+
+
+def bench_service(headings):
+    responses = {}
+
+    def fake_call_vllm_api(messages, max_tokens=2000, max_retries=3, stream_parser=None):
+        return responses["current"]
+
+    with redirect_stdout(io.StringIO()):
+        service = LevelAnalysisService()
+    service.rule_classifier = None
+    service.check_vllm_service_status = lambda: True
+    service.call_vllm_api = fake_call_vllm_api
+
+    quarter = max(1, len(headings) // 4)
+    quarter_times = []
+    started_at = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for i, heading in enumerate(headings):
+            responses["current"] = f"所以判断为{{层级{heading['level']}}}。"
+            service.process_single_item({"id": heading["id"], "text": heading["text"],
+                                         "isTitleMarked": heading["isTitleMarked"]})
+            if (i + 1) % quarter == 0:
+                now = time.perf_counter()
+                quarter_times.append((now - started_at) / quarter)
+                started_at = now
+        service.close_log()
+
+    print(f"\n=== LevelAnalysisService 完整流程（{len(headings)} 条，含prompt构建和日志）===")
+    for i, per_item in enumerate(quarter_times):
+        print(f"  第{i + 1}个四分位: {per_item * 1e6:.1f}µs/条")
+    print(f"  日志: {service.get_log_file_path()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="层级分析状态基准测试")
+    parser.add_argument("--count", type=int, default=50000, help="状态基准的标题条数")
+    parser.add_argument("--service-count", type=int, default=50000, help="完整流程基准的标题条数，0表示跳过")
+    args = parser.parse_args()
+
+    bench_state(make_headings(args.count))
+    if args.service_count:
+        bench_service(make_headings(args.service_count))
+
+
+if __name__ == "__main__":
+    main()
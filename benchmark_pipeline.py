@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+QA处理 / 层级分析端到端基准（不需要GPU和数据库）
+在QA和层级分析模型配置的端口上启动替身vLLM服务（mock_vllm_server），生成合成的 pdf_json 文档，
+用正式代码跑完整流程：
+1. QA：process_qa_for_version_0（读版本0 → 构建上下文和prompt → 分批并发请求 → 解析调整 → 保存版本1）
+2. 层级分析：update_pdf_json_hierarchy（规则快速通道、推测并行、逐条/共享客户端请求 → 批量写回层级）
+pdf_json 表和QA运行日志换成进程内存储（MemoryPdfJsonStore），测量的是流水线和模型调用本身，不含数据库耗时。
+输出每个任务的条目数/秒、每个文档的耗时分位数，以及替身服务端的请求延迟分位数（含排队）。
+
+用法：
+    python benchmark_pipeline.py
+    python benchmark_pipeline.py --task level --documents 8 --concurrency 8 --level-client shared
+    python benchmark_pipeline.py --pages 40 --latency lognormal:0.5,0.5 --max-concurrency 16 --max-rps 100
+    python benchmark_pipeline.py --task level --per-token 0.01 --level-trailing-tokens 60 [--no-level-streaming]
+"""
+
+import io
+import os
+import sys
+import copy
+import time
+import random
+import argparse
+import tempfile
+import itertools
+import threading
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+from model_config import get_model_config
+from mock_vllm_server import MockVLLMServer, MOCK_VLLM_CONFIG, parse_latency_spec, percentile, numbering_level
+from vllm_lifecycle import ModelLifecycleDaemon, FakeContainerRuntime, set_lifecycle_daemon
+from script_checks import check, finish
+
+CHINESE_NUMERALS = "零一二三四五六七八九"
+TOPICS = ["增值税", "企业所得税", "个人所得税", "印花税", "土地增值税", "消费税", "关税", "房产税", "契税", "车船税"]
+PHRASES = ["纳税义务发生时间", "应纳税额的计算", "税收优惠政策", "征收管理", "申报缴纳", "发票管理",
+           "留抵退税", "跨境应税行为", "预缴税款", "汇算清缴"]
+
+
+def chinese_number(n: int) -> str:
+    """1-99 的中文数字"""
+    if n < 10:
+        return CHINESE_NUMERALS[n]
+    tens, ones = divmod(n, 10)
+    return f"{'' if tens == 1 else CHINESE_NUMERALS[tens]}十{CHINESE_NUMERALS[ones] if ones else ''}"
+
+
+def build_synthetic_document(run_id: str, pages: int, blocks_per_page: int, rng: random.Random) -> list:
+    """
+    生成一份合成文档的版本0数据（与 query_pdf_text_contents 返回的格式一致）
+    编号标题按 章 → 节 → 一、 → （一） → 1. 嵌套，其间穿插正文段落、表格和图片；
+    标题的 user_modified_level 为 1（结构层级）或 2（段落层级），作为层级分析的输入
+    """
+    counters = [0] * 5
+    depth = 0
+    rows = []
+    for page_index in range(pages):
+        for block_index in range(blocks_per_page):
+            roll = rng.random()
+            item = {"run_id": run_id, "page_index": page_index, "block_index": block_index, "version": 0,
+                    "text_level": 1, "is_title_marked": False, "exclude_from_finetune": False,
+                    "remark": "", "original_text": "", "user_modified_level": None}
+            if roll < 0.05:
+                item.update(type="table", text=f"<table><tr><td>{rng.choice(TOPICS)}</td><td>{rng.randint(1, 99)}%</td></tr></table>")
+            elif roll < 0.08:
+                item.update(type="image", text="")
+            elif roll < 0.35:
+                # 标题：深度最多比当前深一级，回到浅层时重置更深的编号
+                level = rng.randint(0, min(depth + 1, 4))
+                counters[level] += 1
+                for deeper in range(level + 1, 5):
+                    counters[deeper] = 0
+                depth = level
+                number = counters[level]
+                prefix = [f"第{chinese_number(number)}章 ", f"第{chinese_number(number)}节 ",
+                          f"{chinese_number(number)}、", f"（{chinese_number(number)}）", f"{number}."][level]
+                item.update(type="text", text=f"{prefix}{rng.choice(TOPICS)}{rng.choice(PHRASES)}",
+                            user_modified_level=1 if level < 3 else 2)
+            else:
+                sentences = [f"{rng.choice(TOPICS)}的{rng.choice(PHRASES)}按照有关规定执行" for _ in range(rng.randint(1, 4))]
+                item.update(type="text", text="，".join(sentences) + "。")
+            item["original_text"] = item["text"]
+            rows.append(item)
+    return rows
+
+
+class _MemoryCursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _MemoryConnection:
+    def cursor(self):
+        return _MemoryCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryPdfJsonStore:
+    """进程内的 pdf_json 表和QA运行日志，替换QA处理和层级分析模块中的数据库读写函数"""
+
+    def __init__(self):
+        self.versions = {}      # (run_id, version) -> [行]
+        self.journal = {}       # run_id -> {item_index: ai_response}
+        self.hierarchy = {}     # id -> (层级, 原因)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add_document(self, run_id: str, rows: list):
+        for row in rows:
+            row["id"] = next(self._ids)
+        self.versions[(run_id, 0)] = rows
+
+    def query_pdf_text_contents(self, run_id: str, version: int) -> list:
+        return copy.deepcopy(self.versions.get((run_id, version), []))
+
+    def insert_pdf_text_contents(self, run_id: str, contents: list, based_version: int = None) -> int:
+        with self._lock:
+            new_version = max(version for key_run_id, version in self.versions if key_run_id == run_id) + 1
+            self.versions[(run_id, new_version)] = [
+                {**item, "id": next(self._ids), "run_id": run_id, "version": new_version, "based_version": based_version}
+                for item in contents
+            ]
+        return new_version
+
+    def insert_qa_journal_entries(self, run_id: str, entries: list) -> int:
+        with self._lock:
+            journal = self.journal.setdefault(run_id, {})
+            new_entries = {entry["index"]: entry["ai_response"] for entry in entries
+                           if entry.get("ai_response") and entry["index"] not in journal}
+            journal.update(new_entries)
+        return len(new_entries)
+
+    def query_qa_journal(self, run_id: str) -> dict:
+        return dict(self.journal.get(run_id, {}))
+
+    def clear_qa_journal(self, run_id: str) -> bool:
+        self.journal.pop(run_id, None)
+        return True
+
+    def bulk_update_pdf_json_hierarchy(self, cur, rows: list, chunk_size: int = None) -> tuple:
+        with self._lock:
+            for record_id, level, reasoning, _ in rows:
+                self.hierarchy[record_id] = (level, reasoning)
+        return {row[0] for row in rows}, []
+
+    def get_pg_conn(self):
+        return _MemoryConnection()
+
+    def install(self):
+        """替换QA处理和层级分析模块中的数据库读写函数"""
+        from synapse_flow.web.services import prompt_job_service, level_analysis_service
+
+        for name in ("query_pdf_text_contents", "insert_pdf_text_contents",
+                     "insert_qa_journal_entries", "query_qa_journal", "clear_qa_journal"):
+            setattr(prompt_job_service, name, getattr(self, name))
+        level_analysis_service.get_pg_conn = self.get_pg_conn
+        level_analysis_service.bulk_update_pdf_json_hierarchy = self.bulk_update_pdf_json_hierarchy
+
+
+def level_input(rows: list) -> list:
+    """版本0中的标题，转换为 update_pdf_json_hierarchy 的输入（与 analyze_hierarchy_by_run_id 一致）"""
+    return [{"id": row["id"], "text": row["text"],
+             "isTitleMarked": "section level" if row["user_modified_level"] == 1 else "context level"}
+            for row in rows if row["user_modified_level"] in (1, 2)]
+
+
+def run_documents(run_ids, concurrency, process):
+    """按 concurrency 个文档同时处理，返回 (每个文档的结果和耗时, 总耗时)"""
+    def timed(run_id):
+        started_at = time.perf_counter()
+        result = process(run_id)
+        return run_id, result, time.perf_counter() - started_at
+
+    # redirect_stdout 替换的是全局 sys.stdout，只能在所有文档外层替换一次
+    started_at = time.perf_counter()
+    with redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, run_ids))
+    return outcomes, time.perf_counter() - started_at
+
+
+def report(name, items, outcomes, elapsed, server):
+    durations = [duration for _, _, duration in outcomes]
+    stats = server.get_stats()
+    print(f"\n=== {name}（{len(outcomes)} 个文档，{items} 条）===")
+    print(f"  吞吐:       {items / elapsed:.1f} 条/秒，总耗时 {elapsed:.2f}秒")
+    print(f"  文档耗时:   p50 {percentile(durations, 50):.2f}秒  p90 {percentile(durations, 90):.2f}秒  "
+          f"max {max(durations):.2f}秒")
+    print(f"  模型请求:   {stats['requests']} 次（失败 {stats['errors']} 次），"
+          f"延迟 p50 {stats['latency_p50_ms']}ms  p90 {stats['latency_p90_ms']}ms  p99 {stats['latency_p99_ms']}ms，"
+          f"排队 p90 {stats['queue_wait_p90_ms']}ms")
+    print(f"  token:      prompt {stats['prompt_tokens']}（命中前缀缓存 {stats['cached_tokens']}），"
+          f"completion {stats['completion_tokens']}")
+
+
+def report_token_budget(task):
+    from synapse_flow.web.utils.token_budget import get_token_budget
+
+    stats = get_token_budget(task).get_stats()
+    percentile_key = next(key for key in stats if key.startswith("output_p"))
+    print(f"  token预算:  max_tokens {stats['last_max_tokens']}（输出{percentile_key[7:]} {stats[percentile_key]}，"
+          f"{stats['samples']} 个样本，截断 {stats['capped_outputs']} 个），裁剪上下文块 {stats['trimmed_blocks']} 个"
+          f"{'（按字符近似计数）' if stats['approximate_tokens'] else ''}")
+
+
+def bench_qa(store, run_ids, concurrency, server):
+    from synapse_flow.web.services.prompt_job_service import process_qa_for_version_0
+
+    server.reset_stats()
+    outcomes, elapsed = run_documents(run_ids, concurrency, process_qa_for_version_0)
+    text_items = sum(1 for run_id in run_ids for row in store.versions[(run_id, 0)] if row["type"] == "text")
+    report("QA问答对处理", text_items, outcomes, elapsed, server)
+    report_token_budget("qa")
+    check("QA：每个文档都生成了版本1",
+          all(result["status"] == "success" and (run_id, result["new_version"]) in store.versions
+              for run_id, result, _ in outcomes), [result for _, result, _ in outcomes])
+    check("QA：每个text块都有AI回复",
+          all(row["remark"] for run_id in run_ids for row in store.versions[(run_id, 1)] if row["type"] == "text"))
+
+
+def bench_level(store, run_ids, concurrency, server, level_client):
+    from synapse_flow.web.services.level_analysis_service import update_pdf_json_hierarchy, level_stream_stats
+
+    llm_client_for = lambda run_id: None
+    stream_stats = level_stream_stats
+    if level_client == "shared":
+        # 与层级分析调度器相同：所有文档共用一个异步客户端，按文档公平分配并发预算
+        from synapse_flow.web.services.hierarchy_scheduler_service import get_level_llm_client
+        client = get_level_llm_client()
+        stream_stats = client.stream_stats
+        llm_client_for = lambda run_id: (
+            lambda messages, max_tokens, stream_parser: client.chat(messages, key=run_id, max_tokens=max_tokens,
+                                                                    stream_parser=stream_parser))
+
+    inputs = {run_id: level_input(store.versions[(run_id, 0)]) for run_id in run_ids}
+    server.reset_stats()
+    outcomes, elapsed = run_documents(
+        run_ids, concurrency, lambda run_id: update_pdf_json_hierarchy(inputs[run_id], llm_client=llm_client_for(run_id)))
+    items = sum(len(data_list) for data_list in inputs.values())
+    report(f"层级分析（{'共享客户端' if level_client == 'shared' else '逐条调用'}）", items, outcomes, elapsed, server)
+    report_token_budget("level")
+    check("层级分析：每个文档都成功写回",
+          all(result["status"] == "success" and result["updated_count"] == len(inputs[run_id])
+              for run_id, result, _ in outcomes),
+          [(result["status"], result["message"]) for _, result, _ in outcomes])
+
+    # 替身服务按编号格式回答层级，统计结果与编号层级一致的比例（规则通道、上下文截断等会造成差异）
+    matched = sum(1 for data_list in inputs.values() for item in data_list
+                  if store.hierarchy.get(item["id"], (None,))[0] == numbering_level(item["text"])[0])
+    print(f"  层级与编号一致: {matched}/{items}")
+    stats = stream_stats.get_stats()
+    if stats["streamed"]:
+        print(f"  流式提前结束: {stats['early_stopped']}/{stats['streamed']} 个请求（服务端中止 {server.get_stats()['cancelled']} 个），"
+              f"答案之后平均 {stats['tail_tokens_mean']} token（{stats['calibrated']} 个校准请求），"
+              f"估计节省 {stats['tokens_saved_estimate']} token")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QA处理 / 层级分析端到端基准（替身vLLM服务）")
+    parser.add_argument("--task", choices=["qa", "level", "all"], default="all")
+    parser.add_argument("--documents", type=int, default=4, help="合成文档数")
+    parser.add_argument("--pages", type=int, default=10, help="每个文档的页数")
+    parser.add_argument("--blocks-per-page", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4, help="同时处理的文档数")
+    parser.add_argument("--level-client", choices=["direct", "shared"], default="shared",
+                        help="层级分析逐条调用（direct）或使用调度器的共享异步客户端（shared）")
+    parser.add_argument("--latency", default="lognormal:0.05,0.5", help="替身服务延迟分布，见 mock_vllm_server")
+    parser.add_argument("--per-token", type=float, default=0.0, help="每个输出token的解码耗时（秒）")
+    parser.add_argument("--max-concurrency", type=int, default=MOCK_VLLM_CONFIG["max_concurrency"])
+    parser.add_argument("--max-rps", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--level-trailing-tokens", type=int, default=0, help="替身服务在层级回答之后追加的解释长度（token）")
+    parser.add_argument("--no-level-streaming", action="store_true", help="层级分析不使用流式提前结束（对比用）")
+    args = parser.parse_args()
+
+    # 替身服务监听模型配置中的端口（QA和层级分析的服务状态检查、模型列表请求都直接访问该端口）
+    mock_config = {
+        "latency": parse_latency_spec(args.latency),
+        "per_token_latency": args.per_token,
+        "max_concurrency": args.max_concurrency,
+        "max_rps": args.max_rps,
+        "error_rate": args.error_rate,
+        "seed": args.seed,
+        "level_trailing_tokens": args.level_trailing_tokens
+    }
+    servers = {}
+    for model_name in ("qa_model", "level_model"):
+        port = get_model_config(model_name)["port"]
+        if port not in servers:
+            try:
+                servers[port] = MockVLLMServer(port=port, config=mock_config).start()
+            except OSError as e:
+                print(f"❌ 端口 {port} 无法监听（是否有真实vLLM服务在运行？）: {str(e)}")
+                sys.exit(1)
+    qa_server = servers[get_model_config("qa_model")["port"]]
+    level_server = servers[get_model_config("level_model")["port"]]
+
+    # 服务已由替身提供，生命周期守护不需要启动容器
+    set_lifecycle_daemon(ModelLifecycleDaemon(FakeContainerRuntime(ready_delay=0)))
+
+    from synapse_flow.web.services.level_analysis_service import LEVEL_STREAMING_CONFIG
+    LEVEL_STREAMING_CONFIG["enabled"] = not args.no_level_streaming
+
+    store = MemoryPdfJsonStore()
+    store.install()
+    rng = random.Random(args.seed)
+    run_ids = [f"bench_{i:03d}" for i in range(args.documents)]
+    for run_id in run_ids:
+        store.add_document(run_id, build_synthetic_document(run_id, args.pages, args.blocks_per_page, rng))
+
+    # 层级分析日志、审计日志写到临时目录，不留在仓库里
+    os.chdir(tempfile.mkdtemp(prefix="benchmark_pipeline_"))
+
+    print(f"合成数据: {args.documents} 个文档 × {args.pages} 页 × {args.blocks_per_page} 块，"
+          f"替身服务延迟 {args.latency}，并发槽位 {args.max_concurrency}")
+    if args.task in ("qa", "all"):
+        bench_qa(store, run_ids, args.concurrency, qa_server)
+    if args.task in ("level", "all"):
+        bench_level(store, run_ids, args.concurrency, level_server, args.level_client)
+
+    for server in servers.values():
+        server.shutdown()
+    finish()
+
+
+if __name__ == "__main__":
+    main()
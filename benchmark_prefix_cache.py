@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+vLLM前缀缓存基准测试
+用同一批QA / 层级分析请求跑两轮：
+  - stable：按正式代码构建请求，system prompt 逐字节一致，可以命中前缀缓存
+  - nonce ：在 system prompt 最前面加一段随机串，每个请求前缀都不同，相当于没有前缀缓存
+对比两轮的 prefill token 数和延迟 p50/p90，输出节省的 prefill token 和延迟变化。
+
+cached token 优先取 usage.prompt_tokens_details.cached_tokens（服务端需开启 --enable-prompt-tokens-details），
+没有时读取 /metrics 中 vllm:prefix_cache_hits 计数器的增量。
+
+用法：
+    python benchmark_prefix_cache.py --task qa --port 8201 --n 50
+    python benchmark_prefix_cache.py --task level --port 8202 --n 43 --concurrency 8
+"""
+
+import argparse
+import json
+import re
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+QA_DATA_FILE = "synapse_flow/例子/output.json"
+LEVEL_LOG_FILE = "synapse_flow/例子/level_analysis_log_20250627_014848.json"
+
+
+def build_qa_requests(n):
+    """用正式代码为示例文本构建QA请求消息"""
+    from synapse_flow.web.services.prompt_job_service import (
+        build_qa_context_windows, build_prompt, build_qa_messages
+    )
+
+    with open(QA_DATA_FILE, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    items = [
+        {"text": item["text"], "type": "text", "page_index": 0, "block_index": i}
+        for i, item in enumerate(data)
+    ]
+    instruction = "请问第三文本块是否为新的层级？另外，内容是否正确，如果错误应该建议如何修改"
+
+    all_messages = []
+    for window in build_qa_context_windows(items):
+        if window is None:
+            continue
+        system_prompt, user_prompt = build_prompt(instruction, window)
+        all_messages.append(build_qa_messages(system_prompt, user_prompt))
+    return all_messages[:n]
+
+
+def build_level_requests(n):
+    """按示例日志中的层级结果回放层级路径栈，用正式代码构建每一条的层级判断请求"""
+    from synapse_flow.web.services.level_analysis_service import LevelAnalysisService
+
+    with open(LEVEL_LOG_FILE, 'r', encoding='utf-8') as f:
+        log_entries = json.load(f)
+
+    service = LevelAnalysisService()
+    all_messages = []
+    for entry in log_entries:
+        item = dict(entry["original_data"])
+        parsed = entry["parsed_result"]
+        if len(service.state):
+            system_prompt, user_prompt = service.build_level_prompt(item)
+            all_messages.append([
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ])
+        service.state.push(item["text"], item["isTitleMarked"], parsed["level"], parsed.get("special_type"))
+    return all_messages[:n]
+
+
+def with_nonce(messages):
+    """在system prompt最前面加随机串，使前缀缓存无法命中"""
+    busted = [dict(msg) for msg in messages]
+    busted[0]["content"] = f"[{uuid.uuid4().hex}]\n" + busted[0]["content"]
+    return busted
+
+
+def read_prefix_cache_hits(base_url):
+    """读取 /metrics 中的前缀缓存命中 token 计数（vLLM V1），读取失败返回 None"""
+    try:
+        response = requests.get(f"{base_url}/metrics", timeout=10)
+        if response.status_code != 200:
+            return None
+        total = 0.0
+        found = False
+        for line in response.text.splitlines():
+            if re.match(r"^vllm:prefix_cache_hits(_total)?[{ ]", line):
+                total += float(line.rsplit(" ", 1)[1])
+                found = True
+        return total if found else None
+    except Exception:
+        return None
+
+
+def send_request(base_url, model, messages, max_tokens):
+    """发送一次请求，返回 (延迟秒数, prompt_tokens, cached_tokens或None)"""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": 0.0,
+        "stream": False
+    }
+    start = time.perf_counter()
+    response = requests.post(f"{base_url}/v1/chat/completions", json=payload, timeout=300)
+    latency = time.perf_counter() - start
+    response.raise_for_status()
+    usage = response.json().get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    return latency, usage.get("prompt_tokens", 0), details.get("cached_tokens")
+
+
+def run_round(name, base_url, model, all_messages, max_tokens, concurrency):
+    """跑一轮请求并汇总"""
+    hits_before = read_prefix_cache_hits(base_url)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda messages: send_request(base_url, model, messages, max_tokens), all_messages
+        ))
+    hits_after = read_prefix_cache_hits(base_url)
+
+    latencies = [r[0] for r in results]
+    prompt_tokens = sum(r[1] for r in results)
+    if all(r[2] is not None for r in results):
+        cached_tokens = sum(r[2] for r in results)
+        cached_source = "usage"
+    elif hits_before is not None and hits_after is not None:
+        cached_tokens = int(hits_after - hits_before)
+        cached_source = "metrics"
+    else:
+        cached_tokens = None
+        cached_source = "unavailable"
+
+    summary = {
+        "name": name,
+        "requests": len(results),
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "cached_source": cached_source,
+        "prefill_tokens": prompt_tokens - cached_tokens if cached_tokens is not None else None,
+        "p50": statistics.median(latencies),
+        "p90": sorted(latencies)[max(0, int(len(latencies) * 0.9) - 1)],
+    }
+    print(f"[{name}] 请求数: {summary['requests']}, prompt tokens: {prompt_tokens}, "
+          f"cached tokens: {cached_tokens} ({cached_source}), "
+          f"p50: {summary['p50'] * 1000:.0f}ms, p90: {summary['p90'] * 1000:.0f}ms")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="vLLM前缀缓存基准测试")
+    parser.add_argument("--task", choices=["qa", "level"], default="qa")
+    parser.add_argument("--port", type=int, default=None, help="默认QA为8201，层级分析为8202")
+    parser.add_argument("--model", default="llama3.1_8b")
+    parser.add_argument("--n", type=int, default=50, help="请求条数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=32,
+                        help="输出token上限，取小值让延迟主要反映prefill")
+    args = parser.parse_args()
+
+    port = args.port or (8201 if args.task == "qa" else 8202)
+    base_url = f"http://localhost:{port}"
+
+    all_messages = build_qa_requests(args.n) if args.task == "qa" else build_level_requests(args.n)
+    if not all_messages:
+        print("❌ 没有可用的请求数据")
+        return
+    print(f"任务: {args.task}, 端口: {port}, 请求数: {len(all_messages)}, "
+          f"system prompt长度: {len(all_messages[0][0]['content'])} 字符")
+
+    # 先跑nonce轮，避免stable轮的前缀提前进入缓存
+    nonce = run_round("nonce", base_url, args.model,
+                      [with_nonce(messages) for messages in all_messages],
+                      args.max_tokens, args.concurrency)
+    stable = run_round("stable", base_url, args.model, all_messages,
+                       args.max_tokens, args.concurrency)
+
+    print("\n=== 对比结果 ===")
+    if nonce["prefill_tokens"] is not None and stable["prefill_tokens"] is not None:
+        saved = nonce["prefill_tokens"] - stable["prefill_tokens"]
+        ratio = saved / nonce["prefill_tokens"] if nonce["prefill_tokens"] else 0
+        print(f"节省prefill tokens: {saved} ({ratio:.1%})，"
+              f"平均每个请求 {saved / stable['requests']:.0f}")
+    else:
+        print("⚠️ 服务端未返回cached token信息，无法统计节省的prefill tokens")
+    change = (stable["p50"] - nonce["p50"]) / nonce["p50"] if nonce["p50"] else 0
+    print(f"p50延迟: {nonce['p50'] * 1000:.0f}ms -> {stable['p50'] * 1000:.0f}ms ({change:+.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI回复解析的微基准
+用 synapse_flow/例子/response_parser_corpus.json 中的回复，对比重构前的写法（每次调用按字符串正则搜索、
+每次重建中文数字表、<mark>/<summary>清理在解析、格式清理、最终输出三处各做一次）和 llm_response_parser：
+1. 层级分析回复 → parse_level_response
+2. QA审核回复 → 解析 + 最终清理（即每条回复在 process_qa 中的全部解析开销）
+
+参考结果（Python 3.11，单核，默认参数，多次运行）：层级分析约 1.7~1.9x，QA审核约 1.4~1.7x。
+倍数随机器和负载变化，以本机运行结果为准。
+
+用法：
+    python benchmark_response_parser.py
+    python benchmark_response_parser.py --repeat 2000 --rounds 10
+"""
+
+import io
+import re
+import json
+import time
+import argparse
+from contextlib import redirect_stdout
+from synapse_flow.web.utils.llm_response_parser import parse_level_response, parse_qa_response, normalize_tag_whitespace
+
+DEFAULT_CORPUS_FILE = "synapse_flow/例子/response_parser_corpus.json"
+
+
+def legacy_parse_level_response(response):
+    """重构前的层级回复解析（对照）"""
+    result = {"level": None, "reasoning": response, "is_special_case": False, "special_type": None}
+    try:
+        level_match = re.search(r'\{层级([一二三四五六七八九十\d]+)\}', response)
+        if level_match:
+            level_str = level_match.group(1)
+            chinese_to_arabic = {'一': 1, '二': 2, '三': 3, '四': 4, '五': 5,
+                                 '六': 6, '七': 7, '八': 8, '九': 9, '十': 10}
+            result["level"] = chinese_to_arabic[level_str] if level_str in chinese_to_arabic else int(level_str)
+        if result["level"] is None:
+            level_match = re.search(r'层级(\d+)', response)
+            if level_match:
+                result["level"] = int(level_match.group(1))
+        if result["level"] is None:
+            level_match = re.search(r'第([一二三四五六七八九十\d]+)层级', response)
+            if level_match:
+                level_str = level_match.group(1)
+                chinese_to_arabic = {'一': 1, '二': 2, '三': 3, '四': 4, '五': 5,
+                                     '六': 6, '七': 7, '八': 8, '九': 9, '十': 10}
+                result["level"] = chinese_to_arabic[level_str] if level_str in chinese_to_arabic else int(level_str)
+        if "但我认为" in response:
+            result["is_special_case"] = True
+            special_match = re.search(r'但我认为\{([^}]+)\}', response)
+            if special_match:
+                result["special_type"] = special_match.group(1)
+    except Exception as e:
+        print(f"解析层级响应时出错: {str(e)}")
+    return result
+
+
+def legacy_process_qa_text(ai_response, current_text):
+    """重构前单条QA回复的解析和三处清理（对照）"""
+    level_type = 0
+    adjusted_text = current_text
+    if "判断为{结构新层级}" in ai_response:
+        level_type = 1
+    elif "判断为{段落新层级}" in ai_response:
+        level_type = 2
+    elif "判断为{附注图表新层级}" in ai_response:
+        level_type = 3
+    elif "判断为{非新层级}" in ai_response:
+        level_type = 0
+    elif "判断为{新层级}" in ai_response:
+        level_type = 1
+    if "{删除}" in ai_response:
+        adjusted_text = ""
+    elif "{需要拆分}" in ai_response or "{文本错误}" in ai_response:
+        match = re.search(r'建议处理方式为：\{(.*?)\}', ai_response, re.DOTALL)
+        if not match and "{需要拆分}" not in ai_response:
+            match = re.search(r'建议处理方式为\{(.*?)\}', ai_response, re.DOTALL)
+        if match:
+            adjusted_text = re.sub(r'\\\*\\\*', '**', match.group(1).strip())
+            adjusted_text = re.sub(r'<mark>[\s\u3000]*', '<mark>', adjusted_text)
+    if adjusted_text:
+        adjusted_text = re.sub(r'<mark>[ \t\r\n]*', '<mark>', adjusted_text)
+        adjusted_text = re.sub(r'<summary>[ \t\r\n]*', '<summary>', adjusted_text)
+    if "<mark>\n" in adjusted_text:
+        adjusted_text = adjusted_text.replace("<mark>\n", "<mark>")
+    if "<summary>\n" in adjusted_text:
+        adjusted_text = adjusted_text.replace("<summary>\n", "<summary>")
+    if adjusted_text:
+        adjusted_text = re.sub(r'<mark>[ \t\r\n]*', '<mark>', adjusted_text)
+        adjusted_text = re.sub(r'<summary>[ \t\r\n]*', '<summary>', adjusted_text)
+    return level_type, adjusted_text
+
+
+def process_qa_text(ai_response, current_text):
+    parsed = parse_qa_response(ai_response, current_text)
+    return parsed["level_type"], normalize_tag_whitespace(parsed["text"])
+
+
+def bench(func, cases, repeat):
+    """返回每次调用的平均耗时（微秒）"""
+    with redirect_stdout(io.StringIO()):
+        started_at = time.perf_counter()
+        for _ in range(repeat):
+            for case in cases:
+                func(*case)
+        elapsed = time.perf_counter() - started_at
+    return elapsed / (repeat * len(cases)) * 1e6
+
+
+def report(name, cases, legacy, current, repeat, rounds):
+    """两种写法交替计时，各取最快的一轮（单轮计时受调度和CPU频率影响，倍数波动很大）"""
+    legacy_us, current_us = float("inf"), float("inf")
+    for _ in range(rounds):
+        legacy_us = min(legacy_us, bench(legacy, cases, repeat))
+        current_us = min(current_us, bench(current, cases, repeat))
+    print(f"\n=== {name}（{len(cases)} 条 × {repeat} 次，{rounds} 轮取最快）===")
+    print(f"  重构前: {legacy_us:.2f}µs/条")
+    print(f"  当前:   {current_us:.2f}µs/条（{legacy_us / current_us:.1f}x）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI回复解析微基准")
+    parser.add_argument("corpus_file", nargs="?", default=DEFAULT_CORPUS_FILE)
+    parser.add_argument("--repeat", type=int, default=1000, help="语料重复次数")
+    parser.add_argument("--rounds", type=int, default=5, help="交替计时的轮数，取最快的一轮")
+    args = parser.parse_args()
+
+    with open(args.corpus_file, "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    level_cases = [(case["response"],) for case in corpus["level"]]
+    qa_cases = [(case["response"], case["current_text"]) for case in corpus["qa"]]
+    qa_cases += [(item["ai_response"], item["current_text"])
+                 for document in corpus["documents"] for item in document["items"]]
+
+    report("层级分析回复", level_cases, legacy_parse_level_response, parse_level_response, args.repeat,
+           args.rounds)
+    report("QA审核回复（解析+清理）", qa_cases, legacy_process_qa_text, process_qa_text, args.repeat, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
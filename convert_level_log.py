@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+把层级分析的JSONL日志（level_analysis_logs/level_analysis_log_*.jsonl，包括轮转压缩的分片）
+转换成数组格式的JSON文件，格式与 synapse_flow/例子/level_analysis_log_*.json 一致
+
+用法：
+    python convert_level_log.py level_analysis_logs/level_analysis_log_20250627_014848.jsonl
+    python convert_level_log.py level_analysis_logs/level_analysis_log_20250627_014848.jsonl -o output.json
+    python convert_level_log.py --all   # 转换 level_analysis_logs 下的全部日志
+"""
+
+import argparse
+import glob
+import os
+from synapse_flow.web.utils.jsonl_log_writer import convert_jsonl_log_to_array
+
+LOG_DIR = "level_analysis_logs"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="层级分析JSONL日志转数组格式")
+    parser.add_argument("log_file", nargs="?", help="JSONL日志路径")
+    parser.add_argument("-o", "--output", help="输出路径，默认与日志同名的 .json 文件")
+    parser.add_argument("--all", action="store_true", help=f"转换 {LOG_DIR} 下的全部日志")
+    args = parser.parse_args()
+
+    if args.all:
+        log_files = sorted(glob.glob(os.path.join(LOG_DIR, "level_analysis_log_*.jsonl")))
+    elif args.log_file:
+        log_files = [args.log_file]
+    else:
+        parser.print_help()
+        return
+
+    for log_file in log_files:
+        output_file = convert_jsonl_log_to_array(log_file, None if args.all else args.output)
+        print(f"✅ {log_file} -> {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线的OpenAI兼容vLLM替身服务（不需要GPU）
+提供 /health、/v1/models、/v1/chat/completions（以及运行时挂载适配器的 /v1/load_lora_adapter），用于在没有GPU时
+跑通QA处理、层级分析的完整流程，测量流水线本身的吞吐：
+- 延迟：每个请求的基础延迟按分布采样（fixed / uniform / normal / lognormal / exponential），
+  另加每个输出token的解码耗时
+- 吞吐限制：max_concurrency 个请求同时处理（相当于vLLM的batch槽位），多出的排队；max_rps 限制每秒放行的请求数
+- 回答：按system prompt识别任务，返回 {层级X} / 判断为{...} 格式的固定回答。同一个prompt总是得到同样的回答，
+  推测并行、增量重新分析的结果可以和逐条处理比较
+- 故障注入：error_rate 的请求返回503，failing=True 时所有请求返回503
+- 流式：stream=true 时按token逐个发送（server-sent events），客户端断开后停止生成，统计实际解码的token数；
+  level_trailing_tokens 在层级回答之后追加一段解释，模拟答案之后继续解释的模型
+
+用法：
+    python mock_vllm_server.py --port 8202 --latency lognormal:0.3,0.4 --max-concurrency 32
+    python mock_vllm_server.py --port 8201 --latency fixed:0.05 --per-token 0.002 --max-rps 200
+"""
+
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, List, Optional
+
+from model_config import MODEL_CONFIGS
+
+# 替身服务配置
+MOCK_VLLM_CONFIG = {
+    "latency": {"distribution": "lognormal", "params": [0.3, 0.4]},  # 每个请求的基础延迟（秒）
+    "per_token_latency": 0.0,      # 每个输出token的解码耗时（秒）
+    "max_concurrency": 64,         # 同时处理的请求数，0 表示不限制
+    "max_rps": 0,                  # 每秒最多放行的请求数，0 表示不限制
+    "error_rate": 0.0,             # 随机返回503的比例
+    "seed": 0,
+    # QA回答中各类错误判断的占比，其余为{正确}
+    "qa_error_weights": {"文本错误": 0.08, "删除": 0.04, "需要拆分": 0.03},
+    "level_special_rate": 0.05,    # 层级回答中带「但我认为{...}」特殊情况的比例
+    "level_trailing_tokens": 0     # 层级回答之后追加的解释长度（token）
+}
+
+# 层级编号格式 → (层级, 是否结构层级)，按顺序匹配
+NUMBERING_LEVELS = [
+    (re.compile(r'^第[一二三四五六七八九十百\d]+[章编部]'), 1, True),
+    (re.compile(r'^第[一二三四五六七八九十百\d]+节'), 2, True),
+    (re.compile(r'^[一二三四五六七八九十]+、'), 3, True),
+    (re.compile(r'^[（(][一二三四五六七八九十]+[）)]'), 4, False),
+    (re.compile(r'^\d+[.．、]'), 5, False),
+    (re.compile(r'^[（(]\d+[）)]'), 6, False),
+]
+NOTE_PATTERN = re.compile(r'^(表|图|注)[\d一二三四五六七八九十：:]')
+CONTEXT_LEVEL_PATTERN = re.compile(r'(?:结构|段落)层级(\d+)：')
+LEVEL_TARGET_PATTERN = re.compile(r'请问(?:结构|段落)层级： "(.*?)",是第几层级的开头内容')
+QA_INPUT_PATTERN = re.compile(r'需要分析的这段语句是：(.*)\n请根据问题要求与问题进行回答', re.DOTALL)
+
+
+def sample_latency(latency: Dict[str, Any], rng: random.Random) -> float:
+    """按分布采样一次延迟（秒），不小于0"""
+    params = latency.get("params", [])
+    distribution = latency.get("distribution", "fixed")
+    if distribution == "fixed":
+        value = params[0]
+    elif distribution == "uniform":
+        value = rng.uniform(params[0], params[1])
+    elif distribution == "normal":
+        value = rng.gauss(params[0], params[1])
+    elif distribution == "lognormal":
+        # params: 中位数, sigma
+        value = rng.lognormvariate(math.log(params[0]), params[1])
+    elif distribution == "exponential":
+        value = rng.expovariate(1 / params[0])
+    else:
+        raise ValueError(f"未知的延迟分布: {distribution}")
+    return max(0.0, value)
+
+
+def parse_latency_spec(spec: str) -> Dict[str, Any]:
+    """解析命令行的延迟描述，如 lognormal:0.3,0.4 / fixed:0.05 / uniform:0.1,0.5"""
+    distribution, _, params = spec.partition(":")
+    return {"distribution": distribution, "params": [float(value) for value in params.split(",") if value]}
+
+
+def percentile(values: List[float], p: float) -> float:
+    """p 分位数（0-100），线性插值"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def numbering_level(text: str):
+    """文本开头的编号格式对应的 (层级, 是否结构层级)，没有编号时为 None"""
+    text = text.strip()
+    for pattern, level, is_structure in NUMBERING_LEVELS:
+        if pattern.match(text):
+            return level, is_structure
+    return None
+
+
+def canned_level_answer(user_prompt: str, rng: random.Random, special_rate: float) -> str:
+    """层级判断回答：有编号时按编号格式定层级（不超过上文最深层级+1），没有编号时为上文最深层级+1"""
+    context_levels = [int(level) for level in CONTEXT_LEVEL_PATTERN.findall(user_prompt)]
+    if not context_levels:
+        return "因为目标文本是第一条文本，所以判断为{层级1}。"
+    deepest = context_levels[-1]
+    target = LEVEL_TARGET_PATTERN.search(user_prompt)
+    numbering = numbering_level(target.group(1)) if target else None
+    if numbering is None:
+        level = deepest + 1
+        reason = "因为目标文本开头为前文不具有的一种新层级格式，且是上一级层级下的第一个段落层级"
+    else:
+        level = min(numbering[0], deepest + 1)
+        reason = "因为目标文本开头是前文具有的一种旧层级格式，且与上一级同为结构层级" if level <= deepest \
+            else "因为目标文本开头为前文不具有的一种新层级格式，且与上一级同为结构层级"
+    if rng.random() < special_rate:
+        return f"{reason}，但我认为{{同属以往层级}}，所以判断为{{层级{level}}}。"
+    return f"{reason}，所以判断为{{层级{level}}}。"
+
+
+def canned_qa_answer(user_prompt: str, rng: random.Random, error_weights: Dict[str, float]) -> str:
+    """QA审核回答：按第三文本块的编号格式判断层级类型，按比例随机给出错误判断和处理建议"""
+    target_text = ""
+    match = QA_INPUT_PATTERN.search(user_prompt)
+    if match:
+        try:
+            blocks = json.loads(match.group(1))
+            target_text = blocks[2].get("text", "") if len(blocks) > 2 else ""
+        except (ValueError, AttributeError):
+            pass
+
+    numbering = numbering_level(target_text)
+    if numbering is not None:
+        level_type = "结构新层级" if numbering[1] else "段落新层级"
+        level_reason = "开头是结构标题" if numbering[1] else "是正文段落内的叙述标题"
+    elif NOTE_PATTERN.match(target_text.strip()):
+        level_type, level_reason = "附注图表新层级", "为附注"
+    else:
+        level_type, level_reason = "非新层级", "为这一层级的正文组成部分"
+    answer = f"因为阅读上下文第三文本块{level_reason}，所以判断为{{{level_type}}}。"
+
+    roll = rng.random()
+    for error_type, weight in error_weights.items():
+        if roll >= weight:
+            roll -= weight
+            continue
+        if error_type == "文本错误":
+            fixed_text = target_text.replace("  ", " ").strip()
+            return answer + f"因为第三文本块因含有不合理字符，所以判断为{{文本错误}}。建议处理方式为：{{{fixed_text}}}"
+        if error_type == "删除":
+            if level_type == "非新层级":
+                return answer + "因为第三文本块因开始处句子不完整，所以判断为{格式错误}。建议处理方式为：{向前合并}且{删除}"
+            return answer + "因为第三文本块因为页码，所以判断为{信息错误}。建议处理方式为：{删除}"
+        if error_type == "需要拆分":
+            middle = len(target_text) // 2
+            return answer + (f"因为第三文本块因包含多个层级，所以判断为{{需要拆分}}。"
+                             f"建议处理方式为：{{{target_text[:middle]}<mark>\n{target_text[middle:]}<summary>}}")
+    return answer + "因为第三文本块因没有四类错误，所以判断为{正确}。第三文本块不做任何修改。"
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # 默认5，并发连接多时会被拒绝后重连
+
+
+class MockVLLMServer:
+    """在本机端口上运行的替身vLLM服务（后台线程），可以在测试/基准中直接启动"""
+
+    def __init__(self, port: int = 0, host: str = "127.0.0.1", config: Dict[str, Any] = None,
+                 served_models: Optional[List[str]] = None):
+        """
+        Args:
+            port: 端口，0 表示随机端口
+            config: 覆盖 MOCK_VLLM_CONFIG 的配置
+            served_models: /v1/models 返回的模型名，默认为所有模型配置中的 lora_module_name 和 adapter_name
+        """
+        self.config = {**MOCK_VLLM_CONFIG, **(config or {})}
+        self.served_models = served_models or sorted({
+            name for model in MODEL_CONFIGS.values() for name in (model["lora_module_name"], model["adapter_name"])
+        })
+        self.failing = False
+        self._rng = random.Random(self.config["seed"])
+        self._rng_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.config["max_concurrency"]) if self.config["max_concurrency"] else None
+        self._rate_lock = threading.Lock()
+        self._next_slot_at = 0.0
+        self._stats_lock = threading.Lock()
+        self._seen_prefixes = set()
+        self.reset_stats()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if server.failing:
+                    self._reply(503, {"error": "unavailable"})
+                elif self.path == "/health":
+                    self._reply(200, {})
+                elif self.path == "/v1/models":
+                    self._reply(200, {"object": "list", "data": [
+                        {"id": name, "object": "model", "owned_by": "mock"} for name in server.served_models
+                    ]})
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def send_event_stream_head(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+            def send_event(self, body):
+                data = f"data: {body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def end_event_stream(self):
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path in ("/v1/load_lora_adapter", "/v1/unload_lora_adapter"):
+                    self._reply(200, {})
+                elif self.path == "/v1/chat/completions":
+                    status, reply = server.handle_chat(json.loads(body or b"{}"), stream_to=self)
+                    if reply is None:
+                        # 流式响应已发送（或客户端已断开），不复用连接
+                        self.close_connection = True
+                    else:
+                        self._reply(status, reply)
+                else:
+                    self._reply(404, {"error": "not found"})
+
+        self.httpd = _MockHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.url = f"http://{host}:{self.port}"
+        self._thread = None
+
+    def start(self) -> "MockVLLMServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name=f"mock_vllm_{self.port}", daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                          "streamed": 0, "cancelled": 0}
+            self.latencies = []     # 每个请求从到达到返回的耗时（含排队）
+            self.queue_waits = []   # 每个请求等待处理槽位/限流的耗时
+
+    def get_stats(self) -> Dict[str, Any]:
+        """累计请求数、token数和延迟分位数（毫秒）"""
+        with self._stats_lock:
+            latencies, queue_waits = list(self.latencies), list(self.queue_waits)
+            stats = dict(self.stats)
+        stats.update({
+            f"latency_p{p}_ms": round(percentile(latencies, p) * 1000, 1) for p in (50, 90, 99)
+        })
+        stats["queue_wait_p90_ms"] = round(percentile(queue_waits, 90) * 1000, 1)
+        return stats
+
+    def handle_chat(self, payload: Dict[str, Any], stream_to=None):
+        """
+        处理一次chat请求，返回 (状态码, 响应体)
+        stream=true 且传入 stream_to（请求处理器）时逐token发送，响应体为None；completion_tokens 统计实际解码的token数
+        """
+        arrived_at = time.time()
+        messages = payload.get("messages", [])
+        system_prompt = next((m["content"] for m in messages if m.get("role") == "system"), "")
+        user_prompt = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+        with self._rng_lock:
+            failed = self.failing or self._rng.random() < self.config["error_rate"]
+            latency = sample_latency(self.config["latency"], self._rng)
+        if failed:
+            with self._stats_lock:
+                self.stats["errors"] += 1
+            return 503, {"error": "unavailable"}
+
+        # 同一prompt总是得到同样的回答
+        prompt_hash = hashlib.sha1(f"{system_prompt}\n{user_prompt}".encode("utf-8")).hexdigest()
+        rng = random.Random(f"{self.config['seed']}:{prompt_hash}")
+        if "文本层级梳理专家" in system_prompt:
+            answer = canned_level_answer(user_prompt, rng, self.config["level_special_rate"])
+            trailing_tokens = self.config["level_trailing_tokens"]
+            if trailing_tokens:
+                explanation = "目标文本的编号格式与上文对应层级一致，层级顺延。" * (trailing_tokens // 20 + 1)
+                answer += "\n解释：" + explanation[:trailing_tokens]
+        elif "审核专家" in system_prompt:
+            answer = canned_qa_answer(user_prompt, rng, self.config["qa_error_weights"])
+        else:
+            answer = "好的。"
+        finish_reason = "stop"
+        max_tokens = payload.get("max_tokens")
+        if max_tokens and len(answer) > max_tokens:
+            answer, finish_reason = answer[:max_tokens], "length"
+
+        # token数按字符数近似；system prompt 出现过一次后视为命中前缀缓存
+        prompt_tokens = len(system_prompt) + len(user_prompt)
+        with self._stats_lock:
+            cached_tokens = len(system_prompt) if system_prompt in self._seen_prefixes else 0
+            self._seen_prefixes.add(system_prompt)
+
+        stream = bool(payload.get("stream")) and stream_to is not None
+        self._wait_for_rate_limit()
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            started_at = time.time()
+            if stream:
+                decoded = self._stream_answer(stream_to, payload, prompt_hash, answer, latency, finish_reason)
+            else:
+                time.sleep(latency + len(answer) * self.config["per_token_latency"])
+                decoded = len(answer)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += decoded
+            self.stats["cached_tokens"] += cached_tokens
+            self.stats["streamed"] += stream
+            self.stats["cancelled"] += decoded < len(answer)
+            self.latencies.append(time.time() - arrived_at)
+            self.queue_waits.append(started_at - arrived_at)
+        if stream:
+            return 200, None
+        return 200, {
+            "id": f"chatcmpl-{prompt_hash[:16]}",
+            "object": "chat.completion",
+            "created": int(arrived_at),
+            "model": payload.get("model", ""),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": finish_reason}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(answer),
+                "total_tokens": prompt_tokens + len(answer),
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}
+            }
+        }
+
+    def _stream_answer(self, handler, payload, prompt_hash, answer, latency, finish_reason) -> int:
+        """逐token（按字符近似）发送回答，客户端断开时停止，返回实际解码的token数"""
+        def chunk(delta, finish=None):
+            return {"id": f"chatcmpl-{prompt_hash[:16]}", "object": "chat.completion.chunk",
+                    "model": payload.get("model", ""),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+
+        decoded = 0
+        try:
+            handler.send_event_stream_head()
+            time.sleep(latency)
+            handler.send_event(chunk({"role": "assistant", "content": ""}))
+            for token in answer:
+                time.sleep(self.config["per_token_latency"])
+                decoded += 1
+                handler.send_event(chunk({"content": token}))
+            handler.send_event(chunk({}, finish_reason))
+            handler.send_event("[DONE]")
+            handler.end_event_stream()
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            pass
+        return decoded
+
+    def _wait_for_rate_limit(self):
+        if not self.config["max_rps"]:
+            return
+        with self._rate_lock:
+            now = time.time()
+            slot_at = max(now, self._next_slot_at)
+            self._next_slot_at = slot_at + 1 / self.config["max_rps"]
+        if slot_at > now:
+            time.sleep(slot_at - now)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线的OpenAI兼容vLLM替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8202)
+    parser.add_argument("--latency", default=None, help="延迟分布，如 lognormal:0.3,0.4 / fixed:0.05 / uniform:0.1,0.5")
+    parser.add_argument("--per-token", type=float, default=None, help="每个输出token的解码耗时（秒）")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="同时处理的请求数，0 表示不限制")
+    parser.add_argument("--max-rps", type=float, default=None, help="每秒最多放行的请求数，0 表示不限制")
+    parser.add_argument("--error-rate", type=float, default=None, help="随机返回503的比例")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--level-trailing-tokens", type=int, default=None, help="层级回答之后追加的解释长度（token）")
+    args = parser.parse_args()
+
+    config = {key: value for key, value in {
+        "latency": parse_latency_spec(args.latency) if args.latency else None,
+        "per_token_latency": args.per_token,
+        "max_concurrency": args.max_concurrency,
+        "max_rps": args.max_rps,
+        "error_rate": args.error_rate,
+        "seed": args.seed,
+        "level_trailing_tokens": args.level_trailing_tokens
+    }.items() if value is not None}
+    server = MockVLLMServer(port=args.port, host=args.host, config=config).start()
+    print(f"✅ 替身vLLM服务已启动: {server.url}（模型: {', '.join(server.served_models)}）")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"📊 {server.get_stats()}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
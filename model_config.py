@@ -6,7 +6,7 @@
 """
 
 import os
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List
 
 # 模型配置字典
 MODEL_CONFIGS = {
@@ -16,8 +16,12 @@ MODEL_CONFIGS = {
         "base_model_path": "/data/training/model/Meta-Llama-3.1-8B-Instruct",
         "lora_path": "/data/training/llama3.1_8b_checkpoint/20250604/checkpoint-1005",
         "lora_module_name": "llama3.1_8b",
+        "adapter_name": "qa",
         "port": 8201,
         "container_name": "vllm_qa",
+        "tensor_parallel_size": 4,
+        # 多副本部署时配置所有副本的地址，请求按在途数均衡分配；本机副本由生命周期守护启动，其它节点自行部署
+        # "endpoints": ["http://localhost:8201", "http://gpu-node-2:8201"],
         "description": "用于QA问答对处理的微调模型"
     },
     "level_model": {
@@ -26,8 +30,10 @@ MODEL_CONFIGS = {
         "base_model_path": "/data/training/model/Meta-Llama-3.1-8B-Instruct",
         "lora_path": "/home/liuxinwei/Models/层级训练",  # 你的新模型路径
         "lora_module_name": "llama3.1_8b",
+        "adapter_name": "level",
         "port": 8202,
         "container_name": "vllm_level",
+        "tensor_parallel_size": 4,
         "description": "用于层级分析的微调模型"
     },
     "default_model": {
@@ -36,12 +42,71 @@ MODEL_CONFIGS = {
         "base_model_path": "/data/training/model/Meta-Llama-3.1-8B-Instruct",
         "lora_path": "/data/training/llama3.1_8b_checkpoint/20250604/checkpoint-1005",
         "lora_module_name": "llama3.1_8b",
+        "adapter_name": "default",
         "port": 8201,
         "container_name": "vllm_default",
+        "tensor_parallel_size": 8,
         "description": "默认微调模型"
     }
 }
 
+# 所有vLLM服务共用的启动参数
+# QA和层级分析每次请求都带同一段数KB的system prompt，开启自动前缀缓存后，
+# 相同前缀的KV cache只需prefill一次，后续请求直接复用
+VLLM_SERVER_ARGS = [
+    "--enable-prefix-caching"
+]
+
+# 多LoRA共享服务：基础模型相同的模型（QA、层级分析）由一个vLLM服务加载一次基础权重，
+# 同时挂载各自的LoRA适配器（--lora-modules qa=... level=...），请求按 model 字段（适配器名）路由。
+# 开启后 adapter_models 中的模型不再单独启动容器，get_model_config 返回的端口和 lora_module_name
+# 分别是共享服务的端口和该模型的适配器名，调用方无需改动。
+MULTI_LORA_CONFIG = {
+    "enabled": False,
+    "name": "multi_lora",
+    "display_name": "多LoRA共享服务",
+    "base_model_path": "/data/training/model/Meta-Llama-3.1-8B-Instruct",
+    "port": 8200,
+    "container_name": "vllm_multi_lora",
+    "tensor_parallel_size": 8,
+    "adapter_models": ["qa_model", "level_model"],
+    "max_loras": 4,                                   # 同一批次中可同时使用的适配器数
+    "max_lora_rank": 64,                              # 不小于所有适配器的rank
+    "adapter_dir": "/home/liuxinwei/checkpoint_data"  # LoRA训练输出目录，挂载到容器中，训练完成的适配器可运行时注册
+}
+
+
+def is_multi_lora_model(model_name: str) -> bool:
+    """该模型是否由多LoRA共享服务提供"""
+    return MULTI_LORA_CONFIG["enabled"] and model_name in MULTI_LORA_CONFIG["adapter_models"]
+
+
+def get_multi_lora_server_config() -> Dict[str, Any]:
+    """多LoRA共享服务的启动配置：lora_modules 为 适配器名 -> LoRA权重路径"""
+    return {
+        **MULTI_LORA_CONFIG,
+        "lora_modules": {
+            MODEL_CONFIGS[name]["adapter_name"]: MODEL_CONFIGS[name]["lora_path"]
+            for name in MULTI_LORA_CONFIG["adapter_models"]
+        }
+    }
+
+
+def get_serving_configs() -> Dict[str, Dict[str, Any]]:
+    """
+    需要启动的vLLM服务配置（服务名 -> 配置），多LoRA模式下共享服务代替其中各模型的单独服务
+    """
+    if not MULTI_LORA_CONFIG["enabled"]:
+        return dict(MODEL_CONFIGS)
+    configs = {name: config for name, config in MODEL_CONFIGS.items() if not is_multi_lora_model(name)}
+    configs[MULTI_LORA_CONFIG["name"]] = get_multi_lora_server_config()
+    return configs
+
+
+def get_serving_name(model_name: str) -> str:
+    """提供该模型的vLLM服务名（多LoRA模式下为共享服务）"""
+    return MULTI_LORA_CONFIG["name"] if is_multi_lora_model(model_name) else model_name
+
 class ModelManager:
     """模型管理器"""
     
@@ -50,8 +115,17 @@ class ModelManager:
         self.active_models = {}  # 存储已启动的模型服务
     
     def get_model_config(self, model_name: str) -> Optional[Dict[str, Any]]:
-        """获取指定模型的配置"""
-        return MODEL_CONFIGS.get(model_name)
+        """获取指定模型的配置（多LoRA模式下端口、容器为共享服务的，lora_module_name 为适配器名）"""
+        model_config = MODEL_CONFIGS.get(model_name)
+        if model_config is None or not is_multi_lora_model(model_name):
+            return model_config
+        return {
+            **model_config,
+            "port": MULTI_LORA_CONFIG["port"],
+            "container_name": MULTI_LORA_CONFIG["container_name"],
+            "lora_module_name": model_config["adapter_name"],
+            "endpoints": MULTI_LORA_CONFIG.get("endpoints")
+        }
     
     def get_current_model_config(self) -> Dict[str, Any]:
         """获取当前模型的配置"""
@@ -91,6 +165,13 @@ def get_model_config(model_name: str) -> Optional[Dict[str, Any]]:
     """获取模型配置的便捷函数"""
     return model_manager.get_model_config(model_name)
 
+def get_model_endpoints(model_name: str) -> List[str]:
+    """模型的vLLM服务地址：配置了 endpoints 时为所有副本，否则为本机端口"""
+    model_config = get_model_config(model_name)
+    if model_config is None:
+        raise KeyError(f"模型配置不存在: {model_name}")
+    return list(model_config.get("endpoints") or [f"http://localhost:{model_config['port']}"])
+
 def get_current_model_config() -> Dict[str, Any]:
     """获取当前模型配置的便捷函数"""
     return model_manager.get_current_model_config()
@@ -1,26 +1,49 @@
-import pandas as pd
-import torch
+"""
+离线批量推理：对CSV中的每一行（instruction, input）生成output
+- 主进程只读一次CSV、构建一次prompt并计算token长度，按长度排序后分桶组成动态batch：
+  同一batch中的样本在同一个长度桶内（padding有上限），batch大小按 max_batch_tokens 限制（长样本batch小、短样本batch大）
+- 所有worker（每张GPU一个进程）从同一个任务队列取batch，先处理长的batch，快的worker多取，不会因为某个分片慢而拖尾
+- 结果边生成边追加写入 <输出文件>.partial.jsonl，进程崩溃不丢已完成的结果；重新运行时跳过已完成（且输入未变）的行，
+  全部完成后按index排序写出最终CSV
+- 推理后端可替换：hf（GPU，基础模型+LoRA）、cpu（CPU上的小模型，用于测试）、dry_run（不加载模型，检查数据和调度）
+
+用法：
+    python prompt.py
+    python prompt.py --input 20.csv --output out.csv --gpus 0,1,2,3 --max-batch-tokens 65536
+    python prompt.py --backend cpu --model /path/to/tiny-llama --workers 2 --max-new-tokens 64
+    python prompt.py --backend dry_run --input 20.csv --output /tmp/out.csv
+"""
 import os
+import csv
+import sys
 import json
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
-from multiprocessing import Process, Manager
-from tqdm import tqdm
 import time
+import queue
+import argparse
 import traceback
+import multiprocessing as mp
 
 # CUDA内存分配策略
 os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
 
-# 路径配置
-base_model_path = "/data/training/model/Meta-Llama-3.1-8B-Instruct"
-lora_path = "/data/training/llama3.1_8b_checkpoint/20250604/checkpoint-1005"
-input_csv = "/home/liuxinwei/Csv/20250606/20.csv"
-final_output_path = "/home/liuxinwei/Csv/20250606/303030.csv"
-
-# 只用前4张卡
-NUM_GPUS = 4
-gpu_ids = [0, 1, 2, 3]
+# 离线推理配置
+OFFLINE_INFERENCE_CONFIG = {
+    "base_model_path": "/data/training/model/Meta-Llama-3.1-8B-Instruct",
+    "lora_path": "/data/training/llama3.1_8b_checkpoint/20250604/checkpoint-1005",
+    "input_csv": "/home/liuxinwei/Csv/20250606/20.csv",
+    "output_csv": "/home/liuxinwei/Csv/20250606/303030.csv",
+    "backend": "hf",
+    "gpu_ids": [0, 1, 2, 3],       # hf后端每张卡一个worker
+    "cpu_workers": 2,              # cpu / dry_run 后端的worker数
+    "max_input_length": 4096,      # 超过时截断（与原来一致）
+    "max_new_tokens": 2000,
+    "max_batch_tokens": 65536,     # 每个batch的 样本数 ×（最长输入 + max_new_tokens） 上限，约束KV cache占用
+    "max_batch_size": 32,
+    "bucket_width": 128,           # 长度桶宽度（token），同一batch的输入长度差不超过该值
+    "worker_timeout": 30           # 秒，所有worker都已退出且这么久没有新结果时结束等待
+}
+
+ERROR_PREFIX = "处理出错: "
 
 # instruction模板
 instruction_template = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -130,7 +153,7 @@ instruction_template = """<|begin_of_text|><|start_header_id|>system<|end_header
 <|eot_id|>
 """
 def build_prompt(example):
-    # example 是 Series
+    # example 是CSV中的一行（dict）
     input_data = json.loads(example['input'])
     input_text = json.dumps(input_data, ensure_ascii=False, indent=2)
     instruction_text = f"需要你回答的问题是：{example['instruction']}"
@@ -138,146 +161,365 @@ def build_prompt(example):
     prompt = f"{instruction_text}\n{input_text}\n请根据问题要求与问题进行回答。"
     return instruction_template, prompt
 
-def process_batch(model, tokenizer, batch, gpu_id):
-    results = []
-    for _, example in batch.iterrows():
-        try:
-            system_prompt, user_prompt = build_prompt(example)
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ]
-            text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-            inputs = tokenizer(
-                text,
-                return_tensors="pt",
-                truncation=True,
-                max_length=4096,
-                padding=True
-            ).to(f"cuda:{gpu_id}")
-
-            with torch.no_grad():
-                output = model.generate(
-                    **inputs,
-                    max_new_tokens=2000,
-                    do_sample=False,
-                    num_beams=1
-                )
-            decoded = tokenizer.decode(output[0], skip_special_tokens=True)
-            response = decoded.split("assistant")[-1].strip()
-            results.append({
-                "index": int(example['index']),
-                "instruction": example['instruction'],
-                "input": example['input'],
-                "output": response
-            })
-            del inputs, output
-            torch.cuda.empty_cache()
-        except Exception as e:
-            print(f"处理数据时出错 (index: {example['index']}): {str(e)}")
-            results.append({
-                "index": int(example['index']),
-                "instruction": example['instruction'],
-                "input": example['input'],
-                "output": f"处理出错: {str(e)}"
-            })
-    return results
-
-def run_worker(gpu_id, return_dict):
-    try:
-        torch.cuda.set_device(gpu_id)
-        torch.cuda.empty_cache()
-        print(f"GPU {gpu_id}: 开始加载模型...")
-
-        tokenizer = AutoTokenizer.from_pretrained(
-            base_model_path,
-            trust_remote_code=True
-        )
+
+class HFBackend:
+    """transformers 推理后端：基础模型 + LoRA，左侧padding批量生成，只解码新生成的token"""
+
+    def __init__(self, config, device):
+        self.config = config
+        self.device = device
+        self.tokenizer = None
+        self.model = None
+
+    @classmethod
+    def load_tokenizer(cls, config):
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(config["base_model_path"], trust_remote_code=True)
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
-
-        base_model = AutoModelForCausalLM.from_pretrained(
-            base_model_path,
-            device_map={'': gpu_id},
-            torch_dtype=torch.bfloat16,
+        tokenizer.padding_side = "left"  # 批量生成时新token接在每个样本的末尾
+        return tokenizer
+
+    def load(self):
+        import torch
+        from transformers import AutoModelForCausalLM
+
+        if self.device.startswith("cuda"):
+            torch.cuda.set_device(self.device)
+        self.tokenizer = self.load_tokenizer(self.config)
+        model = AutoModelForCausalLM.from_pretrained(
+            self.config["base_model_path"],
+            device_map={'': self.device},
+            torch_dtype=torch.bfloat16 if self.device.startswith("cuda") else torch.float32,
             trust_remote_code=True,
             low_cpu_mem_usage=True
         ).eval()
+        if self.config.get("lora_path"):
+            from peft import PeftModel
+            model = PeftModel.from_pretrained(model, model_id=self.config["lora_path"], device_map={'': self.device})
+        self.model = model.eval()
+
+    def generate(self, prompts):
+        import torch
+
+        inputs = self.tokenizer(
+            prompts,
+            return_tensors="pt",
+            truncation=True,
+            max_length=self.config["max_input_length"],
+            padding=True
+        ).to(self.device)
+        with torch.no_grad():
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=self.config["max_new_tokens"],
+                do_sample=False,
+                num_beams=1,
+                pad_token_id=self.tokenizer.pad_token_id
+            )
+        new_tokens = output[:, inputs["input_ids"].shape[1]:]
+        return [text.strip() for text in self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)]
+
+    def is_out_of_memory(self, error):
+        return "out of memory" in str(error).lower()
+
+    def free_memory(self):
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+class CPUBackend(HFBackend):
+    """CPU上的小模型（--model 指定，默认不加载LoRA），用于在没有GPU时测试完整的推理流程"""
+
+    def __init__(self, config, device="cpu"):
+        super().__init__(config, "cpu")
+
+
+class DryRunBackend:
+    """不加载模型：按字符数近似token长度，返回固定的审核回复，用于检查数据、分桶和调度"""
+
+    ANSWER = "因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因没有四类错误，所以判断为{正确}。第三文本块不做任何修改。"
+
+    def __init__(self, config, device="cpu"):
+        self.config = config
+
+    @classmethod
+    def load_tokenizer(cls, config):
+        return None
+
+    def load(self):
+        pass
+
+    def generate(self, prompts):
+        return [self.ANSWER for _ in prompts]
+
+    def is_out_of_memory(self, error):
+        return False
+
+    def free_memory(self):
+        pass
 
-        model = PeftModel.from_pretrained(
-            base_model,
-            model_id=lora_path,
-            device_map={'': gpu_id}
-        )
-        model.eval()
-        print(f"GPU {gpu_id}: 模型加载完成")
-
-        df = pd.read_csv(input_csv)
-        df = df[df['input'].notnull() & df['instruction'].notnull()].reset_index(drop=True)
-        df['index'] = df.index  # 新增index列
-
-        gpu_data = df.iloc[gpu_id::NUM_GPUS].copy()
-        total_items = len(gpu_data)
-        print(f"GPU {gpu_id}: 开始处理 {total_items} 条数据")
-
-        batch_size = 1
-        results = []
-        for i in range(0, total_items, batch_size):
-            batch = gpu_data.iloc[i:i+batch_size]
-            batch_results = process_batch(model, tokenizer, batch, gpu_id)
-            results.extend(batch_results)
-            progress = (i + batch_size) / total_items * 100
-            print(f"GPU {gpu_id}: 进度 {progress:.2f}% ({i + batch_size}/{total_items})")
-            if i % 10 == 0:
-                torch.cuda.empty_cache()
-
-        return_dict[gpu_id] = results
-        print(f"✅ GPU {gpu_id} 完成任务，处理 {len(results)} 条")
+
+BACKENDS = {"hf": HFBackend, "cpu": CPUBackend, "dry_run": DryRunBackend}
+
+
+def read_examples(input_csv):
+    """读取CSV中 instruction 和 input 都不为空的行，index 为过滤后的行号（与原来一致）"""
+    with open(input_csv, "r", encoding="utf-8-sig", newline="") as f:
+        rows = [row for row in csv.DictReader(f) if row.get("input") and row.get("instruction")]
+    return [{"index": index, "instruction": row["instruction"], "input": row["input"]} for index, row in enumerate(rows)]
+
+
+def render_prompt(example, tokenizer):
+    """按chat模板渲染完整prompt（没有tokenizer时用原始消息拼接，只用于dry_run）"""
+    system_prompt, user_prompt = build_prompt(example)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    if tokenizer is None:
+        return f"{system_prompt}\n{user_prompt}"
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+
+def prompt_lengths(prompts, tokenizer, max_input_length):
+    """每个prompt的token数（超过 max_input_length 时按截断后的长度）"""
+    if tokenizer is None:
+        lengths = [len(prompt) for prompt in prompts]
+    else:
+        lengths = [len(ids) for ids in tokenizer(prompts, add_special_tokens=False)["input_ids"]]
+    return [min(length, max_input_length) for length in lengths]
+
+
+def make_batches(lengths, max_batch_tokens, max_new_tokens, max_batch_size, bucket_width):
+    """
+    按长度分桶组成动态batch，返回下标列表的列表（最长的batch在前）
+    从长到短依次加入当前batch，遇到以下情况开始新batch：长度进入下一个桶、
+    样本数 ×（batch中最长输入 + max_new_tokens）超过 max_batch_tokens、样本数达到 max_batch_size
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    current, current_bucket, current_longest = [], None, 0
+    for i in order:
+        bucket = lengths[i] // bucket_width
+        longest = max(current_longest, lengths[i])
+        if current and (bucket != current_bucket or len(current) >= max_batch_size
+                        or (len(current) + 1) * (longest + max_new_tokens) > max_batch_tokens):
+            batches.append(current)
+            current, longest = [], lengths[i]
+        if not current:
+            current_bucket = bucket
+        current.append(i)
+        current_longest = longest
+    if current:
+        batches.append(current)
+    return batches
+
+
+def padding_ratio(batches, lengths):
+    """padding token占batch中所有输入token的比例"""
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return 1 - sum(lengths) / padded if padded else 0.0
+
+
+def truncate_torn_tail(partial_path):
+    """截掉崩溃时写了一半的最后一行，否则下次追加的第一条结果会接在残行后面而无法解析"""
+    with open(partial_path, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            f.truncate(content.rfind(b"\n") + 1)
+
+
+def load_partial_results(partial_path, examples):
+    """读取已写入的结果，只保留输入未变化且没有出错的行"""
+    if not os.path.exists(partial_path):
+        return {}
+    truncate_torn_tail(partial_path)
+    by_index = {example["index"]: example for example in examples}
+    done = {}
+    with open(partial_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 崩溃时写了一半的行
+            example = by_index.get(record.get("index"))
+            if (example is not None and record["instruction"] == example["instruction"]
+                    and record["input"] == example["input"] and not record["output"].startswith(ERROR_PREFIX)):
+                done[record["index"]] = record
+    return done
+
+
+def generate_batch(backend, items):
+    """
+    生成一个batch，返回 [(index, output)]
+    显存不足时对半拆分重试，单条仍失败时输出错误信息
+    """
+    try:
+        outputs = backend.generate([prompt for _, prompt in items])
+        return [(index, output) for (index, _), output in zip(items, outputs)]
     except Exception as e:
-        print(f"❌ GPU {gpu_id} 执行出错：{str(e)}")
-        traceback.print_exc()
-        return_dict[gpu_id] = []
-    finally:
-        if 'model' in locals():
-            del model
-        if 'base_model' in locals():
-            del base_model
-        torch.cuda.empty_cache()
+        if backend.is_out_of_memory(e):
+            backend.free_memory()
+            if len(items) > 1:
+                middle = len(items) // 2
+                return generate_batch(backend, items[:middle]) + generate_batch(backend, items[middle:])
+        print(f"处理数据时出错 (index: {[index for index, _ in items]}): {str(e)}")
+        return [(index, f"{ERROR_PREFIX}{str(e)}") for index, _ in items]
 
-def main():
-    from torch.multiprocessing import set_start_method
+
+def run_worker(worker_id, backend_name, device, config, task_queue, result_queue):
+    """worker进程：加载一次模型，循环从共享队列取batch，直到取到结束标记"""
     try:
-        set_start_method('spawn', force=True)
-    except RuntimeError:
-        pass
+        backend = BACKENDS[backend_name](config, device)
+        print(f"worker {worker_id} ({device}): 开始加载模型...")
+        backend.load()
+        print(f"worker {worker_id} ({device}): 模型加载完成")
+        while True:
+            items = task_queue.get()
+            if items is None:
+                break
+            result_queue.put(generate_batch(backend, items))
+        print(f"✅ worker {worker_id} ({device}) 完成任务")
+    except Exception as e:
+        print(f"❌ worker {worker_id} ({device}) 执行出错：{str(e)}")
+        traceback.print_exc()
+
+
+def run_inference(config):
+    """
+    执行离线推理
 
-    manager = Manager()
-    return_dict = manager.dict()
-    processes = []
-
-    print(f"启动 {NUM_GPUS} 个GPU进程...")
-    for idx, gpu_id in enumerate(gpu_ids):
-        p = Process(target=run_worker, args=(gpu_id, return_dict))
-        p.start()
-        processes.append(p)
-        time.sleep(2)
-
-    for p in processes:
-        p.join()
-
-    all_results = []
-    for gpu_id in gpu_ids:
-        if gpu_id in return_dict:
-            all_results.extend(return_dict[gpu_id])
-        else:
-            print(f"⚠️ GPU {gpu_id} 没有返回结果，已跳过。")
-
-    if all_results:
-        df_out = pd.DataFrame(all_results).sort_values("index")
-        df_out.to_csv(final_output_path, index=False, encoding="utf-8-sig")
-        print(f"✅ 所有可用 GPU 推理完成，已保存至：{final_output_path}")
+    Returns:
+        dict: 样本数、跳过（已完成）数、本次生成数、出错数、batch数、padding比例、耗时和输出文件
+    """
+    started_at = time.time()
+    backend_cls = BACKENDS[config["backend"]]
+    partial_path = config["output_csv"] + ".partial.jsonl"
+
+    examples = read_examples(config["input_csv"])
+    done = load_partial_results(partial_path, examples)
+    pending = [example for example in examples if example["index"] not in done]
+    print(f"共 {len(examples)} 条数据，已完成 {len(done)} 条，待处理 {len(pending)} 条")
+
+    tokenizer = backend_cls.load_tokenizer(config)
+    prompts, invalid = [], []
+    for example in pending:
+        try:
+            prompts.append(render_prompt(example, tokenizer))
+        except Exception as e:
+            # input 不是合法JSON等，直接记为出错，不进入batch
+            invalid.append((example["index"], f"{ERROR_PREFIX}{str(e)}"))
+    invalid_indices = {index for index, _ in invalid}
+    batchable = [example for example in pending if example["index"] not in invalid_indices]
+    lengths = prompt_lengths(prompts, tokenizer, config["max_input_length"])
+    batches = make_batches(lengths, config["max_batch_tokens"], config["max_new_tokens"],
+                           config["max_batch_size"], config["bucket_width"])
+    ratio = padding_ratio(batches, lengths)
+    print(f"分为 {len(batches)} 个batch，padding比例 {ratio:.1%}")
+
+    devices = ([f"cuda:{gpu_id}" for gpu_id in config["gpu_ids"]] if config["backend"] == "hf"
+               else ["cpu"] * config["cpu_workers"])
+    context = mp.get_context("spawn")
+    task_queue, result_queue = context.Queue(), context.Queue()
+    for batch in batches:
+        task_queue.put([(batchable[i]["index"], prompts[i]) for i in batch])
+    if invalid:
+        result_queue.put(invalid)
+    workers = []
+    if batches:
+        for worker_id, device in enumerate(devices):
+            task_queue.put(None)
+            worker = context.Process(target=run_worker,
+                                     args=(worker_id, config["backend"], device, config, task_queue, result_queue))
+            worker.start()
+            workers.append(worker)
+
+    # 结果边收边写，崩溃后重新运行可以从这里继续
+    by_index = {example["index"]: example for example in pending}
+    generated = errors = 0
+    last_result_at = time.time()
+    with open(partial_path, "a", encoding="utf-8") as partial_file:
+        while generated < len(pending):
+            try:
+                results = result_queue.get(timeout=1)
+            except queue.Empty:
+                if (not any(worker.is_alive() for worker in workers)
+                        and time.time() - last_result_at > config["worker_timeout"]):
+                    print(f"⚠️ 所有worker已退出，{len(pending) - generated} 条没有结果，重新运行可继续处理")
+                    break
+                continue
+            last_result_at = time.time()
+            for index, output in results:
+                example = by_index[index]
+                record = {"index": index, "instruction": example["instruction"], "input": example["input"],
+                          "output": output}
+                partial_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                done[index] = record
+                errors += output.startswith(ERROR_PREFIX)
+            partial_file.flush()
+            generated += len(results)
+            print(f"进度 {len(done) / len(examples) * 100:.2f}% ({len(done)}/{len(examples)})")
+
+    for worker in workers:
+        worker.join()
+
+    if done:
+        with open(config["output_csv"], "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["index", "instruction", "input", "output"])
+            writer.writeheader()
+            writer.writerows(done[index] for index in sorted(done))
+        print(f"✅ 推理完成，已保存至：{config['output_csv']}")
     else:
-        print("❌ 所有进程失败，没有结果保存。")
+        print("❌ 没有结果保存。")
+
+    return {
+        "examples": len(examples),
+        "skipped": len(examples) - len(pending),
+        "generated": generated,
+        "errors": errors,
+        "batches": len(batches),
+        "padding_ratio": ratio,
+        "elapsed": time.time() - started_at,
+        "output_csv": config["output_csv"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量推理")
+    parser.add_argument("--input", default=OFFLINE_INFERENCE_CONFIG["input_csv"])
+    parser.add_argument("--output", default=OFFLINE_INFERENCE_CONFIG["output_csv"])
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=OFFLINE_INFERENCE_CONFIG["backend"])
+    parser.add_argument("--model", default=None, help="基础模型路径（cpu后端为小模型路径）")
+    parser.add_argument("--lora", default=None, help="LoRA路径，cpu后端默认不加载")
+    parser.add_argument("--gpus", default=None, help="使用的GPU，如 0,1,2,3")
+    parser.add_argument("--workers", type=int, default=None, help="cpu / dry_run 后端的worker数")
+    parser.add_argument("--max-new-tokens", type=int, default=None)
+    parser.add_argument("--max-batch-tokens", type=int, default=None)
+    parser.add_argument("--max-batch-size", type=int, default=None)
+    args = parser.parse_args()
+
+    config = dict(OFFLINE_INFERENCE_CONFIG, input_csv=args.input, output_csv=args.output, backend=args.backend)
+    if args.backend == "cpu" or args.lora:
+        config["lora_path"] = args.lora
+    overrides = {
+        "base_model_path": args.model,
+        "gpu_ids": [int(gpu_id) for gpu_id in args.gpus.split(",")] if args.gpus else None,
+        "cpu_workers": args.workers,
+        "max_new_tokens": args.max_new_tokens,
+        "max_batch_tokens": args.max_batch_tokens,
+        "max_batch_size": args.max_batch_size
+    }
+    config.update({key: value for key, value in overrides.items() if value is not None})
+
+    summary = run_inference(config)
+    print(f"📊 {summary}")
+    if summary["generated"] + summary["skipped"] < summary["examples"]:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -76,6 +76,7 @@ def quick_test():
         else:
             print(f"  {'  ' * 2}✗ 分析失败: {result['text'][:30]}{'...' if len(result['text']) > 30 else ''}")
     
+    service.close_log()
     print(f"\n测试完成！")
     print(f"日志文件: {service.get_log_file_path()}")
     
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+脚本式测试的检查项汇总，根目录下直接运行的测试（python test_xxx.py）共用：
+    check("名称", 条件, 失败时打印的详情)
+    ...
+    finish()  # 打印汇总，有失败项时以状态码1退出
+"""
+import sys
+
+failures = []
+
+
+def check(name, ok, detail=""):
+    """打印一项检查结果，失败的记入 failures"""
+    print(f"{'✅' if ok else '❌'} {name}{'' if ok else f' {detail}'}")
+    if not ok:
+        failures.append(name)
+
+
+def finish():
+    """打印汇总，有失败项时以状态码1退出"""
+    if failures:
+        print(f"\n❌ {len(failures)} 项失败")
+        sys.exit(1)
+    print("\n✅ 全部通过")
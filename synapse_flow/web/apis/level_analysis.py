@@ -1,6 +1,10 @@
 from flask import Blueprint, request
 from synapse_flow.web.utils.create_response import create_response
-from synapse_flow.web.services.level_analysis_service import update_pdf_json_hierarchy, analyze_hierarchy_by_run_id
+from synapse_flow.web.services.level_analysis_service import update_pdf_json_hierarchy
+from synapse_flow.web.services.hierarchy_scheduler_service import (
+    submit_hierarchy_task, run_hierarchy_task_and_wait, get_hierarchy_task_status, list_hierarchy_tasks,
+    get_hierarchy_scheduler_stats
+)
 
 # 定义蓝图
 level_analysis_bp = Blueprint('level_analysis_bp', __name__)
@@ -10,10 +14,13 @@ def generate_hierarchy():
     """
     根据run_id生成层级分析
     接收run_id，自动从数据库查询数据并进行分析
+    多个文档的请求由层级分析调度器并发处理，共享vLLM并发预算
     
     请求格式:
     {
-        "run_id": "e46561b4-075c-47f8-80a2-efdeacb5cfa7"
+        "run_id": "e46561b4-075c-47f8-80a2-efdeacb5cfa7",
+        "priority": 0,      # 可选，越大越优先
+        "async": false      # 可选，为true时入队后立即返回任务信息，通过 /generateHierarchy/task/<task_id> 查询
     }
     
     返回格式:
@@ -54,10 +61,26 @@ def generate_hierarchy():
                 code="40003"
             )
         
+        priority = request_data.get('priority', 0)
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            return create_response(
+                data=None,
+                message="priority参数应为整数",
+                code="40004"
+            )
+        
         print(f"开始处理run_id: {run_id} 的层级分析...")
         
-        # 调用层级分析服务
-        result = analyze_hierarchy_by_run_id(run_id)
+        if request_data.get('async'):
+            task = submit_hierarchy_task(run_id, priority)
+            return create_response(
+                data=task,
+                message="层级分析任务已提交",
+                code="00000"
+            )
+        
+        # 调用层级分析服务（经调度器与其它文档并发执行）
+        result = run_hierarchy_task_and_wait(run_id, priority)
         
         if result['status'] == 'success':
             # 只返回成功状态和简要信息
@@ -91,6 +114,35 @@ def generate_hierarchy():
             code="50000"
         )
 
+@level_analysis_bp.route('/generateHierarchy/task/<task_id>', methods=['GET'])
+def generate_hierarchy_task_status(task_id):
+    """
+    查询层级分析任务状态
+    """
+    result = get_hierarchy_task_status(task_id)
+    if result.get("error"):
+        return create_response(data=None, message=result["error"], code="00003"), 404
+
+    return create_response(data=result, message="获取层级分析任务状态成功", code="00000")
+
+@level_analysis_bp.route('/generateHierarchy/tasks', methods=['GET'])
+def generate_hierarchy_tasks():
+    """
+    列出层级分析任务，以及调度器概况（排队/运行中的文档数、共享vLLM客户端的在途请求）
+    可选参数: run_id, limit
+    """
+    run_id = request.args.get('run_id')
+    limit = min(request.args.get('limit', 20, type=int), 100)
+
+    return create_response(
+        data={
+            "tasks": list_hierarchy_tasks(run_id, limit),
+            "scheduler": get_hierarchy_scheduler_stats()
+        },
+        message="获取层级分析任务列表成功",
+        code="00000"
+    )
+
 @level_analysis_bp.route('/analyze_hierarchy', methods=['POST'])
 def analyze_hierarchy():
     """
@@ -3,7 +3,8 @@ import os
 import tempfile
 from werkzeug.utils import secure_filename
 from synapse_flow.web.utils.create_response import create_response
-from synapse_flow.web.services.loratraining_job_service import train_lora_model, get_training_status, list_training_tasks
+from synapse_flow.web.services.loratraining_job_service import train_lora_model, get_training_status, list_training_tasks, register_trained_adapter, cancel_training_task, resume_training_task
+from synapse_flow.web.services.training_export_service import export_training_dataset
 
 # 定义蓝图
 loratraining_job_bp = Blueprint('loratraining_job_bp', __name__)
@@ -21,26 +22,29 @@ def allowed_file(filename):
 def lora_training():
     """
     启动LoRA模型训练
-    支持CSV文件上传和训练参数配置
+    支持CSV文件上传，或通过 export_name（可选 run_ids，逗号分隔）直接使用从pdf_json导出的训练数据，以及训练参数配置
     """
     try:
+        export_name = request.form.get('export_name')
+        run_ids = [run_id.strip() for run_id in request.form.get('run_ids', '').split(',') if run_id.strip()]
+        
         # 检查是否有文件上传
-        if 'file' not in request.files:
+        if not export_name and 'file' not in request.files:
             return create_response(
                 data=None,
                 message="请上传CSV训练文件",
                 code="40001"
             )
         
-        file = request.files['file']
-        if file.filename == '':
+        file = None if export_name else request.files['file']
+        if file is not None and file.filename == '':
             return create_response(
                 data=None,
                 message="未选择文件",
                 code="40002"
             )
         
-        if not allowed_file(file.filename):
+        if file is not None and not allowed_file(file.filename):
             return create_response(
                 data=None,
                 message="只支持CSV文件格式",
@@ -58,18 +62,24 @@ def lora_training():
         }
         
         # 保存上传的文件到临时目录
-        temp_dir = tempfile.mkdtemp()
-        filename = secure_filename(file.filename)
-        csv_file_path = os.path.join(temp_dir, filename)
-        file.save(csv_file_path)
+        csv_file_path, filename = None, None
+        if file is not None:
+            temp_dir = tempfile.mkdtemp()
+            filename = secure_filename(file.filename)
+            csv_file_path = os.path.join(temp_dir, filename)
+            file.save(csv_file_path)
         
         # 构建训练数据
         training_data = {
             "csv_file_path": csv_file_path,
             "original_filename": filename,
+            "export_name": export_name,
+            "run_ids": run_ids or None,
             "batch_size": training_config["batch_size"],
             "num_epochs": training_config["num_epochs"],
-            "learning_rate": training_config["learning_rate"]
+            "learning_rate": training_config["learning_rate"],
+            "adapter_name": request.form.get('adapter_name'),  # 多LoRA模式下训练完成后挂载的适配器名
+            "batching": request.form.get('batching')  # padding / packing / group_by_length，默认 padding
         }
         
         # 调用训练服务
@@ -84,7 +94,7 @@ def lora_training():
         
         return create_response(
             data=result,
-            message="LoRA训练任务已启动",
+            message="LoRA训练任务已提交",
             code="00000"
         )
         
@@ -95,6 +105,72 @@ def lora_training():
             code="50000"
         )
 
+@loratraining_job_bp.route('/export', methods=['POST'])
+def export_training_data():
+    """
+    从审核后的pdf_json版本导出训练数据（Arrow分片，只重新导出有变化的run）
+    请求体：{"name": 导出名, "run_ids": [...], "versions": {run_id: version}, "full": false}
+    """
+    try:
+        data = request.get_json() or {}
+        result = export_training_dataset(
+            data.get('name') or 'default',
+            run_ids=data.get('run_ids'),
+            versions={run_id: int(version) for run_id, version in (data.get('versions') or {}).items()},
+            full=bool(data.get('full'))
+        )
+        result.pop('shards')
+        
+        return create_response(
+            data=result,
+            message="训练数据导出成功",
+            code="00000"
+        )
+        
+    except Exception as e:
+        return create_response(
+            data=None,
+            message=f"训练数据导出异常: {str(e)}",
+            code="50000"
+        )
+
+@loratraining_job_bp.route('/adapters', methods=['POST'])
+def register_adapter():
+    """
+    把已完成的训练任务注册为多LoRA共享服务上的适配器
+    """
+    try:
+        data = request.get_json() or {}
+        task_id = data.get('task_id')
+        adapter_name = data.get('adapter_name')
+        if not task_id or not adapter_name:
+            return create_response(
+                data=None,
+                message="task_id和adapter_name不能为空",
+                code="40001"
+            )
+        
+        result = register_trained_adapter(task_id, adapter_name)
+        if result.get('status') == 'error':
+            return create_response(
+                data=None,
+                message=result.get('message'),
+                code="50001"
+            )
+        
+        return create_response(
+            data=result,
+            message="适配器注册成功",
+            code="00000"
+        )
+        
+    except Exception as e:
+        return create_response(
+            data=None,
+            message=f"注册适配器异常: {str(e)}",
+            code="50000"
+        )
+
 @loratraining_job_bp.route('/status/<task_id>', methods=['GET'])
 def get_training_task_status(task_id):
     """
@@ -123,6 +199,60 @@ def get_training_task_status(task_id):
             code="50000"
         )
 
+@loratraining_job_bp.route('/cancel/<task_id>', methods=['POST'])
+def cancel_training(task_id):
+    """
+    取消训练任务（排队中的直接取消，运行中的保存checkpoint后结束）
+    """
+    try:
+        result = cancel_training_task(task_id)
+        if result.get('status') == 'error':
+            return create_response(
+                data=None,
+                message=result.get('message'),
+                code="40001"
+            )
+        
+        return create_response(
+            data=result,
+            message="已取消训练任务",
+            code="00000"
+        )
+        
+    except Exception as e:
+        return create_response(
+            data=None,
+            message=f"取消训练任务异常: {str(e)}",
+            code="50000"
+        )
+
+@loratraining_job_bp.route('/resume/<task_id>', methods=['POST'])
+def resume_training(task_id):
+    """
+    失败或取消的训练任务重新入队，从最新的checkpoint继续
+    """
+    try:
+        result = resume_training_task(task_id)
+        if result.get('status') == 'error':
+            return create_response(
+                data=None,
+                message=result.get('message'),
+                code="40001"
+            )
+        
+        return create_response(
+            data=result,
+            message="训练任务已重新入队",
+            code="00000"
+        )
+        
+    except Exception as e:
+        return create_response(
+            data=None,
+            message=f"续跑训练任务异常: {str(e)}",
+            code="50000"
+        )
+
 @loratraining_job_bp.route('/tasks', methods=['GET'])
 def get_training_tasks():
     """
@@ -1,6 +1,11 @@
-from flask import Blueprint, request
+import json
+from flask import Blueprint, request, Response, stream_with_context
 from synapse_flow.web.utils.create_response import create_response
-from synapse_flow.web.services.prompt_job_service import split_text,get_api_key,process_qa_for_version_0
+from synapse_flow.web.services.prompt_job_service import split_text,get_api_key
+from synapse_flow.web.services.qa_run_journal_service import query_qa_journal_progress
+from synapse_flow.web.services.qa_task_service import (
+    submit_qa_task, get_qa_task_status, cancel_qa_task, list_qa_tasks, wait_for_qa_task_update, FINISHED_STATUSES
+)
 from synapse_flow.promptJob import promptJobPipeLine  # 确保导入正确
 # 定义蓝图
 prompt_job_bp = Blueprint('prompt_job', __name__)
@@ -32,7 +37,8 @@ def text_split():
 @prompt_job_bp.route('/processQA', methods=['POST'])
 def process_qa():
     """
-    对版本0的数据进行QA问答对处理，生成版本1
+    提交版本0的QA问答对处理任务（后台执行，生成版本1）
+    接口立即返回task_id，通过 /processQA/task/<task_id> 查询进度
     ---
     consumes:
       - application/json
@@ -49,7 +55,7 @@ def process_qa():
               example: "abc123-def456-ghi789"
     responses:
       200:
-        description: 成功执行QA问答对处理
+        description: 任务已入队
       400:
         description: 参数错误
       500:
@@ -64,22 +70,174 @@ def process_qa():
         if not run_id:
             return create_response(data=None, message="缺少run_id参数", code="00001"), 400
         
-        print(f"开始处理QA问答对，run_id: {run_id}")
+        print(f"提交QA问答对处理任务，run_id: {run_id}")
         
-        # 调用服务层处理QA问答对
-        result = process_qa_for_version_0(run_id)
+        # 入队后台执行，避免长时间占用请求线程
+        result = submit_qa_task(run_id)
         
         return create_response(
             data=result,
-            message="QA问答对处理完成",
+            message="QA问答对处理任务已提交",
             code="00000"
         )
         
     except Exception as e:
-        print(f"QA问答对处理失败: {str(e)}")
+        print(f"QA问答对处理任务提交失败: {str(e)}")
         return create_response(
             data=None,
-            message=f"QA问答对处理失败: {str(e)}",
+            message=f"QA问答对处理任务提交失败: {str(e)}",
             code="00002"
         ), 500
 
+
+@prompt_job_bp.route('/processQA/task/<task_id>', methods=['GET'])
+def process_qa_task_status(task_id):
+    """
+    查询QA处理任务状态（完成数/总数、吞吐、预计剩余时间）
+    ---
+    parameters:
+      - name: task_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: 返回任务状态
+      404:
+        description: 任务不存在
+    """
+    result = get_qa_task_status(task_id)
+    if result.get("error"):
+        return create_response(data=None, message=result["error"], code="00003"), 404
+
+    return create_response(data=result, message="获取QA任务状态成功", code="00000")
+
+
+@prompt_job_bp.route('/processQA/task/<task_id>/cancel', methods=['POST'])
+def process_qa_task_cancel(task_id):
+    """
+    取消QA处理任务，已完成的批次保留在运行日志中
+    ---
+    parameters:
+      - name: task_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: 已发出取消请求
+      404:
+        description: 任务不存在
+    """
+    result = cancel_qa_task(task_id)
+    if result.get("error"):
+        return create_response(data=None, message=result["error"], code="00003"), 404
+
+    return create_response(data=result, message="已请求取消QA任务", code="00000")
+
+
+@prompt_job_bp.route('/processQA/task/<task_id>/events', methods=['GET'])
+def process_qa_task_events(task_id):
+    """
+    通过Server-Sent Events实时推送QA处理任务进度，任务结束后关闭连接
+    ---
+    parameters:
+      - name: task_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: text/event-stream
+      404:
+        description: 任务不存在
+    """
+    initial = get_qa_task_status(task_id)
+    if initial.get("error"):
+        return create_response(data=None, message=initial["error"], code="00003"), 404
+
+    def event_stream():
+        task = initial
+        yield f"event: progress\ndata: {json.dumps(task, ensure_ascii=False)}\n\n"
+        while task["status"] not in FINISHED_STATUSES:
+            updated = wait_for_qa_task_update(task_id, task["version"])
+            if updated is None:
+                break
+            if updated["version"] == task["version"]:
+                # 没有变化，发送心跳保持连接
+                yield ": keep-alive\n\n"
+                continue
+            task = updated
+            yield f"event: progress\ndata: {json.dumps(task, ensure_ascii=False)}\n\n"
+        yield f"event: end\ndata: {json.dumps(task, ensure_ascii=False)}\n\n"
+
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@prompt_job_bp.route('/processQA/tasks', methods=['GET'])
+def process_qa_tasks():
+    """
+    获取QA处理任务列表
+    ---
+    parameters:
+      - name: run_id
+        in: query
+        type: string
+        required: false
+      - name: limit
+        in: query
+        type: integer
+        required: false
+    responses:
+      200:
+        description: 返回任务列表
+    """
+    run_id = request.args.get("run_id")
+    limit = min(request.args.get("limit", 20, type=int), 100)
+
+    return create_response(data=list_qa_tasks(run_id, limit), message="获取QA任务列表成功", code="00000")
+
+
+@prompt_job_bp.route('/processQA/progress', methods=['GET'])
+def process_qa_progress():
+    """
+    查询QA问答对处理进度（基于运行日志，处理过程中可随时查询）
+    ---
+    parameters:
+      - name: run_id
+        in: query
+        type: string
+        required: true
+        description: 要查询的run_id
+    responses:
+      200:
+        description: 返回已完成条数和总条数
+      400:
+        description: 参数错误
+      500:
+        description: 服务器内部错误
+    """
+    try:
+        run_id = request.args.get("run_id")
+        if not run_id:
+            return create_response(data=None, message="缺少run_id参数", code="00001"), 400
+
+        result = query_qa_journal_progress(run_id)
+
+        return create_response(
+            data=result,
+            message="查询QA处理进度成功",
+            code="00000"
+        )
+
+    except Exception as e:
+        print(f"查询QA处理进度失败: {str(e)}")
+        return create_response(
+            data=None,
+            message=f"查询QA处理进度失败: {str(e)}",
+            code="00002"
+        ), 500
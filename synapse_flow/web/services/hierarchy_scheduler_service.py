@@ -0,0 +1,258 @@
+# 层级分析的多文档调度
+# 单个文档内的层级判断必须按顺序进行（每条的prompt依赖前面的结果），单文档无法让GPU跑满。
+# 这里同时分析多个文档：每个文档有独立的 LevelAnalysisService 状态，所有文档共用一个异步vLLM客户端，
+# 在途请求数受全局并发预算限制。文档按优先级出队；请求放行时按优先级、再按各文档当前在途数公平分配。
+import uuid
+import heapq
+import itertools
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional
+from model_config import get_model_config
+from synapse_flow.web.services.vllm_async_client import AsyncVLLMClient
+from synapse_flow.web.services.level_analysis_service import (
+    analyze_hierarchy_by_run_id, LEVEL_STREAMING_CONFIG
+)
+from vllm_lifecycle import get_lifecycle_daemon
+from vllm_endpoint_pool import get_endpoint_pool
+from vllm_circuit_breaker import get_circuit_breaker
+
+# 调度配置
+HIERARCHY_SCHEDULER_CONFIG = {
+    "max_documents": 8,            # 同时分析的文档数
+    "max_inflight_requests": 32,   # 所有文档共享的vLLM在途请求上限
+    "max_finished_tasks": 100      # 内存中最多保留的已结束任务数
+}
+
+FINISHED_STATUSES = ("completed", "failed")
+
+# 全局变量存储层级分析任务状态
+hierarchy_tasks = {}
+_task_condition = threading.Condition()  # 保护任务状态和待处理队列，任务状态变化时通知等待者
+_pending_heap = []                       # (-priority, seq, task_id)
+_task_seq = itertools.count()
+_workers = []
+_level_client = None
+_client_lock = threading.Lock()
+
+
+def get_level_llm_client() -> AsyncVLLMClient:
+    """所有文档共用的层级分析vLLM客户端（首次调用时创建）"""
+    global _level_client
+    with _client_lock:
+        if _level_client is None:
+            model_config = get_model_config("level_model") or {}
+            endpoint_pool = get_endpoint_pool("level_model")
+            _level_client = AsyncVLLMClient(
+                base_url=endpoint_pool.urls[0],
+                model_name=model_config.get("lora_module_name", "llama3.1_8b"),
+                max_concurrency=HIERARCHY_SCHEDULER_CONFIG["max_inflight_requests"],
+                endpoint_pool=endpoint_pool,
+                circuit_breaker=get_circuit_breaker("level_model"),
+                stream_calibration_every=LEVEL_STREAMING_CONFIG["calibration_every"]
+            )
+        return _level_client
+
+
+def submit_hierarchy_task(run_id: str, priority: int = 0) -> Dict[str, Any]:
+    """
+    提交层级分析任务（入队后立即返回）
+    同一个run_id已有排队或运行中的任务时直接返回该任务，新的优先级更高时提升其优先级
+
+    Args:
+        run_id: 运行ID
+        priority: 优先级，越大越先开始、请求越先放行
+
+    Returns:
+        Dict: 任务状态信息
+    """
+    with _task_condition:
+        for task in hierarchy_tasks.values():
+            if task["run_id"] == run_id and task["status"] not in FINISHED_STATUSES:
+                if priority > task["priority"]:
+                    task["priority"] = priority
+                    if task["status"] == "queued":
+                        heapq.heappush(_pending_heap, (-priority, next(_task_seq), task["task_id"]))
+                        _task_condition.notify_all()
+                print(f"run_id {run_id} 已有未结束的层级分析任务: {task['task_id']}")
+                return task.copy()
+
+        task_id = f"hierarchy_{uuid.uuid4().hex[:12]}"
+        now = datetime.now().isoformat()
+        hierarchy_tasks[task_id] = {
+            "task_id": task_id,
+            "run_id": run_id,
+            "priority": priority,
+            "status": "queued",
+            "create_time": now,
+            "start_time": None,
+            "end_time": None,
+            "error_message": None,
+            "result": None
+        }
+        heapq.heappush(_pending_heap, (-priority, next(_task_seq), task_id))
+        _prune_finished_tasks()
+        _ensure_workers()
+        _task_condition.notify_all()
+        task = hierarchy_tasks[task_id].copy()
+
+    # 入队时就在后台启动模型服务，任务开始前服务已在加载
+    get_lifecycle_daemon().expect_demand("level_model")
+    print(f"✅ 层级分析任务已入队: {task_id} (run_id: {run_id}, 优先级: {priority})")
+    return task
+
+
+def run_hierarchy_task_and_wait(run_id: str, priority: int = 0, timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    提交任务并等待完成（同步接口使用），返回 analyze_hierarchy_by_run_id 格式的结果
+    """
+    task = submit_hierarchy_task(run_id, priority)
+    task = wait_for_hierarchy_task(task["task_id"], timeout)
+    if task is None:
+        return {"status": "error", "message": "层级分析任务不存在", "run_id": run_id}
+    if task["status"] not in FINISHED_STATUSES:
+        return {"status": "error", "message": f"层级分析任务 {task['task_id']} 等待超时，仍在后台执行", "run_id": run_id}
+    if task["result"] is not None:
+        return task["result"]
+    return {"status": "error", "message": task["error_message"] or "层级分析失败", "run_id": run_id}
+
+
+def _ensure_workers():
+    """按配置启动文档工作线程，调用方需持有 _task_condition"""
+    while len(_workers) < HIERARCHY_SCHEDULER_CONFIG["max_documents"]:
+        worker = threading.Thread(target=_worker_loop, name=f"hierarchy_worker_{len(_workers)}", daemon=True)
+        _workers.append(worker)
+        worker.start()
+
+
+def _worker_loop():
+    """从待处理队列按优先级取任务执行"""
+    while True:
+        with _task_condition:
+            task_id = None
+            while task_id is None:
+                while not _pending_heap:
+                    _task_condition.wait()
+                _, _, candidate = heapq.heappop(_pending_heap)
+                task = hierarchy_tasks.get(candidate)
+                # 提升优先级时会重复入队，已经开始的任务跳过
+                if task is not None and task["status"] == "queued":
+                    task_id = candidate
+            _update_task_locked(task_id, status="running", start_time=datetime.now().isoformat())
+        _run_hierarchy_task(task_id)
+
+
+def _run_hierarchy_task(task_id: str):
+    """在工作线程中分析一个文档，模型请求通过共享客户端发出"""
+    task = hierarchy_tasks[task_id]
+    run_id = task["run_id"]
+    try:
+        # 多个文档同时开始时只启动一次服务；租用期间服务不会被空闲停止
+        with get_lifecycle_daemon().lease("level_model") as vllm_ready:
+            if not vllm_ready:
+                raise RuntimeError("层级分析vLLM服务不可用")
+
+            client = get_level_llm_client()
+
+            def llm_client(messages, max_tokens, stream_parser):
+                # 每次请求时读取优先级，排队中提升的优先级对后续请求生效
+                return client.chat(messages, key=run_id, priority=task["priority"],
+                                   max_tokens=max_tokens, stream_parser=stream_parser)
+
+            result = analyze_hierarchy_by_run_id(run_id, llm_client=llm_client)
+        # 逐条结果已写入数据库，任务中只保留摘要
+        summary = {key: value for key, value in result.items() if key != "results"}
+        status = "completed" if result.get("status") == "success" else "failed"
+        _update_task(task_id, status=status, result=summary,
+                     error_message=None if status == "completed" else result.get("message"),
+                     end_time=datetime.now().isoformat())
+        print(f"{'✅' if status == 'completed' else '❌'} 层级分析任务 {task_id} 结束: {result.get('message')}")
+    except Exception as e:
+        _update_task(task_id, status="failed", error_message=str(e), end_time=datetime.now().isoformat())
+        print(f"❌ 层级分析任务 {task_id} 失败: {str(e)}")
+
+
+def _update_task(task_id: str, **fields):
+    with _task_condition:
+        _update_task_locked(task_id, **fields)
+
+
+def _update_task_locked(task_id: str, **fields):
+    """更新任务状态并通知等待者，调用方需持有 _task_condition"""
+    task = hierarchy_tasks.get(task_id)
+    if task is None:
+        return
+    task.update(fields)
+    _task_condition.notify_all()
+
+
+def _prune_finished_tasks():
+    """清理过多的已结束任务，调用方需持有 _task_condition"""
+    finished = [task for task in hierarchy_tasks.values() if task["status"] in FINISHED_STATUSES]
+    overflow = len(finished) - HIERARCHY_SCHEDULER_CONFIG["max_finished_tasks"]
+    if overflow > 0:
+        finished.sort(key=lambda x: x["create_time"])
+        for task in finished[:overflow]:
+            hierarchy_tasks.pop(task["task_id"], None)
+
+
+def wait_for_hierarchy_task(task_id: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    阻塞等待任务结束
+
+    Returns:
+        Dict: 任务状态（超时时为当前状态）；任务不存在返回None
+    """
+    with _task_condition:
+        _task_condition.wait_for(
+            lambda: task_id not in hierarchy_tasks or hierarchy_tasks[task_id]["status"] in FINISHED_STATUSES,
+            timeout
+        )
+        task = hierarchy_tasks.get(task_id)
+        return task.copy() if task is not None else None
+
+
+def get_hierarchy_task_status(task_id: str) -> Dict[str, Any]:
+    """
+    获取层级分析任务状态
+
+    Args:
+        task_id: 任务ID
+
+    Returns:
+        Dict: 任务状态信息
+    """
+    with _task_condition:
+        if task_id in hierarchy_tasks:
+            return hierarchy_tasks[task_id].copy()
+    return {"error": "任务不存在"}
+
+
+def list_hierarchy_tasks(run_id: str = None, limit: int = 20) -> list:
+    """
+    列出层级分析任务（内存存储），按创建时间倒序
+
+    Args:
+        run_id: 运行ID（可选）
+        limit: 限制数量
+    """
+    with _task_condition:
+        tasks = [task.copy() for task in hierarchy_tasks.values()]
+
+    if run_id:
+        tasks = [task for task in tasks if task["run_id"] == run_id]
+    tasks.sort(key=lambda x: x.get("create_time", ""), reverse=True)
+    return tasks[:limit]
+
+
+def get_hierarchy_scheduler_stats() -> Dict[str, Any]:
+    """调度器概况：排队/运行中的文档数，以及共享客户端的在途请求情况"""
+    with _task_condition:
+        queued = sum(1 for task in hierarchy_tasks.values() if task["status"] == "queued")
+        running = sum(1 for task in hierarchy_tasks.values() if task["status"] == "running")
+    return {
+        "queued_documents": queued,
+        "running_documents": running,
+        "max_documents": HIERARCHY_SCHEDULER_CONFIG["max_documents"],
+        "llm_client": get_level_llm_client().get_stats()
+    }
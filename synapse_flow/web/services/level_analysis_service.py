@@ -11,17 +11,167 @@ import requests
 import re
 import datetime
 import os
-import subprocess
-import signal
+import threading
 from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
 from synapse_flow.db import get_pg_conn
 from vllm_service_manager import start_model_service, call_model_api
 from model_config import get_model_config
+from vllm_lifecycle import get_lifecycle_daemon
+from vllm_endpoint_pool import get_endpoint_pool
+from vllm_circuit_breaker import (
+    get_circuit_breaker, CircuitOpenError, RunAbortedError, RunFailureGuard, CIRCUIT_BREAKER_CONFIG, CLOSED
+)
+from synapse_flow.web.utils.jsonl_log_writer import JsonlLogWriter
+from synapse_flow.web.utils.llm_response_parser import parse_level_response, LevelStreamParser
+from synapse_flow.web.utils.token_budget import get_token_budget
+from synapse_flow.web.services.vllm_async_client import StreamEarlyStopStats, consume_stream
+from synapse_flow.web.services.level_hierarchy_state import LevelHierarchyState
+from synapse_flow.web.services.level_rule_classifier import LevelRuleClassifier, LEVEL_RULE_CONFIG, RULE_AI_RESPONSE
+
+# 层级判断的system prompt，模块加载时固定下来，保证每次请求逐字节一致，
+# 这样vLLM的自动前缀缓存可以在所有请求之间复用这段前缀的KV cache
+LEVEL_SYSTEM_PROMPT = """你是一个文本层级梳理专家，你的任务是**判断目标文本块的层级**
+
+你会得到四种信息，辅助你确定目标文本块的层级：
+1. 目标文本块的内容：这个文本块的内容是一个层级的开头部分，具有层级的内容与结构特征，可以方便你进行判断；
+2. 层级主题：
+（1）结构层级：这里指的从这里开始可能是一个结构层级，是整个文章的书写框架结构标题；
+（2）段落层级：这里指的从这里开始可能是一个段落层级，是结构下文章段落内的叙述标题；
+3. 目标文本块的前文相关递进层级：通过对比以往的层级，辅助你判断目标文本块作为层级开头应该属于什么层级；
+
+**注意**：文本的层级计数永远都是按序往后计数的，绝对不可能出现后文的层级数字比前文小，如果出现说明不是同一层级！
+
+回答格式：
+如果是正常情况判断请回答：因为目标文本开头是前文XXX，且XXX，所以判断为{层级X}。
+如果是特殊情况判断请回答：因为目标文本开头是前文XXX，且XXX，但我认为{特殊原因}，所以判断为{层级X}。
+特殊原因：
+（1）层级主题错误：段落和结构层级混淆；
+（2）同属以往层级：是新层级格式，但是明显不属于上一级层级；
+（3）层级顺序混乱：是旧层级格式，但不是往下计数，说明不是同一层级；
+（4）总分结构后的总层级：总分总后的总结语句，一般属于当前同一层级；
+（5）层级为模版内部层级：层级标记为99级，特指文本内部的模版内部层级。
+
+举例1：
+我们已经确认：
+结构层级1："企业设立管理"，
+
+请问结构层级： "第一节 登记信息确认",是第几层级的开头内容？
+
+回答：因为目标文本开头为前文不具有的一种新层级格式，且与上一级同为结构层级，所以判断为{层级2}。
+
+举例2：
+我们已经确认：
+结构层级1："中华人民共和国个人所得税法"，
+结构层级2："第一条【征税范围】"，
+
+请问段落层级： "第一条在中国境内有住所，...",是第几层级的开头内容？
+
+回答：因为目标文本开头为前文不具有的一种新层级格式，且是上一级结构层级下的第一个段落层级，所以判断为{层级3}。
+
+举例3：
+我们已经确认：
+段落层级1："28.资源综合利用企业受到税务处罚能否继续享受增值税即征即退？"，
+段落层级2："问题："，
+段落层级3： "（2）依据《税收征收管理法》第六十八条规定，..."，
+段落层级3："回复："，
+
+请问段落层级： "（1）集团公司采取资金池模式集中资金管理是常规做法，...",是第几层级的开头内容？
+
+回答：因为目标文本开头是前文具有的一种旧层级格式，且与上一级同为段落层级，但我认为{层级顺序混乱}，所以判断为{层级4}。
+
+举例4：
+我们已经确认：
+结构层级1："第一章 税收的产生与发展"，
+段落层级2："内容提要：税收是政府为了实现其职能、满足社会公共需要，..."，
+段落层级2："导入案例：西方税与东方税的交汇 国王与税收 "，
+
+请问结构层级："第一节 税收词源",是第几层级的开头内容？
+
+回答：因为目标文本开头为前文不具有的一种新层级格式，且是段落层级回到结构层级，但我认为{同属以往层级}，所以判断为{层级2}。
+
+举例5：
+我们已经确认：
+结构层级1："第一章 税收的产生与发展"，
+结构层级2："第二节 税收的产生"，
+结构层级3："一、税收产生的前提条件"，
+段落层级4： "3.社会条件：经常化的社会公共需要出现"，
+段落层级5："（4）社会公共需要是一种具有外部性的需求，..."，
+
+请问段落层级： "这些特征确定了社会公共需求是一个社会需求不可或缺的部分，...",是第几层级的开头内容？
+
+回答：因为目标文本开头是前文具有的一种旧层级格式，且与上一级同为段落层级，但我认为{总分结构后的总层级}，所以判断为{层级5}。
+
+举例6：
+我们已经确认：
+结构层级1："税款缴纳及退税管理"，
+结构层级2："第二节 退（抵）税"，
+结构层级3："四、留抵退税"，
+结构层级4："（一）一般企业留抵退税"，
+段落层级5： "3.操作办法。"，
+段落层级6："（5）税务机关对增值税涉税风险疑点进行排查时，..."，
+
+请问结构层级： "4.附加税费的处理",是第几层级的开头内容？
+
+回答：因为目标文本开头是前文具有的一种旧层级格式，且是段落层级回到结构层级，但我认为{层级主题错误}，所以判断为{层级5}。""".strip() + "\n请注意，第一条文本一定是层级1，后续层级在此基础上顺延。"
+
+# 推测并行配置：同一文档最多同时在途 window 个请求，结果与逐条处理一致
+LEVEL_SPECULATION_CONFIG = {
+    "enabled": True,
+    "window": 4
+}
+
+# 增量重新分析：用上一次分析过的版本预填AI响应缓存，prompt（即上下文路径和目标文本）未变化的条目不再调用AI
+LEVEL_INCREMENTAL_CONFIG = {
+    "enabled": True
+}
+
+# 流式请求：答案（{层级X}及之前的特殊情况）确定后断开连接，不再等待后面的解释；
+# 每 calibration_every 个请求读完一次整个回答，用于估计节省的token
+LEVEL_STREAMING_CONFIG = {
+    "enabled": True,
+    "calibration_every": 50
+}
+
+# 逐条调用模式（call_vllm_api）的流式统计，共享客户端的统计见其 get_stats()["stream"]
+level_stream_stats = StreamEarlyStopStats(LEVEL_STREAMING_CONFIG["calibration_every"])
+
+# 只有真实的AI响应才能复用（排除第一条、规则判断、vLLM不可用时的默认层级等）
+LLM_ANSWER_PATTERN = re.compile(r"判断为\{层级[一二三四五六七八九十\d]+\}")
+
+def flip_title_mark(is_title_marked: str) -> str:
+    """结构层级与段落层级互换（层级主题错误时使用）"""
+    if is_title_marked == "section level":
+        return "context level"
+    if is_title_marked == "context level":
+        return "section level"
+    return is_title_marked
+
+# 同一秒内创建多个服务实例（多文档并发）时，日志文件名加序号区分
+_log_name_lock = threading.Lock()
+_log_name_seq = {}
+
+def _new_log_file_path(log_dir: str) -> str:
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    with _log_name_lock:
+        seq = _log_name_seq.get(timestamp, 0)
+        _log_name_seq.clear()
+        _log_name_seq[timestamp] = seq + 1
+    suffix = f"_{seq}" if seq else ""
+    return os.path.join(log_dir, f"level_analysis_log_{timestamp}{suffix}.jsonl")
 
 class LevelAnalysisService:
     """层级分析服务"""
     
-    def __init__(self, port: int = 8202):
+    def __init__(self, port: int = 8202, llm_client=None):
+        """
+        Args:
+            port: level_model配置不存在时使用的端口
+            llm_client: 可选的模型调用函数 (messages, max_tokens, stream_parser) -> AI响应，由层级分析调度器传入共享的vLLM客户端
+                        （stream_parser 原样传给 AsyncVLLMClient，未启用流式时为None）；
+                        为None时用本实例的 call_vllm_api 逐条调用
+        """
         # 获取level_model的配置
         self.model_config = get_model_config("level_model")
         if self.model_config:
@@ -32,23 +182,61 @@ class LevelAnalysisService:
             self.port = port
             self.base_url = f"http://localhost:{self.port}"
         
-        self.confirmed_levels = []  # 存储已确认的层级信息
-        self.level_path_stack = []  # 存储当前活跃的层级路径栈
+        # 已确认的层级、层级路径栈、层级上下文（紧凑数组 + 父指针，路径按需推导）
+        self.state = LevelHierarchyState()
+        
+        # 规则快速通道：编号格式明确的层级不调用AI
+        self.rule_classifier = LevelRuleClassifier() if LEVEL_RULE_CONFIG["enabled"] else None
+        self._level_predictor = LevelRuleClassifier()  # 推测并行时猜测后续层级
+        self.speculation_stats = {}
+        self.llm_client = llm_client
+        
+        # 熔断：服务中途宕机时请求挂起等待恢复或快速失败，连续失败条目过多时中止本次运行
+        self.circuit_breaker = get_circuit_breaker("level_model")
+        self.failure_guard = RunFailureGuard(name="层级分析")
+        self._vllm_available = None  # 逐条调用模式下只在第一次请求前检查一次服务
+        
+        # token预算：上下文文本块裁剪和按输出长度分位数设置的 max_tokens
+        self.token_budget = get_token_budget("level")
+        self._run_max_tokens = None  # 本次运行固定使用的 max_tokens，见 run_max_tokens
         
-        # 新增：层级上下文传递相关
-        self.level_sequence = []  # 存储层级序列 [1, 2, 3, 3, 4, 4, 5, 2, 3, 3]
-        self.context_paths = []   # 存储每个位置的上文路径 [[], [0], [0,1], [0,2], ...]
-        self.current_context = [] # 当前维护的上下文路径
+        # 增量重新分析：user_prompt -> 上次的AI响应（见 seed_response_cache）
+        self.response_cache = {}
+        self.cache_stats = {"seeded": 0, "hits": 0}
         
         # 创建日志目录
         self.log_dir = "level_analysis_logs"
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir)
         
-        # 生成日志文件名
-        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        self.log_file = os.path.join(self.log_dir, f"level_analysis_log_{timestamp}.json")
-        self.detailed_log = []  # 存储详细日志
+        # 生成日志文件名（JSONL，每处理完一条追加一行；需要数组格式时用 convert_level_log.py 转换）
+        self.log_file = _new_log_file_path(self.log_dir)
+        self.log_writer = JsonlLogWriter(self.log_file)
+    
+    @property
+    def confirmed_levels(self) -> List[Dict[str, Any]]:
+        """已确认的层级信息（按需生成）"""
+        return [self.state.confirmed_level(i) for i in range(len(self.state))]
+    
+    @property
+    def level_path_stack(self) -> List[Any]:
+        """当前活跃的层级路径栈（从根到栈顶）"""
+        return self.state.path_stack()
+    
+    @property
+    def level_sequence(self) -> List[int]:
+        """层级序列 [1, 2, 3, 3, 4, 4, 5, 2, 3, 3]"""
+        return self.state.levels.tolist()
+    
+    @property
+    def context_paths(self) -> List[List[int]]:
+        """每个位置的上文路径 [[], [0], [0,1], [0,2], ...]（按需生成）"""
+        return [self.state.context_chain(i - 1) for i in range(len(self.state))]
+    
+    @property
+    def current_context(self) -> List[int]:
+        """当前的层级上下文"""
+        return self.state.context_chain()
     
     def log_step(self, step_name: str, data: Dict[str, Any]):
         """记录处理步骤到日志"""
@@ -67,7 +255,7 @@ class LevelAnalysisService:
                     "special_type": data["final_result"]["special_type"]
                 },
                 "context_path": data["final_result"]["context_path"],
-                "current_index": len(self.confirmed_levels) - 1 if self.confirmed_levels else -1,  # 新增：当前记录在confirmed_levels中的索引
+                "current_index": len(self.state) - 1,  # 新增：当前记录在confirmed_levels中的索引
                 "model_info": {
                     "model_name": "llama3.1_8b",
                     "base_model": "Meta-Llama-3.1-8B-Instruct",
@@ -77,21 +265,28 @@ class LevelAnalysisService:
                 "prompt_details": data.get("prompt_details", {}),  # 新增：prompt详情
                 "timestamp": datetime.datetime.now().isoformat()
             }
-            self.detailed_log.append(log_entry)
             
-            # 实时写入文件
+            # 追加写入（缓冲，按批刷盘）
             try:
-                with open(self.log_file, 'w', encoding='utf-8') as f:
-                    json.dump(self.detailed_log, f, ensure_ascii=False, indent=2)
+                self.log_writer.append(log_entry)
             except Exception as e:
                 print(f"写入日志文件失败: {str(e)}")
     
+    def close_log(self):
+        """处理完成后写完日志缓冲并落盘"""
+        try:
+            self.log_writer.close()
+        except Exception as e:
+            print(f"关闭日志文件失败: {str(e)}")
+    
     def get_log_file_path(self) -> str:
         """获取日志文件路径"""
         return self.log_file
     
     def check_vllm_service_status(self) -> bool:
-        """检查vLLM服务状态"""
+        """检查vLLM服务状态（未启动时由生命周期守护启动并等待就绪）"""
+        if not start_level_vllm_service():
+            return False
         try:
             # 使用正确的端口检查服务状态
             response = requests.get(f"{self.base_url}/v1/models", timeout=10)
@@ -105,26 +300,35 @@ class LevelAnalysisService:
             print(f"✗ vLLM服务连接失败 (端口: {self.port}): {str(e)}")
             return False
     
-    def call_vllm_api(self, messages: List[Dict[str, str]], max_tokens: int = 2000, max_retries: int = 3) -> str:
-        """调用vLLM API，专用于层级分析"""
-        # 启动服务（如果没启动）
-        start_level_vllm_service()
+    def call_vllm_api(self, messages: List[Dict[str, str]], max_tokens: int = None, max_retries: int = 3,
+                      stream_parser=None) -> str:
+        """
+        调用vLLM API，专用于层级分析
+        服务由 check_vllm_service_status 在第一次请求前启动，这里不再逐条启动；
+        失败后短暂退避重试；熔断断开或重试用完时熔断已断开，抛出 CircuitOpenError（由调用方挂起等待恢复）
+        启用流式时答案确定后即断开连接，返回已收到的文本（见 LEVEL_STREAMING_CONFIG）；
+        max_tokens 不传时按token预算（最近输出长度的分位数）设置，stream_parser 不传时按 LEVEL_STREAMING_CONFIG
+        """
+        stream_parser = stream_parser or level_stream_parser()
+        max_tokens = max_tokens or self.token_budget.max_tokens()
+        # 多LoRA模式下端口为共享服务的端口，model 为层级分析适配器名
+        lora_module_name = self.model_config["lora_module_name"] if self.model_config else "llama3.1_8b"
         
         # 打印调用的模型信息
         print(f"\n=== vLLM API调用信息 ===")
-        print(f"调用的微调模型: llama3.1_8b (LoRA微调模型)")
+        print(f"调用的微调模型: {lora_module_name} (LoRA微调模型)")
         print(f"基础模型: Meta-Llama-3.1-8B-Instruct")
         print(f"LoRA权重路径: /home/liuxinwei/Models/层级训练")
-        print(f"API端点: http://localhost:8202/v1/chat/completions")
+        endpoint_pool = get_endpoint_pool("level_model")
+        print(f"API端点: {', '.join(endpoint_pool.urls)}")
         
-        # 调用API
-        url = f"http://localhost:8202/v1/chat/completions"
+        # 调用API，每次尝试从地址池取在途请求最少的副本
         payload = {
-            "model": "llama3.1_8b",  # 修改为与vLLM服务启动时一致的模型名称
+            "model": lora_module_name,  # 与vLLM服务启动时的 --lora-modules 名称一致
             "messages": messages,
             "max_tokens": max_tokens,
             "temperature": 0.0,
-            "stream": False
+            "stream": stream_parser is not None
         }
         
         # 打印传入的prompt详情
@@ -134,15 +338,35 @@ class LevelAnalysisService:
             print(f"内容: {msg['content']}")
             print("-" * 50)
         
+        failed_endpoints = set()
         for attempt in range(max_retries):
+            probe = self.circuit_breaker.acquire()
+            endpoint = endpoint_pool.acquire(exclude=failed_endpoints)
+            endpoint_ok = False
             try:
+                url = f"{endpoint}/v1/chat/completions"
                 print(f"\n=== API调用 (第{attempt + 1}次) ===")
                 print(f"请求URL: {url}")
                 print(f"请求参数: model={payload['model']}, max_tokens={payload['max_tokens']}, temperature={payload['temperature']}")
                 
-                response = requests.post(url, json=payload, timeout=300)
+                response = requests.post(url, json=payload, timeout=300, stream=stream_parser is not None)
+                endpoint_ok = response.status_code < 500
                 print(f"响应状态码: {response.status_code}")
                 
+                if response.status_code == 200 and stream_parser is not None:
+                    parser = stream_parser()
+                    try:
+                        stopped_early = consume_stream(response.iter_lines(), parser, level_stream_stats)
+                    finally:
+                        # 提前结束时关闭连接，vLLM随即中止生成
+                        response.close()
+                    
+                    print(f"\n=== API返回结果（流式） ===")
+                    print(f"AI响应内容: {parser.text}")
+                    print(f"收到token: {parser.tokens}{'，答案确定后提前结束' if stopped_early else ''}")
+                    print("=" * 80)
+                    
+                    return parser.text
                 if response.status_code == 200:
                     result = response.json()
                     ai_response = result["choices"][0]["message"]["content"]
@@ -153,116 +377,38 @@ class LevelAnalysisService:
                     print("=" * 80)
                     
                     return ai_response
-                else:
-                    print(f"API调用失败，状态码: {response.status_code}")
-                    print(f"错误响应: {response.text}")
-                    if attempt < max_retries - 1:
-                        print(f"等待5秒后重试...")
-                        time.sleep(5)
-                        continue
-                    else:
-                        print("所有重试次数已用完，返回空字符串")
-                        return ""
+                print(f"API调用失败，状态码: {response.status_code}")
+                print(f"错误响应: {response.text}")
             except Exception as e:
                 print(f"API调用出错 (第{attempt + 1}次): {str(e)}")
-                if attempt < max_retries - 1:
-                    print(f"等待5秒后重试...")
-                    time.sleep(5)
-                    continue
-                else:
-                    print("所有重试次数已用完，返回空字符串")
-                    return ""
+            finally:
+                service_ok = endpoint_pool.release(endpoint, endpoint_ok)
+                self.circuit_breaker.release(service_ok, probe)
+                if not endpoint_ok:
+                    failed_endpoints.add(endpoint)
+            if attempt < max_retries - 1:
+                backoff = CIRCUIT_BREAKER_CONFIG["retry_backoff"] * 2 ** attempt
+                print(f"等待{backoff}秒后重试...")
+                time.sleep(backoff)
+        if self.circuit_breaker.state != CLOSED:
+            raise CircuitOpenError("层级分析重试用完时vLLM服务已熔断")
+        print("所有重试次数已用完，返回空字符串")
         return ""
     
-    def update_level_path_stack(self, new_level: int, item_data: Dict[str, Any]):
-        """
-        更新层级路径栈
-        实现"递归向上路径"算法
-        """
-        # 创建新的层级信息
-        level_info = {
-            "text": item_data["text"],
-            "isTitleMarked": item_data["isTitleMarked"],
-            "level": new_level,
-            "index": len(self.confirmed_levels),  # 记录在confirmed_levels中的索引
-            "special_type": item_data.get("special_type")  # 添加special_type信息
-        }
-        
-        # 更新层级路径栈
-        # 1. 移除所有大于等于新层级的节点
-        self.level_path_stack = [node for node in self.level_path_stack if node["level"] < new_level]
-        
-        # 2. 添加新节点
-        self.level_path_stack.append(level_info)
-        
-        print(f"更新层级路径栈: {[node['level'] for node in self.level_path_stack]}")
-        print(f"更新层级路径栈索引: {[node['index'] for node in self.level_path_stack]}")
-        print(f"更新层级路径栈special_type: {[node.get('special_type', 'None') for node in self.level_path_stack]}")
-    
-    def get_context_path(self) -> List[Dict[str, Any]]:
+    def get_context_path(self) -> List[Any]:
         """
         获取当前活跃的层级路径（递归父级路径）
-        返回递归向上路径中的节点
+        返回递归向上路径中的节点，"同属以往层级"的节点之前补充同级的上一个非特殊节点
         注意：这里返回的是处理当前文本之前的路径，不包含当前文本
         """
-        context_path = []
-        for node in self.level_path_stack:
-            # 如果是同属以往层级，补充同级的上一个非特殊节点
-            if node.get("special_type") == "同属以往层级":
-                for i in range(node["index"]-1, -1, -1):
-                    if (self.confirmed_levels[i]["level"] == node["level"] and
-                        self.confirmed_levels[i].get("special_type") != "同属以往层级"):
-                        # 只补充一次
-                        context_path.append({
-                            "text": self.confirmed_levels[i]["text"],
-                            "isTitleMarked": self.confirmed_levels[i]["isTitleMarked"],
-                            "level": self.confirmed_levels[i]["level"],
-                            "index": i
-                        })
-                        break
-            # 正常递归路径
-            context_path.append(node)
-        return context_path
+        return self.state.context_path_nodes()
     
-    def get_extended_context_path(self) -> List[Dict[str, Any]]:
+    def get_extended_context_path(self) -> List[Any]:
         """
-        获取扩展的上下文路径
+        获取扩展的上下文路径：之前所有已确认的层级（按时间顺序）
         当上一个结果是"同属以往层级"时，需要带上更早的层级信息
         """
-        extended_path = []
-        
-        print(f"DEBUG: 开始扩展上下文路径，confirmed_levels长度: {len(self.confirmed_levels)}")
-        print(f"DEBUG: confirmed_levels: {[(i, level.get('special_type', 'None')) for i, level in enumerate(self.confirmed_levels)]}")
-        
-        # 当上一个结果是"同属以往层级"时，应该带上：
-        # 1. 之前所有层级（按时间顺序）
-        # 2. 当前这个"同属以往层级"的层级
-        
-        # 遍历所有confirmed_levels（除了最后一个，因为最后一个就是"同属以往层级"）
-        for i in range(len(self.confirmed_levels) - 1):
-            level_info = self.confirmed_levels[i]
-            print(f"DEBUG: 添加索引{i}: special_type={level_info.get('special_type', 'None')}")
-            extended_path.append({
-                "text": level_info["text"],
-                "isTitleMarked": level_info["isTitleMarked"],
-                "level": level_info["level"],
-                "index": i
-            })
-        
-        # 再加上当前这个"同属以往层级"的层级
-        if self.confirmed_levels:
-            last_level = self.confirmed_levels[-1]
-            print(f"DEBUG: 添加最后一个层级，索引{len(self.confirmed_levels) - 1}")
-            extended_path.append({
-                "text": last_level["text"],
-                "isTitleMarked": last_level["isTitleMarked"],
-                "level": last_level["level"],
-                "index": len(self.confirmed_levels) - 1
-            })
-        
-        print(f"DEBUG: 扩展上下文路径: {[node['level'] for node in extended_path]}")
-        print(f"DEBUG: 扩展上下文路径索引: {[node['index'] for node in extended_path]}")
-        return extended_path
+        return [self.state.node(i) for i in range(len(self.state))]
     
     def build_level_prompt(self, target_item: Dict[str, Any]) -> tuple:
         """构建层级判断的prompt"""
@@ -284,188 +430,47 @@ class LevelAnalysisService:
                 # 取较小的位置（更早出现的标点）
                 return text[:min(comma_pos, period_pos)]
         
-        system_prompt = """你是一个文本层级梳理专家，你的任务是**判断目标文本块的层级**
-
-你会得到四种信息，辅助你确定目标文本块的层级：
-1. 目标文本块的内容：这个文本块的内容是一个层级的开头部分，具有层级的内容与结构特征，可以方便你进行判断；
-2. 层级主题：
-（1）结构层级：这里指的从这里开始可能是一个结构层级，是整个文章的书写框架结构标题；
-（2）段落层级：这里指的从这里开始可能是一个段落层级，是结构下文章段落内的叙述标题；
-3. 目标文本块的前文相关递进层级：通过对比以往的层级，辅助你判断目标文本块作为层级开头应该属于什么层级；
-
-**注意**：文本的层级计数永远都是按序往后计数的，绝对不可能出现后文的层级数字比前文小，如果出现说明不是同一层级！
-
-回答格式：
-如果是正常情况判断请回答：因为目标文本开头是前文XXX，且XXX，所以判断为{层级X}。
-如果是特殊情况判断请回答：因为目标文本开头是前文XXX，且XXX，但我认为{特殊原因}，所以判断为{层级X}。
-特殊原因：
-（1）层级主题错误：段落和结构层级混淆；
-（2）同属以往层级：是新层级格式，但是明显不属于上一级层级；
-（3）层级顺序混乱：是旧层级格式，但不是往下计数，说明不是同一层级；
-（4）总分结构后的总层级：总分总后的总结语句，一般属于当前同一层级；
-（5）层级为模版内部层级：层级标记为99级，特指文本内部的模版内部层级。
-
-举例1：
-我们已经确认：
-结构层级1："企业设立管理"，
-
-请问结构层级： "第一节 登记信息确认",是第几层级的开头内容？
-
-回答：因为目标文本开头为前文不具有的一种新层级格式，且与上一级同为结构层级，所以判断为{层级2}。
-
-举例2：
-我们已经确认：
-结构层级1："中华人民共和国个人所得税法"，
-结构层级2："第一条【征税范围】"，
-
-请问段落层级： "第一条在中国境内有住所，...",是第几层级的开头内容？
-
-回答：因为目标文本开头为前文不具有的一种新层级格式，且是上一级结构层级下的第一个段落层级，所以判断为{层级3}。
-
-举例3：
-我们已经确认：
-段落层级1："28.资源综合利用企业受到税务处罚能否继续享受增值税即征即退？"，
-段落层级2："问题："，
-段落层级3： "（2）依据《税收征收管理法》第六十八条规定，..."，
-段落层级3："回复："，
-
-请问段落层级： "（1）集团公司采取资金池模式集中资金管理是常规做法，...",是第几层级的开头内容？
-
-回答：因为目标文本开头是前文具有的一种旧层级格式，且与上一级同为段落层级，但我认为{层级顺序混乱}，所以判断为{层级4}。
-
-举例4：
-我们已经确认：
-结构层级1："第一章 税收的产生与发展"，
-段落层级2："内容提要：税收是政府为了实现其职能、满足社会公共需要，..."，
-段落层级2："导入案例：西方税与东方税的交汇 国王与税收 "，
-
-请问结构层级："第一节 税收词源",是第几层级的开头内容？
-
-回答：因为目标文本开头为前文不具有的一种新层级格式，且是段落层级回到结构层级，但我认为{同属以往层级}，所以判断为{层级2}。
-
-举例5：
-我们已经确认：
-结构层级1："第一章 税收的产生与发展"，
-结构层级2："第二节 税收的产生"，
-结构层级3："一、税收产生的前提条件"，
-段落层级4： "3.社会条件：经常化的社会公共需要出现"，
-段落层级5："（4）社会公共需要是一种具有外部性的需求，..."，
-
-请问段落层级： "这些特征确定了社会公共需求是一个社会需求不可或缺的部分，...",是第几层级的开头内容？
-
-回答：因为目标文本开头是前文具有的一种旧层级格式，且与上一级同为段落层级，但我认为{总分结构后的总层级}，所以判断为{层级5}。
-
-举例6：
-我们已经确认：
-结构层级1："税款缴纳及退税管理"，
-结构层级2："第二节 退（抵）税"，
-结构层级3："四、留抵退税"，
-结构层级4："（一）一般企业留抵退税"，
-段落层级5： "3.操作办法。"，
-段落层级6："（5）税务机关对增值税涉税风险疑点进行排查时，..."，
-
-请问结构层级： "4.附加税费的处理",是第几层级的开头内容？
-
-回答：因为目标文本开头是前文具有的一种旧层级格式，且是段落层级回到结构层级，但我认为{层级主题错误}，所以判断为{层级5}。"""
+        context_path = self.get_context_path()
+        texts = [truncate_text(level_info["text"]) for level_info in context_path] + [truncate_text(target_item["text"])]
         
-        system_prompt = system_prompt.strip() + "\n请注意，第一条文本一定是层级1，后续层级在此基础上顺延。"
+        # 没有逗号/句号的长文本截断后仍然很长，按token预算裁剪（保留开头的编号格式）
+        fixed_tokens = self.token_budget.count(self.format_level_prompt(context_path, target_item, [""] * len(texts)))
+        texts = self.token_budget.fit_blocks(texts, fixed_tokens)
         
+        return LEVEL_SYSTEM_PROMPT, self.format_level_prompt(context_path, target_item, texts)
+    
+    def format_level_prompt(self, context_path: List[Any], target_item: Dict[str, Any], texts: List[str]) -> str:
+        """按层级路径和（已截断的）文本构建user_prompt，texts 依次为路径中的各层级和目标文本"""
         # 构建递归向上路径的上下文信息
         context_info = ""
-        context_path = self.get_context_path()
         
         if context_path:
             context_info = "我们已经确认：\n"
-            for i, level_info in enumerate(context_path):
+            for level_info, truncated_text in zip(context_path, texts):
                 level_type = "结构层级" if level_info["isTitleMarked"] == "section level" else "段落层级"
-                truncated_text = truncate_text(level_info["text"])
                 context_info += f"{level_type}{level_info['level']}：\"{truncated_text}\"，\n"
             context_info += "\n"
         
         # 构建目标文本块信息
         target_type = "结构层级" if target_item["isTitleMarked"] == "section level" else "段落层级"
-        truncated_target_text = truncate_text(target_item["text"])
-        target_info = f"请问{target_type}： \"{truncated_target_text}\",是第几层级的开头内容？"
+        target_info = f"请问{target_type}： \"{texts[-1]}\",是第几层级的开头内容？"
         
         # 按照新格式构建user_prompt
-        user_prompt = f"需要分析的这段语句是:\"{context_info}{target_info}\"\n请根据问题要求与问题进行回答"
-        
-        return system_prompt, user_prompt
+        return f"需要分析的这段语句是:\"{context_info}{target_info}\"\n请根据问题要求与问题进行回答"
     
     def parse_level_response(self, response: str) -> Dict[str, Any]:
-        """解析AI返回的层级判断结果"""
-        result = {
-            "level": None,
-            "reasoning": response,
-            "is_special_case": False,
-            "special_type": None
-        }
-        
-        try:
-            # 提取层级数字 - 支持多种格式
-            # 1. 尝试匹配 {层级X} 格式
-            level_match = re.search(r'\{层级([一二三四五六七八九十\d]+)\}', response)
-            if level_match:
-                level_str = level_match.group(1)
-                # 转换中文数字为阿拉伯数字
-                chinese_to_arabic = {
-                    '一': 1, '二': 2, '三': 3, '四': 4, '五': 5,
-                    '六': 6, '七': 7, '八': 8, '九': 9, '十': 10
-                }
-                if level_str in chinese_to_arabic:
-                    result["level"] = chinese_to_arabic[level_str]
-                else:
-                    result["level"] = int(level_str)
-            
-            # 2. 如果上面没匹配到，尝试匹配 层级X 格式
-            if result["level"] is None:
-                level_match = re.search(r'层级(\d+)', response)
-                if level_match:
-                    result["level"] = int(level_match.group(1))
-            
-            # 3. 如果还没匹配到，尝试匹配 第X层级 格式
-            if result["level"] is None:
-                level_match = re.search(r'第([一二三四五六七八九十\d]+)层级', response)
-                if level_match:
-                    level_str = level_match.group(1)
-                    chinese_to_arabic = {
-                        '一': 1, '二': 2, '三': 3, '四': 4, '五': 5,
-                        '六': 6, '七': 7, '八': 8, '九': 9, '十': 10
-                    }
-                    if level_str in chinese_to_arabic:
-                        result["level"] = chinese_to_arabic[level_str]
-                    else:
-                        result["level"] = int(level_str)
-            
-            # 判断是否为特殊情况并提取具体类型
-            if "但我认为" in response:
-                result["is_special_case"] = True
-                # 提取特殊情况类型
-                special_match = re.search(r'但我认为\{([^}]+)\}', response)
-                if special_match:
-                    result["special_type"] = special_match.group(1)
-                else:
-                    # 兼容旧格式和新格式
-                    if "层级主题错误" in response:
-                        result["special_type"] = "层级主题错误"
-                    elif "层级顺序混乱" in response or "顺序混乱" in response:
-                        result["special_type"] = "层级顺序混乱"
-                    elif "同属以往层级" in response:
-                        result["special_type"] = "同属以往层级"
-                    elif "总分结构后的总层级" in response:
-                        result["special_type"] = "总分结构后的总层级"
-                    elif "层级为模版内部层级" in response:
-                        result["special_type"] = "层级为模版内部层级"
-                    elif "层级格式不同却语义相关" in response:
-                        result["special_type"] = "层级格式不同却语义相关"
-            
-        except Exception as e:
-            print(f"解析层级响应时出错: {str(e)}")
-        
-        return result
+        """解析AI返回的层级判断结果（见 llm_response_parser.parse_level_response）"""
+        return parse_level_response(response)
     
-    def process_single_item(self, item_data: Dict[str, Any]) -> Dict[str, Any]:
-        """处理单个数据项的层级判断"""
+    def process_single_item(self, item_data: Dict[str, Any], request_llm=None) -> Dict[str, Any]:
+        """
+        处理单个数据项的层级判断：prepare_item → (需要时)调用AI → commit_item
+
+        Args:
+            item_data: 数据项
+            request_llm: 调用AI的函数 request_llm(prepared) -> ai_response，vLLM不可用时返回None；
+                         默认为 request_level_llm，推测并行模式下传入复用推测结果的函数
+        """
         # 新增：空文本直接跳过
         if not item_data.get("text") or item_data["text"].strip() == "":
             print("跳过空文本块")
@@ -481,292 +486,329 @@ class LevelAnalysisService:
                 "context_path": []
             }
         try:
-            # 获取调用AI之前的context_path
-            context_path_before = self.get_context_path()
+            prepared = self.prepare_item(item_data)
+            if prepared["kind"] == "llm":
+                ai_response = self.request_llm_guarded(request_llm or self.request_level_llm, prepared)
+                self.resolve_llm_response(prepared, ai_response)
+            return self.commit_item(item_data, prepared)
             
-            # 检查是否是第一条数据
-            is_first_item = len(self.confirmed_levels) == 0
+        except RunAbortedError as e:
+            print(f"❌ {str(e)}")
+            self.close_log()
+            raise
+        except Exception as e:
+            error_msg = f"处理单个数据项时出错: {str(e)}"
+            print(error_msg)
             
-            if is_first_item:
-                # 第一条数据直接设置为层级1，不调用AI
-                print(f"\n{'='*80}")
-                print(f"=== 处理第一条数据项 ===")
-                print(f"数据ID: {item_data.get('id', '未知')}")
-                print(f"目标文本: {item_data['text']}")
-                print(f"标记类型: {item_data['isTitleMarked']}")
-                print(f"自动设置为层级1（第一条数据）")
-                print(f"{'='*80}")
-                
-                # 直接设置层级1
-                parsed_result = {
-                    "level": 1,
-                    "reasoning": "第一条文本自动设置为层级1",
-                    "is_special_case": False,
-                    "special_type": None
-                }
-                
-                # 更新层级路径栈、层级序列和层级上下文传递
-                current_index = len(self.level_sequence)  # 当前元素在层级序列中的索引
-                current_context_path = self.current_context.copy()
-                
-                # 更新层级路径栈
-                item_data_with_special = {
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "special_type": parsed_result["special_type"]
-                }
-                self.update_level_path_stack(parsed_result['level'], item_data_with_special)
-                
-                # 更新层级序列
-                self.level_sequence.append(parsed_result['level'])
-                
-                # 更新层级上下文传递
-                self.update_hierarchical_context(parsed_result['level'], current_index)
-                
-                # 添加到已确认层级列表
-                confirmed_level_info = {
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "level": parsed_result["level"],
-                    "reasoning": parsed_result["reasoning"],
-                    "is_special_case": parsed_result["is_special_case"],
-                    "special_type": parsed_result["special_type"],
-                    "context_path": current_context_path
-                }
-                self.confirmed_levels.append(confirmed_level_info)
-                
-                # 记录处理完成
-                self.log_step("处理完成", {
-                    "final_result": {
-                        "id": item_data.get("id"),
-                        "text": item_data["text"],
-                        "isTitleMarked": item_data["isTitleMarked"],
-                        "level": parsed_result["level"],
-                        "reasoning": parsed_result["reasoning"],
-                        "is_special_case": parsed_result["is_special_case"],
-                        "special_type": parsed_result["special_type"],
-                        "context_path": current_context_path,
-                        "ai_response": "第一条数据，未调用AI"
-                    },
-                    "prompt_details": {
-                        "system_prompt": "第一条数据，未调用AI",
-                        "user_prompt": "第一条数据，未调用AI",
-                        "messages": []
-                    }
-                })
-                
-                # 返回处理结果
-                return {
-                    "id": item_data.get("id"),
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "level": parsed_result["level"],
-                    "reasoning": parsed_result["reasoning"],
-                    "is_special_case": parsed_result["is_special_case"],
-                    "special_type": parsed_result["special_type"],
-                    "ai_response": "第一条数据，未调用AI",
-                    "context_path": current_context_path
-                }
+            return {
+                "id": item_data.get("id"),
+                "text": item_data["text"],
+                "isTitleMarked": item_data["isTitleMarked"],
+                "level": None,
+                "reasoning": f"处理出错: {str(e)}",
+                "is_special_case": False,
+                "special_type": None,
+                "ai_response": "",
+                "context_path": []
+            }
+    
+    def seed_response_cache(self, previous_items: List[Dict[str, Any]]) -> int:
+        """
+        用上一次分析的结果预填AI响应缓存（增量重新分析）
+        按顺序回放上次的层级结果，推算出当时每条实际发送的user_prompt，记下对应的AI响应。
+        本次处理时prompt完全一致（上下文路径和目标文本都没变）的条目直接复用响应：
+        未修改的前缀全部命中，第一处修改之后重新逐条推理，上下文路径恢复一致的后续条目仍会命中。
+        
+        Args:
+            previous_items: 上次分析的版本中按顺序的条目
+                [{"text", "isTitleMarked"（库中保存的值，层级主题错误时已翻转）, "level", "reasoning"}]
+        
+        Returns:
+            int: 写入缓存的条数
+        """
+        state = _SpeculativeState(self)
+        seeded = 0
+        for item in previous_items:
+            level = item.get("level")
+            if level is None:
+                # 上次未得到层级的条目不会进入状态
+                continue
+            reasoning = item.get("reasoning") or ""
+            parsed = self.parse_level_response(reasoning)
+            special_type = parsed["special_type"] if parsed["level"] == level else None
             
-            # 从第二条开始，正常调用AI进行层级判断
-            # 构建prompt
-            system_prompt, user_prompt = self.build_level_prompt(item_data)
+            # 层级主题错误时库中保存的是翻转后的标记，当时传给AI的是翻转前的
+            input_title_mark = item["isTitleMarked"]
+            if special_type == "层级主题错误":
+                input_title_mark = flip_title_mark(input_title_mark)
             
-            # 构建消息
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ]
+            if (len(state) > 0 and parsed["level"] == level and not reasoning.startswith("规则判断")
+                    and LLM_ANSWER_PATTERN.search(reasoning)):
+                _, user_prompt = state.build_level_prompt({"text": item["text"], "isTitleMarked": input_title_mark})
+                self.response_cache[user_prompt] = reasoning
+                seeded += 1
             
+            state.push({"text": item["text"], "isTitleMarked": item["isTitleMarked"]}, level, special_type)
+        
+        self.cache_stats["seeded"] += seeded
+        print(f"增量分析: 从上次结果中预填 {seeded} 条AI响应")
+        return seeded
+    
+    def prepare_item(self, item_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        根据当前状态决定数据项的判断方式（不修改状态）
+        - first：第一条数据，直接为层级1
+        - rule：编号格式明确，按规则判断
+        - llm：需要调用AI，返回构建好的prompt
+        """
+        # 检查是否是第一条数据
+        if len(self.state) == 0:
+            # 第一条数据直接设置为层级1，不调用AI
             print(f"\n{'='*80}")
-            print(f"=== 处理数据项 ===")
+            print(f"=== 处理第一条数据项 ===")
             print(f"数据ID: {item_data.get('id', '未知')}")
             print(f"目标文本: {item_data['text']}")
             print(f"标记类型: {item_data['isTitleMarked']}")
-            print(f"当前层级路径栈: {[node['level'] for node in self.level_path_stack]}")
-            print(f"当前层级序列: {self.level_sequence}")
-            print(f"当前层级上下文: {self.current_context}")
+            print(f"自动设置为层级1（第一条数据）")
             print(f"{'='*80}")
-            
-            # 检查vLLM服务状态
-            if not self.check_vllm_service_status():
-                print("vLLM服务不可用，使用默认层级1")
-                # 当vLLM服务不可用时，使用默认层级1
-                parsed_result = {
+            return {
+                "kind": "first",
+                "parsed_result": {
+                    "level": 1,
+                    "reasoning": "第一条文本自动设置为层级1",
+                    "is_special_case": False,
+                    "special_type": None
+                },
+                "ai_response": "第一条数据，未调用AI",
+                "system_prompt": "第一条数据，未调用AI",
+                "user_prompt": "第一条数据，未调用AI",
+                "messages": []
+            }
+        
+        # 编号格式明确的情况（同一编号样式的下一个序号）直接按规则判断，不调用AI
+        rule_result = self.rule_classifier.classify(item_data, self.level_path_stack) if self.rule_classifier else None
+        if rule_result is not None:
+            print(f"✅ 规则判断: 层级{rule_result['level']}，{rule_result['reasoning']}")
+            return {
+                "kind": "rule",
+                "parsed_result": rule_result,
+                "ai_response": RULE_AI_RESPONSE,
+                "system_prompt": RULE_AI_RESPONSE,
+                "user_prompt": RULE_AI_RESPONSE,
+                "messages": []
+            }
+        
+        # 从第二条开始，正常调用AI进行层级判断
+        # 构建prompt
+        system_prompt, user_prompt = self.build_level_prompt(item_data)
+        
+        # 构建消息
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
+        
+        print(f"\n{'='*80}")
+        print(f"=== 处理数据项 ===")
+        print(f"数据ID: {item_data.get('id', '未知')}")
+        print(f"目标文本: {item_data['text']}")
+        print(f"标记类型: {item_data['isTitleMarked']}")
+        print(f"当前层级路径栈: {[node['level'] for node in self.level_path_stack]}")
+        print(f"当前层级上下文: {self.current_context}")
+        print(f"{'='*80}")
+        
+        return {
+            "kind": "llm",
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "messages": messages
+        }
+    
+    def request_llm_guarded(self, request_llm, prepared: Dict[str, Any]) -> Any:
+        """
+        调用AI并计入本次运行的连续失败数：服务不可用（None）、重试用完（空字符串）、熔断拒绝都算失败
+
+        Raises:
+            RunAbortedError: 连续失败条目达到 run_abort_failures，或熔断挂起等待 park_timeout 后服务仍未恢复
+        """
+        try:
+            ai_response = request_llm(prepared)
+        except CircuitOpenError as e:
+            if self.circuit_breaker.park_timeout:
+                # 已经挂起等待了 park_timeout，服务仍未恢复，不再逐条尝试
+                raise RunAbortedError(f"层级分析vLLM服务 {self.circuit_breaker.park_timeout}秒内未恢复，中止运行: {str(e)}")
+            self.failure_guard.record(False, str(e))
+            raise
+        self.failure_guard.record(bool(ai_response), "vLLM服务不可用" if ai_response is None else "AI响应为空")
+        return ai_response
+    
+    def request_level_llm(self, prepared: Dict[str, Any]) -> Any:
+        """调用AI判断层级并记录输出长度（用于max_tokens）；vLLM服务不可用时返回None"""
+        ai_response, output = self.fetch_level_llm(prepared)
+        self.record_level_output(ai_response, output)
+        return ai_response
+    
+    def record_level_output(self, ai_response: Any, output: Dict[str, Any]):
+        """
+        记录被采用的AI响应的输出长度：流式提前结束的回答不是完整长度，不作为分位数样本，
+        否则 max_tokens 按截断后的长度学习，每 calibration_every 个读完整个回答的校准请求也会被截断
+        """
+        if output is None or output["stopped_early"]:
+            return
+        self.token_budget.record_output(ai_response, max_tokens=output["max_tokens"])
+    
+    def fetch_level_llm(self, prepared: Dict[str, Any]):
+        """
+        调用AI判断层级（只依赖prepared中的消息，可以在其它线程中执行），不记录输出长度：
+        推测并行时结果可能被丢弃，只有被采用的结果才由 record_level_output 计入输出长度的统计
+        
+        Returns:
+            tuple: (AI响应，vLLM服务不可用时为None;
+                    本次请求的 {"max_tokens", "stopped_early"}，命中缓存或服务不可用时为None)
+        """
+        cached = self.response_cache.get(prepared["user_prompt"])
+        if cached is not None:
+            self.cache_stats["hits"] += 1
+            return cached, None
+        max_tokens = self.run_max_tokens()
+        stream_parser, parsers = self._tracked_stream_parser()
+        if self.llm_client is not None:
+            # 共享客户端：服务状态由调度器在文档开始前检查，这里不再逐条检查
+            ai_response = self.llm_client(prepared["messages"], max_tokens, stream_parser)
+        else:
+            # 只在第一次请求前检查（需要时启动）服务，之后服务中途故障由熔断器处理，不再逐条检查
+            if self._vllm_available is None:
+                self._vllm_available = self.check_vllm_service_status()
+            if not self._vllm_available:
+                return None, None
+            # 熔断断开时按配置挂起等待恢复后重新请求
+            ai_response = self.circuit_breaker.call(self.call_vllm_api, prepared["messages"], max_tokens,
+                                                    stream_parser=stream_parser)
+        # 每次尝试新建一个解析器，返回的是最后一次尝试收到的文本
+        return ai_response, {"max_tokens": max_tokens, "stopped_early": bool(parsers) and parsers[-1].stopped_early}
+    
+    def run_max_tokens(self) -> int:
+        """
+        本次运行（一个文档）所有请求使用的 max_tokens：第一次请求前按token预算确定，之后不随输出长度样本变化。
+        推测请求在发出时就要确定 max_tokens，按全局预算的当前值会与逐条处理时不同（样本在提交时才记录，
+        其它文档也在同时记录），固定下来后推测并行发出的每个请求与逐条处理完全一致
+        """
+        if self._run_max_tokens is None:
+            self._run_max_tokens = self.token_budget.max_tokens()
+        return self._run_max_tokens
+    
+    @staticmethod
+    def _tracked_stream_parser():
+        """
+        流式解析器类的包装，记下每次尝试新建的解析器，用于判断返回的回答是否提前结束
+        
+        Returns:
+            tuple: (传给客户端的 stream_parser，未启用流式时为None; 已新建的解析器列表)
+        """
+        parser_cls = level_stream_parser()
+        parsers = []
+        if parser_cls is None:
+            return None, parsers
+        
+        def new_parser():
+            parser = parser_cls()
+            parsers.append(parser)
+            return parser
+        return new_parser, parsers
+    
+    def resolve_llm_response(self, prepared: Dict[str, Any], ai_response: Any):
+        """把AI响应解析为层级结果，写入prepared"""
+        if ai_response is None:
+            print("vLLM服务不可用，使用默认层级1")
+            # 当vLLM服务不可用时，使用默认层级1
+            prepared.update({
+                "parsed_result": {
                     "level": 1,
                     "reasoning": "vLLM服务不可用，使用默认层级1",
                     "is_special_case": False,
                     "special_type": None
-                }
-                
-                # 更新层级路径栈、层级序列和层级上下文传递
-                current_index = len(self.level_sequence)  # 当前元素在层级序列中的索引
-                actual_context_path = self.get_context_path()
-                actual_context_indices = [node['index'] for node in actual_context_path]
-                
-                # 更新层级路径栈
-                item_data_with_special = {
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "special_type": parsed_result["special_type"]
-                }
-                self.update_level_path_stack(parsed_result['level'], item_data_with_special)
-                
-                # 更新层级序列
-                self.level_sequence.append(parsed_result['level'])
-                
-                # 更新层级上下文传递
-                self.update_hierarchical_context(parsed_result['level'], current_index)
-                
-                # 添加到已确认层级列表
-                confirmed_level_info = {
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "level": parsed_result["level"],
-                    "reasoning": parsed_result["reasoning"],
-                    "is_special_case": parsed_result["is_special_case"],
-                    "special_type": parsed_result["special_type"],
-                    "context_path": actual_context_indices
-                }
-                self.confirmed_levels.append(confirmed_level_info)
-                
-                # 记录处理完成
-                self.log_step("处理完成", {
-                    "final_result": {
-                        "id": item_data.get("id"),
-                        "text": item_data["text"],
-                        "isTitleMarked": item_data["isTitleMarked"],
-                        "level": parsed_result["level"],
-                        "reasoning": parsed_result["reasoning"],
-                        "is_special_case": parsed_result["is_special_case"],
-                        "special_type": parsed_result["special_type"],
-                        "context_path": actual_context_indices,
-                        "ai_response": "vLLM服务不可用，使用默认层级1"
-                    },
-                    "prompt_details": {
-                        "system_prompt": "vLLM服务不可用",
-                        "user_prompt": "vLLM服务不可用",
-                        "messages": []
-                    }
-                })
-                
-                # 返回处理结果
-                return {
-                    "id": item_data.get("id"),
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "level": parsed_result["level"],
-                    "reasoning": parsed_result["reasoning"],
-                    "is_special_case": parsed_result["is_special_case"],
-                    "special_type": parsed_result["special_type"],
-                    "ai_response": "vLLM服务不可用，使用默认层级1",
-                    "context_path": actual_context_indices
-                }
-            
-            # 调用API
-            ai_response = self.call_vllm_api(messages)
-            
-            # 解析响应
-            parsed_result = self.parse_level_response(ai_response)
+                },
+                "ai_response": "vLLM服务不可用，使用默认层级1",
+                "system_prompt": "vLLM服务不可用",
+                "user_prompt": "vLLM服务不可用",
+                "messages": []
+            })
+            return
+        
+        # 解析响应
+        parsed_result = self.parse_level_response(ai_response)
+        
+        print(f"\n=== 解析结果 ===")
+        print(f"解析结果: 层级{parsed_result['level']}")
+        if parsed_result['is_special_case']:
+            print(f"特殊情况: {parsed_result['special_type']}")
+        print(f"推理过程: {parsed_result['reasoning']}")
+        print(f"{'='*80}")
+        
+        prepared["parsed_result"] = parsed_result
+        prepared["ai_response"] = ai_response
+    
+    def commit_item(self, item_data: Dict[str, Any], prepared: Dict[str, Any]) -> Dict[str, Any]:
+        """按判断结果更新层级路径栈、层级序列、层级上下文和已确认层级列表，并记录日志"""
+        parsed_result = prepared["parsed_result"]
+        ai_response = prepared["ai_response"]
+        
+        # 处理层级主题错误
+        if parsed_result['is_special_case'] and parsed_result['special_type'] == "层级主题错误":
+            print(f"\n{'='*80}")
+            print(f"=== 检测到层级主题错误，需要翻转标记类型 ===")
+            print(f"原始AI响应: {ai_response}")
+            print(f"原始标记类型: {item_data['isTitleMarked']}")
             
-            print(f"\n=== 解析结果 ===")
-            print(f"解析结果: 层级{parsed_result['level']}")
-            if parsed_result['is_special_case']:
-                print(f"特殊情况: {parsed_result['special_type']}")
-            print(f"推理过程: {parsed_result['reasoning']}")
-            print(f"{'='*80}")
+            # 翻转当前项的标记类型
+            original_is_title_marked = item_data["isTitleMarked"]
+            if original_is_title_marked == "section level":
+                item_data["isTitleMarked"] = "context level"
+                print(f"✅ 将标记类型从 'section level' 改为 'context level'")
+            elif original_is_title_marked == "context level":
+                item_data["isTitleMarked"] = "section level"
+                print(f"✅ 将标记类型从 'context level' 改为 'section level'")
             
-            # 处理层级主题错误
-            if parsed_result['is_special_case'] and parsed_result['special_type'] == "层级主题错误":
-                print(f"\n{'='*80}")
-                print(f"=== 检测到层级主题错误，需要翻转标记类型 ===")
-                print(f"原始AI响应: {ai_response}")
-                print(f"原始标记类型: {item_data['isTitleMarked']}")
-                
-                # 翻转当前项的标记类型
-                original_is_title_marked = item_data["isTitleMarked"]
-                if original_is_title_marked == "section level":
-                    item_data["isTitleMarked"] = "context level"
-                    print(f"✅ 将标记类型从 'section level' 改为 'context level'")
-                elif original_is_title_marked == "context level":
-                    item_data["isTitleMarked"] = "section level"
-                    print(f"✅ 将标记类型从 'context level' 改为 'section level'")
-                
-                # 更新已确认层级列表中对应项的标记（如果存在）
-                if self.confirmed_levels:
-                    # 找到最后一个已确认的层级，更新其标记
-                    last_confirmed = self.confirmed_levels[-1]
-                    if last_confirmed["text"] == item_data["text"]:
-                        last_confirmed["isTitleMarked"] = item_data["isTitleMarked"]
-                        print(f"✅ 更新已确认层级列表中的标记类型")
-                
-                # 更新层级路径栈中对应项的标记（如果存在）
-                for stack_node in self.level_path_stack:
-                    if stack_node["text"] == item_data["text"]:
-                        stack_node["isTitleMarked"] = item_data["isTitleMarked"]
-                        print(f"✅ 更新层级路径栈中的标记类型")
-                        break
-                
-                print(f"标记翻转完成，当前项标记: {item_data['isTitleMarked']}")
-                print(f"{'='*80}")
+            # 更新已确认层级列表中对应项的标记（如果存在）
+            last_index = len(self.state) - 1
+            if last_index >= 0 and self.state.text(last_index) == item_data["text"]:
+                # 找到最后一个已确认的层级，更新其标记
+                self.state.set_title_mark(last_index, item_data["isTitleMarked"])
+                print(f"✅ 更新已确认层级列表中的标记类型")
             
-            # 如果成功解析到层级，更新层级路径栈、层级序列和层级上下文传递
-            if parsed_result['level'] is not None:
-                current_index = len(self.level_sequence)  # 当前元素在层级序列中的索引
-                
-                # 获取实际传给AI的上下文路径（在更新之前）
-                actual_context_path = self.get_context_path()
-                # 将实际上下文路径转换为索引列表
-                actual_context_indices = [node['index'] for node in actual_context_path]
-                
-                # 更新层级路径栈（原有逻辑）
-                item_data_with_special = {
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "special_type": parsed_result["special_type"]
-                }
-                self.update_level_path_stack(parsed_result['level'], item_data_with_special)
-                
-                # 新增：更新层级序列
-                self.level_sequence.append(parsed_result['level'])
-                
-                # 新增：更新层级上下文传递
-                self.update_hierarchical_context(parsed_result['level'], current_index)
-                
-                # 添加到已确认层级列表
-                confirmed_level_info = {
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "level": parsed_result["level"],
-                    "reasoning": parsed_result["reasoning"],
-                    "is_special_case": parsed_result["is_special_case"],
-                    "special_type": parsed_result["special_type"],
-                    "context_path": actual_context_indices  # 使用实际传给AI的上下文路径
-                }
-                self.confirmed_levels.append(confirmed_level_info)
+            # 更新层级路径栈中对应项的标记（如果存在）
+            for stack_node in self.level_path_stack:
+                if stack_node.text == item_data["text"]:
+                    self.state.set_path_title_mark(stack_node.index, item_data["isTitleMarked"])
+                    print(f"✅ 更新层级路径栈中的标记类型")
+                    break
             
-            # 记录处理完成（使用简化格式）
-            self.log_step("处理完成", {
-                "final_result": {
-                    "id": item_data.get("id"),
-                    "text": item_data["text"],
-                    "isTitleMarked": item_data["isTitleMarked"],
-                    "level": parsed_result["level"],
-                    "reasoning": parsed_result["reasoning"],
-                    "is_special_case": parsed_result["is_special_case"],
-                    "special_type": parsed_result["special_type"],
-                    "context_path": actual_context_indices if parsed_result['level'] is not None else [],
-                    "ai_response": ai_response
-                },
-                "prompt_details": {
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "messages": messages
-                }
-            })
+            print(f"标记翻转完成，当前项标记: {item_data['isTitleMarked']}")
+            print(f"{'='*80}")
+        
+        context_indices = []
+        # 如果成功解析到层级，更新层级路径栈、层级序列和层级上下文传递
+        if parsed_result['level'] is not None:
+            if prepared["kind"] == "first":
+                context_indices = self.current_context
+            else:
+                # 获取实际传给AI的上下文路径（在更新之前），转换为索引列表
+                context_indices = [node.index for node in self.get_context_path()]
             
-            # 返回处理结果
-            return {
+            # 更新层级路径栈、层级序列、层级上下文，并加入已确认层级
+            current_index = self.state.push(
+                item_data["text"], item_data["isTitleMarked"], parsed_result["level"],
+                special_type=parsed_result["special_type"],
+                is_special_case=parsed_result["is_special_case"],
+                reasoning=parsed_result["reasoning"]
+            )
+            print(f"更新层级路径栈: {[node.level for node in self.level_path_stack]}")
+            print(f"层级上下文更新: 新层级={parsed_result['level']}, 当前索引={current_index}, "
+                  f"更新后context: {self.current_context}")
+        
+        # 记录处理完成（使用简化格式）
+        self.log_step("处理完成", {
+            "final_result": {
                 "id": item_data.get("id"),
                 "text": item_data["text"],
                 "isTitleMarked": item_data["isTitleMarked"],
@@ -774,30 +816,39 @@ class LevelAnalysisService:
                 "reasoning": parsed_result["reasoning"],
                 "is_special_case": parsed_result["is_special_case"],
                 "special_type": parsed_result["special_type"],
-                "ai_response": ai_response,
-                "context_path": actual_context_indices if parsed_result['level'] is not None else []  # 使用实际传给AI的上下文路径
-            }
-            
-        except Exception as e:
-            error_msg = f"处理单个数据项时出错: {str(e)}"
-            print(error_msg)
-            
-            return {
-                "id": item_data.get("id"),
-                "text": item_data["text"],
-                "isTitleMarked": item_data["isTitleMarked"],
-                "level": None,
-                "reasoning": f"处理出错: {str(e)}",
-                "is_special_case": False,
-                "special_type": None,
-                "ai_response": "",
-                "context_path": []
+                "context_path": context_indices,
+                "ai_response": ai_response
+            },
+            "prompt_details": {
+                "system_prompt": prepared["system_prompt"],
+                "user_prompt": prepared["user_prompt"],
+                "messages": prepared["messages"]
             }
+        })
+        
+        # 返回处理结果
+        return {
+            "id": item_data.get("id"),
+            "text": item_data["text"],
+            "isTitleMarked": item_data["isTitleMarked"],
+            "level": parsed_result["level"],
+            "reasoning": parsed_result["reasoning"],
+            "is_special_case": parsed_result["is_special_case"],
+            "special_type": parsed_result["special_type"],
+            "ai_response": ai_response,
+            "context_path": context_indices
+        }
     
     def process_batch(self, data_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """批量处理数据列表"""
         # 新增：批量前过滤空文本
         data_list = [item for item in data_list if item.get("text") and item["text"].strip() != ""]
+        # 在发出任何请求（包括推测请求）之前确定本次运行的 max_tokens
+        self.run_max_tokens()
+        
+        if LEVEL_SPECULATION_CONFIG["enabled"] and LEVEL_SPECULATION_CONFIG["window"] > 1:
+            return self.process_batch_speculative(data_list, LEVEL_SPECULATION_CONFIG["window"])
+        
         results = []
         
         for i, item_data in enumerate(data_list):
@@ -808,23 +859,127 @@ class LevelAnalysisService:
         
         # 打印层级分析摘要
         self.print_hierarchy_analysis_summary()
+        self.close_log()
+        
+        return results
+    
+    def process_batch_speculative(self, data_list: List[Dict[str, Any]], window: int = 4) -> List[Dict[str, Any]]:
+        """
+        推测并行的批量处理，结果与逐条处理完全一致
+        
+        逐条处理时每条的prompt依赖之前所有条目的结果，同一文档同时只有一个请求。
+        这里在处理第i条之前，从当前真实状态出发，用规则/编号启发式猜出第i..i+window-1条的层级，
+        推算出这些条目的prompt并提前并发请求；之后仍按顺序提交，只有真实prompt与推测时一致的
+        结果才会被采用，不一致的条目按真实prompt重新请求。第i条总是基于真实状态推算，所以一定命中。
+        
+        Args:
+            data_list: 数据列表（已过滤空文本）
+            window: 推测窗口大小，即同一文档最多同时在途的请求数
+        """
+        results = []
+        inflight = {}  # 位置 -> (推测时的user_prompt, future)
+        stats = {"llm_items": 0, "issued": 0, "hits": 0, "mispredicted": 0, "reissued": 0}
+        
+        def issue(position, prepared, mispredicted=False):
+            stats["issued"] += 1
+            if mispredicted:
+                stats["mispredicted"] += 1
+            return executor.submit(self.fetch_level_llm, prepared)
+        
+        def adopt(future):
+            """采用推测请求的结果，只有这时才记录输出长度"""
+            ai_response, output = future.result()
+            self.record_level_output(ai_response, output)
+            return ai_response
+        
+        def request_llm_for(position):
+            def request_llm(prepared):
+                stats["llm_items"] += 1
+                speculated = inflight.pop(position, None)
+                if speculated is not None and speculated[0] == prepared["user_prompt"]:
+                    stats["hits"] += 1
+                    return adopt(speculated[1])
+                # 推测的上下文与真实上下文不一致，按真实prompt重新请求
+                stats["reissued"] += 1
+                if speculated is not None:
+                    speculated[1].cancel()
+                return adopt(issue(position, prepared))
+            return request_llm
+        
+        with ThreadPoolExecutor(max_workers=window, thread_name_prefix="level_speculative") as executor:
+            try:
+                for i, item_data in enumerate(data_list):
+                    print(f"处理第 {i+1}/{len(data_list)} 条数据（推测并行，窗口 {window}）...")
+                    self._speculate(data_list, i, window, inflight, issue)
+                    result = self.process_single_item(item_data, request_llm=request_llm_for(i))
+                    results.append(result)
+                    # 实际没有调用AI（第一条/规则判断）的条目，丢弃推测时发出的请求
+                    stale = inflight.pop(i, None)
+                    if stale is not None:
+                        stale[1].cancel()
+            finally:
+                # 正常结束或运行中止时，丢弃还没开始的推测请求
+                for _, future in inflight.values():
+                    future.cancel()
+        
+        wasted = stats["issued"] - stats["llm_items"]
+        print(f"推测并行统计: AI判断 {stats['llm_items']} 条，推测命中 {stats['hits']} 条，"
+              f"推测上下文有误重新请求 {stats['mispredicted'] + stats['reissued']} 次，"
+              f"共发出请求 {stats['issued']} 次（多余 {wasted} 次）")
+        self.speculation_stats = stats
+        
+        # 打印层级分析摘要
+        self.print_hierarchy_analysis_summary()
+        self.close_log()
         
         return results
     
+    def _speculate(self, data_list: List[Dict[str, Any]], start: int, window: int, inflight: Dict[int, Any], issue):
+        """从当前真实状态出发推算 start 之后 window 条的prompt，为还没有同样prompt在途的条目发出请求"""
+        state = _SpeculativeState(self)
+        for position in range(start, min(start + window, len(data_list))):
+            item_data = data_list[position]
+            
+            if len(state) == 0:
+                level = 1
+            else:
+                rule_result = self.rule_classifier.classify(item_data, state.level_path_stack) if self.rule_classifier else None
+                if rule_result is not None:
+                    level = rule_result["level"]
+                else:
+                    system_prompt, user_prompt = state.build_level_prompt(item_data)
+                    speculated = inflight.get(position)
+                    if speculated is None or speculated[0] != user_prompt:
+                        if speculated is not None:
+                            speculated[1].cancel()
+                        prepared = {
+                            "kind": "llm",
+                            "system_prompt": system_prompt,
+                            "user_prompt": user_prompt,
+                            "messages": [
+                                {"role": "system", "content": system_prompt},
+                                {"role": "user", "content": user_prompt},
+                            ]
+                        }
+                        inflight[position] = (user_prompt, issue(position, prepared, mispredicted=speculated is not None))
+                    level = self._level_predictor.predict_level(item_data, state.level_path_stack)
+            
+            state.push(item_data, level)
+    
     def get_confirmed_levels(self) -> List[Dict[str, Any]]:
         """获取已确认的层级列表"""
-        return self.confirmed_levels.copy()
+        return self.confirmed_levels
     
     def get_level_sequence(self) -> List[int]:
         """获取层级序列"""
-        return [level_info["level"] for level_info in self.confirmed_levels]
+        return self.level_sequence
     
     def get_hierarchical_contexts(self) -> List[List[int]]:
         """
         获取所有位置的层级上下文
         返回一个列表，其中每个子列表是对应元素（按其在原序列中的下标）的层级上下文（上文）
         """
-        return [path.copy() for path in self.context_paths]
+        return self.context_paths
     
     def get_level_sequence_with_contexts(self) -> Dict[str, Any]:
         """
@@ -832,10 +987,10 @@ class LevelAnalysisService:
         返回包含层级序列和每个位置上下文的完整信息
         """
         return {
-            "level_sequence": self.level_sequence.copy(),
-            "context_paths": self.context_paths.copy(),
-            "current_context": self.current_context.copy(),
-            "confirmed_levels": self.confirmed_levels.copy()
+            "level_sequence": self.level_sequence,
+            "context_paths": self.context_paths,
+            "current_context": self.current_context,
+            "confirmed_levels": self.confirmed_levels
         }
     
     def print_hierarchy_analysis_summary(self):
@@ -849,114 +1004,156 @@ class LevelAnalysisService:
         print(f"层级序列: {self.level_sequence}")
         print(f"当前上下文: {self.current_context}")
         print("\n各位置上下文:")
-        for i, context_path in enumerate(self.context_paths):
-            level = self.level_sequence[i] if i < len(self.level_sequence) else "未知"
-            text = self.confirmed_levels[i]["text"][:30] + "..." if i < len(self.confirmed_levels) else "未知"
-            print(f"  位置{i}: 层级{level} - 上文{context_path} - 文本: {text}")
+        for i in range(len(self.state)):
+            text = self.state.text(i)[:30] + "..."
+            print(f"  位置{i}: 层级{self.state.level(i)} - 上文{self.state.context_chain(i - 1)} - 文本: {text}")
         print("="*60)
 
-    def update_hierarchical_context(self, new_level: int, current_index: int):
-        """
-        更新层级上下文传递
-        实现层级结构传递算法
-        """
-        # 记录更新前的状态
-        self.log_step("层级上下文更新前", {
-            "current_context": self.current_context.copy(),
-            "new_level": new_level,
-            "current_index": current_index,
-            "level_sequence": self.level_sequence.copy()
-        })
-        
-        # 1. 记录当前元素的"上文"（处理当前元素之前的context）
-        self.context_paths.append(self.current_context.copy())
-        
-        # 2. 根据层级关系更新 current_context
-        if not self.current_context:  # a. 如果 current_context 为空 (处理第一个元素)
-            self.current_context.append(current_index)
-        else:
-            # 获取上一个在 current_context 中的元素的层级值
-            previous_level_index_in_context = self.current_context[-1]
-            previous_level_value = self.level_sequence[previous_level_index_in_context]
-            
-            if new_level == previous_level_value:  # b. 层级相等 (同级元素)
-                # 替换最后一个元素
-                self.current_context[-1] = current_index
-            elif new_level > previous_level_value:  # c. 层级递增 (深入子级)
-                # 追加到末尾
-                self.current_context.append(current_index)
-            else:  # new_level < previous_level_value // d. 层级骤降 (跳出父级)
-                matched_parent_index_in_context = -1
-                
-                # 从 current_context 末尾向前查找匹配的父级
-                for i in range(len(self.current_context) - 1, -1, -1):
-                    ancestor_index = self.current_context[i]
-                    ancestor_level_value = self.level_sequence[ancestor_index]
-                    
-                    if ancestor_level_value <= new_level:
-                        matched_parent_index_in_context = i
-                        break  # 找到第一个匹配的就停止
-                
-                if matched_parent_index_in_context != -1:
-                    # 截断 current_context 到 matched_parent_index_in_context 的前面（不包含它）
-                    # 然后将 current_index 追加到新的 context 列表的末尾
-                    self.current_context = self.current_context[:matched_parent_index_in_context]
-                    self.current_context.append(current_index)
-                else:
-                    # 如果没有找到匹配的父级，清空并只保留当前
-                    self.current_context.clear()
-                    self.current_context.append(current_index)
-        
-        # 记录更新后的状态
-        self.log_step("层级上下文更新后", {
-            "updated_context": self.current_context.copy(),
-            "context_paths": self.context_paths.copy(),
-            "level_sequence": self.level_sequence.copy()
-        })
-        
-        print(f"层级上下文更新: 新层级={new_level}, 当前索引={current_index}")
-        print(f"  更新前context: {self.context_paths[-1] if self.context_paths else []}")
-        print(f"  更新后context: {self.current_context}")
-    
     def get_current_context_path(self) -> List[int]:
         """
         获取当前的上文路径
         返回当前元素的上文（不包含当前元素）
         """
-        return self.current_context.copy()
+        return self.current_context
     
     def get_context_path_for_index(self, index: int) -> List[int]:
         """
         获取指定索引位置的上文路径
         """
-        if 0 <= index < len(self.context_paths):
-            return self.context_paths[index].copy()
+        if 0 <= index < len(self.state):
+            return self.state.context_chain(index - 1)
         return []
 
     def print_tree_view(self):
         """
         打印树状缩进的层级结构（带特殊标记）
         """
-        stack = []
-        for i, node in enumerate(self.confirmed_levels):
-            level = node["level"]
-            text = node["text"][:40] + ("..." if len(node["text"]) > 40 else "")
-            special = node.get("special_type")
+        depths = []  # 每一条在层级路径栈中的深度
+        for i in range(len(self.state)):
+            level = self.state.level(i)
+            full_text = self.state.text(i)
+            text = full_text[:40] + ("..." if len(full_text) > 40 else "")
+            special = self.state.special_type(i)
             marker = "⚠" if special == "同属以往层级" else "✓"
             special_info = f" ({special})" if special else ""
-            # 维护栈
-            while stack and self.confirmed_levels[stack[-1]]["level"] >= level:
-                stack.pop()
-            indent = "  " * len(stack)
+            parent = self.state.path_parent(i)
+            depths.append(depths[parent] + 1 if parent >= 0 else 0)
+            indent = "  " * depths[i]
             print(f"{indent}{marker} 层级{level}: {text}{special_info}")
-            stack.append(i)
 
-def update_pdf_json_hierarchy(data_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+class _SpeculativeState:
+    """
+    推测/回放用的状态分支：在服务当前状态之上追加条目，不复制已确认的数据，
+    复用 LevelAnalysisService 的 get_context_path / build_level_prompt，保证推算出的prompt与真实处理逐字节一致
+    """
+    
+    get_context_path = LevelAnalysisService.get_context_path
+    build_level_prompt = LevelAnalysisService.build_level_prompt
+    format_level_prompt = LevelAnalysisService.format_level_prompt
+    
+    def __init__(self, service: LevelAnalysisService):
+        self.state = service.state.branch()
+        self.token_budget = service.token_budget
+    
+    def __len__(self) -> int:
+        return len(self.state)
+    
+    @property
+    def level_path_stack(self) -> List[Any]:
+        return self.state.path_stack()
+    
+    def push(self, item_data: Dict[str, Any], level: int, special_type: str = None):
+        """与 commit_item 相同的状态变化（推测时special_type按无特殊情况处理）"""
+        self.state.push(item_data["text"], item_data["isTitleMarked"], level, special_type)
+
+# 层级结果写库：每块一条 UPDATE ... FROM (VALUES ...)，块内失败时二分定位到具体记录
+HIERARCHY_UPDATE_CHUNK_SIZE = 1000
+
+HIERARCHY_UPDATE_SQL = """
+    UPDATE pdf_json AS p
+    SET prompt_hierarchy = v.level,
+        prompt_hierarchy_reason = v.reason,
+        user_modified_level = COALESCE(v.user_modified_level, p.user_modified_level)
+    FROM (VALUES %s) AS v(id, level, reason, user_modified_level)
+    WHERE p.id = v.id
+    RETURNING p.id
+"""
+# VALUES 中的参数没有类型信息，显式转换，避免整列为NULL时推断成text
+HIERARCHY_UPDATE_TEMPLATE = "(%s::bigint, %s::integer, %s::text, %s::integer)"
+
+def build_hierarchy_update_rows(results: List[Dict[str, Any]]) -> List[tuple]:
+    """
+    把层级分析结果转换为待更新的行 (id, 层级, 原因, 新的user_modified_level或None)
+    层级主题错误的条目按修改后的isTitleMarked同时更新user_modified_level（结构层级1，段落层级2）
+    """
+    rows = []
+    for result in results:
+        if not result["id"] or result["level"] is None:
+            continue
+        new_user_modified_level = None
+        if result.get("is_special_case") and result.get("special_type") == "层级主题错误":
+            if result["isTitleMarked"] == "section level":
+                new_user_modified_level = 1
+            elif result["isTitleMarked"] == "context level":
+                new_user_modified_level = 2
+            else:
+                print(f"⚠️ 记录ID {result['id']} 未知的isTitleMarked类型: {result['isTitleMarked']}，不更新user_modified_level")
+        rows.append((result["id"], result["level"], result["reasoning"], new_user_modified_level))
+    return rows
+
+def bulk_update_pdf_json_hierarchy(cur, rows: List[tuple], chunk_size: int = HIERARCHY_UPDATE_CHUNK_SIZE) -> tuple:
+    """
+    批量写入层级结果（调用方负责提交事务）
+    每块一条语句，在SAVEPOINT中执行；某块失败时回滚到SAVEPOINT并二分重试，最终定位到出错的单条记录，
+    其它记录照常写入。
+    
+    Args:
+        cur: 数据库游标
+        rows: build_hierarchy_update_rows 的结果
+        chunk_size: 每条语句包含的记录数
+    
+    Returns:
+        tuple: (已更新的id集合, 失败记录列表 [{"id", "error"}])，数据库中不存在的id也记为失败
+    """
+    updated_ids = set()
+    failed = []
+    for start in range(0, len(rows), chunk_size):
+        _update_hierarchy_chunk(cur, rows[start:start + chunk_size], updated_ids, failed)
+    
+    failed_ids = {item["id"] for item in failed}
+    for row in rows:
+        if row[0] not in updated_ids and row[0] not in failed_ids:
+            failed.append({"id": row[0], "error": "记录不存在"})
+            failed_ids.add(row[0])
+    return updated_ids, failed
+
+def _update_hierarchy_chunk(cur, rows: List[tuple], updated_ids: set, failed: List[Dict[str, Any]]):
+    cur.execute("SAVEPOINT hierarchy_update")
+    try:
+        returned = execute_values(cur, HIERARCHY_UPDATE_SQL, rows, template=HIERARCHY_UPDATE_TEMPLATE,
+                                  page_size=len(rows), fetch=True)
+        cur.execute("RELEASE SAVEPOINT hierarchy_update")
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT hierarchy_update")
+        cur.execute("RELEASE SAVEPOINT hierarchy_update")
+        if len(rows) == 1:
+            failed.append({"id": rows[0][0], "error": str(e).strip()})
+            return
+        middle = len(rows) // 2
+        _update_hierarchy_chunk(cur, rows[:middle], updated_ids, failed)
+        _update_hierarchy_chunk(cur, rows[middle:], updated_ids, failed)
+        return
+    updated_ids.update(row[0] for row in returned)
+
+def update_pdf_json_hierarchy(data_list: List[Dict[str, Any]], llm_client=None,
+                              previous_items: List[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     更新pdf_json表中的层级信息
     
     Args:
         data_list: 包含id、text、isTitleMarked等字段的数据列表
+        llm_client: 可选的模型调用函数，见 LevelAnalysisService
+        previous_items: 可选，上一次分析的结果，用于增量重新分析，见 LevelAnalysisService.seed_response_cache
         
     Returns:
         Dict: 更新结果
@@ -967,10 +1164,14 @@ def update_pdf_json_hierarchy(data_list: List[Dict[str, Any]]) -> Dict[str, Any]
     
     try:
         # 初始化层级分析服务
-        level_service = LevelAnalysisService()
+        level_service = LevelAnalysisService(llm_client=llm_client)
+        if previous_items:
+            level_service.seed_response_cache(previous_items)
         
         # 处理数据
         results = level_service.process_batch(data_list)
+        if previous_items:
+            print(f"增量分析: 复用上次AI响应 {level_service.cache_stats['hits']} 条")
         
         # 新增：调试用，输出树状结构
         level_service.print_tree_view()
@@ -978,153 +1179,21 @@ def update_pdf_json_hierarchy(data_list: List[Dict[str, Any]]) -> Dict[str, Any]
         # 更新数据库
         conn = get_pg_conn()
         updated_count = 0
+        failed_updates = []
         
         try:
             with conn.cursor() as cur:
-                # 准备批量更新的数据
-                update_data = []
-                user_modified_level_updates = []  # 用于更新user_modified_level的数据
-                for result in results:
-                    if result["id"] and result["level"] is not None:
-                        update_data.append((result["level"], result["reasoning"], result["id"]))
-                        
-                        # 处理层级主题错误的user_modified_level更新
-                        if result.get("is_special_case") and result.get("special_type") == "层级主题错误":
-                            print(f"\n=== 处理层级主题错误的user_modified_level更新 ===")
-                            print(f"记录ID: {result['id']}")
-                            print(f"修改后的isTitleMarked: {result['isTitleMarked']}")
-                            
-                            # 根据修改后的isTitleMarked确定新的user_modified_level
-                            new_user_modified_level = None
-                            if result["isTitleMarked"] == "section level":
-                                new_user_modified_level = 1  # 结构层级
-                                print(f"✅ 设置user_modified_level为1（结构层级）")
-                            elif result["isTitleMarked"] == "context level":
-                                new_user_modified_level = 2  # 段落层级
-                                print(f"✅ 设置user_modified_level为2（段落层级）")
-                            else:
-                                print(f"⚠️ 未知的isTitleMarked类型: {result['isTitleMarked']}")
-                            
-                            if new_user_modified_level is not None:
-                                user_modified_level_updates.append((new_user_modified_level, result["id"]))
-                                print(f"准备更新记录ID {result['id']} 的user_modified_level为 {new_user_modified_level}")
-                            else:
-                                print(f"❌ 无法确定user_modified_level，跳过更新")
-                
+                update_rows = build_hierarchy_update_rows(results)
                 print(f"\n=== 数据库更新详情 ===")
-                print(f"准备更新的数据条数: {len(update_data)}")
-                if update_data:
-                    print(f"更新数据示例: {update_data[:3] if len(update_data) > 3 else update_data}")
+                print(f"准备更新的数据条数: {len(update_rows)}")
                 
-                if update_data:
-                    print(f"开始批量更新 {len(update_data)} 条记录...")
-                    
-                    # 使用小批量更新，提高性能
-                    BATCH_SIZE = 50  # 每批50条
-                    print(f"开始小批量更新 {len(update_data)} 条记录（每批{BATCH_SIZE}条）...")
-                    updated_count = 0
+                if update_rows:
                     start_time = time.time()
-                    
-                    for i in range(0, len(update_data), BATCH_SIZE):
-                        batch = update_data[i:i + BATCH_SIZE]
-                        batch_start_time = time.time()
-                        
-                        try:
-                            # 批量更新
-                            cur.executemany("""
-                                UPDATE pdf_json 
-                                SET prompt_hierarchy = %s, prompt_hierarchy_reason = %s
-                                WHERE id = %s
-                            """, batch)
-                            
-                            # 批量更新user_modified_level
-                            if user_modified_level_updates:
-                                # 过滤出当前批次中需要更新的记录
-                                batch_ids = {record_id for _, _, record_id in batch}
-                                current_batch_updates = [(new_level, record_id) for new_level, record_id in user_modified_level_updates if record_id in batch_ids]
-                                
-                                if current_batch_updates:
-                                    print(f"批量更新 {len(current_batch_updates)} 条记录的user_modified_level...")
-                                    cur.executemany("""
-                                        UPDATE pdf_json 
-                                        SET user_modified_level = %s
-                                        WHERE id = %s
-                                    """, current_batch_updates)
-                                    print(f"✅ 成功批量更新 {len(current_batch_updates)} 条记录的user_modified_level")
-                            
-                            updated_count += len(batch)
-                            batch_time = time.time() - batch_start_time
-                            
-                            # 每500条打印一次进度
-                            if updated_count % 500 == 0:
-                                elapsed_time = time.time() - start_time
-                                avg_time_per_record = elapsed_time / updated_count
-                                remaining_records = len(update_data) - updated_count
-                                estimated_remaining_time = remaining_records * avg_time_per_record
-                                
-                                print(f"进度: {updated_count}/{len(update_data)} "
-                                      f"({updated_count/len(update_data)*100:.1f}%) "
-                                      f"耗时: {elapsed_time:.2f}秒 "
-                                      f"平均每条: {avg_time_per_record:.3f}秒 "
-                                      f"预计剩余: {estimated_remaining_time:.1f}秒")
-                            
-                            # 每1000条提交一次事务
-                            if updated_count % 1000 == 0:
-                                conn.commit()
-                                print(f"已提交事务，更新了 {updated_count} 条记录")
-                                
-                        except Exception as batch_error:
-                            print(f"批量更新失败: {str(batch_error)}")
-                            # 如果批量更新失败，尝试单条更新
-                            print("尝试单条更新...")
-                            for level, reasoning, record_id in batch:
-                                try:
-                                    cur.execute("""
-                                        UPDATE pdf_json 
-                                        SET prompt_hierarchy = %s, prompt_hierarchy_reason = %s
-                                        WHERE id = %s
-                                    """, (level, reasoning, record_id))
-                                    updated_count += 1
-                                except Exception as single_error:
-                                    print(f"单条更新记录ID {record_id} 失败: {str(single_error)}")
-                                    continue
-                            
-                            # 单条更新user_modified_level
-                            for new_level, record_id in user_modified_level_updates:
-                                try:
-                                    cur.execute("""
-                                        UPDATE pdf_json 
-                                        SET user_modified_level = %s
-                                        WHERE id = %s
-                                    """, (new_level, record_id))
-                                    print(f"✅ 单条更新记录ID {record_id} 的user_modified_level为 {new_level}")
-                                except Exception as single_error:
-                                    print(f"❌ 单条更新记录ID {record_id} 的user_modified_level失败: {str(single_error)}")
-                                    continue
-                    
-                    # 最终提交剩余的事务
-                    if updated_count > 0:
-                        conn.commit()
-                        print(f"最终提交事务，总共更新了 {updated_count} 条记录")
-                    
-                    total_time = time.time() - start_time
-                    print(f"小批量更新完成，共更新 {updated_count} 条记录，总耗时 {total_time:.2f}秒")
-                    
-                    print(f"批量更新完成，共更新 {updated_count} 条记录")
-                    
-                    # 验证更新结果
-                    print("验证更新结果...")
-                    for level, reasoning, record_id in update_data[:3]:  # 只验证前3条
-                        cur.execute("""
-                            SELECT id, prompt_hierarchy, prompt_hierarchy_reason 
-                            FROM pdf_json 
-                            WHERE id = %s
-                        """, (record_id,))
-                        verify_result = cur.fetchone()
-                        if verify_result:
-                            print(f"记录ID {record_id}: 层级={verify_result[1]}, 原因={verify_result[2]}")
-                        else:
-                            print(f"记录ID {record_id}: 未找到")
+                    updated_ids, failed_updates = bulk_update_pdf_json_hierarchy(cur, update_rows)
+                    updated_count = len(updated_ids)
+                    print(f"批量更新完成，共更新 {updated_count} 条记录，耗时 {time.time() - start_time:.2f}秒")
+                    for failed in failed_updates:
+                        print(f"❌ 更新记录ID {failed['id']} 失败: {failed['error']}")
                 else:
                     print("没有需要更新的记录")
             
@@ -1132,9 +1201,11 @@ def update_pdf_json_hierarchy(data_list: List[Dict[str, Any]]) -> Dict[str, Any]
             
             result = {
                 "status": "success",
-                "message": f"成功更新 {updated_count} 条记录",
+                "message": f"成功更新 {updated_count} 条记录" + (f"，{len(failed_updates)} 条失败" if failed_updates else ""),
                 "total_processed": len(results),
                 "updated_count": updated_count,
+                "failed_updates": failed_updates,  # [{"id", "error"}]，逐条定位的失败记录
+                "reused_count": level_service.cache_stats["hits"],  # 增量分析时复用上次AI响应的条数
                 "results": results,
                 "log_file_path": level_service.get_log_file_path(),  # 返回日志文件路径
                 "hierarchy_analysis": level_service.get_level_sequence_with_contexts()  # 新增：返回层级分析结果
@@ -1162,12 +1233,52 @@ def update_pdf_json_hierarchy(data_list: List[Dict[str, Any]]) -> Dict[str, Any]
         print(f"返回错误结果: {error_result}")
         return error_result
 
-def analyze_hierarchy_by_run_id(run_id: str) -> Dict[str, Any]:
+def load_previous_hierarchy_items(cur, run_id: str, version: int) -> List[Dict[str, Any]]:
+    """
+    查询不晚于version的、最近一次做过层级分析的版本中的条目（顺序与分析时一致），用于增量重新分析
+
+    Returns:
+        list: [{"text", "isTitleMarked", "level", "reasoning"}]，没有分析过的版本时为空列表
+    """
+    cur.execute("""
+        SELECT MAX(version)
+        FROM pdf_json
+        WHERE run_id = %s AND version <= %s AND prompt_hierarchy IS NOT NULL
+    """, (run_id, version))
+    row = cur.fetchone()
+    if not row or row[0] is None:
+        return []
+    previous_version = row[0]
+
+    cur.execute("""
+        SELECT text, user_modified_level, prompt_hierarchy, prompt_hierarchy_reason
+        FROM pdf_json
+        WHERE run_id = %s AND version = %s
+        AND user_modified_level IN (1, 2)
+        ORDER BY id ASC
+    """, (run_id, previous_version))
+
+    items = []
+    for text, user_modified_level, level, reasoning in cur.fetchall():
+        if not text or text.strip() == "":
+            continue
+        items.append({
+            "text": text,
+            "isTitleMarked": "section level" if user_modified_level == 1 else "context level",
+            "level": level,
+            "reasoning": reasoning
+        })
+    print(f"增量分析: 上次分析的版本为 {previous_version}，共 {len(items)} 条")
+    return items
+
+def analyze_hierarchy_by_run_id(run_id: str, llm_client=None, incremental: bool = None) -> Dict[str, Any]:
     """
     根据run_id从数据库查询数据并进行层级分析
     
     Args:
         run_id: 运行ID
+        llm_client: 可选的模型调用函数，见 LevelAnalysisService
+        incremental: 是否复用上一次分析的结果（增量重新分析），默认按 LEVEL_INCREMENTAL_CONFIG
         
     Returns:
         Dict: 分析结果
@@ -1270,6 +1381,17 @@ def analyze_hierarchy_by_run_id(run_id: str) -> Dict[str, Any]:
                 print(f"准备分析 {len(data_list)} 条数据")
                 print(f"转换后的数据示例: {data_list[:2] if data_list else '无数据'}")
                 
+                if incremental is None:
+                    incremental = LEVEL_INCREMENTAL_CONFIG["enabled"]
+                previous_items = load_previous_hierarchy_items(cur, run_id, version) if incremental else []
+                if previous_items:
+                    unchanged_prefix = 0
+                    for new_item, old_item in zip(data_list, previous_items):
+                        if (new_item["text"], new_item["isTitleMarked"]) != (old_item["text"], old_item["isTitleMarked"]):
+                            break
+                        unchanged_prefix += 1
+                    print(f"增量分析: 与上次分析相比前 {unchanged_prefix}/{len(data_list)} 条未变化")
+                
         finally:
             conn.close()
         
@@ -1290,7 +1412,7 @@ def analyze_hierarchy_by_run_id(run_id: str) -> Dict[str, Any]:
         
         # 调用层级分析服务
         print(f"准备调用 update_pdf_json_hierarchy 函数...")
-        result = update_pdf_json_hierarchy(data_list)
+        result = update_pdf_json_hierarchy(data_list, llm_client=llm_client, previous_items=previous_items)
         print(f"update_pdf_json_hierarchy 函数调用完成，返回结果: {result}")
         
         # 添加run_id和version信息到结果中
@@ -1314,93 +1436,18 @@ def analyze_hierarchy_by_run_id(run_id: str) -> Dict[str, Any]:
             "results": []
         }
 
+def level_stream_parser():
+    """层级判断请求的流式解析器类，传给 AsyncVLLMClient 的 stream_parser；未启用流式时为None"""
+    return LevelStreamParser if LEVEL_STREAMING_CONFIG["enabled"] else None
+
+
 def start_level_vllm_service():
     """
     启动专用于层级分析的vLLM服务（如已启动则跳过）
+    由模型生命周期守护负责启动和就绪等待：已就绪时不发请求、直接返回
     """
-    import requests
-    import subprocess
-    import time
-
-    # 1. 检查端口服务是否已启动
-    try:
-        resp = requests.get("http://localhost:8202/v1/models", timeout=5)
-        if resp.status_code == 200:
-            print("层级分析vLLM服务已在运行，端口8202")
-            return True
-    except Exception:
-        pass
-
-    # 2. 检查容器是否存在（包括已停止的）
-    result = subprocess.run(
-        ["docker", "ps", "-a", "-q", "-f", "name=vllm_level"],
-        stdout=subprocess.PIPE, text=True
-    )
-    
-    if result.stdout.strip():
-        # 容器存在，检查是否在运行
-        running_result = subprocess.run(
-            ["docker", "ps", "-q", "-f", "name=vllm_level"],
-            stdout=subprocess.PIPE, text=True
-        )
-        if running_result.stdout.strip():
-            print("vllm_level 容器已在运行，但服务未响应，建议手动检查容器日志。")
-            return False
-        else:
-            # 容器存在但未运行，尝试启动
-            print("尝试启动 vllm_level 容器...")
-            subprocess.run(["docker", "start", "vllm_level"])
-    else:
-        # 容器不存在，需要创建
-        print("vllm_level 容器不存在，自动创建...")
-        
-        # 获取模型配置
-        model_config = get_model_config("level_model")
-        if not model_config:
-            print("❌ 无法获取 level_model 配置")
-            return False
-        
-        # 构建 docker run 命令
-        cmd = [
-            "docker", "run",
-            "--gpus", "all",
-            "-v", "/data/.cache/vllm:/root/.cache/vllm",
-            "-v", "/data/.cache/huggingface:/root/.cache/huggingface", 
-            "-v", "/data/training/model:/root/model",
-            "-v", f"{model_config['lora_path']}:/root/lora",
-            f"-p", f"{model_config['port']}:8000",
-            "--ipc=host",
-            "-d",
-            f"--name", model_config["container_name"],
-            "vllm/vllm-openai:latest",
-            "--enable-lora",
-            f"--lora-modules", f"{model_config['lora_module_name']}=/root/lora",
-            "--model", model_config["base_model_path"],
-            "--tensor-parallel-size", "4"
-        ]
-        
-        print(f"执行命令: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            print(f"❌ 创建容器失败: {result.stderr}")
-            return False
-        
-        print("✅ vllm_level 容器创建成功")
-
-    # 4. 等待服务端口可用（延长等待时间到5分钟）
-    print("等待服务启动（最多5分钟）...")
-    for i in range(30):  # 30次，每次10秒，总共5分钟
-        try:
-            resp = requests.get("http://localhost:8202/v1/models", timeout=3)
-            if resp.status_code == 200:
-                print("✅ vLLM服务已成功启动")
-                return True
-        except Exception:
-            pass
-        time.sleep(10)
-        if (i + 1) % 6 == 0:  # 每分钟打印一次进度
-            print(f"等待中... ({i+1}/30)")
-    
-    print("❌ vLLM服务启动失败，请检查容器日志！")
+    daemon = get_lifecycle_daemon()
+    if daemon.ensure_ready("level_model"):
+        return True
+    print(f"❌ 层级分析vLLM服务启动失败: {daemon.get_status('level_model')['error']}")
     return False 
\ No newline at end of file
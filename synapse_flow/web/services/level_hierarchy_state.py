@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+层级分析状态的紧凑实现
+按确认顺序用并行数组保存每条的层级、父节点下标和特殊情况编码，文本只保存引用。
+层级路径栈、层级上下文、上文路径都通过父指针按需推导，每确认一条的开销为均摊O(1)，
+不再为每一条复制一份路径。
+"""
+
+from array import array
+from typing import List, Dict, Any, Optional
+
+# 特殊情况类型与编码（0为无特殊情况），未知类型在运行时追加
+SPECIAL_TYPES = [None, "层级主题错误", "层级顺序混乱", "同属以往层级", "总分结构后的总层级",
+                 "层级为模版内部层级", "层级格式不同却语义相关"]
+TITLE_MARKS = [None, "section level", "context level"]
+
+
+class _CodeTable:
+    """字符串 <-> 小整数编码"""
+
+    __slots__ = ("values", "codes")
+
+    def __init__(self, values: List[Optional[str]]):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def encode(self, value: Optional[str]) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[value] = code
+        return code
+
+
+class HierarchyNode:
+    """
+    已确认条目的只读视图（按需创建）
+    支持 node["level"] / node.get("text") 的访问方式，与原来的dict节点兼容（规则判断、prompt构建都按这种方式读取）
+    """
+
+    __slots__ = ("index", "text", "isTitleMarked", "level", "special_type")
+
+    def __init__(self, index: int, text: str, is_title_marked: str, level: int, special_type: Optional[str]):
+        self.index = index
+        self.text = text
+        self.isTitleMarked = is_title_marked
+        self.level = level
+        self.special_type = special_type
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "text": self.text,
+            "isTitleMarked": self.isTitleMarked,
+            "level": self.level,
+            "index": self.index,
+            "special_type": self.special_type
+        }
+
+    def __eq__(self, other):
+        if isinstance(other, HierarchyNode):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f"HierarchyNode({self.to_dict()})"
+
+
+class LevelHierarchyState:
+    """
+    层级分析状态，每条确认的结果对应一个下标，保存：
+    - levels: 层级
+    - path_parents: 层级路径栈中的父节点（之前最近一个层级更小、仍在栈中的条目），栈 = 从最后一条沿父指针向上
+    - context_parents: 层级上下文中的父节点（update_hierarchical_context 原算法），层级上下文同样沿父指针推导
+    - anchors: "同属以往层级"节点补充的同级节点（之前最近一个同层级、非同属以往层级的条目），其余为-1
+    - special_codes / title_codes / special_flags: 特殊情况类型、结构/段落标记、是否特殊情况
+    - path_title_codes: 作为层级路径栈节点时的结构/段落标记。层级主题错误时已确认列表和路径栈中的标记分别修改，
+      两者可能不同（与原来两份dict的行为一致）
+    - texts / reasonings: 文本和判断理由（只保存引用）
+
+    branch() 返回在当前状态之上追加条目的分支（推测、回放用），不复制数组，分支存在期间基础状态不能再追加。
+    """
+
+    __slots__ = ("_base", "_offset", "levels", "path_parents", "context_parents", "anchors",
+                 "special_codes", "title_codes", "path_title_codes", "special_flags", "texts", "reasonings",
+                 "_specials", "_marks", "_last_plain_by_level")
+
+    def __init__(self, base: "LevelHierarchyState" = None):
+        self._base = base
+        self._offset = len(base) if base is not None else 0
+        self.levels = array("i")
+        self.path_parents = array("i")
+        self.context_parents = array("i")
+        self.anchors = array("i")
+        self.special_codes = array("b")
+        self.title_codes = array("b")
+        self.path_title_codes = array("b")
+        self.special_flags = array("b")
+        self.texts = []
+        self.reasonings = []
+        if base is not None:
+            self._specials = base._specials
+            self._marks = base._marks
+            self._last_plain_by_level = dict(base._last_plain_by_level)
+        else:
+            self._specials = _CodeTable(SPECIAL_TYPES)
+            self._marks = _CodeTable(TITLE_MARKS)
+            self._last_plain_by_level = {}  # 层级 -> 最近一个非同属以往层级的下标
+
+    def branch(self) -> "LevelHierarchyState":
+        return LevelHierarchyState(self)
+
+    def __len__(self) -> int:
+        return self._offset + len(self.levels)
+
+    # ---- 按下标读取（下标小于 _offset 的在基础状态中） ----
+
+    def level(self, index: int) -> int:
+        return self.levels[index - self._offset] if index >= self._offset else self._base.level(index)
+
+    def text(self, index: int) -> str:
+        return self.texts[index - self._offset] if index >= self._offset else self._base.text(index)
+
+    def title_mark(self, index: int) -> str:
+        if index >= self._offset:
+            return self._marks.values[self.title_codes[index - self._offset]]
+        return self._base.title_mark(index)
+
+    def path_title_mark(self, index: int) -> str:
+        if index >= self._offset:
+            return self._marks.values[self.path_title_codes[index - self._offset]]
+        return self._base.path_title_mark(index)
+
+    def special_type(self, index: int) -> Optional[str]:
+        if index >= self._offset:
+            return self._specials.values[self.special_codes[index - self._offset]]
+        return self._base.special_type(index)
+
+    def is_special_case(self, index: int) -> bool:
+        if index >= self._offset:
+            return bool(self.special_flags[index - self._offset])
+        return self._base.is_special_case(index)
+
+    def reasoning(self, index: int) -> Optional[str]:
+        return self.reasonings[index - self._offset] if index >= self._offset else self._base.reasoning(index)
+
+    def path_parent(self, index: int) -> int:
+        return self.path_parents[index - self._offset] if index >= self._offset else self._base.path_parent(index)
+
+    def context_parent(self, index: int) -> int:
+        if index >= self._offset:
+            return self.context_parents[index - self._offset]
+        return self._base.context_parent(index)
+
+    def anchor(self, index: int) -> int:
+        return self.anchors[index - self._offset] if index >= self._offset else self._base.anchor(index)
+
+    def node(self, index: int, in_path: bool = False) -> HierarchyNode:
+        """条目视图，in_path=True 时使用作为层级路径栈节点的标记"""
+        is_title_marked = self.path_title_mark(index) if in_path else self.title_mark(index)
+        return HierarchyNode(index, self.text(index), is_title_marked, self.level(index), self.special_type(index))
+
+    def set_title_mark(self, index: int, is_title_marked: str):
+        """修改已确认条目的结构/段落标记（层级主题错误时使用）"""
+        self._check_writable(index)
+        self.title_codes[index - self._offset] = self._marks.encode(is_title_marked)
+
+    def set_path_title_mark(self, index: int, is_title_marked: str):
+        """修改层级路径栈节点的结构/段落标记（层级主题错误时使用）"""
+        self._check_writable(index)
+        self.path_title_codes[index - self._offset] = self._marks.encode(is_title_marked)
+
+    def _check_writable(self, index: int):
+        if index < self._offset:
+            raise ValueError("不能在分支中修改基础状态的条目")
+
+    # ---- 追加 ----
+
+    def push(self, text: str, is_title_marked: str, level: int, special_type: Optional[str] = None,
+             is_special_case: bool = False, reasoning: Optional[str] = None) -> int:
+        """
+        追加一条确认的结果，同时完成原来 update_level_path_stack 和 update_hierarchical_context 的状态变化
+
+        Returns:
+            int: 新条目的下标
+        """
+        index = len(self)
+        top = index - 1
+
+        # 层级路径栈：移除所有层级大于等于新层级的节点，新节点的父节点是剩下的栈顶
+        path_parent = top
+        while path_parent >= 0 and self.level(path_parent) >= level:
+            path_parent = self.path_parent(path_parent)
+
+        # 层级上下文：同级替换栈顶，更深追加，更浅时从栈顶向前找到第一个层级<=新层级的节点并替换它
+        if top < 0:
+            context_parent = -1
+        else:
+            previous_level = self.level(top)
+            if level == previous_level:
+                context_parent = self.context_parent(top)
+            elif level > previous_level:
+                context_parent = top
+            else:
+                matched = top
+                while matched >= 0 and self.level(matched) > level:
+                    matched = self.context_parent(matched)
+                context_parent = self.context_parent(matched) if matched >= 0 else -1
+
+        if special_type == "同属以往层级":
+            anchor = self._last_plain_by_level.get(level, -1)
+        else:
+            anchor = -1
+            self._last_plain_by_level[level] = index
+
+        self.levels.append(level)
+        self.path_parents.append(path_parent)
+        self.context_parents.append(context_parent)
+        self.anchors.append(anchor)
+        self.special_codes.append(self._specials.encode(special_type))
+        self.title_codes.append(self._marks.encode(is_title_marked))
+        self.path_title_codes.append(self.title_codes[-1])
+        self.special_flags.append(1 if is_special_case else 0)
+        self.texts.append(text)
+        self.reasonings.append(reasoning)
+        return index
+
+    # ---- 推导 ----
+
+    def path_stack(self, top: int = None) -> List[HierarchyNode]:
+        """层级路径栈（从根到栈顶），top 默认为最后一条，即当前状态"""
+        top = len(self) - 1 if top is None else top
+        indices = []
+        while top >= 0:
+            indices.append(top)
+            top = self.path_parent(top)
+        return [self.node(i, in_path=True) for i in reversed(indices)]
+
+    def context_path_nodes(self, top: int = None) -> List[HierarchyNode]:
+        """
+        传给AI的上文路径：层级路径栈，"同属以往层级"节点之前补充它的同级节点
+        与原 get_context_path 一致
+        """
+        context_path = []
+        for node in self.path_stack(top):
+            if node.special_type == "同属以往层级":
+                anchor = self.anchor(node.index)
+                if anchor >= 0:
+                    context_path.append(self.node(anchor))
+            context_path.append(node)
+        return context_path
+
+    def context_chain(self, top: int = None) -> List[int]:
+        """层级上下文（原 current_context），top 默认为最后一条"""
+        top = len(self) - 1 if top is None else top
+        chain = []
+        while top >= 0:
+            chain.append(top)
+            top = self.context_parent(top)
+        chain.reverse()
+        return chain
+
+    def confirmed_level(self, index: int) -> Dict[str, Any]:
+        """与原 confirmed_levels 元素相同格式的dict"""
+        return {
+            "text": self.text(index),
+            "isTitleMarked": self.title_mark(index),
+            "level": self.level(index),
+            "reasoning": self.reasoning(index),
+            "is_special_case": self.is_special_case(index),
+            "special_type": self.special_type(index),
+            "context_path": [node.index for node in self.context_path_nodes(index - 1)]
+        }
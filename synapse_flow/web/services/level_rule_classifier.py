@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+层级判断的规则快速通道
+根据标题编号（第X章、第X节、一、（一）、1.、（1）、①等）和当前层级路径栈，
+对明确的情况直接给出层级，其余情况仍交给vLLM判断
+"""
+
+import re
+from typing import List, Dict, Any, Optional
+
+# 规则快速通道配置
+LEVEL_RULE_CONFIG = {
+    "enabled": True
+}
+
+# 规则判断时记录的AI响应
+RULE_AI_RESPONSE = "规则判断，未调用AI"
+
+CHINESE_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4,
+                  "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+CHINESE_UNITS = {"十": 10, "百": 100}
+CIRCLED_DIGITS = "①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳"
+
+_CN = "[零〇一二两三四五六七八九十百]+"
+
+# (编号样式, 正则)，按顺序匹配，第一个匹配的生效
+NUMBERING_PATTERNS = [
+    ("第X章", re.compile(rf"^第({_CN}|\d+)章")),
+    ("第X节", re.compile(rf"^第({_CN}|\d+)节")),
+    ("第X条", re.compile(rf"^第({_CN}|\d+)条")),
+    ("第X部分", re.compile(rf"^第({_CN}|\d+)部分")),
+    ("第X编", re.compile(rf"^第({_CN}|\d+)编")),
+    ("一、", re.compile(rf"^({_CN})[、．.]")),
+    ("（一）", re.compile(rf"^[（(]({_CN})[）)]")),
+    ("（1）", re.compile(r"^[（(](\d+)[）)]")),
+    ("1.", re.compile(r"^(\d+)(?:[.．](?!\d)|、)")),
+    ("①", re.compile(rf"^([{CIRCLED_DIGITS}])")),
+]
+
+
+def parse_chinese_number(text: str) -> Optional[int]:
+    """把一、十二、二十三、一百零五之类的中文数字转成整数，无法解析时返回None"""
+    total, current = 0, 0
+    for char in text:
+        if char in CHINESE_DIGITS:
+            current = CHINESE_DIGITS[char]
+        elif char in CHINESE_UNITS:
+            total += (current or 1) * CHINESE_UNITS[char]
+            current = 0
+        else:
+            return None
+    return total + current
+
+
+def parse_numbering(text: str) -> Optional[Dict[str, Any]]:
+    """
+    解析文本开头的编号
+
+    Returns:
+        dict: {"style": "（一）", "number": 3, "prefix": "（三）"}，没有编号时返回None
+    """
+    text = (text or "").lstrip()
+    for style, pattern in NUMBERING_PATTERNS:
+        match = pattern.match(text)
+        if not match:
+            continue
+        token = match.group(1)
+        if token in CIRCLED_DIGITS:
+            number = CIRCLED_DIGITS.index(token) + 1
+        elif token.isdigit():
+            number = int(token)
+        else:
+            number = parse_chinese_number(token)
+        if not number:
+            return None
+        return {"style": style, "number": number, "prefix": match.group(0)}
+    return None
+
+
+class LevelRuleClassifier:
+    """基于编号连续性的层级判断"""
+
+    def classify(self, item_data: Dict[str, Any], level_path_stack: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        只处理一种高置信度情况：目标文本块是层级路径栈中最近一个同编号样式节点的下一个序号
+        （如路径中有"（二）"，目标为"（三）"），且结构/段落标记相同，此时两者为同级。
+        其余情况（新出现的编号样式、序号不连续、标记不同、没有编号）返回None，交给vLLM判断。
+
+        Args:
+            item_data: 目标文本块 {"text", "isTitleMarked"}
+            level_path_stack: 当前层级路径栈（LevelAnalysisService.level_path_stack）
+
+        Returns:
+            dict: 与 parse_level_response 相同格式的结果，无法判断时返回None
+        """
+        numbering = parse_numbering(item_data.get("text", ""))
+        if numbering is None:
+            return None
+
+        # 路径栈中最近一个同样式的节点
+        for node in reversed(level_path_stack):
+            node_numbering = parse_numbering(node.get("text", ""))
+            if node_numbering is None or node_numbering["style"] != numbering["style"]:
+                continue
+            if node_numbering["number"] + 1 != numbering["number"]:
+                return None
+            if node.get("isTitleMarked") != item_data.get("isTitleMarked"):
+                return None
+            if node.get("special_type") == "层级主题错误":
+                return None
+
+            level = node["level"]
+            level_type = "结构层级" if item_data.get("isTitleMarked") == "section level" else "段落层级"
+            reasoning = (
+                f"规则判断：因为目标文本开头\"{numbering['prefix']}\"与前文{level_type}{level}"
+                f"\"{node_numbering['prefix']}\"是同一种编号格式且序号连续，"
+                f"所以判断为{{层级{level}}}。"
+            )
+            return {
+                "level": level,
+                "reasoning": reasoning,
+                "is_special_case": False,
+                "special_type": None
+            }
+        return None
+
+    def predict_level(self, item_data: Dict[str, Any], level_path_stack: List[Dict[str, Any]]) -> int:
+        """
+        猜测层级（用于推测并行时预测后续条目的上下文，猜错只会导致重新请求，不影响结果）
+        规则能判断时用规则结果；路径栈中有同编号样式的节点时视为同级；否则视为上一条的下一级
+        """
+        rule_result = self.classify(item_data, level_path_stack)
+        if rule_result is not None:
+            return rule_result["level"]
+        if not level_path_stack:
+            return 1
+
+        numbering = parse_numbering(item_data.get("text", ""))
+        if numbering is not None:
+            for node in reversed(level_path_stack):
+                node_numbering = parse_numbering(node.get("text", ""))
+                if node_numbering is not None and node_numbering["style"] == numbering["style"]:
+                    return node["level"]
+        return level_path_stack[-1]["level"] + 1
@@ -0,0 +1,38 @@
+"""
+LoRA训练子进程：由 training_scheduler_service 为每个任务启动一个，GPU由 CUDA_VISIBLE_DEVICES 指定
+进度（loss、学习率、吞吐量）按 PROGRESS_PREFIX 格式输出到标准输出，由调度器写入任务表；
+收到 SIGTERM（取消任务）时在当前step结束后保存checkpoint并退出。
+
+用法：
+    python -m synapse_flow.web.services.lora_training_worker <输出目录>/training_env.json
+"""
+import os
+import sys
+import json
+import signal
+import threading
+
+from synapse_flow.web.services.training_scheduler_service import emit_training_progress
+from synapse_flow.web.services.loratraining_job_service import execute_training, TrainingProgressCallback
+
+
+def main():
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        training_env = json.load(f)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    print(f"开始执行训练任务: {training_env['task_id']}（GPU {os.environ.get('CUDA_VISIBLE_DEVICES')}）")
+    if training_env.get("resume_from_checkpoint"):
+        print(f"从checkpoint继续: {training_env['resume_from_checkpoint']}")
+    result = execute_training(training_env, callbacks=[TrainingProgressCallback(emit_training_progress, stop_event)])
+    if stop_event.is_set():
+        print(f"⏹️ 训练任务 {training_env['task_id']} 已取消，checkpoint已保存")
+    elif result["success"]:
+        print(f"✅ 训练任务 {training_env['task_id']} 完成")
+    sys.exit(0 if result["success"] else 1)
+
+
+if __name__ == "__main__":
+    main()
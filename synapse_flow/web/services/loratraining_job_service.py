@@ -4,19 +4,27 @@ import time
 import subprocess
 import threading
 import shutil
+import uuid
 from datetime import datetime
 from typing import Dict, Any, Optional
 import pandas as pd
 import torch
-from datasets import Dataset
 from transformers import (
     AutoTokenizer, 
     AutoModelForCausalLM, 
     DataCollatorForSeq2Seq, 
     TrainingArguments, 
-    Trainer
+    Trainer,
+    TrainerCallback
 )
 from peft import LoraConfig, TaskType, get_peft_model
+from model_config import MULTI_LORA_CONFIG
+from vllm_lifecycle import get_lifecycle_daemon
+from synapse_flow.web.services.training_scheduler_service import TrainingScheduler, get_training_scheduler, COMPLETED
+from synapse_flow.web.services.training_data_service import (
+    load_tokenized_dataset, load_tokenized_shards, pack_dataset, padding_report, PackedSequenceCollator, BATCHING_MODES
+)
+from synapse_flow.web.services.training_export_service import export_training_dataset, snapshot_export
 
 # LoRA训练配置
 LORA_TRAINING_CONFIG = {
@@ -32,60 +40,39 @@ LORA_TRAINING_CONFIG = {
     "logging_steps": 10,
     "lora_rank": 16,
     "lora_alpha": 64,
-    "lora_dropout": 0.05
+    "lora_dropout": 0.05,
+    "batching": "padding"  # padding / packing / group_by_length（后两种需在请求中显式指定），见 training_data_service
 }
 
-# 全局变量存储训练任务状态
-training_tasks = {}
-
 def train_lora_model(training_data: Dict[str, Any], user_id: str = None) -> Dict[str, Any]:
     """
-    执行LoRA模型训练
+    提交LoRA模型训练任务（进入训练队列，由调度器分配GPU后在独立进程中训练）
     
     Args:
-        training_data: 训练数据，包含CSV文件路径、训练参数等
+        training_data: 训练数据，包含CSV文件路径（或从pdf_json导出的 export_name / run_ids）、训练参数等
         user_id: 用户ID，用于记录训练任务
     
     Returns:
-        Dict包含训练结果信息
+        Dict包含训练任务信息
     """
     try:
         print("开始LoRA模型训练...")
         
-        # 生成训练任务ID
-        task_id = f"lora_training_{int(time.time())}"
-        
-        # 记录训练任务到内存
-        training_tasks[task_id] = {
-            "task_id": task_id,
-            "user_id": user_id,
-            "status": "started",
-            "create_time": datetime.now().isoformat(),
-            "update_time": datetime.now().isoformat(),
-            "error_message": None,
-            "output_path": None
-        }
+        # 生成训练任务ID（同一秒内提交的任务用随机后缀区分）
+        task_id = f"lora_training_{int(time.time())}_{uuid.uuid4().hex[:6]}"
         
         # 准备训练环境
         training_env = prepare_training_environment(training_data, task_id)
         
-        # 更新输出路径
-        training_tasks[task_id]["output_path"] = training_env["output_dir"]
-        
-        # 启动训练进程（异步）
-        training_thread = threading.Thread(
-            target=run_training_process,
-            args=(training_env, task_id)
-        )
-        training_thread.daemon = True
-        training_thread.start()
+        # 提交到训练队列
+        job = get_scheduler().submit(task_id, training_env, user_id)
         
         # 返回任务信息
         return {
             "task_id": task_id,
-            "status": "started",
-            "message": "LoRA训练任务已启动",
-            "start_time": datetime.now().isoformat(),
+            "status": job["status"],
+            "message": "LoRA训练任务已进入队列",
+            "create_time": job["create_time"],
             "output_dir": training_env["output_dir"]
         }
         
@@ -111,27 +98,43 @@ def prepare_training_environment(training_data: Dict[str, Any], task_id: str) ->
         # 获取当前日期作为目录名
         current_date = datetime.now().strftime("%Y%m%d")
         
-        # 创建输出目录
-        output_dir = os.path.join(LORA_TRAINING_CONFIG["checkpoint_base_dir"], current_date)
+        # 创建输出目录（每个任务单独一个目录，同时训练的任务和续跑时的checkpoint互不影响）
+        output_dir = os.path.join(LORA_TRAINING_CONFIG["checkpoint_base_dir"], current_date, task_id)
         os.makedirs(output_dir, exist_ok=True)
         
-        # 处理CSV文件
-        csv_file_path = training_data.get("csv_file_path")
-        if not csv_file_path or not os.path.exists(csv_file_path):
-            raise Exception("CSV文件路径不存在")
-        
-        # 复制CSV文件到输出目录
-        training_csv_path = os.path.join(output_dir, "training_data.csv")
-        shutil.copy2(csv_file_path, training_csv_path)
+        batching = training_data.get("batching") or LORA_TRAINING_CONFIG["batching"]
+        if batching not in BATCHING_MODES:
+            raise Exception(f"不支持的batch方式: {batching}，可选 {'/'.join(BATCHING_MODES)}")
         
-        # 验证CSV文件格式
-        validate_csv_file(training_csv_path)
+        if training_data.get("export_name"):
+            # 从审核后的pdf_json导出（只重新导出有变化的run），分片硬链接到输出目录
+            export = export_training_dataset(training_data["export_name"], training_data.get("run_ids"),
+                                             training_data.get("versions"))
+            if export["examples"] == 0:
+                raise Exception("导出的训练数据为空")
+            training_files = {
+                "training_shards": snapshot_export(export["export_path"], os.path.join(output_dir, "training_data"))
+            }
+        else:
+            # 处理CSV文件
+            csv_file_path = training_data.get("csv_file_path")
+            if not csv_file_path or not os.path.exists(csv_file_path):
+                raise Exception("CSV文件路径不存在")
+            
+            # 复制CSV文件到输出目录
+            training_csv_path = os.path.join(output_dir, "training_data.csv")
+            shutil.copy2(csv_file_path, training_csv_path)
+            
+            # 验证CSV文件格式
+            validate_csv_file(training_csv_path)
+            training_files = {"training_csv_path": training_csv_path}
         
         # 构建训练环境配置
         training_env = {
             "task_id": task_id,
             "output_dir": output_dir,
-            "training_csv_path": training_csv_path,
+            "adapter_name": training_data.get("adapter_name") or task_id,  # 默认用任务ID，同一天完成的任务不会互相替换
+            **training_files,
             "base_model_path": LORA_TRAINING_CONFIG["base_model_path"],
             "max_length": LORA_TRAINING_CONFIG["max_length"],
             "per_device_train_batch_size": training_data.get("batch_size", LORA_TRAINING_CONFIG["per_device_train_batch_size"]),
@@ -142,7 +145,8 @@ def prepare_training_environment(training_data: Dict[str, Any], task_id: str) ->
             "logging_steps": LORA_TRAINING_CONFIG["logging_steps"],
             "lora_rank": LORA_TRAINING_CONFIG["lora_rank"],
             "lora_alpha": LORA_TRAINING_CONFIG["lora_alpha"],
-            "lora_dropout": LORA_TRAINING_CONFIG["lora_dropout"]
+            "lora_dropout": LORA_TRAINING_CONFIG["lora_dropout"],
+            "batching": batching
         }
         
         print(f"✅ 训练环境准备完成: {output_dir}")
@@ -179,85 +183,47 @@ def validate_csv_file(csv_path: str):
         print(f"❌ CSV文件验证失败: {str(e)}")
         raise e
 
-def run_training_process(training_env: Dict[str, Any], task_id: str):
+def execute_training(training_env: Dict[str, Any], callbacks: list = None) -> Dict[str, Any]:
     """
-    运行训练进程
+    执行训练（在训练子进程中调用，GPU由调度器通过 CUDA_VISIBLE_DEVICES 指定）
     
     Args:
-        training_env: 训练环境配置
-        task_id: 任务ID
-    """
-    try:
-        print(f"开始执行训练任务: {task_id}")
-        
-        # 更新任务状态为运行中
-        update_training_status(task_id, "running")
-        
-        # 执行训练
-        result = execute_training(training_env)
-        
-        if result["success"]:
-            print(f"✅ 训练任务 {task_id} 完成")
-            update_training_status(task_id, "completed", output_path=training_env["output_dir"])
-        else:
-            print(f"❌ 训练任务 {task_id} 失败: {result['error']}")
-            update_training_status(task_id, "failed", result['error'])
-            
-    except Exception as e:
-        print(f"❌ 训练任务 {task_id} 出错: {str(e)}")
-        update_training_status(task_id, "error", str(e))
-
-def execute_training(training_env: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    执行训练
-    
-    Args:
-        training_env: 训练环境配置
+        training_env: 训练环境配置，resume_from_checkpoint 不为空时从该checkpoint继续
+        callbacks: Trainer回调，如 TrainingProgressCallback
     
     Returns:
         Dict: 训练结果
     """
     try:
-        # 设置GPU
-        os.environ["CUDA_VISIBLE_DEVICES"] = "0"
-        
-        # 1. 加载和处理数据
-        print("正在加载数据集...")
-        ds = load_and_process_data(training_env["training_csv_path"])
-        
-        # 2. 设置tokenizer
+        # 1. 设置tokenizer
         print("正在加载tokenizer...")
         tokenizer = setup_tokenizer(training_env["base_model_path"])
         
-        # 3. 处理数据
+        # 2. 加载并处理数据（相同数据和tokenizer直接使用缓存）
         print("正在处理数据...")
-        tokenized_dataset = ds['train'].map(
-            lambda example, index: process_func(example, index, ds['train'], tokenizer, training_env["max_length"]), 
-            with_indices=True
-        )
+        if training_env.get("training_shards"):
+            tokenized_dataset = load_tokenized_shards(
+                training_env["training_shards"], tokenizer, training_env["max_length"]
+            )
+        else:
+            tokenized_dataset = load_tokenized_dataset(
+                training_env["training_csv_path"], tokenizer, training_env["max_length"]
+            )
         
-        # 4. 设置模型和LoRA
+        # 3. 设置模型和LoRA
         print("正在设置模型和LoRA...")
         model = setup_model_and_lora(training_env["base_model_path"], training_env)
         
-        # 5. 训练模型
+        # 4. 训练模型
         print("开始训练模型...")
-        train_model(model, tokenizer, tokenized_dataset, training_env)
+        report = train_model(model, tokenizer, tokenized_dataset, training_env, callbacks)
         
-        return {"success": True}
+        return {"success": True, "report": report}
         
     except Exception as e:
         print(f"❌ 训练执行失败: {str(e)}")
         return {"success": False, "error": str(e)}
 
-def load_and_process_data(csv_file_path: str) -> Dataset:
-    """加载并处理CSV数据集"""
-    print("正在加载数据集...")
-    ds = Dataset.from_csv(csv_file_path)
-    ds = ds.filter(lambda x: x['input'] and str(x['input']).strip())  # 去掉空的行
-    print(f"数据集加载完成，共{len(ds)}条数据")
-    return ds
-
 def setup_tokenizer(model_path: str):
     """设置tokenizer"""
     print("正在加载tokenizer...")
@@ -270,150 +236,6 @@ def setup_tokenizer(model_path: str):
     tokenizer.pad_token = tokenizer.eos_token
     return tokenizer
 
-def process_func(example, index, ds, tokenizer, max_length):
-    """数据处理函数"""
-    # 构建各部分的输入
-    input_text = f"需要分析的这段语句是：\"{example['input']}\""
-    output_text = example['output']
-    
-    # 使用原始的 instruction 模板
-    instruction_text = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
-你是文本切割处理的审核专家，将会看到一个目标文本块，以及它的前两个文本块和后一个文本块。
-
-你的任务是**目标文本块（即第三个）**（1）是否为新层级（2）是否存在以下四类错误，并给出对应判断和修改建议。
-文本块层级判断：
-（1）新层级：文本块开头句子具有明确新文本层级结构特征如：（1）、一、首先、a.等；
-（2）非新层级：文本块开头句子没有明确新文本层级结构特征；
-
-错误文本内容判断：
-（1）字符错误：文本含有不合理字符，如乱码、错误符号、混杂代码符号（公式不算）；
-（2）格式错误：文本块开头是句子残段，其上半句存在于上一个文本块结尾；
-（3）信息错误：文本块为空、为页码、目录、标题页、版权页、装订信息等与正文无关的内容。
-（4）需要拆分：文本块有多个层级的文本块，在原文中加入"<mark>"将其区分。
-
-正确文本内容判断：
-如果目标文本块不存在上述四类问题，即为正常文本块。
-
-判断顺序：（1）判断是否为新层级（2）判断文本块内容是否错误
-
-输出格式要求：
-判断结论请统一使用如下格式：
-因为阅读上下文第三文本块XXX，所以判断为{是否为新层级}。因为第三文本块因xxx，所以判断为{错误类型}，建议处理方式为：{修改方式}
-如果文本无误，请回复：
-因为阅读上下文第三文本块XXX，所以判断为{是否为新层级}。因为第三文本块因没有四类错误，所以判断为{正确}。第三文本块不做任何修改。
-
-
-
-举例情况（1）：开头是新层级且为字符错误；
-    {
-        "text": "答：可以。根据文件规定：",
-        "page_idx": 6
-    },
-    {
-        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
-        "page_idx": 6
-    },
-    {
-        "text": "二、。增值税小规模纳税人适用 $3 \\%$ 征收率@的应税销售收入",
-        "page_idx": 6
-    },
-    {
-        "text": "，减按 $1 \\%$ 征收率@征收增值税。",
-        "page_idx": 7
-    },
-你应该回复：因为阅读上下文第三文本块带有广义标题特征，所以判断为{新层级}。因为第三文本块因含有不合理字符，所以判断为{文本错误}。建议处理方式为：{二、增值税小规模纳税人适用 $3 \\%$ 征收率的应税销售收入}
-
-举例情况（2）：开头非新层级且格式错误（开头为残句）
-    {
-        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
-        "page_idx": 6
-    },
-    {
-        "text": "二、。增值税小规模纳税人适用 $3 \\%$ 征收率@的应税销售收入",
-        "page_idx": 6
-    },
-    {
-        "text": "，减按 $1 \\%$ 征收率@征收增值税。",
-        "page_idx": 7
-    },
-    {
-        "text": "三、本公告执行至2027年12月31日。",
-        "page_idx": 7
-    },
-你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因开始处句子不完整，所以判断为{格式错误}。建议处理方式为：{向前合并}且{删除}
-
-举例情况（3）：开头非新层级且需要拆分（包含多个层级）
-[
-  {
-    "text": "（四）通过纳税客体的非转移进行的国际避税",
-    "page_idx": 248
-  },
-  {
-    "text": "纳税客体的非转移，又称物的不流动。物的不流动，是指跨国纳税人在不移动资金、货物和劳务的情况下，采取其他手段避免自己的所得受到税收管辖。",
-    "page_idx": 248
-  },
-  {
-    "text": "通过物的不流动进行国际避税，主要有两种做法：一是变更公司组织形式以改变所得性质；二是利用延期纳税方式。",
-    "page_idx": 248
-  },
-  {
-    "text": "1.变更公司组织形式以改变所得性质",
-    "page_idx": 248
-  }
-]
-你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因含有多个文本块，所以判断为{需要拆分}。建议处理方式为：{通过物的不流动进行国际避税，主要有两种做法：<mark>一是变更公司组织形式以改变所得性质；<mark>二是利用延期纳税方式。}
-**注意**如果后面的第四个文本块不会是新的层级，你需要在结尾标记上<mark>,从而告诉我们层级的结束位置！
-
-举例情况（4）：开头非新层级且信息错误（无效内容）
-    {
-        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
-        "page_idx": 6
-    },
-    {
-        "text": "二、。增值税小规模纳税人适用 $3 \\%$ 征收率@的应税销售收入",
-        "page_idx": 6
-    },
-    {
-        "text": "12366热点问答年度精选汇编",
-        "page_idx": 7
-    },
-    {
-        "text": "，减按 $1 \\%$ 征收率@征收增值税。",
-        "page_idx": 7
-    },
-你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因是夹杂信息，所以判断为{信息错误}。建议处理方式为：{删除}
-    <|eot_id|>
-    """
-    
-    # 构建完整的instruction文本
-    user_part = f"""<|start_header_id|>user<|end_header_id|>
-    
-    需要你回答的问题是："{example['instruction']}"
-     {input_text}
-    请根据问题要求与问题进行回答<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-    """
-    
-    instruction_text = instruction_text + user_part
-
-    # Tokenize instruction with response
-    instruction = tokenizer(instruction_text, add_special_tokens=False)
-    response = tokenizer(f"{output_text}<|eot_id|>", add_special_tokens=False)
-    input_ids = instruction["input_ids"] + response["input_ids"] + [tokenizer.pad_token_id]
-    attention_mask = instruction["attention_mask"] + response["attention_mask"] + [1]
-    labels = [-100] * len(instruction["input_ids"]) + response["input_ids"] + [tokenizer.pad_token_id]
-
-    # 确保长度不超过max_length
-    if len(input_ids) > max_length:
-        input_ids = input_ids[:max_length]
-        attention_mask = attention_mask[:max_length]
-        labels = labels[:max_length]
-
-    return {
-        "input_ids": input_ids,
-        "attention_mask": attention_mask,
-        "labels": labels
-    }
-
 def setup_model_and_lora(model_path: str, training_env: Dict[str, Any]):
     """设置模型和LoRA配置"""
     print("正在加载基础模型...")
@@ -441,69 +263,168 @@ def setup_model_and_lora(model_path: str, training_env: Dict[str, Any]):
     
     return model
 
-def train_model(model, tokenizer, tokenized_dataset, training_env: Dict[str, Any]):
-    """训练模型"""
+def train_model(model, tokenizer, tokenized_dataset, training_env: Dict[str, Any], callbacks: list = None) -> Dict[str, Any]:
+    """
+    训练模型
+
+    Returns:
+        Dict: batch组织方式、padding比例（与原来的padding方式对比）和每秒训练的实际token数
+    """
     print("开始训练模型...")
-    
+    batching = training_env.get("batching", "padding")
+    batch_size = training_env["per_device_train_batch_size"]
+    lengths = [len(ids) for ids in tokenized_dataset["input_ids"]]
+    report = padding_report(lengths, batch_size, batching, training_env["max_length"])
+    baseline = padding_report(lengths, batch_size, "padding", training_env["max_length"])
+    print(f"📊 batch方式 {batching}：{report['batches']}个batch，padding比例 {report['padding_ratio']:.1%}"
+          f"（padding方式 {baseline['batches']}个batch，{baseline['padding_ratio']:.1%}）")
+
+    train_dataset = tokenized_dataset
+    if batching == "packing":
+        train_dataset = pack_dataset(tokenized_dataset, training_env["max_length"])
+        data_collator = PackedSequenceCollator(tokenizer.pad_token_id, model.config._attn_implementation, model.dtype)
+    else:
+        if batching == "group_by_length":
+            train_dataset = tokenized_dataset.add_column("length", lengths)
+        data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, padding=True)
+
     args = TrainingArguments(
         output_dir=training_env["output_dir"],
-        per_device_train_batch_size=training_env["per_device_train_batch_size"],
+        per_device_train_batch_size=batch_size,
         gradient_accumulation_steps=training_env["gradient_accumulation_steps"],
         logging_steps=training_env["logging_steps"],
         num_train_epochs=training_env["num_train_epochs"],
         save_steps=training_env["save_steps"],
         learning_rate=training_env["learning_rate"],
         save_on_each_node=True,
-        gradient_checkpointing=True
+        gradient_checkpointing=True,
+        group_by_length=batching == "group_by_length",
+        remove_unused_columns=batching != "packing"  # position_ids 要交给collator
     )
 
+    for callback in callbacks or []:
+        if isinstance(callback, TrainingProgressCallback):
+            callback.total_tokens = sum(lengths) * training_env["num_train_epochs"]
+
     trainer = Trainer(
         model=model,
         args=args,
-        train_dataset=tokenized_dataset,
-        data_collator=DataCollatorForSeq2Seq(tokenizer=tokenizer, padding=True),
+        train_dataset=train_dataset,
+        data_collator=data_collator,
+        callbacks=callbacks,
     )
 
-    trainer.train()
-    print("训练完成！")
+    result = trainer.train(resume_from_checkpoint=training_env.get("resume_from_checkpoint"))
+    report["train_runtime"] = result.metrics["train_runtime"]
+    report["tokens_per_second"] = sum(lengths) * training_env["num_train_epochs"] / result.metrics["train_runtime"]
+    report["baseline_padding_ratio"] = baseline["padding_ratio"]
+    print(f"训练完成！每秒训练 {report['tokens_per_second']:.0f} 个token（不含padding）")
+    return report
+
+class TrainingProgressCallback(TrainerCallback):
+    """把loss、学习率和吞吐量报告给调度器；收到停止信号（取消任务）时保存checkpoint并结束训练"""
 
-def update_training_status(task_id: str, status: str, error_message: str = None, output_path: str = None):
+    def __init__(self, report, stop_event: threading.Event = None):
+        self.report = report
+        self.stop_event = stop_event
+        self.total_tokens = None  # 整个训练的实际token数（不含padding），由 train_model 设置
+        self._started_at = None
+        self._start_step = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._started_at = time.time()
+        self._start_step = state.global_step  # 续跑时从checkpoint的步数开始
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        progress = {"step": state.global_step, "max_steps": state.max_steps, "epoch": round(state.epoch or 0, 4)}
+        for key in ("loss", "learning_rate", "grad_norm"):
+            if key in (logs or {}):
+                progress[key] = logs[key]
+        steps = state.global_step - self._start_step
+        elapsed = time.time() - self._started_at
+        if self.total_tokens and state.max_steps and steps > 0 and elapsed > 0:
+            progress["tokens_per_second"] = round(self.total_tokens / state.max_steps * steps / elapsed)
+        self.report(progress)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.stop_event is not None and self.stop_event.is_set():
+            control.should_save = True
+            control.should_training_stop = True
+        return control
+
+def find_adapter_checkpoint(output_dir: str) -> Optional[str]:
     """
-    更新训练任务状态（内存存储）
-    
+    训练输出目录中可挂载的适配器：目录本身有 adapter_config.json 时用目录本身，
+    否则用步数最大的 checkpoint-N
+    """
+    if os.path.exists(os.path.join(output_dir, "adapter_config.json")):
+        return output_dir
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        checkpoint_dir = os.path.join(output_dir, name)
+        if name.startswith("checkpoint-") and name[len("checkpoint-"):].isdigit() \
+                and os.path.exists(os.path.join(checkpoint_dir, "adapter_config.json")):
+            checkpoints.append((int(name[len("checkpoint-"):]), checkpoint_dir))
+    return max(checkpoints)[1] if checkpoints else None
+
+def register_trained_adapter(task_id: str, adapter_name: str, replace: bool = True) -> Dict[str, Any]:
+    """
+    把训练任务的输出注册为多LoRA共享服务上的适配器（服务运行中时立即挂载）
+
     Args:
-        task_id: 任务ID
-        status: 状态
-        error_message: 错误信息
-        output_path: 输出路径
+        task_id: 训练任务ID
+        adapter_name: 适配器名，请求时作为 model 字段
+        replace: 同名适配器已注册为其他路径时是否替换（训练完成后自动注册时不替换）
+
+    Returns:
+        Dict: 注册结果
     """
-    if task_id in training_tasks:
-        training_tasks[task_id]["status"] = status
-        training_tasks[task_id]["update_time"] = datetime.now().isoformat()
-        if error_message:
-            training_tasks[task_id]["error_message"] = error_message
-        if output_path:
-            training_tasks[task_id]["output_path"] = output_path
-        print(f"✅ 更新任务状态: {task_id} -> {status}")
+    if not MULTI_LORA_CONFIG["enabled"]:
+        return {"status": "error", "message": "未开启多LoRA共享服务（model_config.MULTI_LORA_CONFIG）"}
+    task = get_scheduler().get_job(task_id)
+    if task is None:
+        return {"status": "error", "message": "任务不存在"}
+    if task["status"] != "completed" or not task.get("output_path"):
+        return {"status": "error", "message": f"任务未完成: {task['status']}"}
+
+    lora_path = find_adapter_checkpoint(task["output_path"])
+    if lora_path is None:
+        return {"status": "error", "message": f"输出目录中没有适配器: {task['output_path']}"}
+
+    registered_path = get_lifecycle_daemon().list_adapters().get(adapter_name)
+    if not replace and registered_path and registered_path != lora_path:
+        print(f"⚠️ 适配器 {adapter_name} 已注册为 {registered_path}，不自动替换")
+        return {"status": "error", "message": f"适配器 {adapter_name} 已注册为 {registered_path}"}
+
+    try:
+        loaded = get_lifecycle_daemon().register_adapter(adapter_name, lora_path)
+    except Exception as e:
+        print(f"❌ 注册适配器 {adapter_name} 失败: {str(e)}")
+        return {"status": "error", "message": f"注册适配器失败: {str(e)}"}
+
+    get_scheduler().store.update(task_id, adapter_name=adapter_name, adapter_path=lora_path)
+    print(f"✅ 适配器 {adapter_name} 已注册: {lora_path}（{'已挂载' if loaded else '服务启动后挂载'}）")
+    return {"status": "success", "adapter_name": adapter_name, "adapter_path": lora_path, "loaded": loaded}
 
 def get_training_status(task_id: str) -> Dict[str, Any]:
     """
-    获取训练任务状态（内存存储）
+    获取训练任务状态（任务表）
     
     Args:
         task_id: 任务ID
     
     Returns:
-        Dict: 训练任务状态信息
+        Dict: 训练任务状态信息，包括分配的GPU和训练进度
     """
-    if task_id in training_tasks:
-        return training_tasks[task_id]
+    task = get_scheduler().get_job(task_id)
+    if task is not None:
+        return task
     else:
         return {"error": "任务不存在"}
 
 def list_training_tasks(user_id: str = None, limit: int = 20) -> list:
     """
-    列出训练任务（内存存储）
+    列出训练任务（任务表，最新的在前）
     
     Args:
         user_id: 用户ID（可选）
@@ -512,14 +433,32 @@ def list_training_tasks(user_id: str = None, limit: int = 20) -> list:
     Returns:
         list: 训练任务列表
     """
-    tasks = list(training_tasks.values())
-    
-    # 按用户ID过滤
-    if user_id:
-        tasks = [task for task in tasks if task.get("user_id") == user_id]
-    
-    # 按创建时间排序（最新的在前）
-    tasks.sort(key=lambda x: x.get("create_time", ""), reverse=True)
-    
-    # 限制数量
-    return tasks[:limit] 
\ No newline at end of file
+    return get_scheduler().list_jobs(user_id, limit)
+
+def cancel_training_task(task_id: str) -> Dict[str, Any]:
+    """取消训练任务（运行中的任务保存checkpoint后结束）"""
+    return get_scheduler().cancel(task_id)
+
+def resume_training_task(task_id: str) -> Dict[str, Any]:
+    """失败或取消的训练任务重新入队，从最新的checkpoint继续"""
+    return get_scheduler().resume(task_id)
+
+def on_training_status(task_id: str, status: str, task: Dict[str, Any]):
+    """训练完成后在多LoRA共享服务上挂载新适配器，不需要重启服务"""
+    if status == COMPLETED and MULTI_LORA_CONFIG["enabled"] and task:
+        # 挂载适配器可能需要等待服务就绪，不阻塞调度线程
+        threading.Thread(target=register_trained_adapter, args=(task_id, task["training_env"]["adapter_name"]),
+                         kwargs={"replace": False}, daemon=True).start()
+
+_subscribed_scheduler = None
+_subscribe_lock = threading.Lock()
+
+def get_scheduler() -> TrainingScheduler:
+    """全局训练调度器（首次使用时订阅任务完成事件）"""
+    global _subscribed_scheduler
+    scheduler = get_training_scheduler()
+    with _subscribe_lock:
+        if _subscribed_scheduler is not scheduler:
+            scheduler.subscribe(on_training_status)
+            _subscribed_scheduler = scheduler
+    return scheduler
@@ -4,92 +4,178 @@ import json
 import time
 import os
 import requests
-import subprocess
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from synapse_flow.web.services.dataset_job_service import query_pdf_text_contents, insert_pdf_text_contents
-import re
+from synapse_flow.web.services.qa_run_journal_service import insert_qa_journal_entries, query_qa_journal, clear_qa_journal
+from synapse_flow.web.utils.context_window import build_context_windows
+from synapse_flow.web.utils.prompt_audit_logger import get_prompt_audit_logger
+from synapse_flow.web.utils.token_budget import get_token_budget
+from synapse_flow.web.utils.llm_response_parser import (
+    QA_LEVEL_JUDGEMENT_PATTERN, parse_qa_response, normalize_tag_whitespace
+)
+from model_config import get_model_config
+from vllm_lifecycle import get_lifecycle_daemon, READY, FAILED
+from vllm_endpoint_pool import get_endpoint_pool
+from vllm_circuit_breaker import get_circuit_breaker, CircuitOpenError, RunAbortedError, RunFailureGuard, CLOSED
 import traceback
 import datetime
+import functools
 
 # 配置参数
 BASE_MODEL_PATH = "/data/training/model/Meta-Llama-3.1-8B-Instruct"
 LORA_PATH = "/data/training/llama3.1_8b_checkpoint/20250604/checkpoint-1005"
 
-# vLLM服务配置 - 使用8张显卡
+# 上下文中无效/缺失文本块的占位文本
+QA_PLACEHOLDER_TEXT = "(此text不是有效文本，不需要参与判断)"
+
+# QA处理的问题（导出训练数据时使用同一个问题，见 training_export_service）
+QA_INSTRUCTION = "请问第三文本块是否为新的层级？另外，内容是否正确，如果错误应该建议如何修改"
+
+# QA审核的system prompt，放在模块级保证每次请求逐字节一致，
+# 这样vLLM的自动前缀缓存可以在所有请求之间复用这段前缀的KV cache
+QA_SYSTEM_PROMPT = """
+你是文本切割处理的审核专家，将会看到一个目标文本块，以及它的前两个文本块和后一个文本块。
+
+你的任务是**目标文本块（即第三个）**（1）判断是哪一种新层级（2）是否存在以下四类错误，并给出对应判断和修改建议。
+根据第三文本块上下文进行层级判断：
+（1）结构新层级：第三文本块的开头是文章的结构性标题，特征如："第一章 增值税"等，是一个标题词汇；
+（2）段落新层级：第三文本块的开头句子是正文段落内的叙述标题，特征也如：（1）、一、首先、a.等，但是一句句子；
+（3）附注图表新层级：1.文本块开头句子正文内容中特指附注的小标题，特征如："附：XX"等，2.文本块开头句子正文内容中特指图表的小标题，特征如：图：XXXX，下表如：，等；
+**注意**不是内容里有说到图或表就是附注图表新层级，而是特指后面文本块跟着是表或图！
+（4）非新层级：文本块开头句子没有明确新文本层级结构特征；
+
+错误文本内容判断：
+（1）字符错误：文本含有不合理字符，如乱码、错误符号、错别字、混杂代码符号（公式不算）；
+（2）格式错误：文本块开头是句子残段，其上半句存在于上一个文本块结尾；
+（3）信息错误：文本块为空、为页码、目录、标题页、版权页、装订信息等与正文无关的内容。
+（4）需要拆分：文本块有多个层级的文本块，在原文中加入"<mark>"将其区分。**注意**最后必须以<summary>作为结尾
+
+正确文本内容判断：
+如果目标文本块不存在上述四类问题，即为正常文本块。
+
+判断顺序：（1）判断是哪一种新层级（2）判断文本块内容是否错误
+
+输出格式要求：
+判断结论请统一使用如下格式：
+因为阅读上下文第三文本块XXX，所以判断为{XX新层级}。因为第三文本块因xxx，所以判断为{错误类型}，建议处理方式为：{修改方式}
+如果文本无误，请回复：
+因为阅读上下文第三文本块XXX，所以判断为{XX新层级}。因为第三文本块因没有四类错误，所以判断为{正确}。第三文本块不做任何修改。
+
+
+
+举例情况（1）：开头是段落新层级且为字符错误；
+    {
+        "text": "答：可以。根据文件规定：",
+        "page_idx": 6
+    },
+    {
+        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
+        "page_idx": 6
+    },
+    {
+        "text": "二、。增值税小规模纳税人适用3%征收率@的应税销售收人",
+        "page_idx": 6
+    },
+    {
+        "text": "，减按1%征收率@征收增值税。",
+        "page_idx": 7
+    },
+你应该回复：因为阅读上下文第三文本块是正文段落内的叙述标题，所以判断为{段落新层级}。因为第三文本块因含有不合理字符，所以判断为{文本错误}。建议处理方式为：{二、增值税小规模纳税人适用3%征收率的应税销售收入。}
+
+举例情况（2）：开头非新层级且格式错误（开头为残句）
+    {
+        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
+        "page_idx": 6
+    },
+    {
+        "text": "二、。增值税小规模纳税人适用3%征收率@的应税销售收入",
+        "page_idx": 6
+    },
+    {
+        "text": "，减按1%征收率@征收增值税。",
+        "page_idx": 7
+    },
+    {
+        "text": "三、本公告执行至2027年12月31日。",
+        "page_idx": 7
+    },
+你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因开始处句子不完整，所以判断为{格式错误}。建议处理方式为：{向前合并}且{删除}
+
+举例情况（3）：开头非新层级且需要拆分（包含多个层级）
+[
+  {
+    "text": "（四）通过纳税客体的非转移进行的国际避税",
+    "page_idx": 248
+  },
+  {
+    "text": "纳税客体的非转移，又称物的不流动。物的不流动，是指跨国纳税人在不移动资金、货物和劳务的情况下，采取其他手段避免自己的所得受到税收管辖。",
+    "page_idx": 248
+  },
+  {
+    "text": "通过物的不流动进行国际避税，主要有两种做法：一是变更公司组织形式以改变所得性质；二是利用延期纳税方式。",
+    "page_idx": 248
+  },
+  {
+    "text": "1.变更公司组织形式以改变所得性质",
+    "page_idx": 248
+  }
+]
+你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因含有多个文本块，所以判断为{需要拆分}。建议处理方式为：{通过物的不流动进行国际避税，主要有两种做法：<mark>一是变更公司组织形式以改变所得性质；<mark>二是利用延期纳税方式。<mark>}
+**注意**如果后面的第四个文本块不会是新的层级，你需要在结尾标记上<summary>,从而告诉我们层级的结束位置！
+
+举例情况（4）：开头非新层级且信息错误（无效内容）
+    {
+        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
+        "page_idx": 6
+    },
+    {
+        "text": "二、。增值税小规模纳税人适用3%征收率@的应税销售收入",
+        "page_idx": 6
+    },
+    {
+        "text": "12366热点问答年度精选汇编",
+        "page_idx": 7
+    },
+    {
+        "text": "，减按1%征收率@征收增值税。",
+        "page_idx": 7
+    },
+你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因是夹杂信息，所以判断为{信息错误}。建议处理方式为：{删除}
+"""
+
+# vLLM服务配置，容器的启动/停止由模型生命周期守护按 model_config 中的 qa_model 管理
+# 多LoRA模式下端口为共享服务的端口，请求的 model 为QA适配器名
+_QA_MODEL_CONFIG = get_model_config("qa_model")
 VLLM_SERVICE = {
-    "port": 8201,
-    "container_name": "vllm"
+    "model_name": "qa_model",
+    "port": _QA_MODEL_CONFIG["port"]
 }
 
 def start_vllm_service():
-    """启动vLLM服务"""
-    print("开始启动vLLM服务...")
-    
-    # 检查服务是否已经运行
-    try:
-        response = requests.get(f"http://localhost:{VLLM_SERVICE['port']}/health", timeout=5)
-        if response.status_code == 200:
-            print(f"✅ vLLM服务已在端口 {VLLM_SERVICE['port']} 运行")
-            return True
-    except:
-        pass
-    
-    # 停止可能存在的旧服务
-    try:
-        subprocess.run(["docker", "stop", VLLM_SERVICE["container_name"]], capture_output=True)
-        # subprocess.run(["docker", "rm", VLLM_SERVICE["container_name"]], capture_output=True)
-        print(f"✅ 停止旧服务 {VLLM_SERVICE['container_name']}")
-    except:
-        pass
-    
-    # 启动新的vLLM服务
-    cmd = [
-        "docker", "run",
-        "--gpus", "all",
-        "-v", "/data/.cache/vllm:/root/.cache/vllm",
-        "-v", "/data/.cache/huggingface:/root/.cache/huggingface",
-        "-v", "/data/training/model:/root/model",
-        "-v", "/data/training/llama3.1_8b_checkpoint:/root/lora",
-        f"-p", f"{VLLM_SERVICE['port']}:8000",
-        "--ipc=host",
-        "-d",
-        f"--name", VLLM_SERVICE["container_name"],
-        "vllm/vllm-openai:latest",
-        "--enable-lora",
-        f"--lora-modules", f"llama3.1_8b=/root/lora/20250604/checkpoint-1005",
-        "--model", "/root/model/Meta-Llama-3.1-8B-Instruct",
-        "--tensor-parallel-size", "4"
-    ]
-    
+    """启动vLLM服务（后台启动，不等待就绪；已在运行时直接返回）"""
+    status = get_lifecycle_daemon().expect_demand(VLLM_SERVICE["model_name"])
+    if status == FAILED:
+        print(f"❌ vLLM服务启动失败，端口: {VLLM_SERVICE['port']}, "
+              f"错误: {get_lifecycle_daemon().get_status(VLLM_SERVICE['model_name'])['error']}")
+        return False
+    print(f"✅ vLLM服务{'已在运行' if status == READY else '开始启动'}，端口: {VLLM_SERVICE['port']}")
+    return True
+
+def expect_vllm_demand():
+    """
+    任务入队时通知生命周期守护很快会用到QA模型：只在后台开始启动，不检查、不等待就绪，
+    出错时只打印日志，不影响任务提交（真正的启动和等待就绪在后台任务中进行）
+    """
     try:
-        print(f"启动vLLM服务，端口: {VLLM_SERVICE['port']}, 使用所有GPU")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-        
-        if result.returncode == 0:
-            print(f"✅ vLLM服务启动成功，端口: {VLLM_SERVICE['port']}")
-            # 等待服务启动
-            time.sleep(30)
-            return True
-        else:
-            print(f"❌ vLLM服务启动失败，端口: {VLLM_SERVICE['port']}, 错误: {result.stderr}")
-            return False
-            
+        get_lifecycle_daemon().expect_demand(VLLM_SERVICE["model_name"])
     except Exception as e:
-        print(f"❌ 启动vLLM服务出错，端口: {VLLM_SERVICE['port']}, 错误: {str(e)}")
-        return False
+        print(f"⚠️ 预先启动vLLM服务失败（任务执行时重试）: {str(e)}")
 
 def stop_vllm_service():
     """停止vLLM服务"""
     print("停止vLLM服务...")
-    
-    try:
-        # 停止并删除容器
-        subprocess.run(["docker", "stop", VLLM_SERVICE["container_name"]], capture_output=True)
-        subprocess.run(["docker", "rm", VLLM_SERVICE["container_name"]], capture_output=True)
-        print(f"✅ 停止vLLM服务，端口: {VLLM_SERVICE['port']}")
-    except Exception as e:
-        print(f"⚠️ 停止vLLM服务出错，端口: {VLLM_SERVICE['port']}, 错误: {str(e)}")
+    get_lifecycle_daemon().stop(VLLM_SERVICE["model_name"], remove=True)
 
 def check_vllm_service_health():
     """检查vLLM服务健康状态"""
@@ -110,7 +196,7 @@ def verify_lora_model_loaded():
             available_models = [model.get('id', '') for model in models_data.get('data', [])]
             print(f"可用模型列表: {available_models}")
             
-            lora_model_name = "llama3.1_8b"
+            lora_model_name = QA_LORA_MODEL_NAME
             if lora_model_name in available_models:
                 print(f"✅ LoRA模型 '{lora_model_name}' 已正确加载")
                 return True
@@ -131,35 +217,95 @@ import aiohttp
 from concurrent.futures import ThreadPoolExecutor
 import json
 
-async def call_vllm_api_async(messages, max_tokens=2000, session=None):
-    """异步调用vLLM API"""
-    url = f"http://localhost:{VLLM_SERVICE['port']}/v1/chat/completions"
+# 实际请求使用的模型名称（首次解析后缓存）
+QA_LORA_MODEL_NAME = _QA_MODEL_CONFIG["lora_module_name"]
+_served_model_name = None
+
+def _cache_served_model_name(models_data):
+    """从 /v1/models 的返回中选定模型名称并缓存：优先使用 LoRA 模型"""
+    global _served_model_name
+    available_models = [model.get('id', '') for model in models_data.get('data', [])]
+    print(f"可用模型列表: {available_models}")
+    
+    if QA_LORA_MODEL_NAME in available_models:
+        model_name = QA_LORA_MODEL_NAME
+        print(f"✅ 使用 LoRA 模型: {model_name}")
+    elif available_models:
+        model_name = available_models[0]
+        print(f"⚠️ LoRA 模型未找到，使用第一个可用模型: {model_name}")
+    else:
+        model_name = QA_LORA_MODEL_NAME
+        print(f"⚠️ 未找到可用模型，使用默认模型: {model_name}")
+    
+    _served_model_name = model_name
+    return model_name
+
+def resolve_qa_model_name(refresh=False):
+    """
+    获取请求使用的模型名称
+    只在第一次（或refresh=True时）请求 /v1/models，获取失败时使用默认模型且不缓存，下次再试
+    """
+    if _served_model_name is not None and not refresh:
+        return _served_model_name
     
-    # 首先获取可用的模型列表
     try:
-        async with session.get(f"http://localhost:{VLLM_SERVICE['port']}/v1/models", timeout=10) as response:
-            if response.status == 200:
-                models_data = await response.json()
-                available_models = [model.get('id', '') for model in models_data.get('data', [])]
-                print(f"可用模型列表: {available_models}")
-                
-                # 优先使用 LoRA 模型
-                lora_model_name = "llama3.1_8b"
-                if lora_model_name in available_models:
-                    model_name = lora_model_name
-                    print(f"✅ 使用 LoRA 模型: {model_name}")
-                elif available_models:
-                    model_name = available_models[0]
-                    print(f"⚠️ LoRA 模型未找到，使用第一个可用模型: {model_name}")
-                else:
-                    model_name = "llama3.1_8b"
-                    print(f"⚠️ 未找到可用模型，使用默认模型: {model_name}")
-            else:
-                model_name = "llama3.1_8b"
-                print(f"⚠️ 获取模型列表失败，使用默认模型: {model_name}")
+        response = requests.get(f"http://localhost:{VLLM_SERVICE['port']}/v1/models", timeout=10)
+        if response.status_code == 200:
+            return _cache_served_model_name(response.json())
+        print(f"⚠️ 获取模型列表失败，使用默认模型: {QA_LORA_MODEL_NAME}")
     except Exception as e:
-        model_name = "llama3.1_8b"
-        print(f"⚠️ 获取模型列表出错: {str(e)}，使用默认模型: {model_name}")
+        print(f"⚠️ 获取模型列表出错: {str(e)}，使用默认模型: {QA_LORA_MODEL_NAME}")
+    return QA_LORA_MODEL_NAME
+
+def is_qa_response_parsable(ai_response):
+    """回复中是否包含可解析的层级判断（与 parse_remark_and_adjust_data 的判断一致）"""
+    return bool(QA_LEVEL_JUDGEMENT_PATTERN.search(ai_response))
+
+def audit_qa_prompt(item_data, system_prompt, user_prompt, ai_response, elapsed):
+    """把一次请求交给审计日志（只做采样和入队，不阻塞调用方）"""
+    if not ai_response:
+        status = "failed"
+    elif not is_qa_response_parsable(ai_response):
+        status = "unparsable"
+    else:
+        status = "ok"
+    get_prompt_audit_logger().record(
+        item_data.get("run_id"), item_data["index"], system_prompt, user_prompt, ai_response,
+        status=status, latency_ms=round(elapsed * 1000), current_text=item_data["item"].get("text", "")
+    )
+
+def build_qa_messages(system_prompt, user_prompt):
+    """
+    构建请求消息，固定为 [system, user] 两条
+    system prompt 逐字节不变、位于最前，所有请求共享同一段前缀
+    """
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+async def call_vllm_api_async(messages, max_tokens=2000, session=None):
+    """
+    异步调用vLLM API（有多个副本时发往在途请求最少的副本）
+    熔断断开时请求不发出，直接抛出 CircuitOpenError（由批次循环挂起等待恢复后重新处理）
+    """
+    endpoint_pool = get_endpoint_pool(VLLM_SERVICE["model_name"])
+    circuit_breaker = get_circuit_breaker(VLLM_SERVICE["model_name"])
+    
+    # 模型名称只在第一次调用时解析，之后所有请求固定使用同一个模型（LoRA），保证前缀缓存命中
+    model_name = _served_model_name
+    if model_name is None:
+        try:
+            async with session.get(f"http://localhost:{VLLM_SERVICE['port']}/v1/models", timeout=10) as response:
+                if response.status == 200:
+                    models_data = await response.json()
+                    model_name = _cache_served_model_name(models_data)
+                else:
+                    model_name = QA_LORA_MODEL_NAME
+                    print(f"⚠️ 获取模型列表失败，使用默认模型: {model_name}")
+        except Exception as e:
+            model_name = QA_LORA_MODEL_NAME
+            print(f"⚠️ 获取模型列表出错: {str(e)}，使用默认模型: {model_name}")
     
     payload = {
         "model": model_name,
@@ -168,48 +314,32 @@ async def call_vllm_api_async(messages, max_tokens=2000, session=None):
         "stream": False
     }
     
+    probe = circuit_breaker.acquire()
+    endpoint = endpoint_pool.acquire()
+    endpoint_ok = False
     try:
-        async with session.post(url, json=payload, timeout=300) as response:
+        async with session.post(f"{endpoint}/v1/chat/completions", json=payload, timeout=300) as response:
+            endpoint_ok = response.status < 500
             if response.status == 200:
                 result = await response.json()
                 return result["choices"][0]["message"]["content"]
             else:
                 error_text = await response.text()
-                print(f"❌ API调用失败，状态码: {response.status}, 错误: {error_text[:200]}")
+                print(f"❌ API调用失败（{endpoint}），状态码: {response.status}, 错误: {error_text[:200]}")
                 return ""
     except Exception as e:
-        print(f"❌ 异步API调用出错: {str(e)}")
+        print(f"❌ 异步API调用出错（{endpoint}）: {str(e)}")
         return ""
+    finally:
+        service_ok = endpoint_pool.release(endpoint, endpoint_ok)
+        circuit_breaker.release(service_ok, probe)
 
 def call_vllm_api(messages, max_tokens=2000):
-    """同步调用vLLM API（保持向后兼容）"""
-    url = f"http://localhost:{VLLM_SERVICE['port']}/v1/chat/completions"
+    """同步调用vLLM API（保持向后兼容），熔断断开时抛出 CircuitOpenError"""
+    endpoint_pool = get_endpoint_pool(VLLM_SERVICE["model_name"])
+    circuit_breaker = get_circuit_breaker(VLLM_SERVICE["model_name"])
     
-    # 首先获取可用的模型列表
-    try:
-        response = requests.get(f"http://localhost:{VLLM_SERVICE['port']}/v1/models", timeout=10)
-        if response.status_code == 200:
-            models_data = response.json()
-            available_models = [model.get('id', '') for model in models_data.get('data', [])]
-            print(f"可用模型列表: {available_models}")
-            
-            # 优先使用 LoRA 模型
-            lora_model_name = "llama3.1_8b"
-            if lora_model_name in available_models:
-                model_name = lora_model_name
-                print(f"✅ 使用 LoRA 模型: {model_name}")
-            elif available_models:
-                model_name = available_models[0]
-                print(f"⚠️ LoRA 模型未找到，使用第一个可用模型: {model_name}")
-            else:
-                model_name = "llama3.1_8b"
-                print(f"⚠️ 未找到可用模型，使用默认模型: {model_name}")
-        else:
-            model_name = "llama3.1_8b"
-            print(f"⚠️ 获取模型列表失败，使用默认模型: {model_name}")
-    except Exception as e:
-        model_name = "llama3.1_8b"
-        print(f"⚠️ 获取模型列表出错: {str(e)}，使用默认模型: {model_name}")
+    model_name = resolve_qa_model_name()
     
     payload = {
         "model": model_name,
@@ -219,20 +349,27 @@ def call_vllm_api(messages, max_tokens=2000):
         "stream": False
     }
     
+    probe = circuit_breaker.acquire()
+    endpoint = endpoint_pool.acquire()
+    endpoint_ok = False
     try:
-        response = requests.post(url, json=payload, timeout=300)
+        response = requests.post(f"{endpoint}/v1/chat/completions", json=payload, timeout=300)
+        endpoint_ok = response.status_code < 500
         
         if response.status_code == 200:
             result = response.json()
             return result["choices"][0]["message"]["content"]
         else:
-            print(f"❌ API调用失败，状态码: {response.status_code}")
+            print(f"❌ API调用失败（{endpoint}），状态码: {response.status_code}")
             print(f"错误信息: {response.text[:200]}")  # 只显示前200个字符
             return ""
                 
     except Exception as e:
-        print(f"❌ API调用出错: {str(e)}")
+        print(f"❌ API调用出错（{endpoint}）: {str(e)}")
         return ""
+    finally:
+        service_ok = endpoint_pool.release(endpoint, endpoint_ok)
+        circuit_breaker.release(service_ok, probe)
 
 async def process_single_item(item_data, session, semaphore):
     """处理单个数据项的协程"""
@@ -249,18 +386,16 @@ async def process_single_item(item_data, session, semaphore):
 
     # 在任务内部构建 prompt 和 messages，确保数据隔离
     system_prompt, user_prompt = build_prompt(instruction, context_data)
-    
-    print(f"\n=== 处理数据 index: {original_index} ===")
-    print(f"System Prompt: {system_prompt}")
-    print(f"User Prompt: {user_prompt}")
-    
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt},
-    ]
+    messages = build_qa_messages(system_prompt, user_prompt)
+    token_budget = get_token_budget("qa")
+    target_text = context_data[2]["text"]
+    max_tokens = token_budget.max_tokens(target_text)
 
     async with semaphore:
-        ai_response = await call_vllm_api_async(messages, session=session)
+        started_at = time.time()
+        ai_response = await call_vllm_api_async(messages, max_tokens=max_tokens, session=session)
+        token_budget.record_output(ai_response, target_text, max_tokens)
+        audit_qa_prompt(item_data, system_prompt, user_prompt, ai_response, time.time() - started_at)
         return {
             "index": original_index, "ai_response": ai_response,
             "current_text": current_item.get("text", ""), "item": current_item
@@ -293,22 +428,12 @@ async def process_batch_with_vllm_async(batch_data):
                     "index": batch_data[i]["index"],
                     "ai_response": "",
                     "current_text": batch_data[i]["item"].get("text", ""),
-                    "item": batch_data[i]["item"]
+                    "item": batch_data[i]["item"],
+                    "rejected": isinstance(result, CircuitOpenError)  # 熔断拒绝，请求没有发出
                 })
             else:
-                original_index, ai_response = result
-                # 打印输出结果
-                print(f"\n=== 输出结果 index: {original_index} ===")
-                print(f"AI Response: {ai_response}")
-                print(f"Current Text: {batch_data[i]['item'].get('text', '')}")
-                print("=" * 50)
-                
-                temp_results.append({
-                    "index": original_index,
-                    "ai_response": ai_response,
-                    "current_text": batch_data[i]["item"].get("text", ""),
-                    "item": batch_data[i]["item"]
-                })
+                # process_single_item 已经返回完整的结果字典
+                temp_results.append(result)
         
         # 按原始索引排序
         temp_results.sort(key=lambda x: x["index"])
@@ -348,26 +473,17 @@ def process_batch_with_vllm_sync(batch_data):
             # 构建prompt
             system_prompt, user_prompt = build_prompt(instruction, context_data)
             
-            # 打印prompt信息
-            print(f"\n=== 处理数据 index: {item_data['index']} (同步模式) ===")
-            print(f"System Prompt: {system_prompt}")
-            print(f"User Prompt: {user_prompt}")
-            # print(f"Context Data: {json.dumps(context_data, ensure_ascii=False, indent=2)}")
-            
             # 构建消息格式
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ]
+            messages = build_qa_messages(system_prompt, user_prompt)
             
             # 调用vLLM API
-            ai_response = call_vllm_api(messages)
-            
-            # 打印输出结果
-            print(f"\n=== 输出结果 index: {item_data['index']} (同步模式) ===")
-            print(f"AI Response: {ai_response}")
-            print(f"Current Text: {current_item.get('text', '')}")
-            print("=" * 50)
+            token_budget = get_token_budget("qa")
+            target_text = context_data[2]["text"]
+            max_tokens = token_budget.max_tokens(target_text)
+            started_at = time.time()
+            ai_response = call_vllm_api(messages, max_tokens=max_tokens)
+            token_budget.record_output(ai_response, target_text, max_tokens)
+            audit_qa_prompt(item_data, system_prompt, user_prompt, ai_response, time.time() - started_at)
             
             results.append({
                 "index": item_data["index"],
@@ -382,145 +498,51 @@ def process_batch_with_vllm_sync(batch_data):
                 "index": item_data["index"],
                 "ai_response": "",
                 "current_text": current_item.get("text", ""),
-                "item": current_item
+                "item": current_item,
+                "rejected": isinstance(e, CircuitOpenError)  # 熔断拒绝，请求没有发出
             })
     
     return results
 
 def build_prompt(instruction, input_data):
-    """构建prompt，使用你的instruction模板"""
-    # 修正前两个占位符的page_idx
+    """构建prompt，使用你的instruction模板；前后文块按token预算裁剪（见 fit_qa_context）"""
+    fix_placeholder_page_idx(input_data)
+    return QA_SYSTEM_PROMPT, format_qa_user_prompt(instruction, fit_qa_context(instruction, input_data))
+
+def fix_placeholder_page_idx(input_data):
+    """修正前两个占位符的page_idx"""
     for idx, item in enumerate(input_data):
-        if idx < 2 and item.get("text") == "(此text不是有效文本，不需要参与判断)" and item.get("page_idx", 0) == 0:
+        if idx < 2 and item.get("text") == QA_PLACEHOLDER_TEXT and item.get("page_idx", 0) == 0:
             item["page_idx"] = -1
-    instruction_template = """
-你是文本切割处理的审核专家，将会看到一个目标文本块，以及它的前两个文本块和后一个文本块。
+    return input_data
 
-你的任务是**目标文本块（即第三个）**（1）判断是哪一种新层级（2）是否存在以下四类错误，并给出对应判断和修改建议。
-根据第三文本块上下文进行层级判断：
-（1）结构新层级：第三文本块的开头是文章的结构性标题，特征如："第一章 增值税"等，是一个标题词汇；
-（2）段落新层级：第三文本块的开头句子是正文段落内的叙述标题，特征也如：（1）、一、首先、a.等，但是一句句子；
-（3）附注图表新层级：1.文本块开头句子正文内容中特指附注的小标题，特征如："附：XX"等，2.文本块开头句子正文内容中特指图表的小标题，特征如：图：XXXX，下表如：，等；
-**注意**不是内容里有说到图或表就是附注图表新层级，而是特指后面文本块跟着是表或图！
-（4）非新层级：文本块开头句子没有明确新文本层级结构特征；
-
-错误文本内容判断：
-（1）字符错误：文本含有不合理字符，如乱码、错误符号、错别字、混杂代码符号（公式不算）；
-（2）格式错误：文本块开头是句子残段，其上半句存在于上一个文本块结尾；
-（3）信息错误：文本块为空、为页码、目录、标题页、版权页、装订信息等与正文无关的内容。
-（4）需要拆分：文本块有多个层级的文本块，在原文中加入"<mark>"将其区分。**注意**最后必须以<summary>作为结尾
-
-正确文本内容判断：
-如果目标文本块不存在上述四类问题，即为正常文本块。
-
-判断顺序：（1）判断是哪一种新层级（2）判断文本块内容是否错误
-
-输出格式要求：
-判断结论请统一使用如下格式：
-因为阅读上下文第三文本块XXX，所以判断为{XX新层级}。因为第三文本块因xxx，所以判断为{错误类型}，建议处理方式为：{修改方式}
-如果文本无误，请回复：
-因为阅读上下文第三文本块XXX，所以判断为{XX新层级}。因为第三文本块因没有四类错误，所以判断为{正确}。第三文本块不做任何修改。
-
-
-
-举例情况（1）：开头是段落新层级且为字符错误；
-    {
-        "text": "答：可以。根据文件规定：",
-        "page_idx": 6
-    },
-    {
-        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
-        "page_idx": 6
-    },
-    {
-        "text": "二、。增值税小规模纳税人适用3%征收率@的应税销售收人",
-        "page_idx": 6
-    },
-    {
-        "text": "，减按1%征收率@征收增值税。",
-        "page_idx": 7
-    },
-你应该回复：因为阅读上下文第三文本块是正文段落内的叙述标题，所以判断为{段落新层级}。因为第三文本块因含有不合理字符，所以判断为{文本错误}。建议处理方式为：{二、增值税小规模纳税人适用3%征收率的应税销售收入。}
-
-举例情况（2）：开头非新层级且格式错误（开头为残句）
-    {
-        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
-        "page_idx": 6
-    },
-    {
-        "text": "二、。增值税小规模纳税人适用3%征收率@的应税销售收入",
-        "page_idx": 6
-    },
-    {
-        "text": "，减按1%征收率@征收增值税。",
-        "page_idx": 7
-    },
-    {
-        "text": "三、本公告执行至2027年12月31日。",
-        "page_idx": 7
-    },
-你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因开始处句子不完整，所以判断为{格式错误}。建议处理方式为：{向前合并}且{删除}
-
-举例情况（3）：开头非新层级且需要拆分（包含多个层级）
-[
-  {
-    "text": "（四）通过纳税客体的非转移进行的国际避税",
-    "page_idx": 248
-  },
-  {
-    "text": "纳税客体的非转移，又称物的不流动。物的不流动，是指跨国纳税人在不移动资金、货物和劳务的情况下，采取其他手段避免自己的所得受到税收管辖。",
-    "page_idx": 248
-  },
-  {
-    "text": "通过物的不流动进行国际避税，主要有两种做法：一是变更公司组织形式以改变所得性质；二是利用延期纳税方式。",
-    "page_idx": 248
-  },
-  {
-    "text": "1.变更公司组织形式以改变所得性质",
-    "page_idx": 248
-  }
-]
-你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因含有多个文本块，所以判断为{需要拆分}。建议处理方式为：{通过物的不流动进行国际避税，主要有两种做法：<mark>一是变更公司组织形式以改变所得性质；<mark>二是利用延期纳税方式。<mark>}
-**注意**如果后面的第四个文本块不会是新的层级，你需要在结尾标记上<summary>,从而告诉我们层级的结束位置！
-
-举例情况（4）：开头非新层级且信息错误（无效内容）
-    {
-        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
-        "page_idx": 6
-    },
-    {
-        "text": "二、。增值税小规模纳税人适用3%征收率@的应税销售收入",
-        "page_idx": 6
-    },
-    {
-        "text": "12366热点问答年度精选汇编",
-        "page_idx": 7
-    },
-    {
-        "text": "，减按1%征收率@征收增值税。",
-        "page_idx": 7
-    },
-你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因是夹杂信息，所以判断为{信息错误}。建议处理方式为：{删除}
-"""
-    
+def format_qa_user_prompt(instruction, input_data):
     input_text = json.dumps(input_data, ensure_ascii=False, indent=2)
     instruction_text = f"需要你回答的问题是：\"{instruction}\""
     input_text = f"需要分析的这段语句是：{input_text}"
 
-    # 日志追加写入，带BOM，保证Windows记事本不乱码
-    log_path = "prompt_input_log.txt"
-    if not os.path.exists(log_path):
-        with open(log_path, "w", encoding="utf-8-sig") as f:
-            pass
-    try:
-        with open(log_path, "a", encoding="utf-8-sig") as logf:
-            logf.write(f"\n[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}]\n{input_text}\n")
-    except Exception as e:
-        print(f"[日志写入失败] {e}")
+    return f"{instruction_text}\n{input_text}\n请根据问题要求与问题进行回答"
 
-    prompt = f"{instruction_text}\n{input_text}\n请根据问题要求与问题进行回答"
-    
-    return instruction_template, prompt
+@functools.lru_cache(maxsize=8)
+def _qa_prompt_fixed_tokens(instruction):
+    """user prompt中文本块以外部分（问题、JSON格式）的token数"""
+    empty_blocks = [{"text": "", "page_idx": 0} for _ in range(4)]
+    return get_token_budget("qa").count(format_qa_user_prompt(instruction, empty_blocks))
+
+def fit_qa_context(instruction, input_data):
+    """
+    按token预算裁剪上下文窗口中的前后文块：前文保留靠近目标的结尾，后文保留开头；
+    目标文本块（第三块）会被建议处理方式完整复述，不裁剪。没有超出预算时原样返回
+    """
+    token_budget = get_token_budget("qa")
+    if not token_budget.enabled or len(input_data) != 4:
+        return input_data
+    texts = [item.get("text", "") for item in input_data]
+    fitted = token_budget.fit_blocks(texts, _qa_prompt_fixed_tokens(instruction),
+                                     keep_tail=[True, True, False, False], protected=[2])
+    if fitted == texts:
+        return input_data
+    return [{**item, "text": text} for item, text in zip(input_data, fitted)]
 
 def get_api_key(key_name="openai"):
     """
@@ -566,39 +588,97 @@ def split_text():
     print("split_text")
     return
 
-def process_qa_for_version_0(run_id: str) -> dict:
+class QAProcessCancelled(Exception):
+    """QA处理任务被取消"""
+    pass
+
+def _check_cancelled(cancel_event, run_id: str):
+    """检查取消标记，已取消则中断处理"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise QAProcessCancelled(f"QA问答对处理已取消，run_id: {run_id}")
+
+def _wait_for_qa_circuit(circuit_breaker, cancel_event, run_id: str):
+    """
+    熔断断开时挂起等待服务恢复（或可以发出探测请求），每5秒醒来一次检查是否取消；
+    fail_fast 模式不等待，超过 park_timeout 仍未恢复时中止处理
+    """
+    if not circuit_breaker.park_timeout:
+        return
+    deadline = time.time() + circuit_breaker.park_timeout
+    while not circuit_breaker.wait_available(timeout=min(5, max(0, deadline - time.time()))):
+        _check_cancelled(cancel_event, run_id)
+        if time.time() >= deadline:
+            raise RunAbortedError(f"QA vLLM服务 {circuit_breaker.park_timeout}秒内未恢复，中止处理，run_id: {run_id}")
+
+def is_qa_text_block(item: dict) -> bool:
+    """是否为参与QA处理的text类型文本块"""
+    item_type = item.get("type", "正文")
+    return item_type.lower() == "text" or item_type == "正文"
+
+def build_qa_context_windows(sorted_data: list) -> list:
+    """
+    为每个text类型文本块构建上下文（前两个和后一个text文本块），非text位置为None
+    - 前文为空文本时替换为占位文本，不足两个时用占位符补齐
+    - 当前文本块和后一个文本块为空时保持为空，不加占位符
+    - 没有后文时添加占位符
+    """
+    def before_block(item):
+        return {
+            "text": item.get("text", "").strip() or QA_PLACEHOLDER_TEXT,
+            "page_idx": item.get("page_index", 0)
+        }
+
+    def block(item):
+        return {
+            "text": item.get("text", "").strip(),
+            "page_idx": item.get("page_index", 0)
+        }
+
+    return build_context_windows(
+        sorted_data,
+        is_qa_text_block,
+        before=2,
+        after=1,
+        make_before=before_block,
+        make_target=block,
+        make_after=block,
+        padding=lambda: {"text": QA_PLACEHOLDER_TEXT, "page_idx": 0}
+    )
+
+def process_qa_for_version_0(run_id: str, progress_callback=None, cancel_event=None) -> dict:
     """
     对版本0的数据进行QA问答对处理，生成版本1 - 使用vLLM服务版本
     
     Args:
         run_id (str): 运行ID
+        progress_callback (callable): 进度回调 progress_callback(stage, completed, total)，可选
+        cancel_event (threading.Event): 取消标记，被设置后在下一个检查点抛出 QAProcessCancelled，可选
         
     Returns:
         dict: 处理结果，包含新版本号和处理数量
     """
+    def report(stage, completed=0, total=0):
+        if progress_callback is not None:
+            progress_callback(stage, completed, total)
+
+    daemon = get_lifecycle_daemon()
     try:
         print(f"开始处理QA问答对，run_id: {run_id}")
         
-        # 1. 启动vLLM服务
+        # 1. 启动vLLM服务，处理期间持有租约，服务不会被空闲停止
+        report("starting_vllm")
+        daemon.acquire(VLLM_SERVICE["model_name"])
         if not start_vllm_service():
             raise Exception("vLLM服务启动失败")
         
-        # 等待服务启动完成
+        # 等待服务就绪：就绪时立即被唤醒，每5秒醒来一次检查是否取消
         print("等待vLLM服务启动...")
-        max_wait_time = 300  # 最多等待5分钟
-        check_interval = 10  # 每10秒检查一次
-        waited_time = 0
-        
-        while waited_time < max_wait_time:
-            if check_vllm_service_health():
-                print(f"✅ vLLM服务健康检查通过，端口: {VLLM_SERVICE['port']}")
-                break
-            else:
-                print(f"⏳ 服务尚未就绪，等待中... ({waited_time}/{max_wait_time}秒)")
-                time.sleep(check_interval)
-                waited_time += check_interval
-        else:
-            raise Exception(f"vLLM服务启动超时，等待了{max_wait_time}秒后仍未就绪，端口: {VLLM_SERVICE['port']}")
+        while not daemon.wait_ready(VLLM_SERVICE["model_name"], timeout=5):
+            _check_cancelled(cancel_event, run_id)
+            status = daemon.get_status(VLLM_SERVICE["model_name"])
+            if status["status"] != "starting":
+                raise Exception(f"vLLM服务启动失败，端口: {VLLM_SERVICE['port']}, 错误: {status['error']}")
+        print(f"✅ vLLM服务已就绪，端口: {VLLM_SERVICE['port']}")
         
         # 验证LoRA模型是否正确加载
         if not verify_lora_model_loaded():
@@ -606,6 +686,9 @@ def process_qa_for_version_0(run_id: str) -> dict:
         else:
             print("✅ LoRA模型验证成功")
         
+        # 服务可能刚重启过，重新解析一次模型名称，本次处理的所有请求都使用它
+        resolve_qa_model_name(refresh=True)
+        
         # 2. 获取版本0的数据
         version_0_data = query_pdf_text_contents(run_id, 0)
         
@@ -623,78 +706,25 @@ def process_qa_for_version_0(run_id: str) -> dict:
         
         print(f"开始准备 {len(sorted_data)} 条数据，按页面和块索引排序")
         
+        # 一次遍历建立text块位置索引，为每个text块构建「前两个 + 当前 + 后一个」的4块上下文
+        context_windows = build_qa_context_windows(sorted_data)
+        
+        # 构建instruction
+        instruction = QA_INSTRUCTION
+        
         for i, current_item in enumerate(sorted_data):
-            item_type = current_item.get("type", "正文")
+            context_data = context_windows[i]
             
             # 只处理text类型的文本块
-            if item_type.lower() == "text" or item_type == "正文":
+            if context_data is not None:
                 text_processed_count += 1
                 
-                # 构建上下文数据（前两个和后一个文本块）
-                context_data = []
-                
-                # 添加前两个text类型的文本块（如果存在）
-                prev_count = 0
-                for j in range(i-1, -1, -1):  # 从当前索引向前查找
-                    if prev_count >= 2:  # 已经找到2个前文
-                        break
-                    prev_item = sorted_data[j]
-                    prev_type = prev_item.get("type", "正文")
-                    if prev_type.lower() == "text" or prev_type == "正文":
-                        text = prev_item.get("text", "").strip()
-                        if not text:  # 如果text为空
-                            text = "(此text不是有效文本，不需要参与判断)"
-                        context_data.insert(0, {  # 插入到开头，保持顺序
-                            "text": text,
-                            "page_idx": prev_item.get("page_index", 0)
-                        })
-                        prev_count += 1
-                
-                # 如果前文不足2个，用占位符填充
-                while len(context_data) < 2:
-                    context_data.insert(0, {
-                        "text": "(此text不是有效文本，不需要参与判断)",
-                        "page_idx": 0
-                    })
-                
-                # 添加当前文本块（第三个）
-                current_text = current_item.get("text", "").strip()
-                # 当前文本块遇到空时保持为空，不加占位符
-                context_data.append({
-                    "text": current_text,
-                    "page_idx": current_item.get("page_index", 0)
-                })
-                
-                # 添加后一个text类型的文本块（如果存在）
-                has_next = False
-                for j in range(i+1, len(sorted_data)):
-                    next_item = sorted_data[j]
-                    next_type = next_item.get("type", "正文")
-                    if next_type.lower() == "text" or next_type == "正文":
-                        next_text = next_item.get("text", "").strip()
-                        # 后一个文本块遇到空时保持为空，不加占位符
-                        context_data.append({
-                            "text": next_text,
-                            "page_idx": next_item.get("page_index", 0)
-                        })
-                        has_next = True
-                        break  # 只添加第一个后文
-                
-                # 如果没有后文，添加占位符
-                if not has_next:
-                    context_data.append({
-                        "text": "(此text不是有效文本，不需要参与判断)",
-                        "page_idx": 0
-                    })
-                
                 # 确保context_data正好有4个元素
                 assert len(context_data) == 4, f"上下文数据长度不正确: {len(context_data)}, 应该是4个"
                 
-                # 构建instruction
-                instruction = "请问第三文本块是否为新的层级？另外，内容是否正确，如果错误应该建议如何修改"
-                
                 # 添加到处理队列
                 data_to_process.append({
+                    "run_id": run_id,
                     "index": i,
                     "item": current_item,
                     "context_data": context_data,
@@ -703,6 +733,7 @@ def process_qa_for_version_0(run_id: str) -> dict:
             else:
                 # 对于非text类型（如table），添加到处理队列但标记为空处理
                 data_to_process.append({
+                    "run_id": run_id,
                     "index": i,
                     "item": current_item,
                     "context_data": [],
@@ -714,28 +745,80 @@ def process_qa_for_version_0(run_id: str) -> dict:
         # 4. 使用vLLM服务处理数据
         print("开始使用vLLM服务处理数据...")
         
-        # 分批处理，避免单次请求过大
-        batch_size = 5  # 每批处理5条数据，减少并发压力
+        # 读取运行日志：上次中断前已完成的条目直接复用，只处理缺失的索引
         all_results = []
+        journal = query_qa_journal(run_id)
+        if journal:
+            print(f"检测到未完成的运行日志，已完成 {len(journal)} 条，将只处理缺失部分")
+        pending_data = []
+        for item_data in data_to_process:
+            if item_data["instruction"] and item_data["index"] in journal:
+                all_results.append({
+                    "index": item_data["index"],
+                    "ai_response": journal[item_data["index"]],
+                    "current_text": item_data["item"].get("text", ""),
+                    "item": item_data["item"]
+                })
+            else:
+                pending_data.append(item_data)
         
-        for i in range(0, len(data_to_process), batch_size):
-            batch = data_to_process[i:i+batch_size]
-            print(f"处理批次 {i//batch_size + 1}/{(len(data_to_process) + batch_size - 1)//batch_size}，共 {len(batch)} 条数据")
+        # 分批处理，避免单次请求过大
+        batch_size = 5  # 每批处理5条数据，减少并发压力
+        completed_count = len(all_results)
+        report("processing", completed_count, text_processed_count)
+        
+        # 熔断：服务宕机时批次之间挂起等待恢复（不再让每条请求各自重试、得到空回复），
+        # 熔断拒绝的条目放回队列等恢复后重新处理；连续失败的条目过多时中止本次处理（运行日志保留，可续跑）
+        circuit_breaker = get_circuit_breaker(VLLM_SERVICE["model_name"])
+        failure_guard = RunFailureGuard(name=f"QA问答对处理 {run_id}")
+        
+        position = 0
+        batch_number = 0
+        while position < len(pending_data):
+            _check_cancelled(cancel_event, run_id)
+            _wait_for_qa_circuit(circuit_breaker, cancel_event, run_id)
+            batch = pending_data[position:position+batch_size]
+            position += batch_size
+            batch_number += 1
+            print(f"处理批次 {batch_number}/{batch_number + (len(pending_data) - position + batch_size - 1)//batch_size}，共 {len(batch)} 条数据")
             
+            instructed = {item["index"] for item in batch if item["instruction"]}
             try:
                 batch_results = process_batch_with_vllm(batch)
+                if circuit_breaker.park_timeout:
+                    # 熔断拒绝的，以及熔断断开前后失败的请求，都是服务宕机造成的
+                    service_down = circuit_breaker.state != CLOSED
+                    requeued = {result["index"] for result in batch_results
+                                if result.get("rejected") or (service_down and not result["ai_response"]
+                                                              and result["index"] in instructed)}
+                    if requeued:
+                        print(f"⚠️ {len(requeued)} 条请求因服务熔断未完成，恢复后重新处理")
+                        pending_data.extend(item for item in batch if item["index"] in requeued)
+                        batch_results = [result for result in batch_results if result["index"] not in requeued]
                 all_results.extend(batch_results)
-                print(f"✅ 批次 {i//batch_size + 1} 处理完成")
+                # 每批结果返回后立即追加写入运行日志
+                try:
+                    insert_qa_journal_entries(run_id, batch_results)
+                except Exception as journal_error:
+                    print(f"⚠️ 写入运行日志失败: {str(journal_error)}")
+                print(f"✅ 批次 {batch_number} 处理完成")
             except Exception as e:
-                print(f"❌ 批次 {i//batch_size + 1} 处理失败: {str(e)}")
+                print(f"❌ 批次 {batch_number} 处理失败: {str(e)}")
                 # 对于失败的批次，添加空结果
-                for item in batch:
-                    all_results.append({
-                        "index": item["index"],
-                        "ai_response": "",
-                        "current_text": item["item"].get("text", ""),
-                        "item": item["item"]
-                    })
+                batch_results = [{
+                    "index": item["index"],
+                    "ai_response": "",
+                    "current_text": item["item"].get("text", ""),
+                    "item": item["item"]
+                } for item in batch]
+                all_results.extend(batch_results)
+            
+            # text块才会请求AI，计入连续失败数，达到阈值时抛出 RunAbortedError
+            completed_count += sum(1 for result in batch_results if result["index"] in instructed)
+            for result in batch_results:
+                if result["index"] in instructed:
+                    failure_guard.record(bool(result["ai_response"]), "AI响应为空")
+            report("processing", completed_count, text_processed_count)
         
         # 按原始索引排序
         all_results.sort(key=lambda x: x["index"])
@@ -745,92 +828,9 @@ def process_qa_for_version_0(run_id: str) -> dict:
         # 5. 根据AI分析结果调整数据
         print("根据AI分析结果调整数据...")
         
-        # 第一步：先解析所有AI建议，生成修正后的文本
-        for i, analysis in enumerate(all_results):
-            ai_response = analysis["ai_response"]
-            current_text = analysis["current_text"]
-            
-            if ai_response:  # 有AI分析结果
-                # 解析remark并调整数据
-                adjusted_item = parse_remark_and_adjust_data(ai_response, current_text, i, all_results)
-                # 将修正后的文本存储回结果中
-                all_results[i]["adjusted_text"] = adjusted_item["text"]
-                all_results[i]["level_type"] = adjusted_item["level_type"]
-            else:
-                # 没有AI分析结果，保持原文本
-                all_results[i]["adjusted_text"] = current_text
-                all_results[i]["level_type"] = 0
-        
-        # 第二步：处理向前合并的情况（使用修正后的文本）
-        # 先收集所有需要向前合并的块，按索引排序
-        merge_operations = []
-        for i, analysis in enumerate(all_results):
-            ai_response = analysis["ai_response"]
-            if "{向前合并}" in ai_response and "{删除}" in ai_response:
-                # 找到上一个非空文本
-                prev_index = i - 1
-                while prev_index >= 0 and not all_results[prev_index].get("adjusted_text", "").strip():
-                    prev_index -= 1
-                
-                if prev_index >= 0:
-                    merge_operations.append({
-                        "current_index": i,
-                        "target_index": prev_index,
-                        "current_text": analysis.get("adjusted_text", "").lstrip() or analysis["item"].get("text", "").lstrip()
-                    })
-        
-        # 按目标索引排序，确保合并顺序正确（从后往前合并）
-        merge_operations.sort(key=lambda x: x["target_index"], reverse=True)
-        
-        # 执行合并操作
-        for merge_op in merge_operations:
-            current_index = merge_op["current_index"]
-            target_index = merge_op["target_index"]
-            current_text = merge_op["current_text"]
-            
-            # 获取目标文本块的内容
-            target_text = all_results[target_index].get("adjusted_text", "").rstrip()
-            
-            # 检查目标文本是否包含<mark>或<summary>标记
-            last_mark_pos = target_text.rfind("<mark>")
-            last_summary_pos = target_text.rfind("<summary>")
-            
-            # 找到最后一个标记的位置（<mark>或<summary>，取较后的位置）
-            last_tag_pos = max(last_mark_pos, last_summary_pos)
-            
-            if last_tag_pos != -1:
-                # 如果包含标记，将被合并的文本插入到最后一个标记之前
-                merged_text = target_text[:last_tag_pos] + current_text + target_text[last_tag_pos:]
-            else:
-                # 不包含标记，直接拼接
-                merged_text = target_text + current_text
-            
-            # 正则清理<mark>和<summary>后所有空白和换行
-            merged_text = re.sub(r'<mark>[\s\u3000]*', '<mark>', merged_text)
-            merged_text = re.sub(r'<summary>[\s\u3000]*', '<summary>', merged_text)
-            all_results[target_index]["adjusted_text"] = merged_text
-            # 当前文本置空
-            all_results[current_index]["adjusted_text"] = ""
-            print(f"向前合并: 第{current_index}块文本合并到第{target_index}块，合并后文本: {merged_text[:100]}...")
-        
-        # 第三步：处理<mark>和<summary>标记后的格式清理（移除层级调整逻辑）
-        print("处理<mark>和<summary>标记后的格式清理...")
-        for i in range(len(all_results)):
-            current_text = all_results[i].get("adjusted_text", "")
-            
-            # 清理<mark>\n格式问题
-            if "<mark>\n" in current_text:
-                current_text = current_text.replace("<mark>\n", "<mark>")
-                all_results[i]["adjusted_text"] = current_text
-                print(f"第{i}块文本清理<mark>\\n格式")
-            
-            # 清理<summary>\n格式问题
-            if "<summary>\n" in current_text:
-                current_text = current_text.replace("<summary>\n", "<summary>")
-                all_results[i]["adjusted_text"] = current_text
-                print(f"第{i}块文本清理<summary>\\n格式")
+        apply_qa_adjustments(all_results)
         
-        # 第四步：构建最终的处理数据
+        # 构建最终的处理数据
         processed_data = []
         for i, analysis in enumerate(all_results):
             current_item = analysis["item"]
@@ -838,11 +838,6 @@ def process_qa_for_version_0(run_id: str) -> dict:
             adjusted_text = analysis.get("adjusted_text", "")  # 使用最终调整后的文本
             level_type = analysis.get("level_type", 0)
             
-            # 最终清理：确保所有文本都没有<mark>和<summary>后空白和换行
-            if adjusted_text:
-                adjusted_text = re.sub(r'<mark>[ \t\r\n]*', '<mark>', adjusted_text)
-                adjusted_text = re.sub(r'<summary>[ \t\r\n]*', '<summary>', adjusted_text)
-            
             if ai_response:  # 有AI分析结果
                 # 构建处理后的数据项
                 processed_item = {
@@ -875,10 +870,15 @@ def process_qa_for_version_0(run_id: str) -> dict:
         print(f"QA问答对处理完成，共处理 {len(processed_data)} 条记录（其中 {text_processed_count} 条text类型）")
         
         # 6. 保存为版本1，基于版本0
+        _check_cancelled(cancel_event, run_id)
+        report("saving", completed_count, text_processed_count)
         new_version = insert_pdf_text_contents(run_id, processed_data, based_version=0)
         
         print(f"版本1数据保存成功，新版本号: {new_version}")
         
+        # 结果已落库，运行日志不再需要
+        clear_qa_journal(run_id)
+        
         return {
             "run_id": run_id,
             "new_version": new_version,
@@ -887,77 +887,105 @@ def process_qa_for_version_0(run_id: str) -> dict:
             "status": "success"
         }
         
+    except QAProcessCancelled as e:
+        print(str(e))
+        raise
     except Exception as e:
         print(f"QA问答对处理失败: {str(e)}")
         traceback.print_exc()
         raise
     finally:
-        # 清理vLLM服务
-        print("清理vLLM服务...")
-        #stop_vllm_service()
+        # 释放租约，服务空闲超时后由生命周期守护停止
+        daemon.release(VLLM_SERVICE["model_name"])
 
-def parse_remark_and_adjust_data(ai_response: str, current_text: str, current_index: int, all_data: list) -> dict:
-    """
-    解析AI返回的remark，并根据分析结果调整数据
+def apply_qa_adjustments(all_results: list) -> list:
     """
-    # 默认值
-    level_type = 0  # 默认非新层级
-    adjusted_text = current_text
+    根据AI分析结果调整文本（原地修改 all_results，写入 adjusted_text / level_type / merge_forward）
+    1. 解析每条回复（单次扫描），得到层级类型和修正后的文本
+    2. 处理向前合并
+    3. 统一清理一次<mark>和<summary>后的空白和换行
 
-    try:
-        # 层级类型判断
-        if "判断为{结构新层级}" in ai_response:
-            level_type = 1
-        elif "判断为{段落新层级}" in ai_response:
-            level_type = 2
-        elif "判断为{附注图表新层级}" in ai_response:
-            level_type = 3
-        elif "判断为{非新层级}" in ai_response:
-            level_type = 0
-        # 兼容老的"新层级"写法
-        elif "判断为{新层级}" in ai_response:
-            level_type = 1
-
-        # 2. 解析处理方式（原有逻辑不变）
-        if "{删除}" in ai_response:
-            adjusted_text = ""
-        elif "{向前合并}" in ai_response and "{删除}" in ai_response:
-            adjusted_text = current_text
-        elif "{需要拆分}" in ai_response:
-            pattern = r'建议处理方式为：\{(.*?)\}'
-            match = re.search(pattern, ai_response, re.DOTALL)
-            if match:
-                suggested_text = match.group(1).strip()
-                suggested_text = re.sub(r'\\\*\\\*', '**', suggested_text)
-                suggested_text = re.sub(r'<mark>[\s\u3000]*', '<mark>', suggested_text)
-                adjusted_text = suggested_text
-        elif "{文本错误}" in ai_response:
-            # 匹配两种格式：带冒号和不带冒号
-            pattern1 = r'建议处理方式为：\{(.*?)\}'
-            pattern2 = r'建议处理方式为\{(.*?)\}'
-            
-            match = re.search(pattern1, ai_response, re.DOTALL)
-            if not match:
-                match = re.search(pattern2, ai_response, re.DOTALL)
+    Args:
+        all_results: 按原始索引排序的结果，每项包含 ai_response / current_text / item
+    """
+    # 第一步：先解析所有AI建议（每条回复只扫描一次），生成修正后的文本
+    for i, analysis in enumerate(all_results):
+        ai_response = analysis["ai_response"]
+        current_text = analysis["current_text"]
+        
+        if ai_response:  # 有AI分析结果
+            parsed = parse_qa_response(ai_response, current_text)
+            all_results[i]["adjusted_text"] = parsed["text"]
+            all_results[i]["level_type"] = parsed["level_type"]
+            all_results[i]["merge_forward"] = parsed["merge_forward"]
+        else:
+            # 没有AI分析结果，保持原文本
+            all_results[i]["adjusted_text"] = current_text
+            all_results[i]["level_type"] = 0
+            all_results[i]["merge_forward"] = False
+    
+    # 第二步：处理向前合并的情况（使用修正后的文本）
+    # 先收集所有需要向前合并的块，按索引排序
+    merge_operations = []
+    for i, analysis in enumerate(all_results):
+        if analysis["merge_forward"]:
+            # 找到上一个非空文本
+            prev_index = i - 1
+            while prev_index >= 0 and not all_results[prev_index].get("adjusted_text", "").strip():
+                prev_index -= 1
             
-            if match:
-                suggested_text = match.group(1).strip()
-                suggested_text = re.sub(r'\\\*\\\*', '**', suggested_text)
-                suggested_text = re.sub(r'<mark>[\s\u3000]*', '<mark>', suggested_text)
-                adjusted_text = suggested_text
+            if prev_index >= 0:
+                merge_operations.append({
+                    "current_index": i,
+                    "target_index": prev_index,
+                    "current_text": analysis.get("adjusted_text", "").lstrip() or analysis["item"].get("text", "").lstrip()
+                })
+    
+    # 按目标索引排序，确保合并顺序正确（从后往前合并）
+    merge_operations.sort(key=lambda x: x["target_index"], reverse=True)
+    
+    # 执行合并操作
+    for merge_op in merge_operations:
+        current_index = merge_op["current_index"]
+        target_index = merge_op["target_index"]
+        current_text = merge_op["current_text"]
+        
+        # 获取目标文本块的内容
+        target_text = all_results[target_index].get("adjusted_text", "").rstrip()
+        
+        # 检查目标文本是否包含<mark>或<summary>标记
+        last_mark_pos = target_text.rfind("<mark>")
+        last_summary_pos = target_text.rfind("<summary>")
+        
+        # 找到最后一个标记的位置（<mark>或<summary>，取较后的位置）
+        last_tag_pos = max(last_mark_pos, last_summary_pos)
+        
+        if last_tag_pos != -1:
+            # 如果包含标记，将被合并的文本插入到最后一个标记之前
+            merged_text = target_text[:last_tag_pos] + current_text + target_text[last_tag_pos:]
         else:
-            adjusted_text = current_text
-
-        if adjusted_text:
-            adjusted_text = re.sub(r'<mark>[ \t\r\n]*', '<mark>', adjusted_text)
-            adjusted_text = re.sub(r'<summary>[ \t\r\n]*', '<summary>', adjusted_text)
-
-    except Exception as e:
-        print(f"解析remark时出错: {str(e)}")
-        level_type = 0
-        adjusted_text = current_text
+            # 不包含标记，直接拼接
+            merged_text = target_text + current_text
+        
+        # 清理<mark>和<summary>后所有空白和换行（包括全角空格）
+        merged_text = normalize_tag_whitespace(merged_text, unicode_whitespace=True)
+        all_results[target_index]["adjusted_text"] = merged_text
+        # 当前文本置空
+        all_results[current_index]["adjusted_text"] = ""
+        print(f"向前合并: 第{current_index}块文本合并到第{target_index}块，合并后文本: {merged_text[:100]}...")
+    
+    # 第三步：统一清理，确保所有文本都没有<mark>和<summary>后空白和换行
+    for analysis in all_results:
+        analysis["adjusted_text"] = normalize_tag_whitespace(analysis["adjusted_text"])
+    
+    return all_results
 
+def parse_remark_and_adjust_data(ai_response: str, current_text: str, current_index: int, all_data: list) -> dict:
+    """
+    解析AI返回的remark，并根据分析结果调整数据（单条使用，返回的文本已清理<mark>/<summary>后的空白）
+    """
+    parsed = parse_qa_response(ai_response, current_text)
     return {
-        "level_type": level_type,
-        "text": adjusted_text
+        "level_type": parsed["level_type"],
+        "text": normalize_tag_whitespace(parsed["text"])
     }
\ No newline at end of file
@@ -0,0 +1,117 @@
+# QA问答对处理的运行日志（断点续跑）
+# 每条文本块的AI回复一返回就追加写入 qa_run_journal 表，按 run_id + item_index 唯一，
+# 进程中途退出后再次处理同一 run_id 时，只需要补跑缺失的索引。
+from datetime import datetime
+from psycopg2.extras import execute_values
+from synapse_flow.db import get_pg_conn
+
+
+def insert_qa_journal_entries(run_id: str, entries: list) -> int:
+    """
+    追加写入一批处理结果，已存在的 (run_id, item_index) 不会被覆盖。
+
+    Args:
+        run_id (str): 运行ID
+        entries (list): [{"index": 12, "ai_response": "..."}, ...]，空回复会被忽略
+
+    Returns:
+        int: 实际写入的条数
+    """
+    rows = [
+        (run_id, entry["index"], entry["ai_response"], datetime.now())
+        for entry in entries
+        if entry.get("ai_response")
+    ]
+    if not rows:
+        return 0
+
+    conn = get_pg_conn()
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO qa_run_journal (run_id, item_index, ai_response, create_time)
+                VALUES %s
+                ON CONFLICT (run_id, item_index) DO NOTHING
+            """, rows)
+            inserted = cur.rowcount
+        conn.commit()
+        return inserted
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+
+
+def query_qa_journal(run_id: str) -> dict:
+    """
+    查询某个 run_id 已完成的处理结果。
+
+    Returns:
+        dict: {item_index: ai_response}
+    """
+    conn = get_pg_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT item_index, ai_response
+                FROM qa_run_journal
+                WHERE run_id = %s
+            """, (run_id,))
+            return {row[0]: row[1] for row in cur.fetchall()}
+    finally:
+        conn.close()
+
+
+def query_qa_journal_progress(run_id: str) -> dict:
+    """
+    查询运行中的QA处理进度（已完成条数 / 版本0中text类型的总条数）。
+    返回格式：
+    {
+        "run_id": "xxxx",
+        "completed_count": 120,
+        "total_count": 800,
+        "last_update_time": "2024-01-01T12:00:00"
+    }
+    """
+    conn = get_pg_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM qa_run_journal WHERE run_id = %s),
+                    (SELECT MAX(create_time) FROM qa_run_journal WHERE run_id = %s),
+                    (SELECT COUNT(*) FROM pdf_json
+                     WHERE run_id = %s AND version = 0
+                     AND (LOWER(type) = 'text' OR type = '正文'))
+            """, (run_id, run_id, run_id))
+            completed_count, last_update_time, total_count = cur.fetchone()
+            return {
+                "run_id": run_id,
+                "completed_count": completed_count,
+                "total_count": total_count,
+                "last_update_time": last_update_time.isoformat() if last_update_time else None
+            }
+    finally:
+        conn.close()
+
+
+def clear_qa_journal(run_id: str) -> bool:
+    """
+    处理结果成功保存为新版本后，清理该 run_id 的运行日志。
+    返回是否成功。
+    """
+    conn = get_pg_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM qa_run_journal WHERE run_id = %s
+            """, (run_id,))
+        conn.commit()
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"clear_qa_journal error: {e}")
+        return False
+    finally:
+        conn.close()
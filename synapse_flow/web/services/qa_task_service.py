@@ -0,0 +1,239 @@
+# QA问答对处理的后台任务管理
+# /processQA 只负责入队并返回task_id，实际处理在后台线程中执行，
+# 进度（完成数/总数、吞吐、预计剩余时间）通过状态查询和SSE推送给前端。
+import time
+import uuid
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+from synapse_flow.web.services.prompt_job_service import process_qa_for_version_0, QAProcessCancelled, expect_vllm_demand
+
+# 后台任务配置
+QA_TASK_CONFIG = {
+    "max_workers": 1,          # 同时执行的QA任务数，vLLM服务共用，默认串行
+    "max_finished_tasks": 100  # 内存中最多保留的已结束任务数
+}
+
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+# 全局变量存储QA任务状态
+qa_tasks = {}
+_qa_task_events = {}  # task_id -> threading.Event，用于取消任务
+_qa_task_condition = threading.Condition()  # 任务状态变化时通知SSE订阅者
+_qa_task_executor = ThreadPoolExecutor(max_workers=QA_TASK_CONFIG["max_workers"], thread_name_prefix="qa_task")
+
+
+def submit_qa_task(run_id: str) -> Dict[str, Any]:
+    """
+    提交QA问答对处理任务（入队后立即返回）
+    同一个run_id已有排队或运行中的任务时，直接返回该任务
+
+    Args:
+        run_id: 运行ID
+
+    Returns:
+        Dict: 任务状态信息
+    """
+    with _qa_task_condition:
+        for task in qa_tasks.values():
+            if task["run_id"] == run_id and task["status"] not in FINISHED_STATUSES:
+                print(f"run_id {run_id} 已有未结束的QA任务: {task['task_id']}")
+                return _public_view(task)
+
+        task_id = f"qa_{uuid.uuid4().hex[:12]}"
+        now = datetime.now().isoformat()
+        qa_tasks[task_id] = {
+            "task_id": task_id,
+            "run_id": run_id,
+            "status": "queued",
+            "stage": "queued",
+            "completed_count": 0,
+            "total_count": 0,
+            "resumed_count": 0,
+            "throughput": 0.0,      # 条/秒，不含断点续跑直接复用的条目
+            "eta_seconds": None,
+            "create_time": now,
+            "start_time": None,
+            "update_time": now,
+            "end_time": None,
+            "error_message": None,
+            "result": None,
+            "version": 0            # 每次状态变化自增，供SSE判断是否需要推送
+        }
+        _qa_task_events[task_id] = threading.Event()
+        _prune_finished_tasks()
+        task = qa_tasks[task_id].copy()
+
+    _qa_task_executor.submit(_run_qa_task, task_id)
+    # 入队时只发出需求信号（不阻塞请求线程），排在前面的任务执行期间服务已在后台加载
+    expect_vllm_demand()
+    print(f"✅ QA任务已入队: {task_id} (run_id: {run_id})")
+    return task
+
+
+def _run_qa_task(task_id: str):
+    """后台线程中执行QA处理"""
+    cancel_event = _qa_task_events[task_id]
+    if cancel_event.is_set():
+        # 排队期间已被取消
+        return
+
+    started_at = time.time()
+    _update_task(task_id, status="running", stage="starting_vllm",
+                 start_time=datetime.now().isoformat())
+
+    def on_progress(stage: str, completed: int, total: int):
+        fields = {"stage": stage, "completed_count": completed, "total_count": total}
+        with _qa_task_condition:
+            task = qa_tasks[task_id]
+            if stage == "processing" and "processing_started_at" not in task:
+                # 进入处理阶段时已完成的条目来自运行日志，不计入吞吐
+                task["resumed_count"] = completed
+                task["processing_started_at"] = time.time()
+            processing_started_at = task.get("processing_started_at")
+            resumed_count = task["resumed_count"]
+        if processing_started_at:
+            elapsed = time.time() - processing_started_at
+            processed = completed - resumed_count
+            if elapsed > 0 and processed > 0:
+                throughput = processed / elapsed
+                fields["throughput"] = round(throughput, 3)
+                fields["eta_seconds"] = round((total - completed) / throughput, 1)
+        _update_task(task_id, **fields)
+
+    try:
+        result = process_qa_for_version_0(qa_tasks[task_id]["run_id"],
+                                          progress_callback=on_progress,
+                                          cancel_event=cancel_event)
+        _update_task(task_id, status="completed", stage="completed", eta_seconds=0,
+                     result=result, end_time=datetime.now().isoformat())
+        print(f"✅ QA任务 {task_id} 完成，耗时 {time.time() - started_at:.1f}秒")
+    except QAProcessCancelled:
+        _update_task(task_id, status="cancelled", stage="cancelled", eta_seconds=None,
+                     end_time=datetime.now().isoformat())
+        print(f"⚠️ QA任务 {task_id} 已取消")
+    except Exception as e:
+        _update_task(task_id, status="failed", stage="failed", eta_seconds=None,
+                     error_message=str(e), end_time=datetime.now().isoformat())
+        print(f"❌ QA任务 {task_id} 失败: {str(e)}")
+
+
+def _update_task(task_id: str, **fields):
+    """更新任务状态并通知订阅者"""
+    with _qa_task_condition:
+        task = qa_tasks.get(task_id)
+        if task is None:
+            return
+        task.update(fields)
+        task["update_time"] = datetime.now().isoformat()
+        task["version"] += 1
+        _qa_task_condition.notify_all()
+
+
+def _prune_finished_tasks():
+    """清理过多的已结束任务，调用方需持有 _qa_task_condition"""
+    finished = [task for task in qa_tasks.values() if task["status"] in FINISHED_STATUSES]
+    overflow = len(finished) - QA_TASK_CONFIG["max_finished_tasks"]
+    if overflow > 0:
+        finished.sort(key=lambda x: x["create_time"])
+        for task in finished[:overflow]:
+            qa_tasks.pop(task["task_id"], None)
+            _qa_task_events.pop(task["task_id"], None)
+
+
+def _public_view(task: Dict[str, Any]) -> Dict[str, Any]:
+    """去掉内部字段后的任务信息"""
+    return {key: value for key, value in task.items() if key != "processing_started_at"}
+
+
+def get_qa_task_status(task_id: str) -> Dict[str, Any]:
+    """
+    获取QA任务状态
+
+    Args:
+        task_id: 任务ID
+
+    Returns:
+        Dict: 任务状态信息
+    """
+    with _qa_task_condition:
+        if task_id in qa_tasks:
+            return _public_view(qa_tasks[task_id])
+    return {"error": "任务不存在"}
+
+
+def cancel_qa_task(task_id: str) -> Dict[str, Any]:
+    """
+    取消QA任务：排队中的任务直接取消，运行中的任务在下一批次开始前停止
+    已完成的批次保留在运行日志中，之后重新提交同一run_id可以继续处理
+
+    Args:
+        task_id: 任务ID
+
+    Returns:
+        Dict: 任务状态信息
+    """
+    with _qa_task_condition:
+        task = qa_tasks.get(task_id)
+        if task is None:
+            return {"error": "任务不存在"}
+        if task["status"] in FINISHED_STATUSES:
+            return _public_view(task)
+        _qa_task_events[task_id].set()
+        queued = task["status"] == "queued"
+
+    if queued:
+        _update_task(task_id, status="cancelled", stage="cancelled",
+                     end_time=datetime.now().isoformat())
+    else:
+        _update_task(task_id, stage="cancelling")
+    return get_qa_task_status(task_id)
+
+
+def list_qa_tasks(run_id: str = None, limit: int = 20) -> list:
+    """
+    列出QA任务（内存存储）
+
+    Args:
+        run_id: 运行ID（可选）
+        limit: 限制数量
+
+    Returns:
+        list: 任务列表
+    """
+    with _qa_task_condition:
+        tasks = [_public_view(task) for task in qa_tasks.values()]
+
+    if run_id:
+        tasks = [task for task in tasks if task["run_id"] == run_id]
+
+    # 按创建时间排序（最新的在前）
+    tasks.sort(key=lambda x: x.get("create_time", ""), reverse=True)
+    return tasks[:limit]
+
+
+def wait_for_qa_task_update(task_id: str, last_version: int, timeout: float = 15.0) -> Optional[Dict[str, Any]]:
+    """
+    阻塞等待任务状态发生变化（供SSE推送使用）
+
+    Args:
+        task_id: 任务ID
+        last_version: 调用方已经拿到的状态版本号
+        timeout: 最长等待秒数
+
+    Returns:
+        Dict: 变化后的任务状态；超时未变化返回当前状态；任务不存在返回None
+    """
+    deadline = time.time() + timeout
+    with _qa_task_condition:
+        while True:
+            task = qa_tasks.get(task_id)
+            if task is None:
+                return None
+            if task["version"] != last_version:
+                return _public_view(task)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return _public_view(task)
+            _qa_task_condition.wait(remaining)
@@ -0,0 +1,422 @@
+# LoRA训练数据：tokenize（带磁盘缓存）和训练batch的组织方式
+# 原来 execute_training 用 lambda 逐条 map：每一条都重新tokenize约3000个token的固定system模板，单进程执行，
+# 而且 lambda 闭包让datasets的指纹缓存失效，每次训练都从头处理。这里：
+# 1. 固定的system模板只tokenize一次，每条样本只tokenize user部分和回答，再拼接token id
+#    （模板以 <|eot_id|> 等特殊token分段，拼接结果与整段tokenize一致；启动时用第一条样本核对，不一致时退回整段tokenize）
+# 2. batched=True + num_proc 并行 map
+# 3. tokenize结果保存到磁盘，按 CSV内容哈希 + tokenizer（模板的token id） + 模板版本 + max_length 命名，相同数据再次训练直接加载
+# 从 pdf_json 导出的训练数据（training_export_service）是Arrow分片，内存映射后同样处理（load_tokenized_shards）
+import os
+import time
+import bisect
+import random
+import shutil
+import hashlib
+import functools
+from typing import Dict, Any, List, Optional
+import torch
+from datasets import Dataset, load_from_disk, concatenate_datasets
+
+# 训练数据配置
+TRAINING_DATA_CONFIG = {
+    "cache_dir": "/home/liuxinwei/checkpoint_data/tokenized_datasets",
+    "num_proc": min(8, os.cpu_count() or 1),
+    "map_batch_size": 256,
+    "min_examples_per_proc": 256,  # 样本太少时减少进程数（进程启动的开销大于tokenize本身）
+    "template_version": 1          # 修改下面的模板或拼接方式时加一，旧缓存不再命中
+}
+
+# instruction模板（system部分，所有样本相同）
+TRAINING_INSTRUCTION_TEMPLATE = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+你是文本切割处理的审核专家，将会看到一个目标文本块，以及它的前两个文本块和后一个文本块。
+
+你的任务是**目标文本块（即第三个）**（1）是否为新层级（2）是否存在以下四类错误，并给出对应判断和修改建议。
+文本块层级判断：
+（1）新层级：文本块开头句子具有明确新文本层级结构特征如：（1）、一、首先、a.等；
+（2）非新层级：文本块开头句子没有明确新文本层级结构特征；
+
+错误文本内容判断：
+（1）字符错误：文本含有不合理字符，如乱码、错误符号、混杂代码符号（公式不算）；
+（2）格式错误：文本块开头是句子残段，其上半句存在于上一个文本块结尾；
+（3）信息错误：文本块为空、为页码、目录、标题页、版权页、装订信息等与正文无关的内容。
+（4）需要拆分：文本块有多个层级的文本块，在原文中加入"<mark>"将其区分。
+
+正确文本内容判断：
+如果目标文本块不存在上述四类问题，即为正常文本块。
+
+判断顺序：（1）判断是否为新层级（2）判断文本块内容是否错误
+
+输出格式要求：
+判断结论请统一使用如下格式：
+因为阅读上下文第三文本块XXX，所以判断为{是否为新层级}。因为第三文本块因xxx，所以判断为{错误类型}，建议处理方式为：{修改方式}
+如果文本无误，请回复：
+因为阅读上下文第三文本块XXX，所以判断为{是否为新层级}。因为第三文本块因没有四类错误，所以判断为{正确}。第三文本块不做任何修改。
+
+
+
+举例情况（1）：开头是新层级且为字符错误；
+    {
+        "text": "答：可以。根据文件规定：",
+        "page_idx": 6
+    },
+    {
+        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
+        "page_idx": 6
+    },
+    {
+        "text": "二、。增值税小规模纳税人适用 $3 \\%$ 征收率@的应税销售收入",
+        "page_idx": 6
+    },
+    {
+        "text": "，减按 $1 \\%$ 征收率@征收增值税。",
+        "page_idx": 7
+    },
+你应该回复：因为阅读上下文第三文本块带有广义标题特征，所以判断为{新层级}。因为第三文本块因含有不合理字符，所以判断为{文本错误}。建议处理方式为：{二、增值税小规模纳税人适用 $3 \\%$ 征收率的应税销售收入}
+
+举例情况（2）：开头非新层级且格式错误（开头为残句）
+    {
+        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
+        "page_idx": 6
+    },
+    {
+        "text": "二、。增值税小规模纳税人适用 $3 \\%$ 征收率@的应税销售收入",
+        "page_idx": 6
+    },
+    {
+        "text": "，减按 $1 \\%$ 征收率@征收增值税。",
+        "page_idx": 7
+    },
+    {
+        "text": "三、本公告执行至2027年12月31日。",
+        "page_idx": 7
+    },
+你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因开始处句子不完整，所以判断为{格式错误}。建议处理方式为：{向前合并}且{删除}
+
+举例情况（3）：开头非新层级且需要拆分（包含多个层级）
+[
+  {
+    "text": "（四）通过纳税客体的非转移进行的国际避税",
+    "page_idx": 248
+  },
+  {
+    "text": "纳税客体的非转移，又称物的不流动。物的不流动，是指跨国纳税人在不移动资金、货物和劳务的情况下，采取其他手段避免自己的所得受到税收管辖。",
+    "page_idx": 248
+  },
+  {
+    "text": "通过物的不流动进行国际避税，主要有两种做法：一是变更公司组织形式以改变所得性质；二是利用延期纳税方式。",
+    "page_idx": 248
+  },
+  {
+    "text": "1.变更公司组织形式以改变所得性质",
+    "page_idx": 248
+  }
+]
+你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因含有多个文本块，所以判断为{需要拆分}。建议处理方式为：{通过物的不流动进行国际避税，主要有两种做法：<mark>一是变更公司组织形式以改变所得性质；<mark>二是利用延期纳税方式。}
+**注意**如果后面的第四个文本块不会是新的层级，你需要在结尾标记上<mark>,从而告诉我们层级的结束位置！
+
+举例情况（4）：开头非新层级且信息错误（无效内容）
+    {
+        "text": "一、对月销售额10万元以下（含本数）的增值税小规模纳税人，免征增值税。",
+        "page_idx": 6
+    },
+    {
+        "text": "二、。增值税小规模纳税人适用 $3 \\%$ 征收率@的应税销售收入",
+        "page_idx": 6
+    },
+    {
+        "text": "12366热点问答年度精选汇编",
+        "page_idx": 7
+    },
+    {
+        "text": "，减按 $1 \\%$ 征收率@征收增值税。",
+        "page_idx": 7
+    },
+你应该回复：因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因是夹杂信息，所以判断为{信息错误}。建议处理方式为：{删除}
+    <|eot_id|>
+    """
+
+# user部分（每条样本不同），后面接回答
+TRAINING_USER_TEMPLATE = """<|start_header_id|>user<|end_header_id|>
+    
+    需要你回答的问题是："{instruction}"
+     需要分析的这段语句是："{input}"
+    请根据问题要求与问题进行回答<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+    """
+
+
+def format_user_part(example: Dict[str, Any]) -> str:
+    """一条样本的user部分"""
+    return TRAINING_USER_TEMPLATE.format(instruction=example['instruction'], input=example['input'])
+
+
+def build_example_features(instruction_ids: List[int], response_ids: List[int], pad_token_id: int,
+                           max_length: int) -> Dict[str, List[int]]:
+    """拼接instruction和回答的token id，只有回答部分计算loss，末尾加一个pad（eos），超过max_length时截断"""
+    input_ids = instruction_ids + response_ids + [pad_token_id]
+    labels = [-100] * len(instruction_ids) + response_ids + [pad_token_id]
+    input_ids, labels = input_ids[:max_length], labels[:max_length]
+    return {"input_ids": input_ids, "attention_mask": [1] * len(input_ids), "labels": labels}
+
+
+def tokenize_example(example: Dict[str, Any], tokenizer, max_length: int) -> Dict[str, List[int]]:
+    """整段tokenize一条样本（拼接不一致时的退回方式，也用于核对）"""
+    instruction = tokenizer(TRAINING_INSTRUCTION_TEMPLATE + format_user_part(example), add_special_tokens=False)
+    response = tokenizer(f"{example['output']}<|eot_id|>", add_special_tokens=False)
+    return build_example_features(instruction["input_ids"], response["input_ids"], tokenizer.pad_token_id, max_length)
+
+
+def tokenize_batch(batch: Dict[str, List[Any]], tokenizer, prefix_ids: Optional[List[int]],
+                   max_length: int) -> Dict[str, List[List[int]]]:
+    """
+    tokenize一批样本（datasets.map batched=True 的处理函数，模块级函数，可以在子进程中执行）
+
+    Args:
+        prefix_ids: system模板的token id；为None时整段tokenize
+    """
+    examples = [dict(zip(batch, values)) for values in zip(*batch.values())]
+    if prefix_ids is None:
+        features = [tokenize_example(example, tokenizer, max_length) for example in examples]
+    else:
+        users = tokenizer([format_user_part(example) for example in examples], add_special_tokens=False)["input_ids"]
+        responses = tokenizer([f"{example['output']}<|eot_id|>" for example in examples],
+                              add_special_tokens=False)["input_ids"]
+        features = [build_example_features(prefix_ids + user_ids, response_ids, tokenizer.pad_token_id, max_length)
+                    for user_ids, response_ids in zip(users, responses)]
+    return {key: [feature[key] for feature in features] for key in ("input_ids", "attention_mask", "labels")}
+
+
+def has_input(batch: Dict[str, List[Any]]) -> List[bool]:
+    """过滤 input 为空的行"""
+    return [bool(value and str(value).strip()) for value in batch["input"]]
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dataset_cache_key(data_sha256: str, prefix_ids: List[int], tokenizer, max_length: int) -> str:
+    """缓存目录名：训练数据内容、tokenizer（词表大小和模板的token id）、模板版本和 max_length"""
+    digest = hashlib.sha256()
+    digest.update(data_sha256.encode())
+    digest.update(f"{type(tokenizer).__name__}:{len(tokenizer)}:{tokenizer.pad_token_id}".encode())
+    digest.update(",".join(map(str, prefix_ids)).encode())
+    digest.update(f"{TRAINING_DATA_CONFIG['template_version']}:{max_length}".encode())
+    return digest.hexdigest()[:24]
+
+
+def load_tokenized_dataset(csv_file_path: str, tokenizer, max_length: int, num_proc: int = None,
+                           cache_dir: str = None) -> Dataset:
+    """
+    加载CSV并tokenize，结果缓存在磁盘上
+
+    Args:
+        csv_file_path: 训练CSV（instruction, input, output）
+        tokenizer: 训练使用的tokenizer
+        max_length: 截断长度
+        num_proc: map 的进程数，默认 TRAINING_DATA_CONFIG["num_proc"]
+        cache_dir: 缓存目录，默认 TRAINING_DATA_CONFIG["cache_dir"]；为空字符串时不缓存
+
+    Returns:
+        Dataset: 只包含 input_ids / attention_mask / labels 三列
+    """
+    return tokenize_with_cache(lambda: Dataset.from_csv(csv_file_path), file_sha256(csv_file_path),
+                               tokenizer, max_length, num_proc, cache_dir)
+
+
+def load_tokenized_shards(shard_paths: List[str], tokenizer, max_length: int, num_proc: int = None,
+                          cache_dir: str = None) -> Dataset:
+    """
+    加载导出的Arrow分片（training_export_service）并tokenize，分片内存映射，不读入内存；参数同 load_tokenized_dataset
+    """
+    digest = hashlib.sha256()
+    for path in shard_paths:
+        digest.update(file_sha256(path).encode())
+    return tokenize_with_cache(lambda: concatenate_datasets([Dataset.from_file(path) for path in shard_paths]),
+                               digest.hexdigest(), tokenizer, max_length, num_proc, cache_dir)
+
+
+def tokenize_with_cache(load_dataset, data_sha256: str, tokenizer, max_length: int, num_proc: int = None,
+                        cache_dir: str = None) -> Dataset:
+    """
+    tokenize训练数据，结果按 dataset_cache_key 缓存在磁盘上
+
+    Args:
+        load_dataset: 返回原始数据集（instruction, input, output 列）的函数，命中缓存时不调用
+        data_sha256: 训练数据内容的哈希
+    """
+    cache_dir = TRAINING_DATA_CONFIG["cache_dir"] if cache_dir is None else cache_dir
+    prefix_ids = tokenizer(TRAINING_INSTRUCTION_TEMPLATE, add_special_tokens=False)["input_ids"]
+    cache_path = None
+    if cache_dir:
+        cache_key = dataset_cache_key(data_sha256, prefix_ids, tokenizer, max_length)
+        cache_path = os.path.join(cache_dir, cache_key)
+        if os.path.exists(cache_path):
+            dataset = load_from_disk(cache_path)
+            print(f"✅ 使用已缓存的tokenize结果: {cache_path}（{len(dataset)}条）")
+            return dataset
+
+    print("正在加载数据集...")
+    ds = load_dataset()
+    ds = ds.filter(has_input, batched=True)  # 去掉空的行
+    print(f"数据集加载完成，共{len(ds)}条数据")
+    if len(ds) == 0:
+        raise Exception("训练数据中没有有效数据")
+
+    # 拼接的token id应与整段tokenize一致（模板在特殊token处分段）；不一致时退回整段tokenize
+    if tokenize_batch(ds[:1], tokenizer, prefix_ids, max_length) != tokenize_batch(ds[:1], tokenizer, None, max_length):
+        print("⚠️ 模板单独tokenize后拼接与整段tokenize结果不一致，改为逐条整段tokenize")
+        prefix_ids = None
+
+    num_proc = num_proc or TRAINING_DATA_CONFIG["num_proc"]
+    num_proc = max(1, min(num_proc, len(ds) // TRAINING_DATA_CONFIG["min_examples_per_proc"]))
+    started_at = time.time()
+    tokenized = ds.map(
+        functools.partial(tokenize_batch, tokenizer=tokenizer, prefix_ids=prefix_ids, max_length=max_length),
+        batched=True,
+        batch_size=TRAINING_DATA_CONFIG["map_batch_size"],
+        num_proc=num_proc if num_proc > 1 else None,
+        remove_columns=ds.column_names,
+        load_from_cache_file=False,
+        desc="tokenize"
+    )
+    print(f"✅ tokenize完成，{len(tokenized)}条，{num_proc}个进程，耗时 {time.time() - started_at:.1f}s")
+
+    if cache_path:
+        # 先写临时目录再改名，中途失败不会留下不完整的缓存
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tokenized.save_to_disk(tmp_path)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)  # 其他训练任务已经写好了同一份缓存
+        tokenized = load_from_disk(cache_path)
+        print(f"✅ tokenize结果已缓存: {cache_path}")
+    return tokenized
+
+
+# 训练batch的组织方式
+# 样本长度从几百到 max_length 不等，DataCollatorForSeq2Seq 按batch中最长的样本padding，大量计算花在padding上：
+# - packing：把多条样本拼成不超过 max_length 的序列（best-fit decreasing装箱），position_ids 在每条样本开头归零，
+#   注意力用块对角的因果mask（flash_attention_2 直接按 position_ids 分段），每条样本的第一个token不计算loss
+# - group_by_length：不改变样本，按长度分组组成batch（Trainer 的 LengthGroupedSampler），不支持自定义mask时使用
+# - padding：原来的方式
+BATCHING_MODES = ("packing", "group_by_length", "padding")
+
+
+def pack_lengths(lengths: List[int], capacity: int) -> List[List[int]]:
+    """
+    把样本装进容量为 capacity 的序列（best-fit decreasing：从长到短，放进剩余空间最小且放得下的序列）
+
+    Returns:
+        list: 每个序列包含的样本下标
+    """
+    bins, free = [], []  # free: 按剩余空间排序的 (剩余空间, 序列下标)
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        position = bisect.bisect_left(free, (lengths[i], -1))
+        if position < len(free):
+            remaining, index = free.pop(position)
+        else:
+            remaining, index = capacity, len(bins)
+            bins.append([])
+        bins[index].append(i)
+        remaining -= lengths[i]
+        if remaining > 0:
+            bisect.insort(free, (remaining, index))
+    return bins
+
+
+def generate_packed_rows(dataset: Dataset, bins: List[List[int]]):
+    """按装箱结果拼接样本（Dataset.from_generator 的生成函数）"""
+    for indices in bins:
+        row = {"input_ids": [], "labels": [], "position_ids": []}
+        examples = dataset[indices]
+        for input_ids, labels in zip(examples["input_ids"], examples["labels"]):
+            row["input_ids"].extend(input_ids)
+            row["labels"].extend([-100] + labels[1:])  # 不用上一条样本的结尾预测这一条的第一个token
+            row["position_ids"].extend(range(len(input_ids)))
+        yield row
+
+
+def pack_dataset(dataset: Dataset, max_length: int) -> Dataset:
+    """
+    把tokenize后的样本拼接成不超过 max_length 的序列
+
+    Returns:
+        Dataset: input_ids / labels / position_ids 三列，position_ids 为0的位置是一条样本的开头
+    """
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    bins = pack_lengths(lengths, max_length)
+    packed = Dataset.from_generator(generate_packed_rows, gen_kwargs={"dataset": dataset, "bins": bins})
+    print(f"✅ 样本拼接完成：{len(dataset)}条样本 -> {len(packed)}条序列，"
+          f"填充率 {sum(lengths) / (len(packed) * max_length):.1%}")
+    return packed
+
+
+class PackedSequenceCollator:
+    """
+    拼接序列的collator：padding到batch中最长的序列，按 position_ids 分段构造块对角的因果mask
+    （4D mask，已取反：可见为0，不可见为dtype最小值）；flash_attention_2 不传mask，由 position_ids 分段
+    """
+
+    def __init__(self, pad_token_id: int, attn_implementation: str = "sdpa", dtype=torch.bfloat16):
+        self.pad_token_id = pad_token_id
+        self.attn_implementation = attn_implementation
+        self.dtype = dtype
+
+    def __call__(self, features: List[Dict[str, List[int]]]) -> Dict[str, Any]:
+        length = max(len(feature["input_ids"]) for feature in features)
+        input_ids = torch.full((len(features), length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(features), length), -100, dtype=torch.long)
+        position_ids = torch.zeros((len(features), length), dtype=torch.long)
+        segment_ids = torch.zeros((len(features), length), dtype=torch.long)  # 0 为padding
+        for row, feature in enumerate(features):
+            size = len(feature["input_ids"])
+            input_ids[row, :size] = torch.tensor(feature["input_ids"])
+            labels[row, :size] = torch.tensor(feature["labels"])
+            position_ids[row, :size] = torch.tensor(feature["position_ids"])
+            segment_ids[row, :size] = torch.cumsum(position_ids[row, :size] == 0, dim=0)
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if self.attn_implementation != "flash_attention_2":
+            batch["attention_mask"] = self.block_causal_mask(segment_ids)
+        return batch
+
+    def block_causal_mask(self, segment_ids):
+        length = segment_ids.shape[1]
+        causal = torch.tril(torch.ones((length, length), dtype=torch.bool))
+        visible = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, :, None] > 0) & causal
+        visible |= torch.eye(length, dtype=torch.bool)  # padding位置只看自己，避免整行被mask时softmax出现NaN
+        mask = torch.zeros((segment_ids.shape[0], 1, length, length), dtype=self.dtype)
+        return mask.masked_fill(~visible[:, None], torch.finfo(self.dtype).min)
+
+
+def batch_rows(lengths: List[int], batch_size: int, mode: str, max_length: int, seed: int = 0) -> List[List[int]]:
+    """按训练时的方式模拟一个epoch的batch（每个batch中各行的token数），用于估算padding比例"""
+    rng = random.Random(seed)
+    if mode == "packing":
+        lengths = [sum(lengths[i] for i in indices) for indices in pack_lengths(lengths, max_length)]
+    order = list(range(len(lengths)))
+    rng.shuffle(order)
+    if mode == "group_by_length":
+        # 与 LengthGroupedSampler 相同：随机取 50 × batch_size 条，组内按长度从长到短排序
+        megabatch = 50 * batch_size
+        order = [i for start in range(0, len(order), megabatch)
+                 for i in sorted(order[start:start + megabatch], key=lambda i: lengths[i], reverse=True)]
+    return [[lengths[i] for i in order[start:start + batch_size]] for start in range(0, len(order), batch_size)]
+
+
+def padding_report(lengths: List[int], batch_size: int, mode: str, max_length: int) -> Dict[str, Any]:
+    """一个epoch的batch数、实际token数和padding比例"""
+    batches = batch_rows(lengths, batch_size, mode, max_length)
+    padded = sum(len(rows) * max(rows) for rows in batches)
+    return {
+        "mode": mode,
+        "batches": len(batches),
+        "tokens": sum(lengths),
+        "padded_tokens": padded,
+        "padding_ratio": 1 - sum(lengths) / padded if padded else 0.0
+    }
@@ -0,0 +1,345 @@
+# LoRA训练数据导出：从审核后的 pdf_json 版本直接生成训练样本
+# 原来训练数据要先手工整理成CSV，经 /upload_csv 上传到临时目录、复制到输出目录，再被 pandas 和 Dataset.from_csv 各解析一遍。
+# 这里直接读取每个run审核后的版本（默认最新的 version >= 1，也可以指定版本）：
+# 1. 样本与QA处理时的输入一致：目标text块及其前两个、后一个text块（build_qa_context_windows），
+#    文本块使用 original_text（QA时模型看到的文本，审核时对 text 的修改不影响输入），回答为审核后的 remark；
+#    exclude_from_finetune 的块、remark 为空或没有层级判断的块不作为样本（仍作为其他样本的上下文）
+# 2. 每个run的样本按 shard_examples 条一个分片写成Arrow文件（IPC stream，与datasets缓存的格式相同），
+#    训练时 Dataset.from_file 直接内存映射（load_tokenized_shards），不再解析CSV
+# 3. manifest.json 记录每个run导出的版本和指纹（版本号、行数、最大id，版本只追加不修改）；
+#    再次导出时只重新生成指纹变化的run，其余run的分片原样保留
+#
+# 目录结构：
+#   <export_dir>/<name>/manifest.json
+#   <export_dir>/<name>/<run_id>/v<version>-<指纹哈希>/shard-00000.arrow
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, List
+import pyarrow as pa
+from synapse_flow.db import get_pg_conn
+from synapse_flow.web.services.dataset_job_service import query_pdf_text_contents
+from synapse_flow.web.services.prompt_job_service import (
+    QA_INSTRUCTION, build_qa_context_windows, fix_placeholder_page_idx
+)
+from synapse_flow.web.utils.llm_response_parser import QA_LEVEL_JUDGEMENT_PATTERN
+
+# 训练数据导出配置
+TRAINING_EXPORT_CONFIG = {
+    "export_dir": "/home/liuxinwei/checkpoint_data/training_exports",
+    "shard_examples": 5000,   # 每个分片的样本数
+    "write_batch_size": 500,  # 每个record batch的样本数
+    "min_version": 1,         # 版本0是识别结果，还没有remark
+    "export_version": 1       # 修改样本的构建方式时加一，已导出的run全部重新生成
+}
+
+MANIFEST_FILE = "manifest.json"
+
+# 分片的列：instruction / input / output 与原来的CSV相同，其余列用于追溯样本来源（tokenize时去掉）
+EXAMPLE_SCHEMA = pa.schema([
+    ("instruction", pa.string()),
+    ("input", pa.string()),
+    ("output", pa.string()),
+    ("run_id", pa.string()),
+    ("version", pa.int64()),
+    ("pdf_json_id", pa.int64()),
+    ("page_index", pa.int64()),
+    ("block_index", pa.int64())
+])
+
+
+class PgReviewedVersionSource:
+    """从 pdf_json 表读取各run的版本和内容"""
+
+    def list_versions(self, run_ids: List[str] = None, min_version: int = 1) -> List[Dict[str, Any]]:
+        """
+        列出各run的版本及指纹所需的行数和最大id
+
+        Returns:
+            list: [{"run_id", "version", "row_count", "max_id"}]，按 run_id、version 从新到旧排序
+        """
+        sql = """
+            SELECT run_id, version, COUNT(*), MAX(id)
+            FROM pdf_json
+            WHERE version >= %s
+        """
+        params = [min_version]
+        if run_ids:
+            sql += " AND run_id = ANY(%s)"
+            params.append(list(run_ids))
+        sql += " GROUP BY run_id, version ORDER BY run_id, version DESC"
+        conn = get_pg_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                return [{"run_id": row[0], "version": row[1], "row_count": row[2], "max_id": row[3]}
+                        for row in cur.fetchall()]
+        finally:
+            conn.close()
+
+    def query_rows(self, run_id: str, version: int) -> List[Dict[str, Any]]:
+        return query_pdf_text_contents(run_id, version)
+
+
+class MemoryReviewedVersionSource:
+    """内存中的 pdf_json（测试用）：{run_id: {version: [行]}}，每行需要有 id"""
+
+    def __init__(self, runs: Dict[str, Dict[int, List[Dict[str, Any]]]] = None):
+        self.runs = runs or {}
+
+    def list_versions(self, run_ids: List[str] = None, min_version: int = 1) -> List[Dict[str, Any]]:
+        versions = []
+        for run_id in sorted(self.runs):
+            if run_ids and run_id not in run_ids:
+                continue
+            for version in sorted(self.runs[run_id], reverse=True):
+                rows = self.runs[run_id][version]
+                if version >= min_version and rows:
+                    versions.append({"run_id": run_id, "version": version, "row_count": len(rows),
+                                     "max_id": max(row["id"] for row in rows)})
+        return versions
+
+    def query_rows(self, run_id: str, version: int) -> List[Dict[str, Any]]:
+        return [dict(row) for row in self.runs[run_id][version]]
+
+
+def select_run_versions(versions: List[Dict[str, Any]], pinned: Dict[str, int] = None) -> Dict[str, Dict[str, Any]]:
+    """每个run取指定的版本，没有指定时取最新的版本"""
+    pinned = pinned or {}
+    selected = {}
+    for version in versions:
+        run_id = version["run_id"]
+        if run_id in pinned:
+            if version["version"] == pinned[run_id]:
+                selected[run_id] = version
+        elif run_id not in selected or version["version"] > selected[run_id]["version"]:
+            selected[run_id] = version
+    missing = [run_id for run_id in pinned if run_id not in selected]
+    if missing:
+        raise Exception(f"指定的版本不存在: {', '.join(f'{run_id} v{pinned[run_id]}' for run_id in missing)}")
+    return selected
+
+
+def version_fingerprint(version: Dict[str, Any]) -> str:
+    return f"v{version['version']}:{version['row_count']}:{version['max_id']}"
+
+
+def build_training_examples(rows: List[Dict[str, Any]], instruction: str = QA_INSTRUCTION):
+    """
+    由一个版本的文本块构建训练样本
+
+    Returns:
+        tuple: (样本列表, 跳过的原因计数 {"excluded", "empty_remark", "unparsed_remark"})
+    """
+    sorted_rows = sorted(rows, key=lambda row: (row.get("page_index") or 0, row.get("block_index") or 0))
+    # 上下文使用QA时的原始文本；审核新增的块没有 original_text，使用 text
+    blocks = [{**row, "text": row.get("original_text") or row.get("text") or ""} for row in sorted_rows]
+    windows = build_qa_context_windows(blocks)
+
+    examples, skipped = [], {"excluded": 0, "empty_remark": 0, "unparsed_remark": 0}
+    for row, window in zip(sorted_rows, windows):
+        if window is None:
+            continue
+        remark = (row.get("remark") or "").strip()
+        if row.get("exclude_from_finetune"):
+            skipped["excluded"] += 1
+        elif not remark:
+            skipped["empty_remark"] += 1
+        elif not QA_LEVEL_JUDGEMENT_PATTERN.search(remark):
+            skipped["unparsed_remark"] += 1  # QA失败时写入的错误信息等
+        else:
+            examples.append({
+                "instruction": instruction,
+                "input": json.dumps(fix_placeholder_page_idx(window), ensure_ascii=False, indent=2),
+                "output": remark,
+                "run_id": row.get("run_id"),
+                "version": row.get("version"),
+                "pdf_json_id": row.get("id"),
+                "page_index": row.get("page_index"),
+                "block_index": row.get("block_index")
+            })
+    return examples, skipped
+
+
+def write_shards(examples: List[Dict[str, Any]], shard_dir: str, shard_examples: int = None,
+                 write_batch_size: int = None) -> List[Dict[str, Any]]:
+    """
+    把样本按 record batch 逐批写入Arrow分片（先写临时目录再改名，中途失败不会留下不完整的分片）
+
+    Returns:
+        list: [{"file": 分片文件名, "examples": 样本数}]
+    """
+    shard_examples = shard_examples or TRAINING_EXPORT_CONFIG["shard_examples"]
+    write_batch_size = write_batch_size or TRAINING_EXPORT_CONFIG["write_batch_size"]
+    tmp_dir = f"{shard_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    shards = []
+    for shard_start in range(0, len(examples), shard_examples):
+        shard = examples[shard_start:shard_start + shard_examples]
+        file_name = f"shard-{len(shards):05d}.arrow"
+        with pa.OSFile(os.path.join(tmp_dir, file_name), "wb") as sink:
+            with pa.ipc.new_stream(sink, EXAMPLE_SCHEMA) as writer:
+                for start in range(0, len(shard), write_batch_size):
+                    writer.write_batch(pa.RecordBatch.from_pylist(shard[start:start + write_batch_size],
+                                                                  schema=EXAMPLE_SCHEMA))
+        shards.append({"file": file_name, "examples": len(shard)})
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.rename(tmp_dir, shard_dir)
+    return shards
+
+
+def load_manifest(export_path: str) -> Dict[str, Any]:
+    """读取导出目录的manifest；不存在或样本构建方式已变化时返回空的manifest"""
+    manifest_path = os.path.join(export_path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("export_version") == TRAINING_EXPORT_CONFIG["export_version"]:
+            return manifest
+        print(f"⚠️ 样本构建方式已变化（export_version {manifest.get('export_version')} -> "
+              f"{TRAINING_EXPORT_CONFIG['export_version']}），全部run重新导出")
+    return {"export_version": TRAINING_EXPORT_CONFIG["export_version"], "runs": {}}
+
+
+def save_manifest(export_path: str, manifest: Dict[str, Any]):
+    manifest_path = os.path.join(export_path, MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.tmp{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def manifest_shard_paths(export_path: str, manifest: Dict[str, Any]) -> List[str]:
+    """manifest中全部分片的路径（按 run_id 排序）"""
+    return [os.path.join(export_path, run["path"], shard["file"])
+            for _, run in sorted(manifest["runs"].items()) for shard in run["shards"]]
+
+
+@contextmanager
+def export_lock(export_path: str):
+    """同名导出互斥（API请求和多个训练任务的准备可能同时导出同一个目录）"""
+    os.makedirs(export_path, exist_ok=True)
+    with open(os.path.join(export_path, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def export_training_dataset(name: str = "default", run_ids: List[str] = None, versions: Dict[str, int] = None,
+                            source=None, export_dir: str = None, full: bool = False) -> Dict[str, Any]:
+    """
+    导出训练数据（增量：只重新生成版本指纹变化的run）
+
+    Args:
+        name: 导出名，同名导出共用一个目录和manifest
+        run_ids: 导出的run，为空时导出所有有审核版本的run；不在其中的run从导出中移除
+        versions: 指定run导出的版本 {run_id: version}，其余run取最新的版本
+        source: 数据来源，默认 PgReviewedVersionSource
+        export_dir: 导出根目录，默认 TRAINING_EXPORT_CONFIG["export_dir"]
+        full: 忽略manifest，全部重新导出
+
+    Returns:
+        Dict: 导出目录、各run的导出情况、样本数和分片路径
+    """
+    if not name or os.sep in name or name.startswith("."):
+        raise Exception(f"导出名不合法: {name}")
+    source = source or PgReviewedVersionSource()
+    export_path = os.path.join(export_dir or TRAINING_EXPORT_CONFIG["export_dir"], name)
+    if versions and run_ids:
+        run_ids = list(set(run_ids) | set(versions))
+
+    with export_lock(export_path):
+        manifest = {"export_version": TRAINING_EXPORT_CONFIG["export_version"], "runs": {}} if full \
+            else load_manifest(export_path)
+        selected = select_run_versions(
+            source.list_versions(run_ids, TRAINING_EXPORT_CONFIG["min_version"]), versions
+        )
+
+        exported, unchanged, stale_paths = [], [], []
+        skipped = {"excluded": 0, "empty_remark": 0, "unparsed_remark": 0}
+        for run_id, version in sorted(selected.items()):
+            fingerprint = version_fingerprint(version)
+            previous = manifest["runs"].get(run_id)
+            if previous and previous["fingerprint"] == fingerprint and all(
+                    os.path.exists(os.path.join(export_path, previous["path"], shard["file"]))
+                    for shard in previous["shards"]):
+                unchanged.append(run_id)
+                continue
+
+            examples, run_skipped = build_training_examples(source.query_rows(run_id, version["version"]))
+            relative_path = os.path.join(
+                run_id, f"v{version['version']}-{hashlib.sha256(fingerprint.encode()).hexdigest()[:8]}"
+            )
+            shards = write_shards(examples, os.path.join(export_path, relative_path))
+            if previous and previous["path"] != relative_path:
+                stale_paths.append(previous["path"])
+            manifest["runs"][run_id] = {
+                "version": version["version"],
+                "fingerprint": fingerprint,
+                "path": relative_path,
+                "shards": shards,
+                "examples": len(examples),
+                "skipped": run_skipped,
+                "export_time": datetime.now().isoformat()
+            }
+            for reason, count in run_skipped.items():
+                skipped[reason] += count
+            exported.append(run_id)
+            print(f"✅ 导出 {run_id} v{version['version']}: {len(examples)}条样本，{len(shards)}个分片")
+
+        removed = [run_id for run_id in manifest["runs"] if run_id not in selected]
+        for run_id in removed:
+            stale_paths.append(manifest["runs"].pop(run_id)["path"])
+
+        manifest["update_time"] = datetime.now().isoformat()
+        save_manifest(export_path, manifest)
+        # manifest写好后再删除旧分片；已提交的训练任务使用的是硬链接到输出目录的分片（snapshot_export），不受影响
+        for path in stale_paths:
+            shutil.rmtree(os.path.join(export_path, path), ignore_errors=True)
+        for run_id in removed:
+            run_dir = os.path.join(export_path, run_id)
+            if os.path.isdir(run_dir) and not os.listdir(run_dir):
+                os.rmdir(run_dir)
+
+    total = sum(run["examples"] for run in manifest["runs"].values())
+    print(f"✅ 训练数据导出完成: {export_path}，{len(manifest['runs'])}个run，{total}条样本"
+          f"（重新导出{len(exported)}个，未变化{len(unchanged)}个，移除{len(removed)}个）")
+    return {
+        "name": name,
+        "export_path": export_path,
+        "runs": len(manifest["runs"]),
+        "examples": total,
+        "exported_runs": exported,
+        "unchanged_runs": unchanged,
+        "removed_runs": removed,
+        "skipped": skipped,
+        "shards": manifest_shard_paths(export_path, manifest)
+    }
+
+
+def snapshot_export(export_path: str, target_dir: str) -> List[str]:
+    """
+    把导出的分片固定到训练任务的目录（硬链接，不复制数据；跨文件系统时复制），
+    之后的导出删除旧分片不影响排队中和续跑的训练任务
+
+    Returns:
+        list: 训练任务目录中的分片路径
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    shard_paths = []
+    with export_lock(export_path):
+        manifest = load_manifest(export_path)
+        for source_path in manifest_shard_paths(export_path, manifest):
+            target_path = os.path.join(target_dir, os.path.relpath(source_path, export_path).replace(os.sep, "-"))
+            if not os.path.exists(target_path):
+                try:
+                    os.link(source_path, target_path)
+                except OSError:
+                    shutil.copy2(source_path, target_path)
+            shard_paths.append(target_path)
+        save_manifest(target_dir, manifest)
+    return shard_paths
@@ -0,0 +1,125 @@
+# LoRA训练任务表
+# 原来训练任务状态只保存在进程内存的 training_tasks 字典中，服务重启后全部丢失。
+# 这里把任务（配置、状态、分配的GPU、进度）保存到 lora_training_job 表，由 training_scheduler_service 调度。
+#
+# CREATE TABLE IF NOT EXISTS lora_training_job (
+#     task_id TEXT PRIMARY KEY,
+#     user_id TEXT,
+#     status TEXT NOT NULL,                 -- queued / running / cancelling / completed / failed / cancelled
+#     training_env JSONB NOT NULL,          -- prepare_training_environment 生成的训练配置
+#     output_path TEXT,
+#     gpu_ids TEXT,                         -- 运行时分配的GPU，如 "2,3"
+#     pid INTEGER,                          -- 训练子进程
+#     attempts INTEGER NOT NULL DEFAULT 0,  -- 启动次数（含续跑）
+#     resume BOOLEAN NOT NULL DEFAULT FALSE,  -- 下次启动时从最新的checkpoint继续
+#     resume_from_checkpoint TEXT,
+#     progress JSONB,                       -- step / max_steps / epoch / loss / learning_rate / tokens_per_second
+#     error_message TEXT,
+#     adapter_name TEXT,
+#     adapter_path TEXT,
+#     create_time TIMESTAMP NOT NULL DEFAULT NOW(),
+#     update_time TIMESTAMP NOT NULL DEFAULT NOW(),
+#     start_time TIMESTAMP,
+#     end_time TIMESTAMP
+# );
+# CREATE INDEX IF NOT EXISTS idx_lora_training_job_status ON lora_training_job (status, create_time);
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from psycopg2.extras import Json, RealDictCursor
+from synapse_flow.db import get_pg_conn
+
+JOB_COLUMNS = (
+    "task_id", "user_id", "status", "training_env", "output_path", "gpu_ids", "pid", "attempts", "resume",
+    "resume_from_checkpoint", "progress", "error_message", "adapter_name", "adapter_path",
+    "create_time", "update_time", "start_time", "end_time"
+)
+JSON_COLUMNS = ("training_env", "progress")
+TIME_COLUMNS = ("create_time", "update_time", "start_time", "end_time")
+
+
+def _to_row_value(column: str, value):
+    if column in JSON_COLUMNS and value is not None:
+        return Json(value)
+    if column in TIME_COLUMNS and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def _from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    job = dict(row)
+    for column in TIME_COLUMNS:
+        if job.get(column) is not None:
+            job[column] = job[column].isoformat()
+    return job
+
+
+class PgTrainingJobStore:
+    """lora_training_job 表的读写（每次操作使用独立连接，可在调度线程和请求线程中同时使用）"""
+
+    def create(self, job: Dict[str, Any]):
+        columns = [column for column in JOB_COLUMNS if column in job]
+        conn = get_pg_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"INSERT INTO lora_training_job ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+                    [_to_row_value(column, job[column]) for column in columns]
+                )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+
+    def update(self, task_id: str, **fields):
+        """更新任务字段，同时刷新 update_time"""
+        fields = {column: value for column, value in fields.items() if column in JOB_COLUMNS}
+        fields.setdefault("update_time", datetime.now())
+        conn = get_pg_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"UPDATE lora_training_job SET {', '.join(f'{column} = %s' for column in fields)} WHERE task_id = %s",
+                    [_to_row_value(column, value) for column, value in fields.items()] + [task_id]
+                )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        conn = get_pg_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM lora_training_job WHERE task_id = %s", (task_id,))
+                row = cur.fetchone()
+                return _from_row(row) if row else None
+        finally:
+            conn.close()
+
+    def list(self, user_id: str = None, statuses: List[str] = None, limit: int = None) -> List[Dict[str, Any]]:
+        """按创建时间从新到旧列出任务"""
+        conditions, params = [], []
+        if user_id:
+            conditions.append("user_id = %s")
+            params.append(user_id)
+        if statuses:
+            conditions.append("status = ANY(%s)")
+            params.append(list(statuses))
+        sql = "SELECT * FROM lora_training_job"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY create_time DESC"
+        if limit:
+            sql += " LIMIT %s"
+            params.append(limit)
+        conn = get_pg_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(sql, params)
+                return [_from_row(row) for row in cur.fetchall()]
+        finally:
+            conn.close()
@@ -0,0 +1,467 @@
+"""
+LoRA训练任务调度
+原来每次 /training 调用都启动一个守护线程，在服务进程内固定使用 CUDA_VISIBLE_DEVICES="0" 训练：
+同时提交的任务争用0号卡，任务状态只在内存中，服务重启后全部丢失。这里：
+- 任务保存在任务表（training_job_registry_service.PgTrainingJobStore），提交后进入队列，按提交顺序调度
+- 按 nvidia-smi 报告的空闲显存找出空闲的GPU（vLLM服务占用的卡不会被分配），每个任务分配 gpus_per_job 张
+- 每个任务在独立的子进程（lora_training_worker）中训练，通过 CUDA_VISIBLE_DEVICES 指定分配的GPU；
+  子进程输出的进度行（loss、学习率、吞吐量）写入任务的 progress，其余输出写入输出目录下的 train.log
+- 取消：排队中的任务直接取消；运行中的任务发送 SIGTERM，子进程保存checkpoint后退出，超过 cancel_grace_seconds 强制结束
+- 续跑：失败或取消的任务可重新入队，从输出目录中最新的checkpoint继续；服务重启时运行中的任务自动重新入队续跑
+GPU探测和任务表可替换：FakeGpuProbe、MemoryTrainingJobStore 用于测试。
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import subprocess
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Callable
+
+logger = logging.getLogger(__name__)
+
+# 训练调度配置
+TRAINING_SCHEDULER_CONFIG = {
+    "gpu_ids": None,               # 可用于训练的GPU，None表示 nvidia-smi 检测到的全部GPU
+    "gpus_per_job": 1,
+    "min_free_memory_mb": 30000,   # 空闲显存不低于该值的GPU才视为空闲
+    "poll_interval": 5,            # 检查子进程和队列的间隔（秒），提交、取消时立即检查
+    "cancel_grace_seconds": 120,   # 取消后等待子进程保存checkpoint的时间，超时强制结束
+    "max_attempts": 3,             # 服务重启时自动续跑的启动次数上限
+    "error_tail_lines": 20,        # 失败时记录在 error_message 中的最后几行输出
+    "worker_command": [sys.executable, "-m", "synapse_flow.web.services.lora_training_worker"]
+}
+
+QUEUED = "queued"
+RUNNING = "running"
+CANCELLING = "cancelling"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+RESUMABLE_STATUSES = (FAILED, CANCELLED)
+
+# 子进程输出中以该前缀开头的行是进度（JSON）
+PROGRESS_PREFIX = "@@training_progress "
+
+
+def emit_training_progress(progress: Dict[str, Any]):
+    """训练子进程中调用：把进度输出给调度器"""
+    print(PROGRESS_PREFIX + json.dumps(progress, ensure_ascii=False), flush=True)
+
+
+def find_latest_checkpoint(output_dir: str) -> Optional[str]:
+    """输出目录中步数最大的、保存完整的 checkpoint-N（含 trainer_state.json）"""
+    if not output_dir or not os.path.isdir(output_dir):
+        return None
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        checkpoint_dir = os.path.join(output_dir, name)
+        if name.startswith("checkpoint-") and name[len("checkpoint-"):].isdigit() \
+                and os.path.exists(os.path.join(checkpoint_dir, "trainer_state.json")):
+            checkpoints.append((int(name[len("checkpoint-"):]), checkpoint_dir))
+    return max(checkpoints)[1] if checkpoints else None
+
+
+def now_iso() -> str:
+    return datetime.now().isoformat()
+
+
+class GpuProbe:
+    """通过 nvidia-smi 查询每张GPU的空闲显存"""
+
+    def free_memory_mb(self) -> Dict[int, int]:
+        output = subprocess.run(
+            ["nvidia-smi", "--query-gpu=index,memory.free", "--format=csv,noheader,nounits"],
+            capture_output=True, text=True, timeout=30, check=True
+        ).stdout
+        free = {}
+        for line in output.strip().splitlines():
+            index, memory = [value.strip() for value in line.split(",")]
+            free[int(index)] = int(memory)
+        return free
+
+
+class FakeGpuProbe(GpuProbe):
+    """测试用：free_memory 可随时修改"""
+
+    def __init__(self, free_memory: Dict[int, int]):
+        self.free_memory = dict(free_memory)
+
+    def free_memory_mb(self) -> Dict[int, int]:
+        return dict(self.free_memory)
+
+
+class MemoryTrainingJobStore:
+    """测试用的内存任务表，接口与 PgTrainingJobStore 相同"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: Dict[str, Any]):
+        with self._lock:
+            if job["task_id"] in self._jobs:
+                raise KeyError(f"任务已存在: {job['task_id']}")
+            self._jobs[job["task_id"]] = dict(job)
+
+    def update(self, task_id: str, **fields):
+        fields.setdefault("update_time", now_iso())
+        with self._lock:
+            self._jobs[task_id].update(fields)
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(task_id)
+            return dict(job) if job else None
+
+    def list(self, user_id: str = None, statuses: List[str] = None, limit: int = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            jobs = [dict(job) for job in self._jobs.values()
+                    if (not user_id or job.get("user_id") == user_id) and (not statuses or job["status"] in statuses)]
+        jobs.sort(key=lambda job: job["create_time"], reverse=True)
+        return jobs[:limit] if limit else jobs
+
+
+class _RunningJob:
+    __slots__ = ("task_id", "process", "gpu_ids", "reader", "tail", "progress", "cancel_deadline")
+
+    def __init__(self, task_id: str, process: subprocess.Popen, gpu_ids: List[int], tail_lines: int):
+        self.task_id = task_id
+        self.process = process
+        self.gpu_ids = gpu_ids
+        self.reader = None
+        self.tail = deque(maxlen=tail_lines)  # 最后几行输出，失败时记录
+        self.progress = {}
+        self.cancel_deadline = None           # 取消后强制结束的时间
+
+
+class TrainingScheduler:
+    """训练调度器：后台线程检查子进程、按空闲GPU启动排队的任务；任务状态都写入任务表"""
+
+    def __init__(self, store=None, gpu_probe: GpuProbe = None, config: Dict[str, Any] = None):
+        """
+        Args:
+            store: 任务表，默认 PgTrainingJobStore
+            gpu_probe: GPU空闲显存查询，默认 nvidia-smi
+            config: 覆盖 TRAINING_SCHEDULER_CONFIG 中的配置
+        """
+        if store is None:
+            from synapse_flow.web.services.training_job_registry_service import PgTrainingJobStore
+            store = PgTrainingJobStore()
+        self.store = store
+        self.gpu_probe = gpu_probe or GpuProbe()
+        self.config = {**TRAINING_SCHEDULER_CONFIG, **(config or {})}
+        self._running = {}   # task_id -> _RunningJob
+        self._condition = threading.Condition()
+        self._subscribers = []
+        self._thread = None
+        self._wakeup = False
+        self._closed = False
+
+    # ---- 对外接口 ----
+
+    def start(self):
+        """恢复上次运行中断的任务并启动后台调度线程（重复调用无影响）"""
+        with self._condition:
+            if self._thread is not None or self._closed:
+                return
+            self._thread = threading.Thread(target=self._loop, name="training_scheduler", daemon=True)
+        self._recover()
+        self._thread.start()
+
+    def submit(self, task_id: str, training_env: Dict[str, Any], user_id: str = None) -> Dict[str, Any]:
+        """提交任务到队列"""
+        self.store.create({
+            "task_id": task_id,
+            "user_id": user_id,
+            "status": QUEUED,
+            "training_env": training_env,
+            "output_path": training_env["output_dir"],
+            "attempts": 0,
+            "resume": False,
+            "progress": None,
+            "create_time": now_iso(),
+            "update_time": now_iso()
+        })
+        print(f"✅ 训练任务已入队: {task_id}")
+        self._notify(task_id, QUEUED)
+        self._wake()
+        return self.store.get(task_id)
+
+    def cancel(self, task_id: str) -> Dict[str, Any]:
+        """取消任务：排队中的直接取消，运行中的通知子进程保存checkpoint后退出"""
+        job = self.store.get(task_id)
+        if job is None:
+            return {"status": "error", "message": "任务不存在"}
+        with self._condition:
+            # 与 _launch、_reap 互斥：排队中的任务要么在启动前被取消，要么按运行中的任务取消；
+            # 子进程已退出的任务 _reap 已在锁内写入结束状态，不会被 cancelling 覆盖
+            job = self.store.get(task_id)
+            running = self._running.get(task_id)
+            if job["status"] == QUEUED:
+                self.store.update(task_id, status=CANCELLED, end_time=now_iso())
+                task_status = CANCELLED
+            elif job["status"] == RUNNING and running is not None:
+                if running.cancel_deadline is None:
+                    running.cancel_deadline = time.time() + self.config["cancel_grace_seconds"]
+                    running.process.terminate()
+                self.store.update(task_id, status=CANCELLING)
+                task_status = CANCELLING
+            else:
+                return {"status": "error", "message": f"任务状态为 {job['status']}，不能取消",
+                        "task_status": job["status"]}
+        self._notify(task_id, task_status)
+        if task_status == CANCELLED:
+            return {"status": "success", "task_status": CANCELLED}
+
+        print(f"⏹️ 正在取消训练任务: {task_id}")
+        self._wake()
+        return {"status": "success", "task_status": CANCELLING}
+
+    def resume(self, task_id: str) -> Dict[str, Any]:
+        """失败或取消的任务重新入队，从最新的checkpoint继续"""
+        job = self.store.get(task_id)
+        if job is None:
+            return {"status": "error", "message": "任务不存在"}
+        if job["status"] not in RESUMABLE_STATUSES:
+            return {"status": "error", "message": f"任务状态为 {job['status']}，不能续跑"}
+        self.store.update(task_id, status=QUEUED, resume=True, error_message=None, end_time=None)
+        self._notify(task_id, QUEUED)
+        self._wake()
+        return {"status": "success", "task_status": QUEUED,
+                "resume_from_checkpoint": find_latest_checkpoint(job["output_path"])}
+
+    def get_job(self, task_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(task_id)
+
+    def list_jobs(self, user_id: str = None, limit: int = 20) -> List[Dict[str, Any]]:
+        return self.store.list(user_id=user_id, limit=limit)
+
+    def subscribe(self, callback: Callable[[str, str, Dict[str, Any]], None]):
+        """订阅状态变化：callback(task_id, status, 任务记录)，在调度线程或调用方线程中调用，不能阻塞"""
+        with self._condition:
+            self._subscribers.append(callback)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {"running": {task_id: running.gpu_ids for task_id, running in self._running.items()},
+                    "queued": len(self.store.list(statuses=[QUEUED]))}
+
+    def close(self, timeout: float = 30):
+        """停止调度线程并结束运行中的子进程（任务保持 running 状态，下次启动时续跑）"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            running_jobs = list(self._running.values())
+        for running in running_jobs:
+            running.process.terminate()
+        for running in running_jobs:
+            try:
+                running.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                running.process.kill()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # ---- 内部实现 ----
+
+    def _wake(self):
+        with self._condition:
+            self._wakeup = True
+            self._condition.notify_all()
+
+    def _notify(self, task_id: str, status: str):
+        with self._condition:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+        job = self.store.get(task_id)
+        for callback in subscribers:
+            try:
+                callback(task_id, status, job)
+            except Exception as e:
+                logger.error(f"训练任务状态订阅回调出错: {str(e)}")
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or self._wakeup, self.config["poll_interval"])
+                if self._closed:
+                    return
+                self._wakeup = False
+            try:
+                self._reap()
+                self._dispatch()
+            except Exception as e:
+                logger.error(f"训练任务调度出错: {str(e)}")
+
+    def _recover(self):
+        """上次服务退出时仍在运行的任务：结束残留的子进程，重新入队续跑（超过启动次数上限的记为失败）"""
+        for job in self.store.list(statuses=[RUNNING, CANCELLING]):
+            self._kill_stale_worker(job)
+            if job["status"] == CANCELLING:
+                self.store.update(job["task_id"], status=CANCELLED, pid=None, end_time=now_iso())
+            elif job.get("attempts", 0) < self.config["max_attempts"]:
+                self.store.update(job["task_id"], status=QUEUED, resume=True, pid=None,
+                                  error_message="服务重启，从最新的checkpoint继续")
+                print(f"🔄 训练任务 {job['task_id']} 重新入队续跑")
+            else:
+                self.store.update(job["task_id"], status=FAILED, pid=None, end_time=now_iso(),
+                                  error_message=f"服务重启，已启动 {job['attempts']} 次，不再续跑")
+
+    def _kill_stale_worker(self, job: Dict[str, Any]):
+        """只结束命令行中包含该任务配置文件的进程（pid可能已被其他进程复用）"""
+        pid = job.get("pid")
+        if not pid:
+            return
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read().decode(errors="ignore")
+            if self._env_path(job["output_path"]) in cmdline:
+                os.kill(pid, 9)
+                print(f"⚠️ 已结束残留的训练进程 {pid}（{job['task_id']}）")
+        except (OSError, ValueError):
+            pass
+
+    def _free_gpus(self) -> List[int]:
+        try:
+            free_memory = self.gpu_probe.free_memory_mb()
+        except Exception as e:
+            logger.warning(f"⚠️ 查询GPU空闲显存失败: {str(e)}")
+            return []
+        with self._condition:
+            assigned = {gpu_id for running in self._running.values() for gpu_id in running.gpu_ids}
+        allowed = self.config["gpu_ids"]
+        return sorted(gpu_id for gpu_id, memory in free_memory.items()
+                      if gpu_id not in assigned and memory >= self.config["min_free_memory_mb"]
+                      and (allowed is None or gpu_id in allowed))
+
+    def _dispatch(self):
+        """按提交顺序为排队的任务分配GPU（队首的任务等不到GPU时后面的任务也等待）"""
+        queued = sorted(self.store.list(statuses=[QUEUED]), key=lambda job: job["create_time"])
+        if not queued:
+            return
+        free = self._free_gpus()
+        for job in queued:
+            if len(free) < self.config["gpus_per_job"]:
+                break
+            gpu_ids = free[:self.config["gpus_per_job"]]
+            if self._launch(job["task_id"], gpu_ids):
+                free = free[len(gpu_ids):]
+
+    @staticmethod
+    def _env_path(output_dir: str) -> str:
+        return os.path.join(output_dir, "training_env.json")
+
+    def _launch(self, task_id: str, gpu_ids: List[int]) -> bool:
+        """启动任务的训练子进程，返回是否已启动（任务已被取消时不启动）"""
+        with self._condition:
+            job = self.store.get(task_id)
+            if job is None or job["status"] != QUEUED:
+                return False
+            training_env = dict(job["training_env"])
+            output_dir = training_env["output_dir"]
+            resume_from = find_latest_checkpoint(output_dir) if job.get("resume") else None
+            training_env["resume_from_checkpoint"] = resume_from
+            try:
+                os.makedirs(output_dir, exist_ok=True)
+                env_path = self._env_path(output_dir)
+                with open(env_path, "w", encoding="utf-8") as f:
+                    json.dump(training_env, f, ensure_ascii=False, indent=2)
+                process = subprocess.Popen(
+                    self.config["worker_command"] + [env_path],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+                    env={**os.environ, "CUDA_VISIBLE_DEVICES": ",".join(map(str, gpu_ids)), "PYTHONUNBUFFERED": "1"}
+                )
+            except Exception as e:
+                print(f"❌ 启动训练任务 {task_id} 失败: {str(e)}")
+                self.store.update(task_id, status=FAILED, end_time=now_iso(),
+                                  error_message=f"启动训练进程失败: {str(e)}")
+                status = FAILED
+            else:
+                running = _RunningJob(task_id, process, gpu_ids, self.config["error_tail_lines"])
+                running.reader = threading.Thread(target=self._read_output,
+                                                  args=(running, os.path.join(output_dir, "train.log")),
+                                                  name=f"training_output_{task_id}", daemon=True)
+                self._running[task_id] = running
+                self.store.update(task_id, status=RUNNING, gpu_ids=",".join(map(str, gpu_ids)), pid=process.pid,
+                                  attempts=job.get("attempts", 0) + 1, resume=False,
+                                  resume_from_checkpoint=resume_from, start_time=now_iso(), end_time=None,
+                                  error_message=None)
+                running.reader.start()
+                print(f"🚀 训练任务 {task_id} 已启动（GPU {','.join(map(str, gpu_ids))}，pid {process.pid}"
+                      f"{f'，从 {resume_from} 继续' if resume_from else ''}）")
+                status = RUNNING
+        self._notify(task_id, status)
+        return status == RUNNING
+
+    def _read_output(self, running: _RunningJob, log_path: str):
+        """读取子进程输出：进度行写入任务表，其余写入 train.log"""
+        with open(log_path, "a", encoding="utf-8") as log_file:
+            for line in running.process.stdout:
+                if line.startswith(PROGRESS_PREFIX):
+                    try:
+                        running.progress.update(json.loads(line[len(PROGRESS_PREFIX):]))
+                        self.store.update(running.task_id, progress=dict(running.progress))
+                    except Exception as e:
+                        logger.warning(f"⚠️ 更新训练进度失败（{running.task_id}）: {str(e)}")
+                    continue
+                log_file.write(line)
+                log_file.flush()
+                running.tail.append(line.rstrip())
+
+    def _reap(self):
+        """处理已退出的子进程，取消超时的强制结束"""
+        with self._condition:
+            running_jobs = list(self._running.values())
+        for running in running_jobs:
+            code = running.process.poll()
+            if code is None:
+                if running.cancel_deadline is not None and time.time() > running.cancel_deadline:
+                    print(f"⚠️ 训练任务 {running.task_id} 取消超时，强制结束")
+                    running.process.kill()
+                continue
+
+            running.reader.join(timeout=10)
+            with self._condition:
+                # 与 cancel 互斥：移出运行列表和写入结束状态在同一把锁内完成
+                self._running.pop(running.task_id, None)
+                error_message = None
+                if running.cancel_deadline is not None:
+                    status = CANCELLED
+                elif code == 0:
+                    status = COMPLETED
+                else:
+                    status = FAILED
+                    error_message = f"训练进程退出码 {code}\n" + "\n".join(running.tail)
+                self.store.update(running.task_id, status=status, pid=None, end_time=now_iso(),
+                                  error_message=error_message)
+            print(f"{'✅' if status == COMPLETED else '⏹️' if status == CANCELLED else '❌'} "
+                  f"训练任务 {running.task_id} {status}（GPU {','.join(map(str, running.gpu_ids))} 已释放）")
+            self._notify(running.task_id, status)
+
+
+# 全局调度器（首次使用时创建并启动）
+_training_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_training_scheduler() -> TrainingScheduler:
+    """全局训练调度器"""
+    global _training_scheduler
+    with _scheduler_lock:
+        if _training_scheduler is None:
+            _training_scheduler = TrainingScheduler()
+            _training_scheduler.start()
+        return _training_scheduler
+
+
+def set_training_scheduler(scheduler: TrainingScheduler) -> TrainingScheduler:
+    """替换全局调度器（测试中换成内存任务表和 FakeGpuProbe），返回原来的实例"""
+    global _training_scheduler
+    with _scheduler_lock:
+        previous, _training_scheduler = _training_scheduler, scheduler
+    return previous
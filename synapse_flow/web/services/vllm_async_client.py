@@ -0,0 +1,326 @@
+# 共享的异步vLLM客户端
+# 所有调用方（不同文档、不同线程）共用一个后台事件循环和一个aiohttp连接池，
+# 在途请求数受全局并发预算限制；预算不足时按优先级、再按各调用方当前在途数（少者优先）、再按先来后到放行，
+# 保证单个文档的请求不会把预算占满，其它文档也能持续推进。
+# 模型有多个副本时每次请求（包括重试）从地址池中选在途最少的健康地址，重试时避开已失败的地址。
+# 每次尝试前经过熔断器：服务宕机时请求不再发出，chat() 按熔断配置挂起等待恢复或立即抛出 CircuitOpenError。
+# 传入 stream_parser 时按流式请求，边接收边解析，答案确定后断开连接（vLLM随即中止该请求），不再等待后面的解释。
+import json
+import asyncio
+import threading
+import concurrent.futures
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Callable, Iterable
+
+import aiohttp
+
+from vllm_endpoint_pool import EndpointPool
+from vllm_circuit_breaker import CircuitBreaker, CircuitOpenError, CIRCUIT_BREAKER_CONFIG, CLOSED
+
+
+def sse_delta(line: bytes) -> Optional[str]:
+    """流式响应中的一行（server-sent events），返回新生成的文本；不是数据行或为结束标记时返回None"""
+    line = line.strip()
+    if not line.startswith(b"data:"):
+        return None
+    data = line[5:].strip()
+    if data == b"[DONE]":
+        return None
+    choices = json.loads(data).get("choices")
+    return (choices[0].get("delta") or {}).get("content") if choices else None
+
+
+class StreamEarlyStopStats:
+    """
+    流式请求提前结束的统计（线程安全）
+    提前结束的请求无从得知完整回答还有多少token：每 calibration_every 个答案已确定的请求中让一个读完整个回答（校准），
+    用校准请求在答案确定之后的平均token数估计提前结束节省的token
+    """
+
+    def __init__(self, calibration_every: int = 50):
+        self.calibration_every = calibration_every
+        self._definitive = 0
+        self._lock = threading.Lock()
+        self.stats = {"streamed": 0, "early_stopped": 0, "tokens_received": 0,
+                      "calibrated": 0, "calibration_tail_tokens": 0}
+
+    def should_stop(self) -> bool:
+        """答案确定时调用：是否提前结束（否则作为校准请求读完，第一个确定的请求总是校准）"""
+        with self._lock:
+            self._definitive += 1
+            return not self.calibration_every or (self._definitive - 1) % self.calibration_every != 0
+
+    def record(self, parser, stopped_early: bool):
+        """记录一次读完或提前结束的流式请求"""
+        with self._lock:
+            self.stats["streamed"] += 1
+            self.stats["tokens_received"] += parser.tokens
+            if stopped_early:
+                self.stats["early_stopped"] += 1
+            elif parser.definitive:
+                self.stats["calibrated"] += 1
+                self.stats["calibration_tail_tokens"] += parser.tail_tokens
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        tail_mean = stats["calibration_tail_tokens"] / stats["calibrated"] if stats["calibrated"] else 0
+        stats["tail_tokens_mean"] = round(tail_mean, 1)
+        stats["tokens_saved_estimate"] = round(stats["early_stopped"] * tail_mean)
+        return stats
+
+
+def consume_stream(lines: Iterable[bytes], parser, stream_stats: StreamEarlyStopStats) -> bool:
+    """同步读取流式响应（如 requests 的 iter_lines()），返回是否提前结束；调用方提前结束时负责关闭响应"""
+    for line in lines:
+        delta = sse_delta(line)
+        if delta and parser.feed(delta) and parser.tail_tokens == 0 and stream_stats.should_stop():
+            parser.stopped_early = True
+            stream_stats.record(parser, True)
+            return True
+    stream_stats.record(parser, False)
+    return False
+
+
+class FairPriorityGate:
+    """
+    全局并发预算（只在事件循环线程中使用）
+    放行顺序：priority 大的优先 → 同优先级时当前在途请求少的 key 优先 → 先来先到
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.in_flight_by_key = defaultdict(int)
+        self._waiters = []  # [priority, seq, key, future]
+        self._seq = 0
+
+    async def acquire(self, key: str, priority: int = 0):
+        if self.in_flight < self.limit and not self._waiters:
+            self._grant(key)
+            return
+
+        self._seq += 1
+        waiter = [priority, self._seq, key, asyncio.get_running_loop().create_future()]
+        self._waiters.append(waiter)
+        try:
+            await waiter[3]
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif not waiter[3].cancelled():
+                # 已经放行但调用方被取消，归还预算
+                self.release(key)
+            raise
+
+    def release(self, key: str):
+        self.in_flight -= 1
+        self.in_flight_by_key[key] -= 1
+        if self.in_flight_by_key[key] <= 0:
+            del self.in_flight_by_key[key]
+        self._wake()
+
+    def waiting_count(self) -> int:
+        return len(self._waiters)
+
+    def _grant(self, key: str):
+        self.in_flight += 1
+        self.in_flight_by_key[key] += 1
+
+    def _wake(self):
+        while self.in_flight < self.limit and self._waiters:
+            waiter = min(self._waiters, key=lambda w: (-w[0], self.in_flight_by_key.get(w[2], 0), w[1]))
+            self._waiters.remove(waiter)
+            if waiter[3].done():
+                continue
+            self._grant(waiter[2])
+            waiter[3].set_result(None)
+
+
+class AsyncVLLMClient:
+    """
+    线程安全的共享vLLM客户端：submit() 可以在任意线程调用，返回 concurrent.futures.Future
+    多LoRA共享服务上可以用一个客户端调用多个适配器：submit(model=适配器名)，不传时使用 model_name
+    """
+
+    def __init__(self, base_url: str, model_name: str, max_concurrency: int = 32,
+                 timeout: float = 300, max_retries: int = 3,
+                 retry_interval: float = CIRCUIT_BREAKER_CONFIG["retry_backoff"],
+                 endpoint_pool: Optional[EndpointPool] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 stream_calibration_every: int = 50):
+        """
+        Args:
+            base_url: 单个服务地址，传入 endpoint_pool 时忽略
+            retry_interval: 第一次重试前的等待时间（秒），之后每次加倍
+            endpoint_pool: 多副本地址池（vllm_endpoint_pool.get_endpoint_pool），请求在副本间均衡分配
+            circuit_breaker: 服务的熔断器（vllm_circuit_breaker.get_circuit_breaker），不传时客户端单独使用一个
+            stream_calibration_every: 流式请求中每多少个读完整个回答，用于估计提前结束节省的token（见 StreamEarlyStopStats）
+        """
+        self.endpoint_pool = endpoint_pool or EndpointPool([base_url])
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(name=model_name)
+        self.base_url = self.endpoint_pool.urls[0]
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+
+        self._loop = None
+        self._session = None
+        self._gate = None
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "failed": 0, "rejected": 0}
+        self.stream_stats = StreamEarlyStopStats(stream_calibration_every)
+
+    def submit(self, messages: List[Dict[str, str]], key: str = "default", priority: int = 0,
+               max_tokens: int = 2000, model: Optional[str] = None,
+               stream_parser: Optional[Callable[[], Any]] = None) -> concurrent.futures.Future:
+        """
+        提交一次chat请求
+
+        Args:
+            messages: 消息列表
+            key: 调用方标识（如run_id），用于公平调度
+            priority: 优先级，越大越先放行
+            max_tokens: 最大token数
+            model: 请求的模型（LoRA适配器名），默认 model_name
+            stream_parser: 流式解析器类（如 LevelStreamParser），每次尝试新建一个；传入时按流式请求，
+                           解析器的 feed() 返回True（答案确定）后断开连接，结果为已收到的文本，
+                           此时解析器的 stopped_early 被设为True
+
+        Returns:
+            Future: 结果为AI响应内容，所有重试失败时为空字符串；
+                    熔断断开（包括重试用完时熔断已断开）时为 CircuitOpenError 异常
+        """
+        self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(
+            self._chat(messages, key, priority, max_tokens, model or self.model_name, stream_parser), self._loop)
+
+    def chat(self, messages: List[Dict[str, str]], key: str = "default", priority: int = 0,
+             max_tokens: int = 2000, model: Optional[str] = None,
+             stream_parser: Optional[Callable[[], Any]] = None) -> str:
+        """
+        同步调用（阻塞当前线程直到返回）
+        熔断断开时在当前线程挂起（不占用事件循环和并发预算），恢复或可以探测时重新提交；
+        fail_fast 模式或挂起超过 park_timeout 时抛出 CircuitOpenError
+        """
+        return self.circuit_breaker.call(
+            lambda: self.submit(messages, key, priority, max_tokens, model, stream_parser).result())
+
+    def get_stats(self) -> Dict[str, Any]:
+        """当前在途、排队的请求数和累计请求数"""
+        gate = self._gate
+        return {
+            **self.stats,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": gate.in_flight if gate else 0,
+            "waiting": gate.waiting_count() if gate else 0,
+            "in_flight_by_key": dict(gate.in_flight_by_key) if gate else {},
+            "endpoints": self.endpoint_pool.get_stats(),
+            "circuit_breaker": self.circuit_breaker.get_stats(),
+            "stream": self.stream_stats.get_stats()
+        }
+
+    def close(self):
+        """关闭连接池并停止事件循环"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result(timeout=10)
+            self._session = None
+        loop.call_soon_threadsafe(loop.stop)
+
+    def _ensure_loop(self):
+        if self._loop is not None:
+            return
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._gate = FairPriorityGate(self.max_concurrency)
+                ready.set()
+                loop.run_forever()
+
+            threading.Thread(target=run, name="vllm_async_client", daemon=True).start()
+            ready.wait()
+            self._loop = loop
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def _chat(self, messages, key, priority, max_tokens, model, stream_parser) -> str:
+        payload = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": 0.0,
+            "stream": stream_parser is not None
+        }
+
+        await self._gate.acquire(key, priority)
+        try:
+            session = await self._get_session()
+            failed_endpoints = set()
+            for attempt in range(self.max_retries):
+                try:
+                    probe = self.circuit_breaker.acquire()
+                except CircuitOpenError:
+                    self.stats["rejected"] += 1
+                    raise
+                endpoint = self.endpoint_pool.acquire(exclude=failed_endpoints)
+                endpoint_ok = False
+                try:
+                    async with session.post(f"{endpoint}/v1/chat/completions", json=payload) as response:
+                        # 4xx 是请求本身的问题，不算副本故障
+                        endpoint_ok = response.status < 500
+                        if response.status == 200:
+                            if stream_parser is not None:
+                                content = await self._read_stream(response, stream_parser())
+                            else:
+                                result = await response.json()
+                                content = result["choices"][0]["message"]["content"]
+                            self.stats["requests"] += 1
+                            return content
+                        error_text = await response.text()
+                        print(f"❌ API调用失败 ({key}, {endpoint})，状态码: {response.status}, 错误: {error_text[:200]}")
+                except Exception as e:
+                    print(f"❌ API调用出错 ({key}, {endpoint}, 第{attempt + 1}次): {str(e)}")
+                finally:
+                    service_ok = self.endpoint_pool.release(endpoint, endpoint_ok)
+                    self.circuit_breaker.release(service_ok, probe)
+                if not endpoint_ok:
+                    failed_endpoints.add(endpoint)
+                # 还有没失败过的健康副本时立即换一个重试
+                if attempt < self.max_retries - 1 and not self.endpoint_pool.has_healthy(exclude=failed_endpoints):
+                    await asyncio.sleep(self.retry_interval * 2 ** attempt)
+            self.stats["failed"] += 1
+            if self.circuit_breaker.state != CLOSED:
+                # 失败是服务宕机造成的，交给调用方挂起等待恢复后重新请求
+                raise CircuitOpenError(f"{self.model_name} 重试用完时vLLM服务已熔断")
+            return ""
+        finally:
+            self._gate.release(key)
+
+    async def _read_stream(self, response: aiohttp.ClientResponse, parser) -> str:
+        """边接收边解析流式响应，答案确定后关闭连接（vLLM检测到断开后中止生成）"""
+        async for line in response.content:
+            delta = sse_delta(line)
+            if delta and parser.feed(delta) and parser.tail_tokens == 0 and self.stream_stats.should_stop():
+                response.close()
+                parser.stopped_early = True
+                self.stream_stats.record(parser, True)
+                return parser.text
+        self.stream_stats.record(parser, False)
+        return parser.text
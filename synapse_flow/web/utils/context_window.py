@@ -0,0 +1,53 @@
+from typing import Any, Callable, List, Optional
+
+
+def build_context_windows(
+    items: List[Any],
+    is_member: Callable[[Any], bool],
+    before: int = 2,
+    after: int = 1,
+    make_before: Optional[Callable[[Any], Any]] = None,
+    make_target: Optional[Callable[[Any], Any]] = None,
+    make_after: Optional[Callable[[Any], Any]] = None,
+    padding: Optional[Callable[[], Any]] = None,
+) -> List[Optional[list]]:
+    """
+    滑动窗口上下文构建：为每个成员元素构建「前 before 个成员 + 自身 + 后 after 个成员」的窗口。
+
+    先一次遍历建立成员位置索引（is_member 对每个元素只调用一次），再按索引切片取前后文，
+    总复杂度 O(n)，与成员之间夹杂多少非成员元素（如表格）无关。
+
+    Args:
+        items: 按原始顺序排列的元素列表
+        is_member: 判断元素是否参与窗口（既作为目标，也作为前后文）
+        before: 目标之前的成员个数
+        after: 目标之后的成员个数
+        make_before / make_target / make_after: 把元素转换成窗口中的块，默认原样返回
+        padding: 前后文不足时用于补齐的占位块，为 None 时不补齐
+
+    Returns:
+        list: 与 items 等长，成员位置为窗口列表，非成员位置为 None
+    """
+    identity = lambda item: item
+    make_before = make_before or identity
+    make_target = make_target or identity
+    make_after = make_after or identity
+
+    positions = [i for i, item in enumerate(items) if is_member(item)]
+    windows: List[Optional[list]] = [None] * len(items)
+
+    for k, position in enumerate(positions):
+        window = [make_before(items[p]) for p in positions[max(0, k - before):k]]
+        if padding is not None:
+            window[:0] = [padding() for _ in range(before - len(window))]
+
+        window.append(make_target(items[position]))
+
+        next_blocks = [make_after(items[p]) for p in positions[k + 1:k + 1 + after]]
+        if padding is not None:
+            next_blocks.extend(padding() for _ in range(after - len(next_blocks)))
+        window.extend(next_blocks)
+
+        windows[position] = window
+
+    return windows
@@ -0,0 +1,163 @@
+# 追加写入的JSONL日志
+# 每条记录一行，只追加不重写；记录先进入内存缓冲，攒够一批或超过间隔后才写文件，
+# close() 时写完缓冲并 fsync。文件超过大小上限后改名为分片并在后台线程中 gzip 压缩。
+import os
+import glob
+import gzip
+import json
+import time
+import shutil
+import threading
+from typing import Dict, Any, List, Optional
+
+
+class JsonlLogWriter:
+    """缓冲、轮转、压缩的JSONL日志写入器"""
+
+    def __init__(self, path: str, flush_every: int = 20, flush_interval: float = 5.0,
+                 max_file_bytes: int = 100 * 1024 * 1024, compress_rotated: bool = True):
+        """
+        Args:
+            path: 当前日志文件路径（*.jsonl），轮转后的分片为 <去掉.jsonl>.partNNN.jsonl[.gz]
+            flush_every: 缓冲多少条记录写一次文件
+            flush_interval: 距离上次写文件超过多少秒时，下一条记录到来即写文件
+            max_file_bytes: 单个文件超过该大小后轮转
+            compress_rotated: 是否gzip压缩轮转出去的分片
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.max_file_bytes = max_file_bytes
+        self.compress_rotated = compress_rotated
+
+        self._buffer: List[str] = []
+        self._file = None
+        self._last_flush = time.time()
+        self._part = len(list_log_parts(path))
+        self._compress_threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+        log_dir = os.path.dirname(path)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+
+    def append(self, entry: Dict[str, Any]):
+        """追加一条记录"""
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.flush_every or time.time() - self._last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def flush(self, fsync: bool = False):
+        """把缓冲写入文件，fsync=True 时同时落盘"""
+        with self._lock:
+            self._flush_locked()
+            if fsync and self._file is not None:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        """处理完成时调用：写完缓冲、fsync、关闭文件，并等待压缩完成。之后再 append 会重新打开文件"""
+        with self._lock:
+            self._flush_locked()
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+            threads, self._compress_threads = self._compress_threads, []
+        for thread in threads:
+            thread.join()
+
+    def _flush_locked(self):
+        self._last_flush = time.time()
+        if not self._buffer:
+            return
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write("".join(self._buffer))
+        self._file.flush()
+        self._buffer = []
+
+        if self._file.tell() >= self.max_file_bytes:
+            self._rotate_locked()
+
+    def _rotate_locked(self):
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+        self._part += 1
+        part_path = f"{_base_path(self.path)}.part{self._part:03d}.jsonl"
+        os.replace(self.path, part_path)
+
+        if self.compress_rotated:
+            thread = threading.Thread(target=_gzip_file, args=(part_path,), daemon=True)
+            thread.start()
+            self._compress_threads.append(thread)
+
+
+def _base_path(path: str) -> str:
+    return path[:-len(".jsonl")] if path.endswith(".jsonl") else path
+
+
+def _gzip_file(path: str):
+    """压缩为 path.gz 后删除原文件"""
+    try:
+        with open(path, "rb") as src, gzip.open(path + ".gz.tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(path + ".gz.tmp", path + ".gz")
+        os.remove(path)
+    except Exception as e:
+        print(f"⚠️ 压缩日志分片失败 {path}: {str(e)}")
+
+
+def list_log_parts(path: str) -> List[str]:
+    """按顺序列出某个日志已轮转出去的分片（压缩或未压缩）"""
+    parts = {}
+    for part_path in glob.glob(f"{glob.escape(_base_path(path))}.part*.jsonl*"):
+        if part_path.endswith(".tmp"):
+            continue
+        name = part_path[:-3] if part_path.endswith(".gz") else part_path
+        # 压缩刚完成、原文件尚未删除时同一分片会同时存在两个文件，.gz 只在写完后才出现，以它为准
+        if name not in parts or part_path.endswith(".gz"):
+            parts[name] = part_path
+    return [parts[name] for name in sorted(parts)]
+
+
+def read_jsonl_log(path: str) -> List[Dict[str, Any]]:
+    """按写入顺序读出一个日志的所有记录（包括已轮转、压缩的分片）"""
+    entries = []
+    files = list_log_parts(path) + ([path] if os.path.exists(path) else [])
+    for file_path in files:
+        opener = gzip.open if file_path.endswith(".gz") else open
+        with opener(file_path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    return entries
+
+
+def load_log_entries(path: str) -> List[Dict[str, Any]]:
+    """读取层级分析日志：.jsonl（包括轮转的分片）或数组格式的 .json（如 synapse_flow/例子 中的日志）"""
+    if path.endswith(".jsonl"):
+        return read_jsonl_log(path)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def convert_jsonl_log_to_array(path: str, output_path: Optional[str] = None) -> str:
+    """
+    把JSONL日志转换成数组格式的JSON文件（与原来 level_analysis_log_*.json 的格式一致）
+
+    Args:
+        path: JSONL日志路径
+        output_path: 输出路径，默认把 .jsonl 换成 .json
+
+    Returns:
+        str: 输出文件路径
+    """
+    output_path = output_path or _base_path(path) + ".json"
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(read_jsonl_log(path), f, ensure_ascii=False, indent=2)
+    return output_path
@@ -0,0 +1,203 @@
+# AI回复解析
+# 层级分析（{层级N}、但我认为{特殊情况}）和QA审核（判断为{X新层级}、{删除}等处理方式、建议处理方式为：{...}）回复的解析。
+# 正则在模块加载时编译好，按优先级依次判断，命中即停；<mark>/<summary>后空白的清理由调用方在最后统一做一次。
+# 回复只有几十到一两百字，"in"判断和预编译正则的搜索都在C里完成，比在Python里逐个括号扫描更快，
+# 结果与原来的实现一致（见 test_response_parser_corpus.py）。
+# 流式请求的层级回答用 LevelStreamParser 增量解析，答案确定后即可断开连接，不再等待后面的解释。
+import re
+from typing import Dict, Any, Optional
+
+# 中文数字层级
+LEVEL_NUMERALS = {
+    '一': 1, '二': 2, '三': 3, '四': 4, '五': 5,
+    '六': 6, '七': 7, '八': 8, '九': 9, '十': 10
+}
+
+# 层级的三种格式，按顺序取第一个能匹配的格式
+BRACE_LEVEL_PATTERN = re.compile(r"\{层级([一二三四五六七八九十\d]+)\}")
+PLAIN_LEVEL_PATTERN = re.compile(r"层级(\d+)")
+ORDINAL_LEVEL_PATTERN = re.compile(r"第([一二三四五六七八九十\d]+)层级")
+SPECIAL_TYPE_PATTERN = re.compile(r"但我认为\{([^}]+)\}")
+
+# 流式解析：{层级X} 之后出现句末标点或换行时答案确定
+SENTENCE_END_PATTERN = re.compile(r"[。\n]")
+
+# "但我认为"后没有大括号时，按关键词判断特殊情况类型（兼容旧格式，按顺序取第一个）
+SPECIAL_TYPE_KEYWORDS = (
+    ("层级主题错误", ("层级主题错误",)),
+    ("层级顺序混乱", ("层级顺序混乱", "顺序混乱")),
+    ("同属以往层级", ("同属以往层级",)),
+    ("总分结构后的总层级", ("总分结构后的总层级",)),
+    ("层级为模版内部层级", ("层级为模版内部层级",)),
+    ("层级格式不同却语义相关", ("层级格式不同却语义相关",)),
+)
+
+# QA层级类型，按优先级排列；"判断为{新层级}"为兼容的旧写法
+QA_LEVEL_TYPES = (
+    ("判断为{结构新层级}", 1),
+    ("判断为{段落新层级}", 2),
+    ("判断为{附注图表新层级}", 3),
+    ("判断为{非新层级}", 0),
+    ("判断为{新层级}", 1),
+)
+
+# 回复中的层级判断，如 "判断为{段落新层级}"
+QA_LEVEL_JUDGEMENT_PATTERN = re.compile(r"判断为\{(?:结构|段落|附注图表|非)?新层级\}")
+
+# 建议处理方式，带冒号的优先
+SUGGESTION_PATTERN = re.compile(r"建议处理方式为：\{(.*?)\}", re.DOTALL)
+SUGGESTION_WITHOUT_COLON_PATTERN = re.compile(r"建议处理方式为\{(.*?)\}", re.DOTALL)
+
+# <mark>/<summary> 后的空白：最终文本只清理空格和换行，建议文本和合并文本还要清理全角空格等
+TAG_WHITESPACE_PATTERN = re.compile(r"<(mark|summary)>[ \t\r\n]+")
+TAG_UNICODE_WHITESPACE_PATTERN = re.compile(r"<(mark|summary)>[\s\u3000]+")
+MARK_UNICODE_WHITESPACE_PATTERN = re.compile(r"<mark>[\s\u3000]+")
+
+
+def level_from_text(level_str: str) -> int:
+    """层级文本转数字，单个中文数字查表，其余按阿拉伯数字解析（"十一"等会抛出ValueError）"""
+    level = LEVEL_NUMERALS.get(level_str)
+    return level if level is not None else int(level_str)
+
+
+def parse_level_response(response: str) -> Dict[str, Any]:
+    """解析AI返回的层级判断结果"""
+    result = {
+        "level": None,
+        "reasoning": response,
+        "is_special_case": False,
+        "special_type": None
+    }
+
+    try:
+        # 提取层级数字：{层级X}、层级X、第X层级，前一种格式没有时才搜索后一种
+        level_match = BRACE_LEVEL_PATTERN.search(response)
+        if level_match:
+            result["level"] = level_from_text(level_match.group(1))
+        else:
+            level_match = PLAIN_LEVEL_PATTERN.search(response)
+            if level_match:
+                result["level"] = int(level_match.group(1))
+            else:
+                level_match = ORDINAL_LEVEL_PATTERN.search(response)
+                if level_match:
+                    result["level"] = level_from_text(level_match.group(1))
+
+        # 判断是否为特殊情况并提取具体类型
+        if "但我认为" in response:
+            result["is_special_case"] = True
+            special_match = SPECIAL_TYPE_PATTERN.search(response)
+            if special_match:
+                result["special_type"] = special_match.group(1)
+            else:
+                result["special_type"] = _special_type_from_keywords(response)
+
+    except Exception as e:
+        print(f"解析层级响应时出错: {str(e)}")
+
+    return result
+
+
+class LevelStreamParser:
+    """
+    流式层级回答的增量解析：逐段 feed 生成的文本，答案确定后 feed 返回True，调用方可以断开连接提前结束请求
+    答案确定：出现 {层级X}，且其后出现句末标点或换行。特殊情况「但我认为{...}」按回答格式在层级之前给出，
+    等到句末，同一句中层级之后补充的特殊情况也能收到；确定时已收到的文本与完整回答的解析结果一致
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.tokens = 0          # 收到的非空片段数（vLLM流式输出每个片段约一个token）
+        self.tail_tokens = 0     # 答案确定之后又收到的片段数（读完整个回答时即提前结束可以节省的token）
+        self.definitive = False
+        self.stopped_early = False  # 调用方在答案确定后断开了连接（text 不是完整回答）
+        self._level_end = None
+
+    def feed(self, delta: str) -> bool:
+        """追加一段生成的文本，返回答案是否已确定"""
+        if not delta:
+            return self.definitive
+        self.tokens += 1
+        start = len(self.text)
+        self.text += delta
+        if self.definitive:
+            self.tail_tokens += 1
+            return True
+        if self._level_end is None:
+            # 新片段可能补全了跨片段的 {层级X}，从稍前的位置开始搜索
+            level_match = BRACE_LEVEL_PATTERN.search(self.text, max(0, start - 16))
+            if level_match is None:
+                return False
+            self._level_end = level_match.end()
+        self.definitive = SENTENCE_END_PATTERN.search(self.text, self._level_end) is not None
+        return self.definitive
+
+    def result(self) -> Dict[str, Any]:
+        return parse_level_response(self.text)
+
+
+def _special_type_from_keywords(response: str) -> Optional[str]:
+    for special_type, keywords in SPECIAL_TYPE_KEYWORDS:
+        for keyword in keywords:
+            if keyword in response:
+                return special_type
+    return None
+
+
+def parse_qa_response(ai_response: str, current_text: str) -> Dict[str, Any]:
+    """
+    解析QA审核回复，得到层级类型、处理方式和调整后的文本
+
+    Returns:
+        Dict: level_type 层级类型（1结构 2段落 3附注图表 0非新层级），
+              merge_forward 是否向前合并（回复中同时有 {向前合并} 和 {删除}），
+              text 调整后的文本（未清理<mark>/<summary>后的空白，由调用方在最后统一清理一次）
+    """
+    try:
+        level_type = 0
+        if "判断为{" in ai_response:
+            for marker, value in QA_LEVEL_TYPES:
+                if marker in ai_response:
+                    level_type = value
+                    break
+
+        merge_forward = False
+        adjusted_text = current_text
+        if "{删除}" in ai_response:
+            adjusted_text = ""
+            merge_forward = "{向前合并}" in ai_response
+        elif "{需要拆分}" in ai_response:
+            match = SUGGESTION_PATTERN.search(ai_response)
+            if match:
+                adjusted_text = clean_suggested_text(match.group(1))
+        elif "{文本错误}" in ai_response:
+            # 匹配两种格式：带冒号和不带冒号
+            match = SUGGESTION_PATTERN.search(ai_response) or SUGGESTION_WITHOUT_COLON_PATTERN.search(ai_response)
+            if match:
+                adjusted_text = clean_suggested_text(match.group(1))
+
+    except Exception as e:
+        print(f"解析remark时出错: {str(e)}")
+        return {"level_type": 0, "merge_forward": False, "text": current_text}
+
+    return {"level_type": level_type, "merge_forward": merge_forward, "text": adjusted_text}
+
+
+def clean_suggested_text(suggested_text: str) -> str:
+    """建议处理方式中的文本：去掉首尾空白、还原转义的加粗符号、清理<mark>后的空白"""
+    suggested_text = suggested_text.strip().replace("\\*\\*", "**")
+    return MARK_UNICODE_WHITESPACE_PATTERN.sub("<mark>", suggested_text)
+
+
+def normalize_tag_whitespace(text: str, unicode_whitespace: bool = False) -> str:
+    """
+    清理<mark>和<summary>后的空白和换行
+
+    Args:
+        text: 文本
+        unicode_whitespace: 是否同时清理全角空格等Unicode空白（合并文本时使用）
+    """
+    if not text or ("<mark>" not in text and "<summary>" not in text):
+        return text
+    pattern = TAG_UNICODE_WHITESPACE_PATTERN if unicode_whitespace else TAG_WHITESPACE_PATTERN
+    return pattern.sub(r"<\1>", text)
@@ -0,0 +1,169 @@
+# Prompt审计日志
+# 调用方只把记录放进有界队列（不阻塞、不做IO），由后台线程批量写入按大小轮转的JSONL文件。
+# 成功的请求按采样率记录，失败/无法解析的请求全部记录；默认只有失败的记录保留完整prompt。
+import os
+import json
+import glob
+import queue
+import atexit
+import random
+import hashlib
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+# 审计日志配置
+PROMPT_AUDIT_CONFIG = {
+    "log_dir": "prompt_audit_logs",
+    "file_prefix": "prompt_audit",
+    "sample_rate": 0.01,                  # 成功请求的采样率，0 表示只记录失败
+    "full_prompt_on_failure_only": True,  # True：只有失败/无法解析的记录保留完整prompt，其余只记hash和长度
+    "queue_size": 10000,                  # 队列满时直接丢弃，不阻塞调用方
+    "batch_size": 200,                    # 每次最多合并写入的记录数
+    "flush_interval": 1.0,                # 秒，没有新记录时也按这个间隔刷盘
+    "max_file_bytes": 50 * 1024 * 1024,   # 单个文件超过该大小后轮转
+    "backup_count": 20                    # 最多保留的轮转文件数
+}
+
+_STOP = object()
+
+
+def _hash_text(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class PromptAuditLogger:
+    """异步、采样的prompt审计日志"""
+
+    def __init__(self, config: Dict[str, Any] = None):
+        self.config = {**PROMPT_AUDIT_CONFIG, **(config or {})}
+        self.queue = queue.Queue(maxsize=self.config["queue_size"])
+        self.dropped_count = 0
+        self.written_count = 0
+        self._file = None
+        self._file_path = os.path.join(self.config["log_dir"], f"{self.config['file_prefix']}.jsonl")
+        self._thread = threading.Thread(target=self._writer_loop, name="prompt_audit_writer", daemon=True)
+        self._thread.start()
+
+    def record(self, run_id: Optional[str], index: int, system_prompt: str, user_prompt: str,
+               ai_response: str, status: str = "ok", **extra) -> bool:
+        """
+        记录一次请求（调用方线程/协程中只做采样判断和入队）
+
+        Args:
+            run_id: 运行ID
+            index: 数据索引
+            system_prompt / user_prompt: 本次请求的prompt
+            ai_response: 模型返回内容
+            status: "ok" | "failed"（请求失败或空回复） | "unparsable"（回复无法解析）
+            extra: 其它需要记录的字段，如 latency_ms
+
+        Returns:
+            bool: 是否写入了队列
+        """
+        failed = status != "ok"
+        if not failed and random.random() >= self.config["sample_rate"]:
+            return False
+
+        entry = {
+            "timestamp": datetime.now().isoformat(),
+            "run_id": run_id,
+            "index": index,
+            "status": status,
+            "system_prompt_hash": _hash_text(system_prompt),
+            "user_prompt_hash": _hash_text(user_prompt),
+            "user_prompt_chars": len(user_prompt),
+            "ai_response": ai_response,
+            **extra
+        }
+        if failed or not self.config["full_prompt_on_failure_only"]:
+            entry["system_prompt"] = system_prompt
+            entry["user_prompt"] = user_prompt
+
+        try:
+            self.queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            self.dropped_count += 1
+            return False
+
+    def close(self, timeout: float = 5.0):
+        """写完队列中剩余的记录后停止后台线程"""
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _writer_loop(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self.config["flush_interval"])
+            except queue.Empty:
+                continue
+
+            batch = []
+            stop = first is _STOP
+            if not stop:
+                batch.append(first)
+            while not stop and len(batch) < self.config["batch_size"]:
+                try:
+                    entry = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stop = True
+                else:
+                    batch.append(entry)
+
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    print(f"⚠️ 写入prompt审计日志失败: {str(e)}")
+            if stop:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                return
+
+    def _write_batch(self, batch: list):
+        if self._file is None:
+            os.makedirs(self.config["log_dir"], exist_ok=True)
+            self._file = open(self._file_path, "a", encoding="utf-8")
+
+        self._file.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch))
+        self._file.flush()
+        self.written_count += len(batch)
+
+        if self._file.tell() >= self.config["max_file_bytes"]:
+            self._rotate()
+
+    def _rotate(self):
+        """当前文件改名为带时间戳的文件，并清理超出数量的旧文件"""
+        self._file.close()
+        self._file = None
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        os.replace(self._file_path, os.path.join(
+            self.config["log_dir"], f"{self.config['file_prefix']}.{timestamp}.jsonl"))
+
+        rotated = sorted(glob.glob(os.path.join(
+            self.config["log_dir"], f"{self.config['file_prefix']}.*.jsonl")))
+        for path in rotated[:-self.config["backup_count"]]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_prompt_audit_logger = None
+_prompt_audit_lock = threading.Lock()
+
+
+def get_prompt_audit_logger() -> PromptAuditLogger:
+    """获取全局审计日志实例（首次调用时启动后台写入线程）"""
+    global _prompt_audit_logger
+    if _prompt_audit_logger is None:
+        with _prompt_audit_lock:
+            if _prompt_audit_logger is None:
+                _prompt_audit_logger = PromptAuditLogger()
+                atexit.register(_prompt_audit_logger.close)
+    return _prompt_audit_logger
@@ -0,0 +1,268 @@
+# Token预算
+# 所有请求原来都带 max_tokens=2000，上下文文本块要么只截到第一个逗号/句号，要么整块放进prompt：
+# 超长的文本块会让prompt超出模型训练时的长度，而很短的回答也按2000个token预留KV cache，vLLM能同时批处理的请求变少。
+# 这里按任务（QA、层级分析）做两件事：
+# 1. 上下文裁剪：用模型的tokenizer计算token数，每个上下文块不超过 max_context_block_tokens，
+#    整段user prompt不超过 max_prompt_tokens（超出时从最长的块开始压缩）；QA的目标文本块会被建议处理方式完整复述，不裁剪
+# 2. max_tokens：按该任务最近的实际输出长度取分位数再乘以余量，样本不足 min_samples 时仍用默认值
+# tokenizer每个模型路径只加载一次，文本的token数按LRU缓存（同一文本块会出现在多个上下文窗口中）；
+# 没有安装transformers或找不到tokenizer时按字符近似（汉字等非ASCII字符一个token，ASCII字符四个一个token）。
+import re
+import logging
+import threading
+import functools
+from collections import deque
+from typing import Dict, Any, List, Optional, Sequence
+
+from model_config import get_model_config
+
+logger = logging.getLogger(__name__)
+
+# Token预算配置
+TOKEN_BUDGET_CONFIG = {
+    "enabled": True,
+    "count_cache_size": 65536,     # token数缓存的文本条数
+    "percentile": 99,              # 按输出长度的哪个分位数设置 max_tokens
+    "margin": 1.5,                 # 分位数之上的余量
+    "min_samples": 50,             # 输出长度样本少于该数时使用 default_max_tokens
+    "sample_window": 2000,         # 每个任务保留最近多少个输出长度样本
+    "min_context_block_tokens": 16,  # 整段prompt超出预算时，上下文块最少保留的token数
+    "tasks": {
+        "qa": {
+            "model": "qa_model",
+            "max_prompt_tokens": 2400,        # user prompt的上限（system prompt固定，不计入）
+            "max_context_block_tokens": 400,  # 前后文块的上限
+            "default_max_tokens": 2000,
+            "min_max_tokens": 256,
+            "max_max_tokens": 2000,
+            "echo_target": True               # 回答可能复述整个目标文本块（文本错误、需要拆分），max_tokens 另加其token数
+        },
+        "level": {
+            "model": "level_model",
+            "max_prompt_tokens": 1200,
+            "max_context_block_tokens": 64,   # 层级路径中的标题和目标文本（已截到第一个逗号/句号）的上限
+            "default_max_tokens": 2000,
+            "min_max_tokens": 128,
+            "max_max_tokens": 2000,
+            "echo_target": False
+        }
+    }
+}
+
+NON_ASCII_PATTERN = re.compile(r"[^\x00-\x7f]")
+
+
+def approximate_token_count(text: str) -> int:
+    """没有tokenizer时的近似token数"""
+    non_ascii = len(NON_ASCII_PATTERN.findall(text))
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+class TokenCounter:
+    """按tokenizer计算token数（带LRU缓存，线程安全）"""
+
+    def __init__(self, tokenizer_path: Optional[str] = None, cache_size: int = None):
+        self.tokenizer_path = tokenizer_path
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.count = functools.lru_cache(maxsize=cache_size or TOKEN_BUDGET_CONFIG["count_cache_size"])(self._count)
+
+    @property
+    def approximate(self) -> bool:
+        """是否在按字符近似计算"""
+        return self._get_tokenizer() is None
+
+    def _get_tokenizer(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._tokenizer = self._load_tokenizer()
+                    self._loaded = True
+        return self._tokenizer
+
+    def _load_tokenizer(self):
+        if not self.tokenizer_path:
+            return None
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_path, use_fast=True, trust_remote_code=True)
+            logger.info(f"✅ 已加载tokenizer: {self.tokenizer_path}")
+            return tokenizer
+        except Exception as e:
+            logger.warning(f"⚠️ 加载tokenizer失败（{self.tokenizer_path}）: {str(e)}，按字符近似计算token数")
+            return None
+
+    def _count(self, text: str) -> int:
+        if not text:
+            return 0
+        tokenizer = self._get_tokenizer()
+        if tokenizer is None:
+            return approximate_token_count(text)
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    def truncate(self, text: str, max_tokens: int, keep_tail: bool = False) -> str:
+        """
+        裁剪到不超过 max_tokens 个token，按字符二分查找（不在token边界上解码，不会切坏多字节字符）
+
+        Args:
+            keep_tail: 保留结尾（紧挨着目标文本的前文），否则保留开头；被裁掉的一侧加省略号
+        """
+        if self.count(text) <= max_tokens:
+            return text
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            piece = text[len(text) - middle:] if keep_tail else text[:middle]
+            if self._count(piece) + 1 <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return "…" + text[len(text) - low:] if keep_tail else text[:low] + "…"
+
+
+class OutputLengthStats:
+    """最近的输出token数样本（线程安全）"""
+
+    def __init__(self, window: int):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, tokens: int):
+        with self._lock:
+            self._samples.append(tokens)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[int]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class TaskTokenBudget:
+    """一个任务（qa / level）的上下文裁剪和 max_tokens"""
+
+    def __init__(self, task: str, counter: TokenCounter, config: Dict[str, Any] = None):
+        self.task = task
+        self.counter = counter
+        self.config = {**{key: value for key, value in TOKEN_BUDGET_CONFIG.items() if key != "tasks"},
+                       **TOKEN_BUDGET_CONFIG["tasks"][task], **(config or {})}
+        self.output_stats = OutputLengthStats(self.config["sample_window"])
+        self.stats = {"trimmed_blocks": 0, "trimmed_prompts": 0, "capped_outputs": 0}
+        self._last_max_tokens = self.config["default_max_tokens"]
+
+    @property
+    def enabled(self) -> bool:
+        return TOKEN_BUDGET_CONFIG["enabled"]
+
+    def count(self, text: str) -> int:
+        return self.counter.count(text)
+
+    def fit_blocks(self, texts: List[str], fixed_tokens: int, keep_tail: Sequence[bool] = None,
+                   protected: Sequence[int] = ()) -> List[str]:
+        """
+        裁剪上下文块：每块不超过 max_context_block_tokens，所有块合计不超过
+        max_prompt_tokens - fixed_tokens - 受保护块的token数（超出时按均分额度压缩较长的块）
+
+        Args:
+            texts: 文本块
+            fixed_tokens: prompt中文本块以外部分的token数
+            keep_tail: 每块是否保留结尾（前文保留靠近目标的结尾，后文保留开头）
+            protected: 不裁剪的块的下标（如QA的目标文本块）
+
+        Returns:
+            list: 裁剪后的文本块（没有超出预算时原样返回）
+        """
+        if not self.enabled:
+            return texts
+        keep_tail = keep_tail or [False] * len(texts)
+        trimmable = [i for i in range(len(texts)) if i not in protected]
+        limits = {i: min(self.count(texts[i]), self.config["max_context_block_tokens"]) for i in trimmable}
+
+        available = (self.config["max_prompt_tokens"] - fixed_tokens
+                     - sum(self.count(texts[i]) for i in protected))
+        if sum(limits.values()) > available:
+            # 均分额度：短于额度的块保持不变，省下的额度分给其余的块
+            self.stats["trimmed_prompts"] += 1
+            remaining = sorted(trimmable, key=lambda i: limits[i])
+            budget = max(0, available)
+            while remaining:
+                share = budget // len(remaining)
+                i = remaining.pop(0)
+                limits[i] = max(min(limits[i], share), self.config["min_context_block_tokens"])
+                budget -= limits[i]
+
+        fitted = list(texts)
+        for i in trimmable:
+            if self.count(texts[i]) > limits[i]:
+                fitted[i] = self.counter.truncate(texts[i], limits[i], keep_tail=keep_tail[i])
+                self.stats["trimmed_blocks"] += 1
+        return fitted
+
+    def max_tokens(self, target_text: str = "") -> int:
+        """按最近输出长度的分位数计算本次请求的 max_tokens"""
+        if not self.enabled or len(self.output_stats) < self.config["min_samples"]:
+            return self.config["default_max_tokens"]
+        expected = self.output_stats.percentile(self.config["percentile"])
+        if self.config["echo_target"]:
+            expected += self.count(target_text)
+        max_tokens = int(expected * self.config["margin"])
+        self._last_max_tokens = max(self.config["min_max_tokens"], min(max_tokens, self.config["max_max_tokens"]))
+        return self._last_max_tokens
+
+    def record_output(self, output_text: str, target_text: str = "", max_tokens: Optional[int] = None):
+        """
+        记录一次实际输出的长度；复述目标文本的任务只记录目标文本以外的部分
+        输出达到 max_tokens（被截断）时计入 capped_outputs，按截断长度记录的样本会让之后的 max_tokens 按余量逐步放大
+        """
+        if not output_text:
+            return
+        tokens = self.count(output_text)
+        if max_tokens is not None and tokens >= max_tokens:
+            self.stats["capped_outputs"] += 1
+        if self.config["echo_target"]:
+            tokens = max(0, tokens - self.count(target_text))
+        self.output_stats.record(tokens)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "task": self.task,
+            "approximate_tokens": self.counter.approximate,
+            "samples": len(self.output_stats),
+            f"output_p{self.config['percentile']}": self.output_stats.percentile(self.config["percentile"]),
+            "last_max_tokens": self._last_max_tokens,
+            "count_cache": self.counter.count.cache_info()._asdict()
+        }
+
+
+# 每个tokenizer路径一个计数器，每个任务一个预算（首次使用时创建）
+_counters = {}
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def get_token_counter(model_name: str) -> TokenCounter:
+    """模型基础权重对应的token计数器，基础模型相同的模型共用"""
+    tokenizer_path = (get_model_config(model_name) or {}).get("base_model_path")
+    with _budgets_lock:
+        counter = _counters.get(tokenizer_path)
+        if counter is None:
+            counter = TokenCounter(tokenizer_path)
+            _counters[tokenizer_path] = counter
+        return counter
+
+
+def get_token_budget(task: str) -> TaskTokenBudget:
+    """任务（"qa" / "level"）的token预算"""
+    with _budgets_lock:
+        budget = _budgets.get(task)
+    if budget is None:
+        counter = get_token_counter(TOKEN_BUDGET_CONFIG["tasks"][task]["model"])
+        with _budgets_lock:
+            budget = _budgets.setdefault(task, TaskTokenBudget(task, counter))
+    return budget
@@ -44,6 +44,7 @@ def test_detailed_logging():
         if result['is_special_case']:
             print(f"  特殊类型: {result['special_type']}")
     
+    service.close_log()
     print(f"\n测试完成！详细日志已保存到: {service.get_log_file_path()}")
 
 if __name__ == "__main__":
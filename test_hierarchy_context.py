@@ -119,7 +119,7 @@ def test_with_real_data():
         print(f"处理: {item_data['text']} (层级{level})")
         
         # 更新层级上下文
-        service.update_hierarchical_context(level, i)
+        service.state.push(item_data["text"], item_data["isTitleMarked"], level)
         
         # 获取该位置的上文
         context_path = service.get_context_path_for_index(i)
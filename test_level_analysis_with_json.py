@@ -8,6 +8,7 @@ import json
 import os
 from datetime import datetime
 from synapse_flow.web.services.level_analysis_service import LevelAnalysisService
+from synapse_flow.web.utils.jsonl_log_writer import convert_jsonl_log_to_array
 
 def load_test_data():
     """加载测试数据"""
@@ -190,8 +191,10 @@ def main():
     # 4. 打印分析摘要
     print_analysis_summary(results)
     
-    # 5. 保存结果
-    output_file = save_results(results, service.get_log_file_path())
+    # 5. 保存结果（详细日志为JSONL，同时转换一份数组格式）
+    service.close_log()
+    array_log_file = convert_jsonl_log_to_array(service.get_log_file_path())
+    output_file = save_results(results, array_log_file)
     
     # 6. 获取层级分析服务的详细信息
     hierarchy_info = service.get_level_sequence_with_contexts()
@@ -214,6 +217,7 @@ def main():
     
     print(f"\n测试完成！")
     print(f"详细日志: {service.get_log_file_path()}")
+    print(f"详细日志（数组格式）: {array_log_file}")
     if output_file:
         print(f"结果文件: {output_file}")
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+增量重新分析的回放测试
+用已记录的层级分析日志（level_analysis_logs 下的 .jsonl，或数组格式的 .json）模拟vLLM：
+1. 对原始数据完整分析一次，得到"上一次分析"的结果（相当于库中的 prompt_hierarchy / prompt_hierarchy_reason）
+2. 修改中间某一条文本的开头（层级prompt只取到第一个"，"或"。"，修改要落在这一段内），模拟审核后保存的新版本
+3. 新版本从头完整分析一次，作为期望结果
+4. 用上一次的结果预填缓存后增量分析新版本，比较结果是否与完整分析一致，并统计省掉的模型调用
+
+用法：
+    python test_level_incremental_replay.py
+    python test_level_incremental_replay.py level_analysis_logs/level_analysis_log_xxx.jsonl --edit-at 20
+"""
+
+import io
+import sys
+import copy
+import argparse
+from contextlib import redirect_stdout
+from synapse_flow.web.services.level_analysis_service import LevelAnalysisService
+from test_level_speculative_replay import load_replay_data, DEFAULT_LOG_FILE
+
+EDIT_PREFIX = "修订"
+
+
+def run_analysis(data_list, responses_by_text, previous_items=None):
+    """逐条分析，返回 (service, results, 模型调用次数)"""
+    calls = {"count": 0}
+
+    def fake_call_vllm_api(messages, max_tokens=2000, max_retries=3, stream_parser=None):
+        calls["count"] += 1
+        return responses_by_text[current["text"]]
+
+    current = {}
+    with redirect_stdout(io.StringIO()):
+        service = LevelAnalysisService()
+        service.check_vllm_service_status = lambda: True
+        service.call_vllm_api = fake_call_vllm_api
+        if previous_items:
+            service.seed_response_cache(previous_items)
+        results = []
+        for item in copy.deepcopy(data_list):
+            current["text"] = item["text"]
+            results.append(service.process_single_item(item))
+        service.close_log()
+    return service, results, calls["count"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="增量层级分析回放测试")
+    parser.add_argument("log_file", nargs="?", default=DEFAULT_LOG_FILE)
+    parser.add_argument("--edit-at", type=int, default=None, help="修改第几条（从0开始），默认取中间一条")
+    args = parser.parse_args()
+
+    data_list, responses_by_text = load_replay_data(args.log_file)
+    edit_at = args.edit_at if args.edit_at is not None else len(data_list) // 2
+    print(f"加载日志: {args.log_file}，共 {len(data_list)} 条，修改第 {edit_at} 条")
+
+    # 上一次分析（库中保存的是翻转后的标记）
+    _, previous_results, _ = run_analysis(data_list, responses_by_text)
+    previous_items = [
+        {"text": r["text"], "isTitleMarked": r["isTitleMarked"], "level": r["level"], "reasoning": r["reasoning"]}
+        for r in previous_results
+    ]
+
+    # 新版本：在开头修改一条文本（truncate_text 截到第一个"，"或"。"，加在结尾时prompt不变），模型对它的回答保持不变
+    edited_list = copy.deepcopy(data_list)
+    original_text = edited_list[edit_at]["text"]
+    edited_list[edit_at]["text"] = EDIT_PREFIX + original_text
+    responses_by_text[EDIT_PREFIX + original_text] = responses_by_text[original_text]
+
+    full_service, full_results, full_calls = run_analysis(edited_list, responses_by_text)
+    inc_service, inc_results, inc_calls = run_analysis(edited_list, responses_by_text, previous_items)
+
+    checks = {
+        "结果": full_results == inc_results,
+        "层级序列": full_service.level_sequence == inc_service.level_sequence,
+        "上下文路径": full_service.context_paths == inc_service.context_paths,
+    }
+    for name, ok in checks.items():
+        print(f"{'✅' if ok else '❌'} {name}{'一致' if ok else '不一致'}")
+
+    stats = inc_service.cache_stats
+    print(f"\n完整分析: 模型调用 {full_calls} 次")
+    print(f"增量分析: 模型调用 {inc_calls} 次，预填 {stats['seeded']} 条，复用 {stats['hits']} 条")
+    # 修改处之后的条目要重新调用模型，之前的条目复用缓存
+    checks["模型调用"] = 0 < inc_calls < full_calls
+    print(f"{'✅' if checks['模型调用'] else '❌'} 增量分析{'从修改处重新调用模型' if checks['模型调用'] else '没有省掉或没有重新调用模型'}")
+
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
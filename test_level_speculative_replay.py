@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+推测并行层级分析的回放测试
+用已记录的层级分析日志（level_analysis_logs 下的 .jsonl，或数组格式的 .json）模拟vLLM：
+1. 逐条模式：模拟模型按文本返回日志中记录的AI响应，同时记下每条的真实prompt
+2. 推测并行模式：模拟模型只对逐条模式中出现过的（文本, prompt）返回同样的响应，
+   其它prompt一律返回错误层级，如果推测结果被错误采用，最终结果就会不一致
+比较两种模式的结果、层级序列、上下文路径和请求的max_tokens是否完全一致，并输出请求统计和耗时
+
+用法：
+    python test_level_speculative_replay.py
+    python test_level_speculative_replay.py level_analysis_logs/level_analysis_log_xxx.jsonl --window 8 --latency 0.05
+"""
+
+import io
+import sys
+import copy
+import time
+import argparse
+import threading
+from contextlib import redirect_stdout
+from synapse_flow.web.services.level_analysis_service import LevelAnalysisService
+from synapse_flow.web.utils.token_budget import TaskTokenBudget, TokenCounter
+from synapse_flow.web.utils.jsonl_log_writer import load_log_entries
+
+DEFAULT_LOG_FILE = "synapse_flow/例子/level_analysis_log_20250627_014848.json"
+POISON_RESPONSE = "因为目标文本开头为前文不具有的一种新层级格式，所以判断为{层级99}。"
+
+
+def load_replay_data(log_file):
+    """从日志中取出原始数据，以及每条文本对应的AI响应"""
+    log_entries = load_log_entries(log_file)
+
+    data_list = []
+    responses_by_text = {}
+    for i, entry in enumerate(log_entries):
+        item = dict(entry["original_data"])
+        item["id"] = f"item_{i+1:03d}"
+        data_list.append(item)
+
+        ai_response = entry.get("ai_response", "")
+        if "判断为{层级" not in ai_response:
+            # 第一条、规则判断等没有真实AI响应的条目，按记录的层级构造一个
+            ai_response = f"所以判断为{{层级{entry['parsed_result']['level'] or 1}}}。"
+        responses_by_text[item["text"]] = ai_response
+    return data_list, responses_by_text
+
+
+def new_service(fake_call_vllm_api):
+    with redirect_stdout(io.StringIO()):
+        service = LevelAnalysisService()
+    service.check_vllm_service_status = lambda: True
+    service.call_vllm_api = fake_call_vllm_api
+    # 每个模式从同样的预算状态开始；样本很少就开始按分位数设置，运行中途预算就会变化
+    service.token_budget = TaskTokenBudget("level", TokenCounter(None), {"min_samples": 5})
+    return service
+
+
+def run_sequential(data_list, responses_by_text, latency):
+    """逐条模式，返回 (service, results, {(文本, user_prompt): 响应}, 耗时)"""
+    seen_prompts = {}
+    current_text = {}
+    sent_max_tokens = set()
+
+    def fake_call_vllm_api(messages, max_tokens=2000, max_retries=3, stream_parser=None):
+        time.sleep(latency)
+        sent_max_tokens.add(max_tokens)
+        response = responses_by_text[current_text["text"]]
+        seen_prompts[(current_text["text"], messages[1]["content"])] = response
+        return response
+
+    service = new_service(fake_call_vllm_api)
+    results = []
+    started_at = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for item in copy.deepcopy(data_list):
+            current_text["text"] = item["text"]
+            results.append(service.process_single_item(item))
+        service.close_log()
+    service.sent_max_tokens = sent_max_tokens
+    return service, results, seen_prompts, time.perf_counter() - started_at
+
+
+def run_speculative(data_list, seen_prompts, latency, window):
+    """推测并行模式，返回 (service, results, 模型调用次数, 耗时)"""
+    lock = threading.Lock()
+    calls = {"count": 0}
+    sent_max_tokens = set()
+    prompt_to_text = {user_prompt: text for text, user_prompt in seen_prompts}
+
+    def fake_call_vllm_api(messages, max_tokens=2000, max_retries=3, stream_parser=None):
+        time.sleep(latency)
+        with lock:
+            calls["count"] += 1
+            sent_max_tokens.add(max_tokens)
+        user_prompt = messages[1]["content"]
+        text = prompt_to_text.get(user_prompt)
+        return seen_prompts.get((text, user_prompt), POISON_RESPONSE)
+
+    service = new_service(fake_call_vllm_api)
+    samples_before = len(service.token_budget.output_stats)
+    started_at = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        results = service.process_batch_speculative(copy.deepcopy(data_list), window)
+    # 被丢弃的推测请求不计入输出长度统计
+    service.recorded_outputs = len(service.token_budget.output_stats) - samples_before
+    service.sent_max_tokens = sent_max_tokens
+    return service, results, calls["count"], time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description="推测并行层级分析回放测试")
+    parser.add_argument("log_file", nargs="?", default=DEFAULT_LOG_FILE)
+    parser.add_argument("--window", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟每次模型调用的耗时（秒）")
+    args = parser.parse_args()
+
+    data_list, responses_by_text = load_replay_data(args.log_file)
+    print(f"加载日志: {args.log_file}，共 {len(data_list)} 条")
+
+    seq_service, seq_results, seen_prompts, seq_time = run_sequential(data_list, responses_by_text, args.latency)
+    spec_service, spec_results, spec_calls, spec_time = run_speculative(data_list, seen_prompts, args.latency, args.window)
+
+    checks = {
+        "结果": seq_results == spec_results,
+        "层级序列": seq_service.level_sequence == spec_service.level_sequence,
+        "上下文路径": seq_service.context_paths == spec_service.context_paths,
+        "已确认层级": seq_service.confirmed_levels == spec_service.confirmed_levels,
+        "输出长度统计（只记录被采用的结果）": spec_service.recorded_outputs == spec_service.speculation_stats["llm_items"],
+        "请求的max_tokens（运行中途预算变化也不影响）": seq_service.sent_max_tokens == spec_service.sent_max_tokens
+        and len(spec_service.sent_max_tokens) == 1,
+    }
+    for name, ok in checks.items():
+        print(f"{'✅' if ok else '❌'} {name}{'一致' if ok else '不一致'}")
+
+    if not checks["结果"]:
+        for i, (a, b) in enumerate(zip(seq_results, spec_results)):
+            if a != b:
+                print(f"  第{i}条不一致: 逐条={a['level']} 推测={b['level']} 文本={a['text'][:30]}")
+
+    stats = spec_service.speculation_stats
+    print(f"\n逐条模式: 模型调用 {len(seen_prompts)} 次，耗时 {seq_time:.2f}秒")
+    print(f"推测并行（窗口 {args.window}）: 模型调用 {spec_calls} 次，"
+          f"推测命中 {stats['hits']}/{stats['llm_items']}，推测上下文有误重新请求 {stats['mispredicted'] + stats['reissued']}，"
+          f"耗时 {spec_time:.2f}秒")
+    if spec_time > 0:
+        print(f"加速比: {seq_time / spec_time:.2f}x")
+
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线批量推理（py脚本/prompt.py）测试，使用 dry_run 后端，不需要GPU和模型
+1. 分桶：每个batch不超过 max_batch_tokens / max_batch_size，同一batch长度差不超过桶宽，padding比例低于不排序的固定batch
+2. 端到端：2个worker从共享队列取batch，输出CSV完整、按index排序，非法input记为出错
+3. 续跑：partial结果中已完成的行跳过，出错的行和输入变化的行重新生成；崩溃时写了一半的行被截掉，之后追加的结果不受影响
+
+用法：
+    python test_offline_inference.py
+"""
+
+import io
+import os
+import csv
+import sys
+import json
+import random
+import tempfile
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "py脚本"))
+import prompt as offline  # noqa: E402
+from script_checks import check, finish
+
+
+def write_csv(path, rows):
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["instruction", "input", "output"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_csv(path):
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def is_json_line(line):
+    try:
+        json.loads(line)
+    except ValueError:
+        return False
+    return line.endswith("\n")
+
+
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        blocks = [{"text": "第一章 总则" + "，纳税人应当按期申报" * rng.randint(0, 40), "page_idx": 0} for _ in range(4)]
+        rows.append({"instruction": f"请问第三文本块是否为新的层级？（{i}）",
+                     "input": json.dumps(blocks, ensure_ascii=False), "output": ""})
+    return rows
+
+
+def run_make_batches():
+    rng = random.Random(1)
+    lengths = [rng.randint(50, 3000) for _ in range(500)]
+    max_batch_tokens, max_new_tokens, max_batch_size, bucket_width = 40000, 500, 16, 128
+    batches = offline.make_batches(lengths, max_batch_tokens, max_new_tokens, max_batch_size, bucket_width)
+
+    check("每个样本恰好出现一次", sorted(i for batch in batches for i in batch) == list(range(len(lengths))))
+    check("不超过 max_batch_tokens",
+          all(len(batch) * (max(lengths[i] for i in batch) + max_new_tokens) <= max_batch_tokens for batch in batches))
+    check("不超过 max_batch_size", all(len(batch) <= max_batch_size for batch in batches))
+    check("同一batch在同一长度桶内",
+          all(len({lengths[i] // bucket_width for i in batch}) == 1 for batch in batches))
+    check("最长的batch在前", max(lengths[i] for i in batches[0]) == max(lengths))
+
+    fixed = [list(range(start, min(start + 8, len(lengths)))) for start in range(0, len(lengths), 8)]
+    sorted_ratio, fixed_ratio = offline.padding_ratio(batches, lengths), offline.padding_ratio(fixed, lengths)
+    check("padding比例低于不排序的固定batch", sorted_ratio < fixed_ratio / 4, (sorted_ratio, fixed_ratio))
+
+
+def run(config):
+    with redirect_stdout(io.StringIO()):
+        return offline.run_inference(config)
+
+
+def run_end_to_end_and_resume():
+    with tempfile.TemporaryDirectory() as tmp:
+        input_csv, output_csv = os.path.join(tmp, "in.csv"), os.path.join(tmp, "out.csv")
+        rows = make_rows(60)
+        rows[5]["input"] = "不是JSON"
+        rows.insert(10, {"instruction": "", "input": rows[0]["input"], "output": ""})  # 空instruction的行被过滤
+        write_csv(input_csv, rows)
+        config = dict(offline.OFFLINE_INFERENCE_CONFIG, backend="dry_run", input_csv=input_csv, output_csv=output_csv,
+                      cpu_workers=2, max_batch_tokens=20000, max_batch_size=8, max_new_tokens=200)
+
+        summary = run(config)
+        output = read_csv(output_csv)
+        check("端到端：所有行都有结果", summary["generated"] == 60 and len(output) == 60, summary)
+        check("端到端：按index排序", [int(row["index"]) for row in output] == list(range(60)))
+        check("端到端：输出与输入对应", output[10]["instruction"] == rows[11]["instruction"]
+              and output[7]["output"] == offline.DryRunBackend.ANSWER)
+        check("端到端：非法input记为出错", summary["errors"] == 1 and output[5]["output"].startswith(offline.ERROR_PREFIX),
+              output[5])
+        check("端到端：多个batch", summary["batches"] > 2, summary)
+
+        # 续跑：删掉一部分结果、修改一行输入，只重新生成这些行和出错的行
+        partial_path = output_csv + ".partial.jsonl"
+        with open(partial_path, "r", encoding="utf-8") as f:
+            records = f.readlines()
+        kept = [line for line in records if json.loads(line)["index"] % 3 != 0]
+        with open(partial_path, "w", encoding="utf-8") as f:
+            f.writelines(kept + ['{"index": 1, "instruc'])  # 模拟崩溃时写了一半的行
+        rows[2]["instruction"] += "（已修改）"
+        write_csv(input_csv, rows)
+
+        summary = run(config)
+        output = read_csv(output_csv)
+        expected = len([index for index in range(60) if index % 3 == 0 or index in (2, 5)])
+        check("续跑：只生成未完成、出错和输入变化的行", summary["skipped"] == 60 - expected
+              and summary["generated"] == expected, summary)
+        check("续跑：最终CSV完整且使用新的输入", len(output) == 60 and output[2]["instruction"] == rows[2]["instruction"])
+
+        summary = run(config)
+        check("全部完成后再运行只重试出错的行", summary["generated"] == 1 and summary["batches"] == 0, summary)
+
+        # 残行后面追加的是正常结果：残行要先截掉，否则这条结果接在残行后面，下次续跑又会重新生成
+        rows[5]["input"] = rows[4]["input"]
+        write_csv(input_csv, rows)
+        with open(partial_path, "a", encoding="utf-8") as f:
+            f.write('{"index": 9, "instr')
+        summary = run(config)
+        check("续跑：残行之后追加的结果", summary["generated"] == 1 and summary["errors"] == 0, summary)
+        with open(partial_path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        check("续跑：残行被截掉，每行都是完整的结果", all(is_json_line(line) for line in lines))
+        summary = run(config)
+        check("续跑：残行之后追加的结果不会被重新生成", summary["generated"] == 0, summary)
+
+
+def main():
+    run_make_batches()
+    run_end_to_end_and_resume()
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI回复解析的语料测试
+语料 synapse_flow/例子/response_parser_corpus.json 中的期望结果由重构前的解析实现生成：
+1. level: 层级分析回复（来自层级分析日志，加上各种格式、特殊情况的构造用例）→ parse_level_response
+2. qa: QA审核回复 → parse_remark_and_adjust_data（单条解析并清理<mark>/<summary>后空白）
+3. documents: 一组QA结果（含向前合并）→ apply_qa_adjustments，比较最终文本和层级类型
+4. level_stream: 层级分析回复逐字送入 LevelStreamParser，答案确定时提前结束，层级和特殊情况与完整回答一致
+
+用法：
+    python test_response_parser_corpus.py
+    python test_response_parser_corpus.py path/to/corpus.json
+"""
+
+import io
+import sys
+import json
+import argparse
+from contextlib import redirect_stdout
+from synapse_flow.web.utils.llm_response_parser import parse_level_response, LevelStreamParser
+from synapse_flow.web.services.prompt_job_service import parse_remark_and_adjust_data, apply_qa_adjustments
+
+DEFAULT_CORPUS_FILE = "synapse_flow/例子/response_parser_corpus.json"
+
+
+def check_cases(name, cases, run):
+    """逐条比较，打印不一致的用例，返回不一致条数"""
+    mismatches = 0
+    for i, case in enumerate(cases):
+        with redirect_stdout(io.StringIO()):
+            actual = run(case)
+        if actual != case["expected"]:
+            mismatches += 1
+            print(f"  ❌ {name}[{i}]")
+            print(f"     期望: {case['expected']}")
+            print(f"     实际: {actual}")
+    print(f"{'✅' if mismatches == 0 else '❌'} {name}: {len(cases) - mismatches}/{len(cases)} 一致")
+    return mismatches
+
+
+def run_document(case):
+    all_results = [
+        {"ai_response": item["ai_response"], "current_text": item["current_text"],
+         "item": {"text": item["current_text"]}}
+        for item in case["items"]
+    ]
+    apply_qa_adjustments(all_results)
+    return [{"text": r["adjusted_text"], "level_type": r["level_type"]} for r in all_results]
+
+
+def run_level_stream(case):
+    """逐字输入，答案确定后不再输入，比较除推理过程（提前结束时被截断）以外的字段"""
+    stream_parser = LevelStreamParser()
+    for char in case["response"]:
+        if stream_parser.feed(char):
+            break
+    return {key: value for key, value in stream_parser.result().items() if key != "reasoning"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI回复解析语料测试")
+    parser.add_argument("corpus_file", nargs="?", default=DEFAULT_CORPUS_FILE)
+    args = parser.parse_args()
+
+    with open(args.corpus_file, "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+    print(f"加载语料: {args.corpus_file}")
+
+    mismatches = 0
+    mismatches += check_cases("level", corpus["level"], lambda c: parse_level_response(c["response"]))
+    mismatches += check_cases("qa", corpus["qa"],
+                              lambda c: parse_remark_and_adjust_data(c["response"], c["current_text"], 0, []))
+    mismatches += check_cases("documents", corpus["documents"], run_document)
+    mismatches += check_cases("level_stream", [
+        {**case, "expected": {key: value for key, value in case["expected"].items() if key != "reasoning"}}
+        for case in corpus["level"]
+    ], run_level_stream)
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token预算测试（不需要GPU；没有安装transformers时按字符近似计数）
+1. 裁剪：保留开头或结尾，裁剪后不超过预算；没有超出预算的文本原样返回
+2. 上下文块：超长的前后文块裁剪到上限，整段超出预算时压缩最长的块，受保护的块（QA目标文本块）不变
+3. QA prompt：正常长度的窗口与原来的格式逐字节一致；超长前文保留靠近目标的结尾，目标文本块不裁剪
+4. 层级prompt：没有逗号/句号的超长标题裁剪后保留开头的编号，其余prompt不变
+5. max_tokens：样本不足时为默认值，之后按输出长度分位数 × 余量（不低于下限）；QA另加目标文本的token数
+6. 层级输出长度：流式提前结束的回答不计入样本，达到发出请求时 max_tokens 的回答计入截断数
+
+用法：
+    python test_token_budget.py
+"""
+
+import io
+import json
+from contextlib import redirect_stdout
+from synapse_flow.web.utils.token_budget import TokenCounter, TaskTokenBudget, get_token_budget, TOKEN_BUDGET_CONFIG
+from script_checks import check, finish
+
+
+def run_truncate():
+    counter = TokenCounter(None)
+    text = "第一章 总则" + "，增值税的纳税义务发生时间按照有关规定执行" * 50
+    head = counter.truncate(text, 40)
+    tail = counter.truncate(text, 40, keep_tail=True)
+    check("保留开头，不超过预算", head.startswith("第一章 总则") and head.endswith("…") and counter.count(head) <= 40,
+          (counter.count(head), head))
+    check("保留结尾，不超过预算", tail.startswith("…") and text.endswith(tail[1:]) and counter.count(tail) <= 40,
+          (counter.count(tail), tail))
+    check("没有超出预算时原样返回", counter.truncate("短文本", 40) == "短文本")
+
+
+def run_fit_blocks():
+    budget = TaskTokenBudget("qa", TokenCounter(None), {"max_prompt_tokens": 300, "max_context_block_tokens": 100})
+    short = ["前文一", "前文二", "目标", "后文"]
+    check("没有超出预算时不裁剪", budget.fit_blocks(short, 20) == short)
+
+    long_text = "税" * 500
+    fitted = budget.fit_blocks([long_text, "前文二", long_text, long_text], 20,
+                               keep_tail=[True, True, False, False], protected=[2])
+    check("超长前后文块裁剪到上限", budget.count(fitted[0]) <= 100 and budget.count(fitted[3]) <= 100
+          and fitted[1] == "前文二", [budget.count(text) for text in fitted])
+    check("受保护的块不裁剪", fitted[2] == long_text)
+
+    fitted = budget.fit_blocks(["税" * 90, "税" * 90, "税" * 90, "税" * 10], 100)
+    total = sum(budget.count(text) for text in fitted) + 100
+    check("整段超出预算时压缩较长的块", 280 < total <= 300 and fitted[3] == "税" * 10,
+          [budget.count(text) for text in fitted])
+
+
+def run_qa_prompt():
+    from synapse_flow.web.services.prompt_job_service import build_prompt, format_qa_user_prompt, QA_PLACEHOLDER_TEXT
+
+    instruction = "请问第三文本块是否为新的层级？另外，内容是否正确，如果错误应该建议如何修改"
+    window = [{"text": QA_PLACEHOLDER_TEXT, "page_idx": 0}, {"text": "第一章 总则", "page_idx": 0},
+              {"text": "一、纳税人", "page_idx": 1}, {"text": "在中华人民共和国境内销售货物的单位和个人。", "page_idx": 1}]
+    expected = format_qa_user_prompt(instruction, [{**window[0], "page_idx": -1}] + window[1:])
+    _, user_prompt = build_prompt(instruction, [dict(block) for block in window])
+    check("QA：正常长度的prompt格式不变", user_prompt == expected)
+
+    long_before = "开头的内容" + "纳税人应当按照规定的期限申报缴纳税款" * 200 + "紧挨着目标的结尾"
+    long_target = "目标文本" * 800
+    _, user_prompt = build_prompt(instruction, [
+        {"text": long_before, "page_idx": 0}, {"text": "第一章 总则", "page_idx": 0},
+        {"text": long_target, "page_idx": 1}, {"text": "后文", "page_idx": 1}
+    ])
+    check("QA：超长前文保留靠近目标的结尾", "紧挨着目标的结尾" in user_prompt and "开头的内容" not in user_prompt)
+    check("QA：目标文本块不裁剪", long_target in user_prompt)
+
+
+def run_level_prompt():
+    from synapse_flow.web.services.level_analysis_service import LevelAnalysisService
+
+    with redirect_stdout(io.StringIO()):
+        service = LevelAnalysisService()
+    service.state.push("第一章 总则", "section level", 1, None)
+    _, normal = service.build_level_prompt({"text": "第一节 纳税人，以及扣缴义务人", "isTitleMarked": "section level"})
+    check("层级：正常长度的prompt不变", '"第一节 纳税人"' in normal and '结构层级1："第一章 总则"' in normal, normal)
+
+    long_heading = "（一）" + "没有标点的超长标题文本" * 100
+    _, trimmed = service.build_level_prompt({"text": long_heading, "isTitleMarked": "context level"})
+    target = trimmed.split('请问段落层级： "')[1].split('",是第几层级')[0]
+    check("层级：超长标题裁剪后保留开头的编号", target.startswith("（一）没有标点")
+          and service.token_budget.count(target) <= TOKEN_BUDGET_CONFIG["tasks"]["level"]["max_context_block_tokens"],
+          target)
+    service.close_log()
+
+
+def run_max_tokens():
+    level = TaskTokenBudget("level", TokenCounter(None), {"min_samples": 10})
+    answer = "因为目标文本开头为前文不具有的一种新层级格式，且与上一级同为结构层级，所以判断为{层级2}。"
+    check("样本不足时为默认值", level.max_tokens() == level.config["default_max_tokens"])
+    for _ in range(20):
+        level.record_output(answer)
+    check("层级：按输出长度分位数设置，不低于下限",
+          level.max_tokens() == max(level.config["min_max_tokens"], int(level.count(answer) * level.config["margin"])),
+          level.get_stats())
+
+    qa = TaskTokenBudget("qa", TokenCounter(None), {"min_samples": 10, "min_max_tokens": 16})
+    target = "在中华人民共和国境内销售货物的单位和个人" * 10
+    for _ in range(20):
+        qa.record_output(f"所以判断为{{非新层级}}。建议处理方式为：{{{target}}}", target)
+    overhead = qa.output_stats.percentile(99)
+    check("QA：只记录目标文本以外的输出长度", overhead < qa.count(target), overhead)
+    check("QA：max_tokens 另加目标文本的token数",
+          qa.max_tokens(target) == int((overhead + qa.count(target)) * qa.config["margin"]), qa.get_stats())
+
+    qa.record_output("判" * 300, "", max_tokens=300)
+    check("达到max_tokens的输出计入截断数", qa.get_stats()["capped_outputs"] == 1)
+
+    TOKEN_BUDGET_CONFIG["enabled"] = False
+    try:
+        check("关闭后使用默认值", qa.max_tokens(target) == qa.config["default_max_tokens"])
+    finally:
+        TOKEN_BUDGET_CONFIG["enabled"] = True
+    check("同一基础模型共用计数器", get_token_budget("qa").counter is get_token_budget("level").counter)
+
+
+def run_level_output_recording():
+    from synapse_flow.web.services.level_analysis_service import LevelAnalysisService
+    from synapse_flow.web.services.vllm_async_client import StreamEarlyStopStats, consume_stream
+
+    full = "所以判断为{层级2}。" + "因为目标文本开头为前文不具有的一种新层级格式" * 3
+    stream_stats = StreamEarlyStopStats(calibration_every=2)  # 答案确定的请求中每两个读完一个
+    sent_max_tokens = []
+
+    def llm_client(messages, max_tokens, stream_parser):
+        # 按字符近似计数时一个汉字一个token：回答截到 max_tokens 个字，逐字流式返回
+        sent_max_tokens.append(max_tokens)
+        lines = [b"data: " + json.dumps({"choices": [{"delta": {"content": char}}]}).encode()
+                 for char in full[:max_tokens]]
+        parser = stream_parser()
+        consume_stream(lines, parser, stream_stats)
+        return parser.text
+
+    def new_service(default_max_tokens):
+        with redirect_stdout(io.StringIO()):
+            service = LevelAnalysisService(llm_client=llm_client)
+        service.token_budget = TaskTokenBudget("level", TokenCounter(None), {"default_max_tokens": default_max_tokens})
+        return service
+
+    def request(service, i):
+        with redirect_stdout(io.StringIO()):
+            service.request_level_llm({"user_prompt": f"prompt{i}", "messages": [{"role": "user", "content": str(i)}]})
+
+    service = new_service(200)
+    budget = service.token_budget
+    for i in range(6):
+        request(service, i)
+    stream = stream_stats.get_stats()
+    check("层级：流式提前结束的回答不计入输出长度样本",
+          stream["early_stopped"] == 3 and len(budget.output_stats) == stream["calibrated"] == 3, (stream, len(budget.output_stats)))
+    check("层级：样本为完整回答的长度", budget.output_stats.percentile(50) == budget.count(full),
+          budget.output_stats.percentile(50))
+
+    service.close_log()
+
+    service = new_service(5)
+    request(service, 0)
+    check("层级：按发出请求时的max_tokens计入截断数",
+          sent_max_tokens[-1] == 5 and service.token_budget.stats["capped_outputs"] == 1,
+          (sent_max_tokens, service.token_budget.get_stats()))
+    service.close_log()
+
+
+def main():
+    run_truncate()
+    run_fit_blocks()
+    run_qa_prompt()
+    run_level_prompt()
+    run_max_tokens()
+    run_level_output_recording()
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
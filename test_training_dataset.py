@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LoRA训练数据tokenize测试（不需要GPU和模型：用 tokenizers 现场训练一个带Llama 3特殊token的小BPE tokenizer）
+1. 模板单独tokenize后拼接的结果与原来逐条整段tokenize完全一致（input_ids、attention_mask、labels）
+2. 多进程 map 与单进程结果一致，空 input 的行被过滤
+3. 缓存：相同CSV再次加载命中缓存；CSV内容、模板版本或 max_length 变化时重新tokenize
+
+用法：
+    python test_training_dataset.py
+"""
+
+import io
+import os
+import csv
+import json
+import random
+import tempfile
+from contextlib import redirect_stdout
+from synapse_flow.web.services.training_data_service import (
+    TRAINING_DATA_CONFIG, TRAINING_INSTRUCTION_TEMPLATE, format_user_part, tokenize_example, load_tokenized_dataset
+)
+from script_checks import check, finish
+
+SPECIAL_TOKENS = ["<|begin_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>"]
+
+
+def build_tiny_tokenizer(texts):
+    """在给定文本上训练一个小的字节级BPE tokenizer"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=2000, special_tokens=SPECIAL_TOKENS,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(texts, trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|begin_of_text|>", eos_token="<|eot_id|>")
+    fast.pad_token = fast.eos_token
+    return fast
+
+
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        blocks = [{"text": "一、纳税人" + "，应当按照规定的期限申报缴纳税款" * rng.randint(0, 20), "page_idx": i}
+                  for _ in range(4)]
+        rows.append({
+            "instruction": "请问第三文本块是否为新的层级？另外，内容是否正确，如果错误应该建议如何修改",
+            "input": json.dumps(blocks, ensure_ascii=False),
+            "output": "因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。"
+                      "因为第三文本块因没有四类错误，所以判断为{正确}。第三文本块不做任何修改。"
+        })
+    return rows
+
+
+def write_csv(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["instruction", "input", "output"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def load(*args, **kwargs):
+    output = io.StringIO()
+    with redirect_stdout(output):
+        dataset = load_tokenized_dataset(*args, **kwargs)
+    return dataset, "使用已缓存的tokenize结果" in output.getvalue()
+
+
+def main():
+    rows = make_rows(600)
+    tokenizer = build_tiny_tokenizer([TRAINING_INSTRUCTION_TEMPLATE] + [format_user_part(row) + row["output"]
+                                                                        for row in rows[:50]])
+    max_length = len(tokenizer(TRAINING_INSTRUCTION_TEMPLATE, add_special_tokens=False)["input_ids"]) + 200
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path, cache_dir = os.path.join(tmp, "training_data.csv"), os.path.join(tmp, "cache")
+        write_csv(csv_path, rows[:300] + [{"instruction": "空", "input": " ", "output": "空"}] + rows[300:])
+
+        dataset, hit = load(csv_path, tokenizer, max_length, num_proc=1, cache_dir="")
+        expected = [tokenize_example(row, tokenizer, max_length) for row in rows]
+        check("过滤空input的行", len(dataset) == len(rows), len(dataset))
+        check("拼接与整段tokenize一致", dataset.to_dict() == {
+            key: [features[key] for features in expected] for key in ("input_ids", "attention_mask", "labels")
+        })
+        check("超长样本截断到max_length", max(len(ids) for ids in dataset["input_ids"]) == max_length)
+
+        parallel, _ = load(csv_path, tokenizer, max_length, num_proc=2, cache_dir="")
+        check("多进程与单进程结果一致", parallel.to_dict() == dataset.to_dict())
+
+        first, hit = load(csv_path, tokenizer, max_length, num_proc=2, cache_dir=cache_dir)
+        check("首次加载不命中缓存", not hit and first.to_dict() == dataset.to_dict())
+        cached, hit = load(csv_path, tokenizer, max_length, cache_dir=cache_dir)
+        check("相同CSV命中缓存", hit and cached.to_dict() == dataset.to_dict())
+        check("缓存目录中没有残留的临时目录", all(".tmp" not in name for name in os.listdir(cache_dir)),
+              os.listdir(cache_dir))
+
+        _, hit = load(csv_path, tokenizer, max_length + 1, cache_dir=cache_dir)
+        check("max_length变化时不命中", not hit)
+
+        TRAINING_DATA_CONFIG["template_version"] += 1
+        try:
+            _, hit = load(csv_path, tokenizer, max_length, cache_dir=cache_dir)
+            check("模板版本变化时不命中", not hit)
+        finally:
+            TRAINING_DATA_CONFIG["template_version"] -= 1
+
+        write_csv(csv_path, rows[:-1])
+        changed, hit = load(csv_path, tokenizer, max_length, cache_dir=cache_dir)
+        check("CSV内容变化时不命中", not hit and len(changed) == len(rows) - 1)
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练数据导出测试（内存中的pdf_json，不需要数据库）
+1. 样本：输入与QA处理时发送的上下文一致（使用 original_text）；exclude_from_finetune、remark为空或没有层级判断的块不作为样本，
+   但仍作为其他样本的上下文；非text块不参与
+2. 分片：按 shard_examples 分片写成Arrow文件，Dataset.from_file 内存映射读取，内容与样本一致
+3. 增量：再次导出时未变化的run不重新生成；新版本只重新导出对应的run并删除旧分片；指定版本；移除不再导出的run；
+   样本构建方式变化时全部重新导出
+4. 快照：训练任务目录中的分片是硬链接，之后的导出删除旧分片不影响
+
+用法：
+    python test_training_export.py
+"""
+
+import io
+import os
+import json
+import tempfile
+from contextlib import redirect_stdout
+
+from datasets import Dataset, concatenate_datasets
+from synapse_flow.web.services.prompt_job_service import (
+    QA_INSTRUCTION, QA_PLACEHOLDER_TEXT, build_qa_context_windows, fix_placeholder_page_idx
+)
+from synapse_flow.web.services.training_export_service import (
+    TRAINING_EXPORT_CONFIG, MemoryReviewedVersionSource, build_training_examples, export_training_dataset,
+    snapshot_export
+)
+from script_checks import check, finish
+
+REMARK = "因为阅读上下文第三文本块为这一层级的正文组成部分，所以判断为{非新层级}。因为第三文本块因没有四类错误，所以判断为{正确}。"
+
+next_id = [0]
+
+
+def make_version(run_id, version, blocks):
+    """blocks: (type, original_text, text, remark, exclude_from_finetune)"""
+    rows = []
+    for i, (type_, original_text, text, remark, exclude) in enumerate(blocks):
+        next_id[0] += 1
+        rows.append({"id": next_id[0], "run_id": run_id, "version": version, "page_index": i // 3, "block_index": i,
+                     "type": type_, "text": text, "original_text": original_text, "remark": remark,
+                     "exclude_from_finetune": exclude})
+    return rows
+
+
+def make_run(run_id, count, version=1):
+    return make_version(run_id, version, [("text", f"{run_id}第{i}块", f"{run_id}第{i}块", f"{REMARK}（{i}）", False)
+                                          for i in range(count)])
+
+
+def export(*args, **kwargs):
+    with redirect_stdout(io.StringIO()):
+        return export_training_dataset(*args, **kwargs)
+
+
+def load_shards(paths):
+    return concatenate_datasets([Dataset.from_file(path) for path in paths])
+
+
+def run_examples():
+    rows = make_version("r", 1, [
+        ("text", "一、总则", "一、总则", REMARK + "0", False),
+        ("text", "原文，带@乱码", "审核后修改的文本", REMARK + "1", False),
+        ("table", "<table></table>", "<table></table>", "", False),
+        ("text", "被排除的块", "被排除的块", REMARK + "3", True),
+        ("text", "", "", REMARK + "4", False),
+        ("text", "没有remark", "没有remark", "", False),
+        ("text", "QA失败", "QA失败", "处理失败: timeout", False),
+        ("text", "", "审核新增的块", REMARK + "7", False),
+    ])
+    examples, skipped = build_training_examples(list(reversed(rows)))
+    check("样本：跳过exclude、空remark和没有层级判断的remark",
+          skipped == {"excluded": 1, "empty_remark": 1, "unparsed_remark": 1}, skipped)
+    check("样本：非text块不作为样本", [example["output"][-1] for example in examples] == ["0", "1", "4", "7"],
+          [example["output"] for example in examples])
+
+    # QA处理时：版本0的text（即 original_text）按同样方式构建上下文，发送前修正占位符的page_idx
+    version_0 = [{**row, "text": row["original_text"]} for row in rows if row["block_index"] != 7]
+    expected = [json.dumps(fix_placeholder_page_idx(window), ensure_ascii=False, indent=2)
+                for window in build_qa_context_windows(version_0) if window is not None]
+    expected_by_block = dict(zip([row["block_index"] for row in version_0 if row["type"] == "text"], expected))
+    check("样本：输入与QA处理时发送的上下文一致",
+          all(example["input"] == expected_by_block[example["block_index"]]
+              for example in examples if example["block_index"] != 7))
+    first = json.loads(examples[0]["input"])
+    check("样本：前文不足时用占位符补齐，page_idx为-1",
+          first[:2] == [{"text": QA_PLACEHOLDER_TEXT, "page_idx": -1}] * 2, first)
+    second = json.loads(examples[1]["input"])
+    check("样本：使用original_text，被排除的块仍作为后文，表格不作为上下文",
+          second[2]["text"] == "原文，带@乱码" and second[3]["text"] == "被排除的块", second)
+    last = json.loads(examples[-1]["input"])
+    check("样本：没有original_text时使用text", last[2]["text"] == "审核新增的块", last)
+    check("样本：instruction为QA的问题", all(example["instruction"] == QA_INSTRUCTION for example in examples))
+
+
+def run_export(tmp):
+    source = MemoryReviewedVersionSource({
+        "run-a": {0: make_run("run-a", 25, 0), 1: make_run("run-a", 25)},
+        "run-b": {1: make_run("run-b", 7)},
+        "run-c": {0: make_run("run-c", 5, 0)}  # 只有版本0（还没有QA），不导出
+    })
+    shard_examples = TRAINING_EXPORT_CONFIG["shard_examples"]
+    TRAINING_EXPORT_CONFIG["shard_examples"] = 10
+    try:
+        result = export("exp", source=source, export_dir=tmp)
+        check("导出：只导出有审核版本的run", result["exported_runs"] == ["run-a", "run-b"] and result["examples"] == 32,
+              result)
+        check("导出：按shard_examples分片", len(result["shards"]) == 4, result["shards"])
+        dataset = load_shards(result["shards"])
+        check("导出：内存映射读取，内容与样本一致",
+              dataset.to_list() == build_training_examples(source.query_rows("run-a", 1))[0]
+              + build_training_examples(source.query_rows("run-b", 1))[0])
+        check("导出：分片直接从磁盘映射",
+              sorted(item["filename"] for item in dataset.cache_files) == sorted(result["shards"]), dataset.cache_files)
+
+        job_dir = os.path.join(tmp, "job")
+        snapshot = snapshot_export(result["export_path"], job_dir)
+        check("快照：分片是硬链接", all(os.stat(path).st_nlink == 2 for path in snapshot), snapshot)
+
+        again = export("exp", source=source, export_dir=tmp)
+        check("增量：未变化时不重新导出", again["exported_runs"] == [] and again["unchanged_runs"] == ["run-a", "run-b"]
+              and again["shards"] == result["shards"], again)
+
+        source.runs["run-b"][2] = make_run("run-b", 9, 2)
+        old_b = [path for path in result["shards"] if "/run-b/" in path]
+        changed = export("exp", source=source, export_dir=tmp)
+        check("增量：新版本只重新导出对应的run", changed["exported_runs"] == ["run-b"]
+              and changed["unchanged_runs"] == ["run-a"] and changed["examples"] == 34, changed)
+        check("增量：删除旧版本的分片", not any(os.path.exists(path) for path in old_b))
+        check("快照：旧分片删除后训练任务目录中的分片仍可读取", len(load_shards(snapshot)) == 32)
+
+        pinned = export("exp", source=source, export_dir=tmp, versions={"run-b": 1})
+        check("指定版本：导出指定的版本", pinned["exported_runs"] == ["run-b"] and pinned["examples"] == 32, pinned)
+        try:
+            export("exp", source=source, export_dir=tmp, versions={"run-b": 5})
+            check("指定版本：版本不存在时报错", False)
+        except Exception as e:
+            check("指定版本：版本不存在时报错", "run-b v5" in str(e), e)
+
+        subset = export("exp", source=source, export_dir=tmp, run_ids=["run-a"])
+        check("移除：不在run_ids中的run从导出中移除", subset["removed_runs"] == ["run-b"] and subset["examples"] == 25
+              and not os.path.exists(os.path.join(tmp, "exp", "run-b")), subset)
+
+        TRAINING_EXPORT_CONFIG["export_version"] += 1
+        try:
+            rebuilt = export("exp", source=source, export_dir=tmp, run_ids=["run-a"])
+            check("样本构建方式变化时全部重新导出", rebuilt["exported_runs"] == ["run-a"], rebuilt)
+        finally:
+            TRAINING_EXPORT_CONFIG["export_version"] -= 1
+        check("导出目录中没有残留的临时文件",
+              not [name for _, dirs, files in os.walk(tmp) for name in dirs + files if ".tmp" in name])
+    finally:
+        TRAINING_EXPORT_CONFIG["shard_examples"] = shard_examples
+
+
+def main():
+    run_examples()
+    with tempfile.TemporaryDirectory() as tmp:
+        run_export(tmp)
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LoRA训练调度测试（内存任务表 + FakeGpuProbe + 模拟训练子进程，不需要GPU、数据库和模型）
+1. 调度：3个任务、2张空闲GPU（另一张显存不足），同时运行2个且GPU不同，第3个排队等GPU释放
+2. 进度：子进程输出的进度写入任务的 progress，其余输出写入 train.log；状态变化通知订阅者
+3. 取消：排队中的任务直接取消；运行中的任务收到SIGTERM后保存checkpoint退出，记为 cancelled
+4. 续跑：失败的任务记录最后几行输出；重新入队后从最新的checkpoint继续
+5. 恢复：服务重启时 running 的任务重新入队续跑，cancelling 的记为取消，超过启动次数上限的记为失败
+
+用法：
+    python test_training_scheduler.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+from synapse_flow.web.services.training_scheduler_service import (
+    TrainingScheduler, MemoryTrainingJobStore, FakeGpuProbe, find_latest_checkpoint, now_iso,
+    QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED, CANCELLING
+)
+from script_checks import check, finish
+
+# 模拟训练子进程：每步输出进度，每两步保存checkpoint；收到SIGTERM时保存checkpoint后退出
+FAKE_WORKER = r'''
+import os, sys, json, time, signal
+env = json.load(open(sys.argv[1], encoding="utf-8"))
+stop = []
+signal.signal(signal.SIGTERM, lambda *args: stop.append(True))
+resume = env.get("resume_from_checkpoint")
+start = int(os.path.basename(resume).split("-")[1]) if resume else 0
+print(f"GPU {os.environ['CUDA_VISIBLE_DEVICES']} resume {resume}", flush=True)
+
+def save(step):
+    checkpoint = os.path.join(env["output_dir"], f"checkpoint-{step}")
+    os.makedirs(checkpoint, exist_ok=True)
+    open(os.path.join(checkpoint, "trainer_state.json"), "w").write("{}")
+
+for step in range(start + 1, env["steps"] + 1):
+    time.sleep(env.get("step_seconds", 0.05))
+    print("@@training_progress " + json.dumps({"step": step, "max_steps": env["steps"], "loss": round(1 / step, 4),
+          "tokens_per_second": 1000, "gpus": os.environ["CUDA_VISIBLE_DEVICES"], "resumed_from": start}), flush=True)
+    if step % 2 == 0 or stop:
+        save(step)
+    if stop:
+        sys.exit(0)
+    if env.get("fail_at") == step and not resume:
+        print("RuntimeError: CUDA out of memory", flush=True)
+        sys.exit(1)
+'''
+
+
+def wait_for(predicate, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def make_scheduler(store, gpu_probe):
+    return TrainingScheduler(store, gpu_probe, {
+        "poll_interval": 0.05, "min_free_memory_mb": 20000, "cancel_grace_seconds": 5,
+        "worker_command": [sys.executable, "-c", FAKE_WORKER]
+    })
+
+
+def status(store, task_id):
+    return store.get(task_id)["status"]
+
+
+def run_scheduling(tmp):
+    store, probe = MemoryTrainingJobStore(), FakeGpuProbe({0: 40000, 1: 40000, 2: 1000})
+    scheduler = make_scheduler(store, probe)
+    events = []
+    scheduler.subscribe(lambda task_id, task_status, job: events.append((task_id, task_status)))
+    scheduler.start()
+    try:
+        for name in ("a", "b", "c"):
+            scheduler.submit(name, {"task_id": name, "output_dir": os.path.join(tmp, name), "steps": 6})
+        check("调度：两个任务同时运行",
+              wait_for(lambda: [status(store, name) for name in "ab"] == [RUNNING, RUNNING]),
+              [store.get(name) for name in "abc"])
+        check("调度：不同任务分配不同GPU，显存不足的GPU不分配",
+              sorted(store.get(name)["gpu_ids"] for name in "ab") == ["0", "1"])
+        check("调度：第三个任务排队", status(store, "c") == QUEUED)
+        check("调度：全部完成", wait_for(lambda: all(status(store, name) == COMPLETED for name in "abc")),
+              [status(store, name) for name in "abc"])
+        check("调度：第三个任务在前面的任务结束后启动", store.get("c")["start_time"] >= min(
+            store.get(name)["end_time"] for name in "ab"))
+
+        job = store.get("c")
+        check("进度：写入任务记录", job["progress"].get("step") == 6 and job["progress"].get("loss") == round(1 / 6, 4)
+              and job["progress"].get("gpus") == job["gpu_ids"], job["progress"])
+        with open(os.path.join(tmp, "c", "train.log"), encoding="utf-8") as f:
+            log = f.read()
+        check("进度：其余输出写入train.log", log.startswith(f"GPU {job['gpu_ids']}") and "@@training_progress" not in log,
+              log)
+        check("订阅：收到状态变化", [event for event in events if event[0] == "a"]
+              == [("a", QUEUED), ("a", RUNNING), ("a", COMPLETED)], events)
+    finally:
+        scheduler.close()
+
+
+def run_cancel_and_resume(tmp):
+    store, probe = MemoryTrainingJobStore(), FakeGpuProbe({0: 40000})
+    scheduler = make_scheduler(store, probe)
+    scheduler.start()
+    try:
+        scheduler.submit("long", {"task_id": "long", "output_dir": os.path.join(tmp, "long"), "steps": 1000})
+        scheduler.submit("waiting", {"task_id": "waiting", "output_dir": os.path.join(tmp, "waiting"), "steps": 2})
+        wait_for(lambda: (store.get("long")["progress"] or {}).get("step", 0) >= 3)
+        result = scheduler.cancel("waiting")
+        check("取消：排队中的任务直接取消", result["task_status"] == CANCELLED and status(store, "waiting") == CANCELLED
+              and store.get("waiting")["attempts"] == 0, result)
+
+        result = scheduler.cancel("long")
+        check("取消：运行中的任务先进入cancelling", result["task_status"] == CANCELLING, result)
+        check("取消：子进程退出后记为cancelled", wait_for(lambda: status(store, "long") == CANCELLED),
+              store.get("long"))
+        stopped_at = store.get("long")["progress"]["step"]
+        check("取消：退出前保存了checkpoint",
+              find_latest_checkpoint(os.path.join(tmp, "long")) == os.path.join(tmp, "long", f"checkpoint-{stopped_at}"))
+        result = scheduler.cancel("long")
+        check("取消：已结束的任务不能再取消，返回并保留结束状态",
+              result["status"] == "error" and result["task_status"] == CANCELLED and status(store, "long") == CANCELLED,
+              result)
+
+        scheduler.submit("flaky", {"task_id": "flaky", "output_dir": os.path.join(tmp, "flaky"), "steps": 6,
+                                   "fail_at": 3})
+        check("失败：记为failed", wait_for(lambda: status(store, "flaky") == FAILED), store.get("flaky"))
+        check("失败：记录最后几行输出", "CUDA out of memory" in (store.get("flaky")["error_message"] or ""),
+              store.get("flaky")["error_message"])
+
+        result = scheduler.resume("flaky")
+        check("续跑：重新入队，从最新的checkpoint继续",
+              result["resume_from_checkpoint"] == os.path.join(tmp, "flaky", "checkpoint-2"), result)
+        check("续跑：完成", wait_for(lambda: status(store, "flaky") == COMPLETED), store.get("flaky"))
+        job = store.get("flaky")
+        check("续跑：子进程从checkpoint的步数开始", job["progress"]["resumed_from"] == 2 and job["attempts"] == 2
+              and job["resume_from_checkpoint"].endswith("checkpoint-2"), job)
+        check("续跑：运行中或已完成的任务不能续跑", scheduler.resume("flaky")["status"] == "error")
+    finally:
+        scheduler.close()
+
+
+def run_recover(tmp):
+    store = MemoryTrainingJobStore()
+    for name, job_status, attempts in (("interrupted", RUNNING, 1), ("cancelling", CANCELLING, 1),
+                                       ("exhausted", RUNNING, 3)):
+        output_dir = os.path.join(tmp, name)
+        os.makedirs(os.path.join(output_dir, "checkpoint-4"))
+        open(os.path.join(output_dir, "checkpoint-4", "trainer_state.json"), "w").close()
+        store.create({"task_id": name, "status": job_status, "attempts": attempts, "output_path": output_dir,
+                      "training_env": {"task_id": name, "output_dir": output_dir, "steps": 6},
+                      "pid": 999999999, "create_time": now_iso(), "update_time": now_iso()})
+
+    scheduler = make_scheduler(store, FakeGpuProbe({0: 40000}))
+    scheduler.start()
+    try:
+        check("恢复：运行中的任务重新入队后完成", wait_for(lambda: status(store, "interrupted") == COMPLETED),
+              store.get("interrupted"))
+        check("恢复：从最新的checkpoint继续", store.get("interrupted")["progress"]["resumed_from"] == 4,
+              store.get("interrupted")["progress"])
+        check("恢复：取消中的任务记为取消", status(store, "cancelling") == CANCELLED)
+        check("恢复：超过启动次数上限的任务记为失败", status(store, "exhausted") == FAILED)
+    finally:
+        scheduler.close()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        run_scheduling(os.path.join(tmp, "scheduling"))
+        run_cancel_and_resume(os.path.join(tmp, "cancel"))
+        run_recover(os.path.join(tmp, "recover"))
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+vLLM调用熔断测试（不需要GPU）
+用 test_vllm_endpoint_pool 中的替身HTTP服务模拟vLLM中途宕机，验证：
+1. 连续失败达到阈值后断开，断开期间请求不再发出；恢复时间到后同时只放行一个探测请求
+2. 探测失败重新断开且等待时间加倍，探测成功后闭合并唤醒挂起的请求
+3. AsyncVLLMClient：fail_fast 模式立即失败，park 模式挂起到服务恢复后完成
+4. 层级分析逐条调用：服务宕机时不再每条等待5秒重试，连续失败达到阈值时中止整个运行
+5. 层级分析通过共享客户端调用：服务中途宕机又恢复时，挂起的条目在恢复后继续，结果完整
+
+用法：
+    python test_vllm_circuit_breaker.py
+"""
+
+import io
+import time
+import threading
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from test_vllm_endpoint_pool import StandInServer
+from vllm_endpoint_pool import EndpointPool, set_endpoint_pool
+from vllm_circuit_breaker import (
+    CircuitBreaker, CircuitOpenError, RunAbortedError, set_circuit_breaker, CIRCUIT_BREAKER_CONFIG,
+    CLOSED, OPEN, HALF_OPEN
+)
+from script_checks import check, finish
+
+# 测试中缩短各种时间
+TEST_CONFIG = {
+    "failure_threshold": 3,
+    "recovery_timeout": 0.1,
+    "max_recovery_timeout": 0.4,
+    "park_timeout": 5
+}
+
+
+def fail(breaker, times):
+    for _ in range(times):
+        breaker.release(False, breaker.acquire())
+
+
+def run_state_machine():
+    breaker = CircuitBreaker("test", {**TEST_CONFIG, "open_behavior": "fail_fast"})
+    fail(breaker, 2)
+    check("未达到阈值时保持闭合", breaker.state == CLOSED, breaker.get_stats())
+    fail(breaker, 1)
+    check("连续失败达到阈值后断开", breaker.state == OPEN, breaker.get_stats())
+
+    try:
+        breaker.acquire()
+        check("断开期间立即拒绝", False)
+    except CircuitOpenError:
+        check("断开期间立即拒绝", True)
+
+    time.sleep(TEST_CONFIG["recovery_timeout"] * 1.5)
+
+    def try_acquire(_):
+        try:
+            return breaker.acquire()
+        except CircuitOpenError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        grants = list(executor.map(try_acquire, range(8)))
+    check("恢复时间到后只放行一个探测请求", grants.count(True) == 1 and grants.count(None) == 7, grants)
+    check("探测期间为半开", breaker.state == HALF_OPEN, breaker.get_stats())
+
+    breaker.release(False, True)
+    check("探测失败重新断开，等待时间加倍", breaker.state == OPEN
+          and breaker.get_stats()["recovery_timeout"] == TEST_CONFIG["recovery_timeout"] * 2, breaker.get_stats())
+
+    # 挂起的请求在探测成功后被唤醒
+    parked = []
+
+    def park():
+        parked.append(breaker.acquire(timeout=2))
+
+    threads = [threading.Thread(target=park) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(TEST_CONFIG["recovery_timeout"] * 3)
+    probe = breaker.get_stats()["state"] == HALF_OPEN
+    # 挂起的线程中有一个拿到了探测名额，模拟它成功返回
+    deadline = time.time() + 1
+    while True not in parked and time.time() < deadline:
+        time.sleep(0.01)
+    breaker.release(True, True)
+    for thread in threads:
+        thread.join(timeout=2)
+    check("探测成功后闭合并唤醒挂起的请求", probe and breaker.state == CLOSED
+          and sorted(parked) == [False, False, False, True], parked)
+    check("闭合后等待时间恢复", breaker.get_stats()["recovery_timeout"] == TEST_CONFIG["recovery_timeout"],
+          breaker.get_stats())
+
+
+def new_client(server, behavior):
+    from synapse_flow.web.services.vllm_async_client import AsyncVLLMClient
+
+    pool = EndpointPool([server.url], name="test")
+    breaker = CircuitBreaker("test", {**TEST_CONFIG, "open_behavior": behavior})
+    client = AsyncVLLMClient(base_url=None, model_name="llama3.1_8b", max_concurrency=8,
+                             max_retries=3, retry_interval=0.01, endpoint_pool=pool, circuit_breaker=breaker)
+    return client, pool, breaker
+
+
+def trip(client):
+    """在故障的服务上发请求直到熔断断开（submit 不会挂起）"""
+    with redirect_stdout(io.StringIO()):
+        while client.circuit_breaker.state != OPEN:
+            try:
+                client.submit([{"role": "user", "content": "x"}]).result()
+            except CircuitOpenError:
+                pass
+
+
+def run_async_client():
+    server = StandInServer(latency=0.01)
+    client, pool, breaker = new_client(server, "fail_fast")
+    server.failing = True
+    trip(client)
+    requests_before = pool.get_stats()[0]["requests"]
+    rejected_before = client.get_stats()["rejected"]
+    started_at = time.time()
+    rejected = 0
+    for _ in range(20):
+        try:
+            client.chat([{"role": "user", "content": "x"}])
+        except CircuitOpenError:
+            rejected += 1
+    check("fail_fast：断开后立即失败且请求不再发出", rejected == 20 and time.time() - started_at < 0.5
+          and pool.get_stats()[0]["requests"] == requests_before,
+          (rejected, time.time() - started_at, pool.get_stats()))
+    check("客户端统计中包含熔断状态", client.get_stats()["circuit_breaker"]["state"] == OPEN
+          and client.get_stats()["rejected"] - rejected_before == 20, client.get_stats())
+    client.close()
+
+    client, pool, breaker = new_client(server, "park")
+    trip(client)
+    requests_before = pool.get_stats()[0]["requests"]
+    threading.Timer(0.5, lambda: setattr(server, "failing", False)).start()
+    with ThreadPoolExecutor(max_workers=8) as executor, redirect_stdout(io.StringIO()):
+        answers = list(executor.map(lambda i: client.chat([{"role": "user", "content": str(i)}]), range(16)))
+    # 0.5秒内探测间隔 0.1→0.2→0.4，断开期间最多发出几个探测请求
+    sent_while_down = pool.get_stats()[0]["requests"] - requests_before - 16
+    check("park：服务恢复后挂起的请求全部完成", all(answers) and breaker.state == CLOSED, answers)
+    check("park：断开期间只有探测请求发出", sent_while_down <= 4, sent_while_down)
+    client.close()
+    server.shutdown()
+
+
+def new_level_service(llm_client=None):
+    from synapse_flow.web.services.level_analysis_service import LevelAnalysisService
+
+    with redirect_stdout(io.StringIO()):
+        service = LevelAnalysisService(llm_client=llm_client)
+    service.check_vllm_service_status = lambda: True
+    return service
+
+
+def sample_items(count):
+    # 没有编号的正文，规则无法判断，每条都需要调用AI
+    return [{"id": f"item_{i}", "text": f"第{i}段正文内容，没有编号。", "isTitleMarked": "正文"} for i in range(count)]
+
+
+def run_level_run_abort():
+    server = StandInServer()
+    server.failing = True
+    pool = EndpointPool([server.url], name="test")
+    previous_pool = set_endpoint_pool("level_model", pool)
+    previous_breaker = set_circuit_breaker("level_model", CircuitBreaker("test", {**TEST_CONFIG, "open_behavior": "fail_fast"}))
+    saved_config = dict(CIRCUIT_BREAKER_CONFIG)
+    CIRCUIT_BREAKER_CONFIG.update({"retry_backoff": 0.01, "run_abort_failures": 5})
+    try:
+        service = new_level_service()
+        started_at = time.time()
+        try:
+            with redirect_stdout(io.StringIO()):
+                service.process_batch(sample_items(50))
+            aborted = False
+        except RunAbortedError:
+            aborted = True
+        elapsed = time.time() - started_at
+        sent = pool.get_stats()[0]["requests"]
+        check("逐条调用：服务宕机时中止整个运行", aborted and service.failure_guard.consecutive_failures == 5,
+              service.failure_guard.consecutive_failures)
+        check("逐条调用：不再每条等待5秒重试", elapsed < 2, f"{elapsed:.2f}秒")
+        check("逐条调用：断开后请求不再发出", sent <= TEST_CONFIG["failure_threshold"] + 2, sent)
+    finally:
+        CIRCUIT_BREAKER_CONFIG.clear()
+        CIRCUIT_BREAKER_CONFIG.update(saved_config)
+        set_endpoint_pool("level_model", previous_pool)
+        set_circuit_breaker("level_model", previous_breaker)
+        server.shutdown()
+
+
+def run_level_park_and_resume():
+    server = StandInServer(latency=0.01)
+    client, pool, breaker = new_client(server, "park")
+    items = sample_items(30)
+
+    def take_down_and_recover():
+        server.failing = True
+        time.sleep(0.5)
+        server.failing = False
+
+    handled = []
+
+    def llm_client(messages, max_tokens, stream_parser):
+        # 处理到第10条时服务宕机，0.5秒后恢复
+        if len(handled) == 10:
+            threading.Thread(target=take_down_and_recover).start()
+            time.sleep(0.05)
+        handled.append(1)
+        return client.chat(messages, max_tokens=max_tokens)  # 替身服务不支持流式
+
+    service = new_level_service(llm_client=llm_client)
+    with redirect_stdout(io.StringIO()):
+        results = service.process_batch(items)
+    check("共享客户端：服务恢复后挂起的条目继续，结果完整",
+          len(results) == 30 and all(result["level"] is not None for result in results)
+          and breaker.get_stats()["opened"] >= 1,
+          (breaker.get_stats(), [result["reasoning"] for result in results if result["level"] is None]))
+    client.close()
+    server.shutdown()
+
+
+def main():
+    run_state_machine()
+    run_async_client()
+    run_level_run_abort()
+    run_level_park_and_resume()
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+vLLM多副本负载均衡测试（不需要GPU）
+在本机启动几个替身HTTP服务（/health、/v1/models、/v1/chat/completions，可设置延迟、可切换为故障），验证：
+1. 在途请求最少优先：慢副本在途请求多，分到的请求明显少于快副本
+2. 连续失败的副本被摘除，之后的请求全部落到其它副本，调用方不再失败
+3. 健康检查发现副本恢复后重新加入并分到请求；服务停掉时健康检查将其摘除
+4. 所有副本都被摘除时仍返回地址（由调用方重试/熔断处理），之后请求成功时重新加入；只有一个副本时不摘除
+5. AsyncVLLMClient 通过地址池在副本间分配请求，故障副本上的请求换副本重试
+
+用法：
+    python test_vllm_endpoint_pool.py
+"""
+
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+from vllm_endpoint_pool import EndpointPool
+from script_checks import check, finish
+
+
+class StandInServer:
+    """替身vLLM服务：latency 为每次chat请求的耗时，failing=True 时所有请求返回503"""
+
+    def __init__(self, latency=0.01):
+        self.latency = latency
+        self.failing = False
+        self.handled = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if server.failing:
+                    self._reply(503, {"error": "unavailable"})
+                elif self.path == "/health":
+                    self._reply(200, {})
+                elif self.path == "/v1/models":
+                    self._reply(200, {"data": [{"id": "llama3.1_8b"}]})
+                else:
+                    self._reply(404, {})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if server.failing:
+                    self._reply(503, {"error": "unavailable"})
+                    return
+                time.sleep(server.latency)
+                server.handled += 1
+                self._reply(200, {"choices": [{"message": {"content": f"所以判断为{{层级1}}。[{server.port}]"}}]})
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def call(pool, exclude=()):
+    """同步调用方的写法：acquire → 请求 → release(是否为副本故障)"""
+    endpoint = pool.acquire(exclude=exclude)
+    endpoint_ok = False
+    try:
+        response = requests.post(f"{endpoint}/v1/chat/completions", json={"messages": []}, timeout=5)
+        endpoint_ok = response.status_code < 500
+        return endpoint, response.status_code == 200
+    except Exception:
+        return endpoint, False
+    finally:
+        pool.release(endpoint, endpoint_ok)
+
+
+def call_with_retry(pool, max_retries=3):
+    failed = set()
+    for _ in range(max_retries):
+        endpoint, ok = call(pool, exclude=failed)
+        if ok:
+            return True
+        failed.add(endpoint)
+    return False
+
+
+def run_least_outstanding():
+    fast = [StandInServer(latency=0.01), StandInServer(latency=0.01)]
+    slow = StandInServer(latency=0.2)
+    servers = fast + [slow]
+    pool = EndpointPool([server.url for server in servers], name="test")
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        results = list(executor.map(lambda _: call(pool)[1], range(300)))
+    counts = [server.handled for server in servers]
+    check("全部请求成功", all(results), results.count(False))
+    check("慢副本分到的请求明显更少", slow.handled * 3 < min(server.handled for server in fast), counts)
+    check("结束后没有在途请求", all(stat["outstanding"] == 0 for stat in pool.get_stats()), pool.get_stats())
+    pool.close()
+    for server in servers:
+        server.shutdown()
+
+
+def run_eject_and_recover():
+    servers = [StandInServer(), StandInServer(), StandInServer()]
+    pool = EndpointPool([server.url for server in servers], config={"max_failures": 2}, name="test")
+    bad = servers[0]
+    bad.failing = True
+
+    results = [call_with_retry(pool) for _ in range(60)]
+    stats = {stat["url"]: stat for stat in pool.get_stats()}
+    check("故障副本上的请求换副本后成功", all(results), results.count(False))
+    check("连续失败的副本被摘除", not stats[bad.url]["healthy"] and stats[bad.url]["failures"] == 2, stats[bad.url])
+
+    bad.failing = False
+    check("健康检查前恢复的副本不分请求", call(pool)[0] != bad.url)
+    pool.check_health()
+    handled_before = bad.handled
+    for _ in range(30):
+        call(pool)
+    check("健康检查后恢复的副本重新分到请求", bad.handled - handled_before >= 5, bad.handled - handled_before)
+
+    servers[1].shutdown()
+    health = pool.check_health()
+    check("服务停掉时健康检查将其摘除", health[servers[1].url] is False
+          and not {stat["url"]: stat for stat in pool.get_stats()}[servers[1].url]["healthy"], health)
+
+    for server in servers:
+        server.failing = True
+    pool.check_health()
+    endpoint = pool.acquire()
+    check("所有副本都被摘除时仍返回地址", endpoint in pool.urls, endpoint)
+    pool.release(endpoint)
+    check("已摘除的副本请求成功时重新加入", {stat["url"]: stat for stat in pool.get_stats()}[endpoint]["healthy"])
+    pool.close()
+    for server in (servers[0], servers[2]):
+        server.shutdown()
+
+
+def run_single_endpoint():
+    server = StandInServer()
+    pool = EndpointPool([server.url], config={"max_failures": 2}, name="test")
+    server.failing = True
+    for _ in range(5):
+        call(pool)
+    check("只有一个副本时连续失败不摘除", pool.has_healthy() and pool.get_stats()[0]["failures"] == 5,
+          pool.get_stats())
+    server.failing = False
+    check("故障恢复后请求成功", call(pool)[1])
+    pool.close()
+    server.shutdown()
+
+
+def run_background_health_check():
+    servers = [StandInServer(), StandInServer()]
+    pool = EndpointPool([server.url for server in servers], config={"max_failures": 1, "health_interval": 0.05},
+                        name="test")
+    servers[0].failing = True
+    for _ in range(4):
+        call_with_retry(pool)
+    servers[0].failing = False
+    deadline = time.time() + 2
+    while time.time() < deadline and not pool.get_stats()[0]["healthy"]:
+        time.sleep(0.02)
+    check("后台健康检查自动恢复副本", pool.get_stats()[0]["healthy"], pool.get_stats())
+    pool.close()
+    for server in servers:
+        server.shutdown()
+
+
+def run_async_client():
+    from synapse_flow.web.services.vllm_async_client import AsyncVLLMClient
+
+    servers = [StandInServer(latency=0.02), StandInServer(latency=0.02), StandInServer(latency=0.02)]
+    servers[2].failing = True
+    pool = EndpointPool([server.url for server in servers], config={"max_failures": 2}, name="test")
+    client = AsyncVLLMClient(base_url=None, model_name="llama3.1_8b", max_concurrency=16,
+                             retry_interval=0.01, endpoint_pool=pool)
+    futures = [client.submit([{"role": "user", "content": str(i)}], key=f"doc{i % 4}") for i in range(120)]
+    answers = [future.result() for future in futures]
+    client.close()
+    counts = [server.handled for server in servers]
+    check("异步客户端全部请求成功", all(answers), sum(1 for answer in answers if not answer))
+    check("异步客户端在健康副本间均衡", min(counts[:2]) >= 40 and counts[2] == 0, counts)
+    check("异步客户端摘除故障副本", not pool.get_stats()[2]["healthy"], pool.get_stats()[2])
+    pool.close()
+    for server in servers:
+        server.shutdown()
+
+
+def main():
+    run_least_outstanding()
+    run_eject_and_recover()
+    run_single_endpoint()
+    run_background_health_check()
+    run_async_client()
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+vLLM模型生命周期守护测试
+用 FakeContainerRuntime 代替 docker，验证：
+1. 多个线程同时 ensure_ready 只启动一次，就绪后不再检查或启动
+2. 空闲超过 idle_ttl 的模型被停止，持有租约或常驻的模型不会被停止；停止前在锁内重新确认，
+   收集后被租用的不停止；启动过程中被停止时，随后创建的容器也被停止
+3. 同端口的模型（qa_model 和 default_model 都是 8201）：空闲的被让出，使用中的不让
+4. 启动失败、容器启动后退出、已就绪服务退出时能及时发现，下次使用时重新启动
+5. 状态变化通知订阅者
+6. 多LoRA模式：QA和层级分析共用一个服务，按适配器名路由，运行时注册的适配器在服务重启后重新挂载
+
+用法：
+    python test_vllm_lifecycle.py
+"""
+
+import time
+import threading
+from model_config import MODEL_CONFIGS, MULTI_LORA_CONFIG, get_model_config
+from vllm_lifecycle import (
+    ModelLifecycleDaemon, ContainerRuntime, FakeContainerRuntime, DockerContainerRuntime, STOPPED, STARTING, READY, STOPPING, FAILED
+)
+from script_checks import check, finish
+
+# 测试中缩短各种时间
+TEST_CONFIG = {
+    "idle_ttl": 0.3,
+    "start_timeout": 2,
+    "watch_interval": 0.05,
+    "probe_interval": 0.01,
+    "probe_max_interval": 0.05
+}
+
+
+def new_daemon(ready_delay=0.05, fail_start=(), **config):
+    runtime = FakeContainerRuntime(ready_delay=ready_delay, fail_start=fail_start)
+    return ModelLifecycleDaemon(runtime, MODEL_CONFIGS, {**TEST_CONFIG, **config}), runtime
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def run_single_start():
+    daemon, runtime = new_daemon(idle_ttl=0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(daemon.ensure_ready("level_model", timeout=2)))
+               for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    check("并发 ensure_ready 全部就绪", results == [True] * 16, results)
+    check("并发 ensure_ready 只启动一次", runtime.count("start", "vllm_level") == 1, runtime.calls)
+
+    for _ in range(100):
+        daemon.ensure_ready("level_model")
+    check("就绪后不再启动", runtime.count("start", "vllm_level") == 1, runtime.calls)
+    daemon.close()
+
+
+def run_idle_reap():
+    daemon, runtime = new_daemon()
+    daemon.ensure_ready("level_model", timeout=2)
+    check("空闲超时后停止",
+          wait_until(lambda: daemon.get_status("level_model")["status"] == STOPPED),
+          daemon.get_status("level_model"))
+
+    check("停止后再次使用重新启动", daemon.ensure_ready("level_model", timeout=2)
+          and runtime.count("start", "vllm_level") == 2, runtime.calls)
+    daemon.close()
+
+
+def run_reap_race():
+    # 后台检查间隔设长，只由测试调用 reap_idle
+    daemon, runtime = new_daemon(watch_interval=60)
+    daemon.ensure_ready("level_model", timeout=2)
+    time.sleep(TEST_CONFIG["idle_ttl"] * 1.5)
+    stop_if_idle = daemon._stop_if_idle
+
+    def lease_first(*args):
+        daemon.acquire("level_model")  # 收集空闲模型之后、停止之前被租用
+        return stop_if_idle(*args)
+
+    daemon._stop_if_idle = lease_first
+    check("收集空闲模型后被租用的不停止", daemon.reap_idle() == []
+          and daemon.get_status("level_model")["status"] == READY
+          and runtime.count("stop", "vllm_level") == 0, runtime.calls)
+    daemon._stop_if_idle = stop_if_idle
+    daemon.release("level_model")
+    time.sleep(TEST_CONFIG["idle_ttl"] * 1.5)
+    check("释放租约后空闲停止", daemon.reap_idle() == ["level_model"]
+          and daemon.get_status("level_model")["status"] == STOPPED, daemon.get_status("level_model"))
+    daemon.close()
+
+
+def run_stop_during_start():
+    class BlockingStartRuntime(FakeContainerRuntime):
+        """start 阻塞到 proceed 被设置，模拟 docker run 期间被停止"""
+
+        def __init__(self):
+            super().__init__(ready_delay=0.05)
+            self.entered, self.proceed = threading.Event(), threading.Event()
+
+        def start(self, model_config):
+            self.entered.set()
+            self.proceed.wait(2)
+            super().start(model_config)
+
+    runtime = BlockingStartRuntime()
+    daemon = ModelLifecycleDaemon(runtime, MODEL_CONFIGS, {**TEST_CONFIG, "idle_ttl": 0})
+    daemon.expect_demand("level_model")
+    runtime.entered.wait(2)
+    daemon.stop("level_model")
+    runtime.proceed.set()
+    check("启动过程中被停止：随后创建的容器也被停止",
+          wait_until(lambda: runtime.count("stop", "vllm_level") == 2)
+          and not runtime.is_running(MODEL_CONFIGS["level_model"])
+          and daemon.get_status("level_model")["status"] == STOPPED, (runtime.calls, daemon.get_status("level_model")))
+    daemon.close()
+
+
+def run_lease_and_warm():
+    daemon, runtime = new_daemon()
+    with daemon.lease("level_model") as ready:
+        check("租用时就绪", ready)
+        time.sleep(TEST_CONFIG["idle_ttl"] * 2)
+        check("持有租约时不会被空闲停止", daemon.get_status("level_model")["status"] == READY,
+              daemon.get_status("level_model"))
+    check("释放租约后空闲停止",
+          wait_until(lambda: daemon.get_status("level_model")["status"] == STOPPED),
+          daemon.get_status("level_model"))
+
+    daemon.keep_warm("qa_model")
+    check("常驻模型立即启动", daemon.wait_ready("qa_model", timeout=2))
+    time.sleep(TEST_CONFIG["idle_ttl"] * 2)
+    check("常驻模型不会被空闲停止", daemon.get_status("qa_model")["status"] == READY,
+          daemon.get_status("qa_model"))
+    daemon.close()
+
+
+def run_port_conflict():
+    daemon, runtime = new_daemon(idle_ttl=0)
+    daemon.ensure_ready("qa_model", timeout=2)
+    check("空闲的同端口模型被让出", daemon.ensure_ready("default_model", timeout=2)
+          and daemon.get_status("qa_model")["status"] == STOPPED
+          and runtime.count("stop", "vllm_qa") == 1, daemon.get_status())
+
+    with daemon.lease("default_model"):
+        status = daemon.expect_demand("qa_model")
+        check("使用中的同端口模型不让出", status == FAILED
+              and daemon.get_status("default_model")["status"] == READY, daemon.get_status())
+    daemon.close()
+
+
+def run_failures():
+    daemon, runtime = new_daemon(fail_start=("vllm_level",))
+    check("启动失败返回False", not daemon.ensure_ready("level_model", timeout=2))
+    check("启动失败记录错误", daemon.get_status("level_model")["status"] == FAILED
+          and "失败" in (daemon.get_status("level_model")["error"] or ""), daemon.get_status("level_model"))
+    daemon.close()
+
+    # 容器启动后退出：探测时立即发现，不用等到 start_timeout
+    daemon, runtime = new_daemon(ready_delay=10, idle_ttl=0, start_timeout=30)
+    daemon.expect_demand("level_model")
+    wait_until(lambda: runtime.count("start", "vllm_level") == 1)
+    started_at = time.time()
+    runtime.crash("vllm_level")
+    ready = daemon.wait_ready("level_model", timeout=5)
+    check("容器启动后退出时立即失败", not ready and time.time() - started_at < 1,
+          f"{time.time() - started_at:.2f}秒")
+    daemon.close()
+
+    # 已就绪的服务退出：后台检查标记为失败，下次使用时重新启动
+    daemon, runtime = new_daemon(idle_ttl=0)
+    daemon.ensure_ready("level_model", timeout=2)
+    runtime.crash("vllm_level")
+    check("已就绪服务退出被发现",
+          wait_until(lambda: daemon.get_status("level_model")["status"] == FAILED),
+          daemon.get_status("level_model"))
+    check("失败后再次使用重新启动", daemon.ensure_ready("level_model", timeout=2)
+          and runtime.count("start", "vllm_level") == 2, runtime.calls)
+    daemon.close()
+
+
+def run_subscribe():
+    daemon, runtime = new_daemon(idle_ttl=0)
+    events = []
+    daemon.subscribe(lambda model_name, status, info: events.append((model_name, status)))
+    daemon.ensure_ready("level_model", timeout=2)
+    daemon.stop("level_model")
+    expected = [("level_model", STARTING), ("level_model", READY), ("level_model", STOPPING), ("level_model", STOPPED)]
+    check("订阅者收到状态变化", events == expected, events)
+    daemon.close()
+
+
+def run_multi_lora():
+    MULTI_LORA_CONFIG["enabled"] = True
+    try:
+        runtime = FakeContainerRuntime(ready_delay=0.05)
+        daemon = ModelLifecycleDaemon(runtime, config={**TEST_CONFIG, "idle_ttl": 0})
+        check("多LoRA模式只有一个共享服务", "multi_lora" in daemon.model_configs
+              and "qa_model" not in daemon.model_configs and "level_model" not in daemon.model_configs,
+              list(daemon.model_configs))
+
+        qa_config, level_config = get_model_config("qa_model"), get_model_config("level_model")
+        check("按适配器名路由", qa_config["port"] == level_config["port"] == MULTI_LORA_CONFIG["port"]
+              and (qa_config["lora_module_name"], level_config["lora_module_name"]) == ("qa", "level"),
+              (qa_config, level_config))
+
+        check("QA和层级分析共用一次启动", daemon.ensure_ready("qa_model", timeout=2)
+              and daemon.ensure_ready("level_model", timeout=2)
+              and runtime.count("start", "vllm_multi_lora") == 1
+              and not runtime.count("start", "vllm_qa") and not runtime.count("start", "vllm_level"), runtime.calls)
+        check("启动时挂载两个适配器",
+              set(runtime.containers["vllm_multi_lora"]["adapters"]) == {"qa", "level"},
+              runtime.containers["vllm_multi_lora"])
+
+        check("就绪时注册的适配器立即挂载",
+              daemon.register_adapter("lora_20250701", "/home/liuxinwei/checkpoint_data/20250701/checkpoint-300")
+              and "lora_20250701" in runtime.containers["vllm_multi_lora"]["adapters"], runtime.containers)
+        runtime.crash("vllm_multi_lora")
+        wait_until(lambda: daemon.get_status("multi_lora")["status"] == FAILED)
+        check("服务重启后重新挂载运行时注册的适配器", daemon.ensure_ready("level_model", timeout=2)
+              and set(runtime.containers["vllm_multi_lora"]["adapters"]) == {"qa", "level", "lora_20250701"},
+              runtime.containers["vllm_multi_lora"])
+        check("适配器列表", set(daemon.list_adapters()) == {"qa", "level", "lora_20250701"}, daemon.list_adapters())
+        daemon.close()
+
+        command = DockerContainerRuntime().build_run_command(daemon.model_configs["multi_lora"])
+        lora_args = command[command.index("--lora-modules") + 1:command.index("--max-loras")]
+        check("docker命令挂载多个适配器", lora_args == ["qa=/root/lora/qa", "level=/root/lora/level"]
+              and "VLLM_ALLOW_RUNTIME_LORA_UPDATING=True" in command, command)
+    finally:
+        MULTI_LORA_CONFIG["enabled"] = False
+
+
+def run_incomplete_runtime():
+    class NoAdapterRuntime(ContainerRuntime):
+        def start(self, model_config):
+            pass
+
+        def stop(self, model_config, remove=False):
+            pass
+
+        def is_running(self, model_config):
+            return True
+
+        def is_ready(self, model_config):
+            return True
+
+    try:
+        NoAdapterRuntime()
+        check("缺少方法的运行时在创建时报错", False)
+    except TypeError as e:
+        check("缺少方法的运行时在创建时报错", "load_adapter" in str(e), e)
+
+
+def main():
+    run_single_start()
+    run_idle_reap()
+    run_reap_race()
+    run_stop_during_start()
+    run_lease_and_warm()
+    run_port_conflict()
+    run_failures()
+    run_subscribe()
+    run_multi_lora()
+    run_incomplete_runtime()
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+vLLM调用熔断
+vLLM服务中途宕机时，逐条重试（每条几次、每次等几秒）会让一个文档卡上很久，最后每条都得到空回复。
+所有调用方在请求前 acquire、结束后 release：
+- 闭合：正常放行，连续失败 failure_threshold 次后断开
+- 断开：请求不发出，抛出 CircuitOpenError；调用方用 call() 包装时按 open_behavior
+  挂起等待恢复后重新执行（park）或直接抛出（fail_fast）
+- 半开：断开 recovery_timeout 秒后只放行一个探测请求，成功则闭合、唤醒挂起的请求；
+  失败则重新断开，等待时间加倍（不超过 max_recovery_timeout）
+同一个服务（多LoRA模式下QA和层级分析共用的服务）只有一个熔断器。
+RunFailureGuard 在一次运行内统计连续失败的条目，达到 run_abort_failures 时中止整个运行，
+避免服务不可用时把整份文档写成默认结果。
+"""
+import time
+import logging
+import threading
+from typing import Dict, Any, Optional
+
+from model_config import get_serving_name
+
+logger = logging.getLogger(__name__)
+
+# 熔断配置
+CIRCUIT_BREAKER_CONFIG = {
+    "failure_threshold": 3,        # 连续失败多少次后断开，与单条请求的重试次数一致：
+                                   # 一条请求重试用完时熔断已断开，这条请求挂起等待恢复，而不是得到空回复
+    "recovery_timeout": 10,        # 断开后多久放行一个探测请求（秒）
+    "max_recovery_timeout": 120,   # 探测失败后等待时间加倍的上限（秒）
+    "open_behavior": "park",       # 断开期间的请求：park 挂起等待恢复 / fail_fast 立即失败
+    "park_timeout": 600,           # 挂起等待的最长时间（秒），超时按失败处理
+    "retry_backoff": 1,            # 单条请求失败后的重试间隔（秒），每次加倍；服务宕机由熔断处理，不再长时间等待
+    "run_abort_failures": 20       # 一次运行中连续失败的条目数达到该值时中止运行
+}
+
+# 熔断状态
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """熔断器断开，请求没有发出"""
+    pass
+
+
+class RunAbortedError(Exception):
+    """连续失败的条目过多，中止整个运行"""
+    pass
+
+
+class CircuitBreaker:
+    """线程安全的熔断器：acquire(timeout=0) 不会阻塞，可以在事件循环线程中调用"""
+
+    def __init__(self, name: str = "", config: Dict[str, Any] = None):
+        self.name = name
+        self.config = {**CIRCUIT_BREAKER_CONFIG, **(config or {})}
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._recovery_timeout = self.config["recovery_timeout"]
+        self._probe_in_flight = False
+        self._condition = threading.Condition()
+        self.stats = {"requests": 0, "failures": 0, "rejected": 0, "opened": 0, "probes": 0}
+
+    @property
+    def state(self) -> str:
+        with self._condition:
+            return self._state
+
+    @property
+    def park_timeout(self) -> float:
+        """断开时调用方应等待的时间：park 模式为 park_timeout，fail_fast 模式为0"""
+        return self.config["park_timeout"] if self.config["open_behavior"] == "park" else 0
+
+    def acquire(self, timeout: float = 0) -> bool:
+        """
+        请求发出前调用
+
+        Args:
+            timeout: 断开时最多等待多少秒，0 表示立即失败
+
+        Returns:
+            bool: 是否为半开状态下的探测请求，release 时原样传回
+
+        Raises:
+            CircuitOpenError: 等待 timeout 秒后仍不可用
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                if self._state == CLOSED:
+                    self.stats["requests"] += 1
+                    return False
+                probe_wait = self._probe_wait_locked()
+                if probe_wait == 0:
+                    self._state = HALF_OPEN
+                    self._probe_in_flight = True
+                    self.stats["requests"] += 1
+                    self.stats["probes"] += 1
+                    logger.info(f"🔍 {self.name} 熔断半开，放行一个探测请求")
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(f"{self.name} vLLM服务熔断中（连续失败 {self._consecutive_failures} 次）")
+                self._condition.wait(remaining if probe_wait is None else min(probe_wait, remaining))
+
+    def release(self, success: bool, probe: bool = False):
+        """
+        请求结束
+
+        Args:
+            success: 服务是否正常响应（4xx 是请求本身的问题，也算成功）
+            probe: acquire 的返回值
+        """
+        with self._condition:
+            if probe:
+                self._probe_in_flight = False
+            if success:
+                self._consecutive_failures = 0
+                if self._state != CLOSED:
+                    self._state = CLOSED
+                    self._opened_at = None
+                    self._recovery_timeout = self.config["recovery_timeout"]
+                    logger.info(f"✅ {self.name} vLLM服务恢复，熔断闭合")
+                    self._condition.notify_all()
+                return
+
+            self.stats["failures"] += 1
+            self._consecutive_failures += 1
+            if probe:
+                self._recovery_timeout = min(self._recovery_timeout * 2, self.config["max_recovery_timeout"])
+                self._open_locked("探测请求失败")
+            elif self._state == CLOSED and self._consecutive_failures >= self.config["failure_threshold"]:
+                self._open_locked(f"连续失败 {self._consecutive_failures} 次")
+            self._condition.notify_all()
+
+    def call(self, func, *args, **kwargs):
+        """
+        执行 func（内部用 acquire() 快速失败），抛出 CircuitOpenError 时按 open_behavior
+        挂起等待恢复或可以探测后重新执行；fail_fast 模式或挂起超过 park_timeout 时抛出 CircuitOpenError
+        """
+        deadline = time.time() + self.park_timeout
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except CircuitOpenError:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.wait_available(remaining):
+                    raise
+
+    def wait_available(self, timeout: float) -> bool:
+        """
+        挂起等待，直到熔断闭合或可以发出探测请求，不占用探测名额（之后仍需 acquire）
+
+        Returns:
+            bool: timeout 秒内是否变为可用
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                if self._state == CLOSED:
+                    return True
+                probe_wait = self._probe_wait_locked()
+                if probe_wait == 0:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining if probe_wait is None else min(probe_wait, remaining))
+
+    def reset(self):
+        """强制闭合（服务确认重启后调用）"""
+        with self._condition:
+            self._state = CLOSED
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._recovery_timeout = self.config["recovery_timeout"]
+            self._probe_in_flight = False
+            self._condition.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """当前状态、连续失败数和累计计数"""
+        with self._condition:
+            return {
+                **self.stats,
+                "name": self.name,
+                "state": self._state,
+                "consecutive_failures": self._consecutive_failures,
+                "opened_at": self._opened_at,
+                "recovery_timeout": self._recovery_timeout
+            }
+
+    def _open_locked(self, reason: str):
+        if self._state != OPEN:
+            self.stats["opened"] += 1
+        self._state = OPEN
+        self._opened_at = time.time()
+        logger.warning(f"⚠️ {self.name} 熔断断开: {reason}，{self._recovery_timeout}秒后探测")
+
+    def _probe_wait_locked(self) -> Optional[float]:
+        """距离可以发出探测请求还有多少秒，探测请求在途时为None（等待其结果）"""
+        if self._probe_in_flight:
+            return None
+        return max(0.0, self._opened_at + self._recovery_timeout - time.time())
+
+
+class RunFailureGuard:
+    """一次运行（一个文档的层级分析、一次QA处理）内连续失败的条目计数"""
+
+    def __init__(self, name: str = "", limit: int = None):
+        self.name = name
+        self.limit = limit if limit is not None else CIRCUIT_BREAKER_CONFIG["run_abort_failures"]
+        self.consecutive_failures = 0
+        self.total_failures = 0
+
+    def record(self, success: bool, reason: str = ""):
+        """
+        记录一个条目的结果
+
+        Raises:
+            RunAbortedError: 连续失败的条目数达到 limit
+        """
+        if success:
+            self.consecutive_failures = 0
+            return
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        if self.limit and self.consecutive_failures >= self.limit:
+            raise RunAbortedError(f"{self.name} 连续 {self.consecutive_failures} 条调用失败，中止运行"
+                                  + (f": {reason}" if reason else ""))
+
+
+# 每个vLLM服务一个熔断器（首次使用时创建）
+_circuit_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(model_name: str) -> CircuitBreaker:
+    """模型所在服务的熔断器，多LoRA模式下共用服务的模型共用一个熔断器"""
+    serving_name = get_serving_name(model_name)
+    with _breakers_lock:
+        breaker = _circuit_breakers.get(serving_name)
+        if breaker is None:
+            breaker = CircuitBreaker(name=serving_name)
+            _circuit_breakers[serving_name] = breaker
+        return breaker
+
+
+def set_circuit_breaker(model_name: str, breaker: Optional[CircuitBreaker]) -> Optional[CircuitBreaker]:
+    """替换模型的熔断器（测试中使用缩短的配置），传None时恢复默认，返回原来的熔断器"""
+    serving_name = get_serving_name(model_name)
+    with _breakers_lock:
+        previous = _circuit_breakers.pop(serving_name, None)
+        if breaker is not None:
+            _circuit_breakers[serving_name] = breaker
+    return previous
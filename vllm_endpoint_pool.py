@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+vLLM多副本负载均衡
+同一个模型可以部署在多个vLLM服务上（model_config 中的 endpoints），调用方每次请求前 acquire 一个地址、
+结束后 release：
+- 选择在途请求最少的健康地址，相同时轮流，新加入或恢复的副本在途为0，自然会先分到请求
+- 连续失败 max_failures 次的地址被摘除，后台线程定期探测 /health，恢复后重新加入
+- 所有地址都被摘除时仍返回最早被摘除的地址（由调用方的重试/熔断决定是否继续），不直接报错
+只有一个地址时（默认配置）行为与直接请求 http://localhost:{port} 相同。
+"""
+import time
+import logging
+import itertools
+import threading
+from typing import Dict, Any, List, Optional
+
+import requests
+
+from model_config import get_model_endpoints
+
+logger = logging.getLogger(__name__)
+
+# 负载均衡配置
+ENDPOINT_POOL_CONFIG = {
+    "max_failures": 3,          # 连续失败多少次后摘除
+    "health_interval": 5,       # 后台健康检查间隔（秒）
+    "health_timeout": 3         # 单次健康检查超时（秒）
+}
+
+
+class _Endpoint:
+    __slots__ = ("url", "outstanding", "requests", "failures", "consecutive_failures", "healthy", "ejected_at")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.ejected_at = None
+
+
+class EndpointPool:
+    """线程安全的地址池：acquire/release 可以在任意线程（包括事件循环线程）中调用，只持有很短的锁"""
+
+    def __init__(self, endpoints: List[str], config: Dict[str, Any] = None, name: str = ""):
+        if not endpoints:
+            raise ValueError("地址池至少需要一个地址")
+        self.name = name
+        self.config = {**ENDPOINT_POOL_CONFIG, **(config or {})}
+        self._endpoints = [_Endpoint(url.rstrip("/")) for url in endpoints]
+        self._by_url = {endpoint.url: endpoint for endpoint in self._endpoints}
+        self._rotation = itertools.count()
+        self._lock = threading.Lock()
+        self._checker = None
+        self._closed = threading.Event()
+
+    @property
+    def urls(self) -> List[str]:
+        return [endpoint.url for endpoint in self._endpoints]
+
+    def acquire(self, exclude=()) -> str:
+        """
+        选择一个地址并计入在途请求
+
+        Args:
+            exclude: 本次请求已经失败过的地址，有其它可选时避开
+
+        Returns:
+            str: 地址，如 http://localhost:8201
+        """
+        self._ensure_checker()
+        with self._lock:
+            candidates = [e for e in self._endpoints if e.healthy and e.url not in exclude] \
+                or [e for e in self._endpoints if e.healthy] \
+                or [min(self._endpoints, key=lambda e: e.ejected_at)]
+            least = min(e.outstanding for e in candidates)
+            candidates = [e for e in candidates if e.outstanding == least]
+            endpoint = candidates[next(self._rotation) % len(candidates)]
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint.url
+
+    def release(self, url: str, success: bool = True) -> bool:
+        """
+        请求结束，success=False 表示地址本身的问题（连接失败、超时、5xx），连续失败达到阈值时摘除；
+        只有一个地址时不摘除（没有后台健康检查把它重新加入），已摘除的地址请求成功时重新加入
+
+        Returns:
+            bool: 服务整体是否可用（本次成功，或还有其它健康地址）；单个副本故障由摘除处理，不计入熔断
+        """
+        with self._lock:
+            endpoint = self._by_url[url]
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            if success:
+                endpoint.consecutive_failures = 0
+                if not endpoint.healthy:
+                    self._readmit_locked(endpoint, "请求成功")
+                return True
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.healthy and len(self._endpoints) > 1 \
+                    and endpoint.consecutive_failures >= self.config["max_failures"]:
+                self._eject_locked(endpoint, f"连续失败 {endpoint.consecutive_failures} 次")
+            return any(e.healthy and e is not endpoint for e in self._endpoints)
+
+    def has_healthy(self, exclude=()) -> bool:
+        """除 exclude 外是否还有健康地址"""
+        with self._lock:
+            return any(e.healthy and e.url not in exclude for e in self._endpoints)
+
+    def check_health(self) -> Dict[str, bool]:
+        """探测所有地址的 /health：失败的摘除，已摘除但恢复的重新加入，返回 地址 -> 是否健康"""
+        results = {url: self._probe(url) for url in self.urls}
+        with self._lock:
+            for endpoint in self._endpoints:
+                if results[endpoint.url] and not endpoint.healthy:
+                    self._readmit_locked(endpoint, "健康检查通过")
+                elif not results[endpoint.url] and endpoint.healthy:
+                    self._eject_locked(endpoint, "健康检查失败")
+        return results
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """各地址的在途请求数、累计请求数、失败数和健康状态"""
+        with self._lock:
+            return [{
+                "url": endpoint.url,
+                "healthy": endpoint.healthy,
+                "outstanding": endpoint.outstanding,
+                "requests": endpoint.requests,
+                "failures": endpoint.failures,
+                "ejected_at": endpoint.ejected_at
+            } for endpoint in self._endpoints]
+
+    def close(self):
+        """停止后台健康检查"""
+        self._closed.set()
+
+    def _eject_locked(self, endpoint: _Endpoint, reason: str):
+        endpoint.healthy = False
+        endpoint.ejected_at = time.time()
+        logger.warning(f"⚠️ {self.name} 地址 {endpoint.url} 被摘除: {reason}")
+
+    def _readmit_locked(self, endpoint: _Endpoint, reason: str):
+        endpoint.healthy = True
+        endpoint.ejected_at = None
+        endpoint.consecutive_failures = 0
+        logger.info(f"✅ {self.name} 地址 {endpoint.url} 恢复（{reason}），重新加入")
+
+    def _probe(self, url: str) -> bool:
+        try:
+            return requests.get(f"{url}/health", timeout=self.config["health_timeout"]).status_code == 200
+        except Exception:
+            return False
+
+    def _ensure_checker(self):
+        # 只有一个地址时摘除没有意义（始终返回它），不需要后台检查
+        if self._checker is not None or len(self._endpoints) < 2 or self._closed.is_set():
+            return
+        with self._lock:
+            if self._checker is None:
+                self._checker = threading.Thread(target=self._check_loop, name=f"endpoint_health_{self.name}",
+                                                 daemon=True)
+                self._checker.start()
+
+    def _check_loop(self):
+        while not self._closed.wait(self.config["health_interval"]):
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.error(f"{self.name} 健康检查出错: {str(e)}")
+
+
+# 每个模型一个地址池（首次使用时按 model_config 创建）
+_endpoint_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_endpoint_pool(model_name: str) -> EndpointPool:
+    """模型的地址池"""
+    with _pools_lock:
+        pool = _endpoint_pools.get(model_name)
+        if pool is None:
+            pool = EndpointPool(get_model_endpoints(model_name), name=model_name)
+            _endpoint_pools[model_name] = pool
+        return pool
+
+
+def set_endpoint_pool(model_name: str, pool: Optional[EndpointPool]) -> Optional[EndpointPool]:
+    """替换模型的地址池（测试中指向本地替身服务），传None时恢复按配置创建，返回原来的地址池"""
+    with _pools_lock:
+        previous = _endpoint_pools.pop(model_name, None)
+        if pool is not None:
+            _endpoint_pools[model_name] = pool
+    return previous
@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+vLLM模型生命周期管理
+统一管理 model_config.MODEL_CONFIGS 中所有模型服务的启动、就绪和停止：
+- ensure_ready / lease：需要时启动，已就绪时直接返回（不再每次请求都检查或 docker 启动）
+- expect_demand：任务入队时预先启动，任务开始执行时服务通常已就绪
+- keep_warm：常驻模型，不会因空闲被停止
+- 空闲超过 idle_ttl 且没有租约的模型自动停止，释放GPU
+- 就绪通过条件变量通知等待者，启动过程只有后台线程在探测（退避间隔），不再各处 time.sleep 轮询
+- 多LoRA模式（model_config.MULTI_LORA_CONFIG）下，共享同一基础模型的模型映射到同一个服务，
+  register_adapter 可在运行时挂载新训练的适配器，服务重启后自动重新挂载
+容器运行时可替换：DockerContainerRuntime 用于实际部署，FakeContainerRuntime 用于测试。
+"""
+import os
+import time
+import logging
+import threading
+import subprocess
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Callable
+
+import requests
+
+from model_config import MODEL_CONFIGS, MULTI_LORA_CONFIG, VLLM_SERVER_ARGS, get_serving_configs, get_serving_name
+
+logger = logging.getLogger(__name__)
+
+# 生命周期配置
+VLLM_LIFECYCLE_CONFIG = {
+    "idle_ttl": 1800,            # 没有租约且空闲超过该时间（秒）的模型自动停止，0表示不自动停止
+    "start_timeout": 600,        # 从启动到就绪的最长时间（秒）
+    "watch_interval": 30,        # 后台检查空闲模型、已就绪服务是否存活的间隔（秒）
+    "probe_interval": 1,         # 启动中的就绪探测初始间隔（秒），之后逐次加倍
+    "probe_max_interval": 10,    # 就绪探测的最大间隔（秒）
+    "warm_models": []            # 常驻模型，首次使用后不会因空闲停止
+}
+
+STOPPED = "stopped"
+STARTING = "starting"
+READY = "ready"
+STOPPING = "stopping"
+FAILED = "failed"
+ACTIVE_STATUSES = (STARTING, READY)
+
+
+class ContainerRuntime(ABC):
+    """容器运行时接口（缺少方法的实现在创建时即报错，而不是在守护线程中第一次调用时）"""
+
+    @abstractmethod
+    def start(self, model_config: Dict[str, Any]):
+        """启动模型容器（已存在的容器直接启动，否则创建），失败时抛出RuntimeError"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stop(self, model_config: Dict[str, Any], remove: bool = False):
+        """停止模型容器，remove=True 时同时删除容器"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_running(self, model_config: Dict[str, Any]) -> bool:
+        """容器进程是否在运行"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_ready(self, model_config: Dict[str, Any]) -> bool:
+        """服务是否可以接收请求"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_adapter(self, model_config: Dict[str, Any], adapter_name: str, lora_path: str):
+        """在运行中的服务上挂载（或替换）LoRA适配器，失败时抛出RuntimeError"""
+        raise NotImplementedError
+
+
+class DockerContainerRuntime(ContainerRuntime):
+    """通过 docker 命令管理 vllm/vllm-openai 容器"""
+
+    image = "vllm/vllm-openai:latest"
+    adapter_mount = "/root/adapters"
+
+    def build_run_command(self, model_config: Dict[str, Any]) -> List[str]:
+        """构建docker启动命令"""
+        # 基础模型所在目录挂载到容器的 /root/model，每个LoRA适配器挂载到 /root/lora/<适配器名>
+        model_dir, model_name = os.path.split(model_config["base_model_path"])
+        lora_modules = model_config.get("lora_modules") or {model_config["lora_module_name"]: model_config["lora_path"]}
+        mounts, lora_args = [], []
+        for adapter_name, lora_path in lora_modules.items():
+            mounts += ["-v", f"{lora_path}:/root/lora/{adapter_name}"]
+            lora_args.append(f"{adapter_name}=/root/lora/{adapter_name}")
+        options = []
+        if model_config.get("adapter_dir"):
+            # 训练输出目录挂载进容器，并允许运行时通过 /v1/load_lora_adapter 挂载新适配器
+            mounts += ["-v", f"{model_config['adapter_dir']}:{self.adapter_mount}",
+                       "-e", "VLLM_ALLOW_RUNTIME_LORA_UPDATING=True"]
+        for key in ("max_loras", "max_lora_rank"):
+            if model_config.get(key):
+                options += [f"--{key.replace('_', '-')}", str(model_config[key])]
+        return [
+            "docker", "run",
+            "--gpus", "all",
+            "-v", "/data/.cache/vllm:/root/.cache/vllm",
+            "-v", "/data/.cache/huggingface:/root/.cache/huggingface",
+            "-v", f"{model_dir}:/root/model",
+            *mounts,
+            "-p", f"{model_config['port']}:8000",
+            "--ipc=host",
+            "-d",
+            "--name", model_config["container_name"],
+            self.image,
+            "--enable-lora",
+            "--lora-modules", *lora_args,
+            *options,
+            "--model", f"/root/model/{model_name}",
+            "--tensor-parallel-size", str(model_config.get("tensor_parallel_size", 4)),
+            *VLLM_SERVER_ARGS
+        ]
+
+    def _container_ids(self, container_name: str, include_stopped: bool) -> str:
+        cmd = ["docker", "ps", "-q", "-f", f"name=^{container_name}$"]
+        if include_stopped:
+            cmd.insert(2, "-a")
+        return subprocess.run(cmd, capture_output=True, text=True).stdout.strip()
+
+    def start(self, model_config: Dict[str, Any]):
+        container_name = model_config["container_name"]
+        if self._container_ids(container_name, include_stopped=True):
+            # 容器已存在（之前空闲停止的），直接启动，省去重新创建
+            cmd = ["docker", "start", container_name]
+        else:
+            cmd = self.build_run_command(model_config)
+        logger.info(f"执行命令: {' '.join(cmd)}")
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+        if result.returncode != 0:
+            raise RuntimeError(f"启动容器 {container_name} 失败: {result.stderr.strip()}")
+
+    def stop(self, model_config: Dict[str, Any], remove: bool = False):
+        container_name = model_config["container_name"]
+        subprocess.run(["docker", "stop", container_name], capture_output=True, text=True)
+        if remove:
+            subprocess.run(["docker", "rm", container_name], capture_output=True, text=True)
+
+    def is_running(self, model_config: Dict[str, Any]) -> bool:
+        try:
+            return bool(self._container_ids(model_config["container_name"], include_stopped=False))
+        except Exception:
+            return False
+
+    def is_ready(self, model_config: Dict[str, Any]) -> bool:
+        try:
+            response = requests.get(f"http://localhost:{model_config['port']}/health", timeout=3)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    def load_adapter(self, model_config: Dict[str, Any], adapter_name: str, lora_path: str):
+        adapter_dir = model_config.get("adapter_dir")
+        if not adapter_dir:
+            raise RuntimeError(f"服务 {model_config['name']} 未配置 adapter_dir，不能运行时挂载适配器")
+        relative_path = os.path.relpath(lora_path, adapter_dir)
+        if relative_path.startswith(".."):
+            raise RuntimeError(f"适配器 {lora_path} 不在 {adapter_dir} 下，容器中不可见")
+        base_url = f"http://localhost:{model_config['port']}"
+        # 同名适配器已挂载时先卸载（未挂载时返回错误，忽略）
+        requests.post(f"{base_url}/v1/unload_lora_adapter", json={"lora_name": adapter_name}, timeout=30)
+        response = requests.post(f"{base_url}/v1/load_lora_adapter", timeout=120, json={
+            "lora_name": adapter_name,
+            "lora_path": f"{self.adapter_mount}/{relative_path}"
+        })
+        if response.status_code != 200:
+            raise RuntimeError(f"挂载适配器 {adapter_name} 失败: {response.text[:200]}")
+
+
+class FakeContainerRuntime(ContainerRuntime):
+    """
+    测试用的内存运行时：start 之后经过 ready_delay 秒服务就绪
+    fail_start 中的容器启动失败，crash() 模拟容器退出
+    """
+
+    def __init__(self, ready_delay: float = 0.0, fail_start=()):
+        self.ready_delay = ready_delay
+        self.fail_start = set(fail_start)
+        self.containers = {}  # container_name -> {"running": bool, "ready_at": float, "adapters": {名称: 路径}}
+        self.calls = []       # (操作, container_name)
+        self._lock = threading.Lock()
+
+    def start(self, model_config: Dict[str, Any]):
+        container_name = model_config["container_name"]
+        with self._lock:
+            self.calls.append(("start", container_name))
+            if container_name in self.fail_start:
+                raise RuntimeError(f"启动容器 {container_name} 失败")
+            self.containers[container_name] = {"running": True, "ready_at": time.time() + self.ready_delay,
+                                               "adapters": dict(model_config.get("lora_modules") or {})}
+
+    def stop(self, model_config: Dict[str, Any], remove: bool = False):
+        container_name = model_config["container_name"]
+        with self._lock:
+            self.calls.append(("stop", container_name))
+            if remove:
+                self.containers.pop(container_name, None)
+            elif container_name in self.containers:
+                self.containers[container_name]["running"] = False
+
+    def crash(self, container_name: str):
+        with self._lock:
+            if container_name in self.containers:
+                self.containers[container_name]["running"] = False
+
+    def is_running(self, model_config: Dict[str, Any]) -> bool:
+        container = self.containers.get(model_config["container_name"])
+        return bool(container and container["running"])
+
+    def is_ready(self, model_config: Dict[str, Any]) -> bool:
+        container = self.containers.get(model_config["container_name"])
+        return bool(container and container["running"] and time.time() >= container["ready_at"])
+
+    def load_adapter(self, model_config: Dict[str, Any], adapter_name: str, lora_path: str):
+        container_name = model_config["container_name"]
+        with self._lock:
+            self.calls.append(("load_adapter", container_name))
+            if not self.is_ready(model_config):
+                raise RuntimeError(f"容器 {container_name} 未就绪")
+            self.containers[container_name]["adapters"][adapter_name] = lora_path
+
+    def count(self, action: str, container_name: str) -> int:
+        return sum(1 for call in self.calls if call == (action, container_name))
+
+
+class _ModelState:
+    __slots__ = ("name", "status", "leases", "warm", "last_used", "started_at", "ready_at", "error", "generation")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.status = STOPPED
+        self.leases = 0
+        self.warm = False
+        self.last_used = 0.0
+        self.started_at = None
+        self.ready_at = None
+        self.error = None
+        self.generation = 0   # 每次启动/停止自增，旧的启动线程据此放弃
+
+
+class ModelLifecycleDaemon:
+    """模型生命周期守护：所有状态变化在 _condition 下进行并通知等待者和订阅者"""
+
+    def __init__(self, runtime: ContainerRuntime = None, model_configs: Dict[str, Dict[str, Any]] = None,
+                 config: Dict[str, Any] = None, aliases: Dict[str, str] = None):
+        """
+        Args:
+            runtime: 容器运行时，默认 DockerContainerRuntime
+            model_configs: 服务名 -> 服务配置，默认按 model_config 中是否开启多LoRA生成
+            config: 覆盖 VLLM_LIFECYCLE_CONFIG 中的配置
+            aliases: 模型名 -> 服务名，多LoRA模式下共享服务中的模型都映射到共享服务
+        """
+        self.runtime = runtime or DockerContainerRuntime()
+        if model_configs is None:
+            model_configs = get_serving_configs()
+            if aliases is None:
+                aliases = {name: get_serving_name(name) for name in MODEL_CONFIGS if get_serving_name(name) != name}
+        self.model_configs = model_configs
+        self.aliases = aliases or {}
+        self.config = {**VLLM_LIFECYCLE_CONFIG, **(config or {})}
+        self._states = {name: _ModelState(name) for name in self.model_configs}
+        self._adapters = {name: {} for name in self.model_configs}  # 服务名 -> 运行时注册的适配器 {名称: 路径}
+        for name in self.config["warm_models"]:
+            if name in self._states:
+                self._states[name].warm = True
+        self._condition = threading.Condition()
+        self._subscribers = []
+        self._watcher = None
+        self._closed = False
+
+    # ---- 对外接口 ----
+
+    def ensure_ready(self, model_name: str, timeout: Optional[float] = None) -> bool:
+        """需要时启动模型并等待就绪；已就绪时立即返回"""
+        self.expect_demand(model_name)
+        return self.wait_ready(model_name, timeout)
+
+    def expect_demand(self, model_name: str) -> str:
+        """
+        预计很快会用到该模型（如任务入队时）：未启动则在后台启动，不等待
+        同时刷新最近使用时间，避免在任务开始前被空闲停止
+
+        Returns:
+            str: 当前状态
+        """
+        state = self._get_state(model_name)
+        model_name = state.name
+        with self._condition:
+            self._ensure_watcher()
+            state.last_used = time.time()
+            if state.status in ACTIVE_STATUSES:
+                return state.status
+            conflicts = self._port_conflicts_locked(model_name)
+            busy = [other.name for other in conflicts if other.leases or other.warm]
+            if busy:
+                self._set_status_locked(state, FAILED,
+                                        error=f"端口 {self.model_configs[model_name]['port']} 被模型 {busy} 占用")
+                return state.status
+            state.generation += 1
+            state.started_at = time.time()
+            state.ready_at = None
+            self._set_status_locked(state, STARTING, error=None)
+            generation = state.generation
+            for other in conflicts:
+                other.generation += 1
+                self._set_status_locked(other, STOPPING)
+
+        threading.Thread(target=self._start_worker, args=(model_name, generation, conflicts),
+                         name=f"vllm_start_{model_name}", daemon=True).start()
+        return STARTING
+
+    def wait_ready(self, model_name: str, timeout: Optional[float] = None) -> bool:
+        """等待模型就绪；启动失败、被停止或超时返回False"""
+        state = self._get_state(model_name)
+        with self._condition:
+            self._condition.wait_for(lambda: state.status != STARTING, timeout)
+            if state.status == READY:
+                state.last_used = time.time()
+                return True
+            return False
+
+    @contextmanager
+    def lease(self, model_name: str, timeout: Optional[float] = None):
+        """
+        租用模型：持有期间不会被空闲停止，yield 是否已就绪
+            with daemon.lease("level_model") as ready:
+                ...
+        """
+        self.acquire(model_name)
+        try:
+            yield self.ensure_ready(model_name, timeout)
+        finally:
+            self.release(model_name)
+
+    def acquire(self, model_name: str):
+        state = self._get_state(model_name)
+        with self._condition:
+            state.leases += 1
+            state.last_used = time.time()
+
+    def release(self, model_name: str):
+        state = self._get_state(model_name)
+        with self._condition:
+            state.leases = max(0, state.leases - 1)
+            state.last_used = time.time()
+
+    def touch(self, model_name: str):
+        """记录一次使用（刷新空闲计时）"""
+        state = self._get_state(model_name)
+        with self._condition:
+            state.last_used = time.time()
+
+    def keep_warm(self, model_name: str, warm: bool = True):
+        """设置常驻；设为常驻时立即在后台启动"""
+        state = self._get_state(model_name)
+        with self._condition:
+            state.warm = warm
+        if warm:
+            self.expect_demand(model_name)
+
+    def stop(self, model_name: str, remove: bool = False) -> bool:
+        """停止模型（不考虑租约），返回是否执行了停止"""
+        state = self._get_state(model_name)
+        with self._condition:
+            generation = self._begin_stop_locked(state)
+        self._finish_stop(state, generation, remove)
+        return True
+
+    def restart(self, model_name: str, timeout: Optional[float] = None) -> bool:
+        """删除容器后重新创建并等待就绪"""
+        self.stop(model_name, remove=True)
+        return self.ensure_ready(model_name, timeout)
+
+    def reap_idle(self) -> List[str]:
+        """停止所有没有租约、非常驻且空闲超过 idle_ttl 的模型，返回停止的模型"""
+        idle_ttl = self.config["idle_ttl"]
+        if not idle_ttl:
+            return []
+        with self._condition:
+            idle = [(state.name, state.generation) for state in self._states.values()
+                    if self._is_idle_locked(state, idle_ttl)]
+        return [model_name for model_name, generation in idle if self._stop_if_idle(model_name, generation, idle_ttl)]
+
+    def check_ready_services(self) -> List[str]:
+        """检查已就绪的服务是否仍然存活，已退出的标记为失败（下次使用时重新启动），返回失败的模型"""
+        with self._condition:
+            ready = [(state.name, state.generation) for state in self._states.values() if state.status == READY]
+        lost = []
+        for model_name, generation in ready:
+            if self.runtime.is_ready(self.model_configs[model_name]):
+                continue
+            with self._condition:
+                state = self._states[model_name]
+                if state.generation == generation and state.status == READY:
+                    self._set_status_locked(state, FAILED, error="服务已退出或不再响应")
+                    lost.append(model_name)
+        return lost
+
+    def register_adapter(self, adapter_name: str, lora_path: str, server_name: str = None) -> bool:
+        """
+        注册LoRA适配器（如新训练完成的），服务已就绪时立即挂载，否则在下次启动就绪后挂载
+
+        Args:
+            adapter_name: 适配器名，请求中的 model 字段
+            lora_path: 适配器目录（需在服务配置的 adapter_dir 下）
+            server_name: 服务名，默认多LoRA共享服务
+
+        Returns:
+            bool: 是否已在运行中的服务上挂载
+        """
+        state = self._get_state(server_name or MULTI_LORA_CONFIG["name"])
+        with self._condition:
+            self._adapters[state.name][adapter_name] = lora_path
+            ready = state.status == READY
+        if not ready:
+            logger.info(f"适配器 {adapter_name} 已注册，服务 {state.name} 就绪后挂载")
+            return False
+        self.runtime.load_adapter(self.model_configs[state.name], adapter_name, lora_path)
+        logger.info(f"✅ 适配器 {adapter_name} 已挂载到服务 {state.name}: {lora_path}")
+        return True
+
+    def list_adapters(self, server_name: str = None) -> Dict[str, str]:
+        """服务上的适配器（启动时配置的和运行时注册的）：名称 -> 路径"""
+        state = self._get_state(server_name or MULTI_LORA_CONFIG["name"])
+        model_config = self.model_configs[state.name]
+        adapters = dict(model_config.get("lora_modules") or {model_config["lora_module_name"]: model_config["lora_path"]})
+        with self._condition:
+            adapters.update(self._adapters[state.name])
+        return adapters
+
+    def subscribe(self, callback: Callable[[str, str, Dict[str, Any]], None]):
+        """订阅状态变化：callback(model_name, status, 状态信息)，在状态变化的线程中调用，不能阻塞"""
+        with self._condition:
+            self._subscribers.append(callback)
+
+    def get_status(self, model_name: str = None) -> Dict[str, Any]:
+        """单个模型或全部模型的状态"""
+        with self._condition:
+            if model_name is not None:
+                return self._view_locked(self._get_state(model_name))
+            return {name: self._view_locked(state) for name, state in self._states.items()}
+
+    def close(self):
+        """停止后台检查线程（不停止模型）"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    # ---- 内部实现 ----
+
+    def _get_state(self, model_name: str) -> _ModelState:
+        state = self._states.get(self.aliases.get(model_name, model_name))
+        if state is None:
+            raise KeyError(f"模型配置不存在: {model_name}")
+        return state
+
+    def _port_conflicts_locked(self, model_name: str) -> List[_ModelState]:
+        """与该模型端口相同、正在启动或运行的其它模型"""
+        port = self.model_configs[model_name]["port"]
+        return [state for name, state in self._states.items()
+                if name != model_name and state.status in ACTIVE_STATUSES
+                and self.model_configs[name]["port"] == port]
+
+    def _set_status_locked(self, state: _ModelState, status: str, **fields):
+        state.status = status
+        for key, value in fields.items():
+            setattr(state, key, value)
+        if status == READY:
+            state.ready_at = time.time()
+        self._condition.notify_all()
+        view = self._view_locked(state)
+        for callback in self._subscribers:
+            try:
+                callback(state.name, status, view)
+            except Exception as e:
+                logger.error(f"模型状态订阅回调出错: {str(e)}")
+
+    def _view_locked(self, state: _ModelState) -> Dict[str, Any]:
+        return {
+            "model_name": state.name,
+            "status": state.status,
+            "port": self.model_configs[state.name]["port"],
+            "leases": state.leases,
+            "warm": state.warm,
+            "last_used": state.last_used,
+            "started_at": state.started_at,
+            "ready_at": state.ready_at,
+            "error": state.error
+        }
+
+    def _is_idle_locked(self, state: _ModelState, idle_ttl: float) -> bool:
+        return (state.status == READY and not state.leases and not state.warm
+                and time.time() - state.last_used >= idle_ttl)
+
+    def _stop_if_idle(self, model_name: str, generation: int, idle_ttl: float) -> bool:
+        """在锁内重新确认仍然空闲（收集后没有 acquire/lease 或重新启动）再停止，返回是否停止"""
+        state = self._states[model_name]
+        with self._condition:
+            if state.generation != generation or not self._is_idle_locked(state, idle_ttl):
+                return False
+            stop_generation = self._begin_stop_locked(state)
+        logger.info(f"模型 {model_name} 空闲超过 {idle_ttl} 秒，停止服务")
+        self._finish_stop(state, stop_generation)
+        return True
+
+    def _begin_stop_locked(self, state: _ModelState) -> int:
+        state.generation += 1
+        self._set_status_locked(state, STOPPING)
+        return state.generation
+
+    def _finish_stop(self, state: _ModelState, generation: int, remove: bool = False):
+        try:
+            self.runtime.stop(self.model_configs[state.name], remove=remove)
+        except Exception as e:
+            logger.error(f"停止模型 {state.name} 出错: {str(e)}")
+        with self._condition:
+            if state.generation == generation:  # 停止期间又被启动的，不覆盖新的状态
+                self._set_status_locked(state, STOPPED)
+        logger.info(f"✅ 模型 {state.name} 服务已停止")
+
+    def _discard_stale_start(self, state: _ModelState, generation: int, model_config: Dict[str, Any]) -> bool:
+        """
+        runtime.start 期间模型被停止（stop 在容器创建前就已执行）：停止刚创建的容器，
+        避免状态为已停止而容器仍在运行。之后又有新的启动时容器归新的启动使用，不停止
+
+        Returns:
+            bool: 本次启动是否已过期
+        """
+        with self._condition:
+            if state.generation == generation:
+                return False
+            restarted = state.status in ACTIVE_STATUSES
+        if not restarted:
+            logger.info(f"模型 {state.name} 在启动过程中被停止，停止刚创建的容器")
+            try:
+                self.runtime.stop(model_config)
+            except Exception as e:
+                logger.error(f"停止模型 {state.name} 出错: {str(e)}")
+        return True
+
+    def _is_current(self, state: _ModelState, generation: int) -> bool:
+        with self._condition:
+            return state.generation == generation and state.status == STARTING and not self._closed
+
+    def _start_worker(self, model_name: str, generation: int, conflicts: List[_ModelState]):
+        """后台启动并探测就绪"""
+        state = self._states[model_name]
+        model_config = self.model_configs[model_name]
+
+        for other in conflicts:
+            logger.info(f"模型 {other.name} 与 {model_name} 使用同一端口，先停止")
+            try:
+                self.runtime.stop(self.model_configs[other.name])
+            except Exception as e:
+                logger.error(f"停止模型 {other.name} 出错: {str(e)}")
+            with self._condition:
+                if other.status == STOPPING:
+                    self._set_status_locked(other, STOPPED)
+
+        try:
+            if self.runtime.is_ready(model_config):
+                logger.info(f"模型 {model_name} 服务已在端口 {model_config['port']} 运行")
+            else:
+                logger.info(f"启动模型 {model_name} 服务，端口: {model_config['port']}")
+                self.runtime.start(model_config)
+                if self._discard_stale_start(state, generation, model_config):
+                    return
+                if not self._wait_until_ready(state, generation, model_config):
+                    return
+            # 运行时注册的适配器不在容器启动参数中，每次就绪后重新挂载
+            with self._condition:
+                adapters = dict(self._adapters[model_name])
+            for adapter_name, lora_path in adapters.items():
+                try:
+                    self.runtime.load_adapter(model_config, adapter_name, lora_path)
+                except Exception as e:
+                    logger.error(f"❌ 重新挂载适配器 {adapter_name} 失败: {str(e)}")
+        except Exception as e:
+            logger.error(f"❌ {str(e)}")
+            with self._condition:
+                if state.generation == generation:
+                    self._set_status_locked(state, FAILED, error=str(e))
+            return
+
+        with self._condition:
+            if state.generation == generation and state.status == STARTING:
+                self._set_status_locked(state, READY, error=None)
+                logger.info(f"✅ 模型 {model_name} 服务就绪，端口: {model_config['port']}")
+
+    def _wait_until_ready(self, state: _ModelState, generation: int, model_config: Dict[str, Any]) -> bool:
+        """按退避间隔探测，容器退出时立即失败，不必等到超时"""
+        deadline = time.time() + self.config["start_timeout"]
+        interval = self.config["probe_interval"]
+        while self._is_current(state, generation):
+            if self.runtime.is_ready(model_config):
+                return True
+            if not self.runtime.is_running(model_config):
+                error = "容器启动后退出"
+            elif time.time() >= deadline:
+                error = f"等待 {self.config['start_timeout']} 秒后仍未就绪"
+            else:
+                with self._condition:
+                    self._condition.wait(min(interval, max(0.0, deadline - time.time())))
+                interval = min(interval * 2, self.config["probe_max_interval"])
+                continue
+            logger.error(f"❌ 模型 {state.name} 启动失败: {error}")
+            with self._condition:
+                if state.generation == generation:
+                    self._set_status_locked(state, FAILED, error=error)
+            return False
+        return False
+
+    def _ensure_watcher(self):
+        """启动后台检查线程，调用方需持有 _condition"""
+        if self._watcher is None and not self._closed:
+            self._watcher = threading.Thread(target=self._watch_loop, name="vllm_lifecycle_watcher", daemon=True)
+            self._watcher.start()
+
+    def _watch_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed, self.config["watch_interval"])
+                if self._closed:
+                    return
+            try:
+                self.check_ready_services()
+                self.reap_idle()
+            except Exception as e:
+                logger.error(f"模型生命周期检查出错: {str(e)}")
+
+
+# 全局守护实例（首次使用时创建）
+_lifecycle_daemon = None
+_daemon_lock = threading.Lock()
+
+
+def get_lifecycle_daemon() -> ModelLifecycleDaemon:
+    """全局模型生命周期守护"""
+    global _lifecycle_daemon
+    with _daemon_lock:
+        if _lifecycle_daemon is None:
+            _lifecycle_daemon = ModelLifecycleDaemon()
+        return _lifecycle_daemon
+
+
+def set_lifecycle_daemon(daemon: ModelLifecycleDaemon) -> ModelLifecycleDaemon:
+    """替换全局守护（测试中换成 FakeContainerRuntime），返回原来的实例"""
+    global _lifecycle_daemon
+    with _daemon_lock:
+        previous, _lifecycle_daemon = _lifecycle_daemon, daemon
+    return previous
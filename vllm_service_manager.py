@@ -4,14 +4,15 @@
 vLLM服务管理器
 支持多模型启动、管理和切换
 """
-import os
-import subprocess
 import time
 import requests
 import json
 import logging
 from typing import Dict, Any, Optional, List
 from model_config import ModelManager, get_model_config
+from vllm_lifecycle import get_lifecycle_daemon
+from vllm_endpoint_pool import get_endpoint_pool
+from vllm_circuit_breaker import get_circuit_breaker, CircuitOpenError, CIRCUIT_BREAKER_CONFIG
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,10 +24,12 @@ class VLLMServiceManager:
     def __init__(self):
         self.model_manager = ModelManager()
         self.active_services = {}  # 存储活跃的服务信息
+        self.served_model_names = {}  # (端口, LoRA模块名) -> 请求使用的模型名称，首次解析后缓存，保证前缀缓存命中
+                                      # 多LoRA模式下同一端口上有多个适配器，按模块名区分
     
     def start_model_service(self, model_name: str, force_restart: bool = False) -> Dict[str, Any]:
         """
-        启动指定模型的服务
+        启动指定模型的服务（由模型生命周期守护启动并等待就绪）
         
         Args:
             model_name: 模型名称
@@ -35,76 +38,20 @@ class VLLMServiceManager:
         Returns:
             Dict: 启动结果
         """
+        model_config = get_model_config(model_name)
+        if not model_config:
+            return {
+                "success": False,
+                "message": f"模型配置不存在: {model_name}",
+                "model_name": model_name
+            }
+        
+        daemon = get_lifecycle_daemon()
         try:
-            # 获取模型配置
-            model_config = get_model_config(model_name)
-            if not model_config:
-                return {
-                    "success": False,
-                    "message": f"模型配置不存在: {model_name}",
-                    "model_name": model_name
-                }
-            
-            # 检查服务是否已经运行
-            if not force_restart and self.is_service_running(model_config["port"]):
-                logger.info(f"模型 {model_name} 服务已在端口 {model_config['port']} 运行")
-                self.active_services[model_name] = {
-                    "port": model_config["port"],
-                    "status": "running",
-                    "config": model_config
-                }
-                return {
-                    "success": True,
-                    "message": f"模型 {model_name} 服务已在运行",
-                    "model_name": model_name,
-                    "port": model_config["port"]
-                }
-            
-            # 停止可能存在的旧服务
-            self.stop_model_service(model_name)
-            
-            # 启动新服务
-            logger.info(f"启动模型 {model_name} 服务，端口: {model_config['port']}")
-            
-            # 构建docker命令
-            cmd = self._build_docker_command(model_config)
-            
-            # 执行启动命令
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-            
-            if result.returncode == 0:
-                logger.info(f"✅ 模型 {model_name} 服务启动成功，端口: {model_config['port']}")
-                
-                # 等待服务启动
-                if self._wait_for_service_ready(model_config["port"]):
-                    self.active_services[model_name] = {
-                        "port": model_config["port"],
-                        "status": "running",
-                        "config": model_config
-                    }
-                    return {
-                        "success": True,
-                        "message": f"模型 {model_name} 服务启动成功",
-                        "model_name": model_name,
-                        "port": model_config["port"]
-                    }
-                else:
-                    return {
-                        "success": False,
-                        "message": f"模型 {model_name} 服务启动超时",
-                        "model_name": model_name,
-                        "port": model_config["port"]
-                    }
+            if force_restart:
+                ready = daemon.restart(model_name)
             else:
-                error_msg = result.stderr.strip()
-                logger.error(f"❌ 模型 {model_name} 服务启动失败: {error_msg}")
-                return {
-                    "success": False,
-                    "message": f"模型 {model_name} 服务启动失败: {error_msg}",
-                    "model_name": model_name,
-                    "port": model_config["port"]
-                }
-                
+                ready = daemon.ensure_ready(model_name)
         except Exception as e:
             logger.error(f"启动模型 {model_name} 服务时出错: {str(e)}")
             return {
@@ -112,31 +59,32 @@ class VLLMServiceManager:
                 "message": f"启动模型 {model_name} 服务时出错: {str(e)}",
                 "model_name": model_name
             }
-    
-    def _build_docker_command(self, model_config: Dict[str, Any]) -> List[str]:
-        """构建docker启动命令"""
-        cmd = [
-            "docker", "run",
-            "--gpus", "all",
-            "-v", "/data/.cache/vllm:/root/.cache/vllm",
-            "-v", "/data/.cache/huggingface:/root/.cache/huggingface",
-            "-v", "/data/training/model:/root/model",
-            "-v", f"{os.path.dirname(model_config['lora_path'])}:/root/lora",
-            f"-p", f"{model_config['port']}:8000",
-            "--ipc=host",
-            "-d",
-            f"--name", model_config["container_name"],
-            "vllm/vllm-openai:latest",
-            "--enable-lora",
-            f"--lora-modules", f"{model_config['lora_module_name']}=/root/lora/{os.path.basename(model_config['lora_path'])}",
-            "--model", model_config["base_model_path"],
-            "--tensor-parallel-size", "8"
-        ]
-        return cmd
+        
+        if ready:
+            self.active_services[model_name] = {
+                "port": model_config["port"],
+                "status": "running",
+                "config": model_config
+            }
+            return {
+                "success": True,
+                "message": f"模型 {model_name} 服务已就绪",
+                "model_name": model_name,
+                "port": model_config["port"]
+            }
+        
+        error = daemon.get_status(model_name)["error"]
+        logger.error(f"❌ 模型 {model_name} 服务启动失败: {error}")
+        return {
+            "success": False,
+            "message": f"模型 {model_name} 服务启动失败: {error}",
+            "model_name": model_name,
+            "port": model_config["port"]
+        }
     
     def stop_model_service(self, model_name: str) -> Dict[str, Any]:
         """
-        停止指定模型的服务
+        停止指定模型的服务（停止并删除容器）
         
         Args:
             model_name: 模型名称
@@ -153,21 +101,14 @@ class VLLMServiceManager:
                     "model_name": model_name
                 }
             
-            container_name = model_config["container_name"]
-            
-            # 停止容器
-            stop_cmd = ["docker", "stop", container_name]
-            stop_result = subprocess.run(stop_cmd, capture_output=True, text=True)
-            
-            # 删除容器
-            rm_cmd = ["docker", "rm", container_name]
-            rm_result = subprocess.run(rm_cmd, capture_output=True, text=True)
+            get_lifecycle_daemon().stop(model_name, remove=True)
             
             # 从活跃服务中移除
             if model_name in self.active_services:
                 del self.active_services[model_name]
+            for key in [key for key in self.served_model_names if key[0] == model_config["port"]]:
+                del self.served_model_names[key]
             
-            logger.info(f"✅ 模型 {model_name} 服务已停止")
             return {
                 "success": True,
                 "message": f"模型 {model_name} 服务已停止",
@@ -190,24 +131,6 @@ class VLLMServiceManager:
         except:
             return False
     
-    def _wait_for_service_ready(self, port: int, max_wait_time: int = 300) -> bool:
-        """等待服务就绪"""
-        logger.info(f"等待服务就绪，端口: {port}")
-        check_interval = 10
-        waited_time = 0
-        
-        while waited_time < max_wait_time:
-            if self.is_service_running(port):
-                logger.info(f"✅ 服务就绪，端口: {port}")
-                return True
-            else:
-                logger.info(f"⏳ 服务尚未就绪，等待中... ({waited_time}/{max_wait_time}秒)")
-                time.sleep(check_interval)
-                waited_time += check_interval
-        
-        logger.error(f"❌ 服务启动超时，端口: {port}")
-        return False
-    
     def verify_model_loaded(self, model_name: str) -> Dict[str, Any]:
         """验证模型是否正确加载"""
         try:
@@ -255,6 +178,36 @@ class VLLMServiceManager:
         """获取所有活跃的服务"""
         return self.active_services.copy()
     
+    def _resolve_served_model_name(self, port: int, lora_module_name: str) -> str:
+        """
+        解析请求使用的模型名称（优先LoRA模型），同一端口只在第一次调用时请求 /v1/models
+        获取失败时返回默认名称且不缓存，下次调用再试
+        """
+        cache_key = (port, lora_module_name)
+        if cache_key in self.served_model_names:
+            return self.served_model_names[cache_key]
+        
+        try:
+            response = requests.get(f"http://localhost:{port}/v1/models", timeout=10)
+            if response.status_code == 200:
+                models_data = response.json()
+                available_models = [model.get('id', '') for model in models_data.get('data', [])]
+                
+                if lora_module_name in available_models:
+                    model_name_for_api = lora_module_name
+                elif available_models:
+                    model_name_for_api = available_models[0]
+                    logger.warning(f"LoRA模型 {lora_module_name} 未找到，使用第一个可用模型: {model_name_for_api}")
+                else:
+                    logger.warning(f"未找到可用模型，使用默认模型: {lora_module_name}")
+                    return lora_module_name
+                self.served_model_names[cache_key] = model_name_for_api
+                return model_name_for_api
+            logger.warning(f"获取模型列表失败，使用默认模型: {lora_module_name}")
+        except Exception as e:
+            logger.warning(f"获取模型列表出错: {str(e)}，使用默认模型: {lora_module_name}")
+        return lora_module_name
+    
     def call_model_api(self, model_name: str, messages: List[Dict[str, str]], 
                       max_tokens: int = 2000, max_retries: int = 3) -> str:
         """
@@ -277,29 +230,11 @@ class VLLMServiceManager:
             
             port = model_config["port"]
             lora_module_name = model_config["lora_module_name"]
-            url = f"http://localhost:{port}/v1/chat/completions"
+            endpoint_pool = get_endpoint_pool(model_name)
             
-            # 获取可用模型列表
-            try:
-                response = requests.get(f"http://localhost:{port}/v1/models", timeout=10)
-                if response.status_code == 200:
-                    models_data = response.json()
-                    available_models = [model.get('id', '') for model in models_data.get('data', [])]
-                    
-                    if lora_module_name in available_models:
-                        model_name_for_api = lora_module_name
-                    elif available_models:
-                        model_name_for_api = available_models[0]
-                        logger.warning(f"LoRA模型 {lora_module_name} 未找到，使用第一个可用模型: {model_name_for_api}")
-                    else:
-                        model_name_for_api = lora_module_name
-                        logger.warning(f"未找到可用模型，使用默认模型: {model_name_for_api}")
-                else:
-                    model_name_for_api = lora_module_name
-                    logger.warning(f"获取模型列表失败，使用默认模型: {model_name_for_api}")
-            except Exception as e:
-                model_name_for_api = lora_module_name
-                logger.warning(f"获取模型列表出错: {str(e)}，使用默认模型: {model_name_for_api}")
+            model_name_for_api = self._resolve_served_model_name(port, lora_module_name)
+            # 刷新空闲计时，使用中的模型不会被生命周期守护停止
+            get_lifecycle_daemon().touch(model_name)
             
             payload = {
                 "model": model_name_for_api,
@@ -309,50 +244,42 @@ class VLLMServiceManager:
                 "stream": False
             }
             
-            # 重试机制
+            # 重试机制，每次尝试从地址池取在途请求最少的副本，避开本次已失败的副本；
+            # 失败后短暂退避，服务宕机时由熔断器挂起等待恢复或直接拒绝，不再每次等待5/10/15秒
+            circuit_breaker = get_circuit_breaker(model_name)
+            failed_endpoints = set()
             for attempt in range(max_retries):
                 try:
-                    logger.info(f"尝试调用API (第{attempt + 1}次)...")
-                    response = requests.post(url, json=payload, timeout=300)
+                    probe = circuit_breaker.acquire(timeout=circuit_breaker.park_timeout)
+                except CircuitOpenError as e:
+                    logger.error(f"{str(e)}，放弃调用")
+                    return ""
+                endpoint = endpoint_pool.acquire(exclude=failed_endpoints)
+                endpoint_ok = False
+                try:
+                    logger.info(f"尝试调用API (第{attempt + 1}次, {endpoint})...")
+                    response = requests.post(f"{endpoint}/v1/chat/completions", json=payload, timeout=300)
+                    endpoint_ok = response.status_code < 500
                     
                     if response.status_code == 200:
                         result = response.json()
                         return result["choices"][0]["message"]["content"]
-                    else:
-                        logger.error(f"API调用失败，状态码: {response.status_code}")
-                        if attempt < max_retries - 1:
-                            logger.info(f"等待5秒后重试...")
-                            time.sleep(5)
-                            continue
-                        else:
-                            return ""
-                            
+                    logger.error(f"API调用失败，状态码: {response.status_code}")
                 except requests.exceptions.ConnectionError as e:
                     logger.error(f"连接错误 (第{attempt + 1}次): {str(e)}")
-                    if attempt < max_retries - 1:
-                        logger.info(f"等待10秒后重试...")
-                        time.sleep(10)
-                        continue
-                    else:
-                        return ""
-                        
                 except requests.exceptions.Timeout as e:
                     logger.error(f"请求超时 (第{attempt + 1}次): {str(e)}")
-                    if attempt < max_retries - 1:
-                        logger.info(f"等待15秒后重试...")
-                        time.sleep(15)
-                        continue
-                    else:
-                        return ""
-                        
                 except Exception as e:
                     logger.error(f"API调用出错 (第{attempt + 1}次): {str(e)}")
-                    if attempt < max_retries - 1:
-                        logger.info(f"等待5秒后重试...")
-                        time.sleep(5)
-                        continue
-                    else:
-                        return ""
+                finally:
+                    service_ok = endpoint_pool.release(endpoint, endpoint_ok)
+                    circuit_breaker.release(service_ok, probe)
+                    if not endpoint_ok:
+                        failed_endpoints.add(endpoint)
+                if attempt < max_retries - 1:
+                    backoff = CIRCUIT_BREAKER_CONFIG["retry_backoff"] * 2 ** attempt
+                    logger.info(f"等待{backoff}秒后重试...")
+                    time.sleep(backoff)
             
             return ""
             